@@ -1,31 +1,67 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, Form, BackgroundTasks, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, Form, BackgroundTasks, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.staticfiles import NotModifiedResponse
 import uvicorn
 import json
+import ast
 import asyncio
+import bisect
+import codecs
+import csv
+import gzip
+import io
+import ipaddress
+import itertools
+import keyword
+import math
+import random
+import re
 import time
+import zlib
 import hashlib
+import hmac
 import secrets
+import signal
+import shutil
+import tempfile
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Any, Union
+from typing import Optional, Dict, List, Any, Union, Literal
 import sqlite3
 import redis
 import docker
 import openai
 from pydantic import BaseModel, EmailStr
 import os
+import socket
+import struct
+import sys
 from pathlib import Path
+from mimetypes import guess_type
 import subprocess
 import threading
+import fcntl
+import pwd
 import logging
 import bcrypt
 import jwt
 from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
+from sqlalchemy import (MetaData, Table, Column, Text, Integer, BigInteger, Float, Boolean, DateTime, Date,
+                        ForeignKey, LargeBinary, Index, PrimaryKeyConstraint, bindparam, select, insert, update,
+                        delete, func, event, text)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 # Load environment variables from .env file
 load_dotenv()
@@ -36,14 +72,18 @@ logger = logging.getLogger(__name__)
 
 # OpenAI Cost Tracking
 class OpenAICostTracker:
-    """Simple cost tracker for OpenAI API usage"""
+    """Simple cost tracker for OpenAI API usage.
+
+    Daily totals live in the shared state store so every worker process and
+    replica enforces the same budget.
+    """
     
     def __init__(self):
         self.cost_per_1k_tokens = {
             "gpt-3.5-turbo": {"input": 0.0005, "output": 0.0015},  # $0.50/$1.50 per 1K tokens
             "gpt-4": {"input": 0.03, "output": 0.06},  # Much more expensive
         }
-        self.daily_usage = {}
+        self.usage_ttl = 2 * 86400  # Keep yesterday's totals around for dashboards
     
     def calculate_cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
         """Calculate cost for API call"""
@@ -60,19 +100,19 @@ class OpenAICostTracker:
         today = datetime.now().strftime("%Y-%m-%d")
         cost = self.calculate_cost(model, input_tokens, output_tokens)
         
-        if today not in self.daily_usage:
-            self.daily_usage[today] = {"cost": 0, "calls": 0}
-        
-        self.daily_usage[today]["cost"] += cost
-        self.daily_usage[today]["calls"] += 1
+        daily_cost = shared_state.incr(f"openai_usage:{today}:cost", cost, ttl=self.usage_ttl)
+        shared_state.incr(f"openai_usage:{today}:calls", 1, ttl=self.usage_ttl)
         
-        logger.info(f"OpenAI API call - Model: {model}, Cost: ${cost:.4f}, Daily total: ${self.daily_usage[today]['cost']:.4f}")
+        logger.info(f"OpenAI API call - Model: {model}, Cost: ${cost:.4f}, Daily total: ${daily_cost:.4f}")
         return cost
     
     def get_daily_usage(self) -> dict:
         """Get today's usage"""
         today = datetime.now().strftime("%Y-%m-%d")
-        return self.daily_usage.get(today, {"cost": 0, "calls": 0})
+        return {
+            "cost": shared_state.get(f"openai_usage:{today}:cost"),
+            "calls": int(shared_state.get(f"openai_usage:{today}:calls"))
+        }
     
     def check_daily_limit(self) -> bool:
         """Check if daily cost limit is exceeded"""
@@ -97,13 +137,783 @@ class OpenAICostTracker:
 # Initialize cost tracker
 cost_tracker = OpenAICostTracker()
 
+# Metrics
+class MetricsRegistry:
+    """Minimal Prometheus-compatible metrics registry.
+
+    Series are plain dicts keyed by label tuples. Updates are single dict/list
+    operations on the event loop thread, so no locks are taken on the hot path;
+    a lost increment under rare thread contention is acceptable for metrics.
+
+    With several worker processes, each worker periodically writes a snapshot
+    to METRICS_DIR/<hostname>/<pid>.json and a scrape merges every live
+    snapshot of the host, so /metrics is consistent whichever worker answers.
+    The counters and histograms of a worker that stopped writing more than
+    METRICS_STALE_SECONDS ago are folded into retired.json before its file is
+    removed, so merged totals never go backwards (which Prometheus would read
+    as a counter reset). A lock file keeps scrapes from seeing a snapshot
+    both before and after it was folded.
+
+    /metrics names every API, so it is only served to loopback clients unless
+    METRICS_TOKEN is set, in which case any client presenting it as a bearer
+    token may scrape.
+    """
+
+    RETIRED = "retired.json"
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.enabled = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+        self.token = os.getenv("METRICS_TOKEN", "")
+        self.counters = {}
+        self.histograms = {}
+        self.meta = {}
+        self.directory = Path(os.getenv("METRICS_DIR", "data/metrics")) / socket.gethostname()
+        self.flush_interval = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+        self.stale_after = float(os.getenv("METRICS_STALE_SECONDS", "3600"))
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()):
+        """Register a counter"""
+        self.meta[name] = ("counter", help_text, label_names, None)
+        self.counters[name] = {}
+
+    def gauge(self, name: str, help_text: str, label_names: tuple = ()):
+        """Register a gauge (kept with the counters; worker values are summed on merge)"""
+        self.meta[name] = ("gauge", help_text, label_names, None)
+        self.counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = None):
+        """Register a histogram"""
+        self.meta[name] = ("histogram", help_text, label_names, buckets or self.DEFAULT_BUCKETS)
+        self.histograms[name] = {}
+
+    def inc(self, name: str, *labels, amount: float = 1.0):
+        """Increment a counter series"""
+        if not self.enabled:
+            return
+        series = self.counters[name]
+        series[labels] = series.get(labels, 0.0) + amount
+
+    def set(self, name: str, value: float, *labels):
+        """Set a gauge series"""
+        if not self.enabled:
+            return
+        self.counters[name][labels] = value
+
+    def observe(self, name: str, value: float, *labels):
+        """Record a histogram observation"""
+        if not self.enabled:
+            return
+        buckets = self.meta[name][3]
+        series = self.histograms[name]
+        state = series.get(labels)
+        if state is None:
+            # Per-bucket counts followed by [sum, count]
+            state = series[labels] = [0] * (len(buckets) + 1) + [0.0, 0]
+        state[bisect.bisect_left(buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def time(self, name: str, *labels):
+        """Context manager observing elapsed seconds into a histogram"""
+        return _MetricsTimer(self, name, labels)
+
+    @staticmethod
+    def _format_labels(label_names: tuple, labels: tuple, extra: str = "") -> str:
+        parts = []
+        for key, value in zip(label_names, labels):
+            escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{key}="{escaped}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def flush(self):
+        """Write this process's series to its snapshot file (atomic replace)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        snapshot = {
+            "counters": {name: [[list(labels), value] for labels, value in list(series.items())]
+                         for name, series in self.counters.items()},
+            "histograms": {name: [[list(labels), list(state)] for labels, state in list(series.items())]
+                           for name, series in self.histograms.items()},
+        }
+        path = self.directory / f"{os.getpid()}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(snapshot))
+        os.replace(tmp_path, path)
+
+    def _retire(self, path: Path):
+        """Fold a dead worker's counters and histograms into retired.json, then remove its snapshot"""
+        try:
+            snapshot = json.loads(path.read_text())
+        except FileNotFoundError:
+            return  # Another worker folded it first
+        except ValueError:
+            snapshot = {"counters": {}, "histograms": {}}
+        retired_path = self.directory / self.RETIRED
+        try:
+            retired = json.loads(retired_path.read_text())
+        except (OSError, ValueError):
+            retired = {"counters": {}, "histograms": {}}
+        for kind in ("counters", "histograms"):
+            for name, entries in snapshot[kind].items():
+                if self.meta.get(name, ("gauge",))[0] == "gauge":
+                    continue  # Gauges of a dead worker mean nothing
+                merged = {tuple(labels): value for labels, value in retired[kind].get(name, [])}
+                for labels, value in entries:
+                    labels = tuple(labels)
+                    if labels in merged:
+                        previous = merged[labels]
+                        value = previous + value if kind == "counters" else [a + b for a, b in zip(previous, value)]
+                    merged[labels] = value
+                retired[kind][name] = [[list(labels), value] for labels, value in merged.items()]
+        tmp_path = retired_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(retired))
+        os.replace(tmp_path, retired_path)
+        path.unlink()
+
+    def collect(self) -> tuple:
+        """Merge the snapshots of every worker on this host (blocking)"""
+        self.flush()
+        counters = {name: {} for name in self.counters}
+        histograms = {name: {} for name in self.histograms}
+        now = time.time()
+        snapshots = []
+        with open(self.directory / ".retired.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for path in list(self.directory.glob("*.json")):
+                try:
+                    if now - path.stat().st_mtime > self.stale_after and path.name != self.RETIRED:
+                        self._retire(path)  # Worker exited long ago
+                except OSError:
+                    continue
+            for path in self.directory.glob("*.json"):
+                try:
+                    snapshots.append((now - path.stat().st_mtime, json.loads(path.read_text())))
+                except (OSError, ValueError):
+                    continue
+        for age, snapshot in snapshots:
+            for name, entries in snapshot["counters"].items():
+                if name not in counters:
+                    continue
+                if self.meta[name][0] == "gauge" and age > 3 * self.flush_interval:
+                    continue  # A current value is only meaningful from a live worker
+                for labels, value in entries:
+                    labels = tuple(labels)
+                    counters[name][labels] = counters[name].get(labels, 0.0) + value
+            for name, entries in snapshot["histograms"].items():
+                if name not in histograms:
+                    continue
+                for labels, state in entries:
+                    labels = tuple(labels)
+                    merged = histograms[name].get(labels)
+                    histograms[name][labels] = state if merged is None else [a + b for a, b in zip(merged, state)]
+        return counters, histograms
+
+    async def run_flusher(self):
+        """Keep this worker's snapshot fresh for scrapes served by other workers"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except OSError as e:
+                logger.warning(f"Metrics snapshot failed: {e}")
+
+    def render(self, counters: dict = None, histograms: dict = None) -> str:
+        """Render series in the Prometheus text exposition format"""
+        counters = self.counters if counters is None else counters
+        histograms = self.histograms if histograms is None else histograms
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind in ("counter", "gauge"):
+                for labels, value in list(counters[name].items()):
+                    lines.append(f"{name}{self._format_labels(label_names, labels)} {value}")
+                continue
+            for labels, state in list(histograms[name].items()):
+                plain = self._format_labels(label_names, labels)
+                cumulative = 0
+                for bound, count in zip(buckets, state):
+                    cumulative += count
+                    le = self._format_labels(label_names, labels, 'le="%s"' % bound)
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                le = self._format_labels(label_names, labels, 'le="+Inf"')
+                lines.append(f"{name}_bucket{le} {state[-1]}")
+                lines.append(f"{name}_sum{plain} {state[-2]}")
+                lines.append(f"{name}_count{plain} {state[-1]}")
+        return "\n".join(lines) + "\n"
+
+class _MetricsTimer:
+    def __init__(self, registry: MetricsRegistry, name: str, labels: tuple):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start, *self.labels)
+        return False
+
+metrics = MetricsRegistry()
+metrics.counter("apiengine_requests_total", "Gateway requests by API and status class", ("api", "status_class"))
+metrics.histogram("apiengine_request_duration_seconds", "End-to-end gateway latency", ("api",))
+metrics.histogram("apiengine_request_stage_seconds", "Gateway latency by request stage", ("api", "stage"))
+metrics.histogram("apiengine_deploy_duration_seconds", "Container deploy duration", ("language", "outcome"),
+                  buckets=(1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0))
+metrics.histogram("apiengine_openai_request_seconds", "OpenAI completion latency", ("model", "outcome"),
+                  buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0))
+metrics.counter("apiengine_openai_cost_dollars_total", "OpenAI spend in dollars", ("model",))
+metrics.counter("apiengine_openai_tokens_total", "OpenAI tokens consumed", ("model", "kind"))
+metrics.histogram("apiengine_sqlite_call_seconds", "Control-plane sqlite statement latency", ("op",))
+metrics.histogram("apiengine_redis_call_seconds", "Redis command latency", ("op",))
+metrics.histogram("apiengine_control_plane_call_seconds", "Control-plane data layer statement latency", ("op",))
+
+def status_class(status_code: int) -> str:
+    """Collapse an HTTP status code into its class label, e.g. 2xx"""
+    return f"{status_code // 100}xx"
+
+class RequestStages:
+    """Accumulates per-stage durations for a single gateway request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.durations = {}
+
+    def mark(self, stage: str):
+        """Attribute the time since the previous mark to the given stage"""
+        now = time.perf_counter()
+        self.durations[stage] = self.durations.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+    def record(self, api_label: str, status_code: int):
+        """Publish the collected stage timings to the metrics registry"""
+        for stage, duration in self.durations.items():
+            metrics.observe("apiengine_request_stage_seconds", duration, api_label, stage)
+        metrics.observe("apiengine_request_duration_seconds", time.perf_counter() - self.started, api_label)
+        metrics.inc("apiengine_requests_total", api_label, status_class(status_code))
+
+    def server_timing(self) -> str:
+        """Format stage timings as a Server-Timing header value"""
+        parts = [f"{stage};dur={duration * 1000:.2f}" for stage, duration in self.durations.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(parts)
+
+    def log_fields(self) -> dict:
+        """Stage timings in milliseconds, suitable for structured logging"""
+        fields = {f"{stage}_ms": round(duration * 1000, 2) for stage, duration in self.durations.items()}
+        fields["total_ms"] = round((time.perf_counter() - self.started) * 1000, 2)
+        return fields
+
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+
+# Admission control
+class _AdmissionState:
+    __slots__ = ("active", "waiters", "service_seconds")
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = deque()
+        self.service_seconds = None  # EWMA of how long an admitted request holds its slot
+
+class AdmissionController:
+    """Per-API and global concurrency limits for proxied requests, with load shedding.
+
+    A request holds a slot while it is forwarded and logged. At most
+    GATEWAY_MAX_CONCURRENCY requests run per worker process, and at most the
+    API's max_concurrency (default GATEWAY_API_MAX_CONCURRENCY). Requests
+    beyond that wait in a FIFO queue of at most GATEWAY_QUEUE_SIZE per API.
+
+    Each request has a queue budget: GATEWAY_QUEUE_BUDGET_SECONDS, or less if
+    the caller sends X-Request-Budget-Ms. A request is shed with 503 and
+    Retry-After when the queue is full, when its expected wait exceeds its
+    budget, or when it reaches the end of its budget while still queued. The
+    expected wait is its queue position times the API's recent slot hold
+    time, divided by the API's limit. A slow API therefore sheds its own
+    excess traffic quickly instead of piling up coroutines, and the global
+    limit keeps it from taking every slot.
+    """
+
+    SMOOTHING = 0.2
+
+    def __init__(self):
+        self.enabled = os.getenv("GATEWAY_ADMISSION_ENABLED", "true").lower() == "true"
+        self.global_limit = int(os.getenv("GATEWAY_MAX_CONCURRENCY", "512"))
+        self.api_limit = int(os.getenv("GATEWAY_API_MAX_CONCURRENCY", "64"))
+        self.queue_size = int(os.getenv("GATEWAY_QUEUE_SIZE", "128"))
+        self.budget = float(os.getenv("GATEWAY_QUEUE_BUDGET_SECONDS", "2"))
+        self.active = 0
+        self.apis = {}
+
+    def request_budget(self, request: Request) -> float:
+        """Queue budget in seconds, shortened by an X-Request-Budget-Ms header"""
+        try:
+            return min(self.budget, max(float(request.headers["X-Request-Budget-Ms"]), 0.0) / 1000)
+        except (KeyError, ValueError):
+            return self.budget
+
+    def _limit(self, limit: Optional[int]) -> int:
+        return max(1, min(limit or self.api_limit, self.global_limit))
+
+    def _shed(self, api: str, reason: str, retry_after: float):
+        metrics.inc("apiengine_admission_shed_total", api, reason)
+        raise HTTPException(status_code=503, detail=f"API is overloaded ({reason.replace('_', ' ')}), retry later",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def _publish(self, api: str, state: _AdmissionState):
+        metrics.set("apiengine_admission_in_flight", state.active, api)
+        metrics.set("apiengine_admission_queue_depth", len(state.waiters), api)
+
+    def _dispatch(self):
+        """Hand free slots to the longest-waiting requests of APIs under their limits"""
+        for api, state in self.apis.items():
+            while state.waiters and self.active < self.global_limit and state.active < state.waiters[0][1]:
+                waiter, _ = state.waiters.popleft()
+                if waiter.done():
+                    continue  # Timed out or disconnected
+                state.active += 1
+                self.active += 1
+                waiter.set_result(None)
+            self._publish(api, state)
+
+    async def acquire(self, api: str, limit: Optional[int], budget: float) -> _AdmissionState:
+        limit = self._limit(limit)
+        state = self.apis.get(api)
+        if state is None:
+            state = self.apis[api] = _AdmissionState()
+        if not state.waiters and state.active < limit and self.active < self.global_limit:
+            state.active += 1
+            self.active += 1
+            self._publish(api, state)
+            return state
+
+        position = len(state.waiters) + 1
+        expected_wait = position * (state.service_seconds or 0.0) / limit
+        if position > self.queue_size:
+            self._shed(api, "queue_full", expected_wait or budget)
+        if expected_wait > budget:
+            self._shed(api, "deadline", expected_wait)
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, limit)
+        state.waiters.append(entry)
+        self._publish(api, state)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), budget)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._forget(api, state, entry)
+                self._shed(api, "timeout", expected_wait or budget)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(api, state, None)  # Admitted just as the client went away
+            else:
+                self._forget(api, state, entry)
+            raise
+        return state
+
+    def _forget(self, api: str, state: _AdmissionState, entry: tuple):
+        """Take a waiter that gave up out of the queue, so it is not counted against later arrivals"""
+        entry[0].cancel()
+        try:
+            state.waiters.remove(entry)
+        except ValueError:
+            pass  # Already popped by _dispatch
+        self._publish(api, state)
+
+    def release(self, api: str, state: _AdmissionState, held_seconds: Optional[float]):
+        state.active -= 1
+        self.active -= 1
+        if held_seconds is not None:
+            previous = state.service_seconds
+            state.service_seconds = held_seconds if previous is None else (
+                previous + self.SMOOTHING * (held_seconds - previous))
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, api: str, limit: Optional[int], budget: float):
+        """Hold a concurrency slot for api, waiting in its queue or raising 503"""
+        if not self.enabled:
+            yield
+            return
+        queued = time.perf_counter()
+        state = await self.acquire(api, limit, budget)
+        admitted = time.perf_counter()
+        metrics.observe("apiengine_admission_wait_seconds", admitted - queued, api)
+        try:
+            yield
+        finally:
+            self.release(api, state, time.perf_counter() - admitted)
+
+    def report(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "global_limit": self.global_limit,
+            "in_flight": self.active,
+            "apis": {api: {"in_flight": state.active, "queued": len(state.waiters),
+                           "mean_hold_seconds": round(state.service_seconds, 4) if state.service_seconds else None}
+                     for api, state in self.apis.items()}
+        }
+
+admission_controller = AdmissionController()
+metrics.gauge("apiengine_admission_in_flight", "Proxied requests holding a concurrency slot", ("api",))
+metrics.gauge("apiengine_admission_queue_depth", "Proxied requests waiting for a concurrency slot", ("api",))
+metrics.counter("apiengine_admission_shed_total", "Requests shed with 503 by reason", ("api", "reason"))
+metrics.histogram("apiengine_admission_wait_seconds", "Time proxied requests waited for a slot", ("api",))
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler producing folded stacks for flamegraphs.
+
+    A background thread snapshots every other thread's stack with
+    sys._current_frames() at a fixed interval. The output is the collapsed
+    "frame;frame;frame count" format understood by flamegraph.pl and speedscope.
+    """
+
+    MAX_SECONDS = 120
+
+    @staticmethod
+    def _folded_stack(frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+    def sample(self, seconds: float, interval: float) -> dict:
+        """Sample all threads for the given duration (blocking)"""
+        own_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        counts = {}
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = f"{thread_names.get(thread_id, thread_id)};{self._folded_stack(frame)}"
+                counts[stack] = counts.get(stack, 0) + 1
+            samples += 1
+            time.sleep(interval)
+        return {"samples": samples, "stacks": counts}
+
+    async def profile(self, seconds: float, interval: float) -> dict:
+        """Run a profiling session of this worker process in a worker thread.
+
+        A shared lock allows one session at a time across all workers.
+        """
+        seconds = min(seconds, self.MAX_SECONDS)
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "profiler", int(seconds) + 30, owner):
+            raise HTTPException(status_code=409, detail="A profiling session is already running")
+        try:
+            return await asyncio.to_thread(self.sample, seconds, interval)
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "profiler", owner)
+
+profiler = SamplingProfiler()
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that records statement latency by SQL verb"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe("apiengine_sqlite_call_seconds", time.perf_counter() - start,
+                            sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "OTHER")
+
+class TimedRedis(redis.Redis):
+    """Redis client that records per-command latency"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.observe("apiengine_redis_call_seconds", time.perf_counter() - start, str(args[0]).upper())
+
 # JWT Secret
-JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_urlsafe(32))
+def load_jwt_secret() -> str:
+    """Return JWT_SECRET, or a generated secret persisted for all worker processes"""
+    if os.getenv("JWT_SECRET"):
+        return os.getenv("JWT_SECRET")
+    secret_path = Path("data/.jwt_secret")
+    if not secret_path.exists():
+        secret_path.parent.mkdir(exist_ok=True)
+        tmp_path = secret_path.with_name(f".jwt_secret.{os.getpid()}")
+        tmp_path.write_text(secrets.token_urlsafe(32))
+        os.chmod(tmp_path, 0o600)
+        try:
+            # link() fails if another worker won the race, so every process reads the same secret
+            os.link(tmp_path, secret_path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+    return secret_path.read_text().strip()
+
+JWT_SECRET = load_jwt_secret()
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
+# Response encoding
+try:
+    import orjson
+except ImportError:
+    logger.info("orjson not installed, JSON responses will use the stdlib encoder")
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def _orjson_default(value):
+    """Fallback for types orjson does not know (Decimal, sets, pydantic models...)"""
+    return jsonable_encoder(value)
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed.
+
+    The output is the same compact UTF-8 JSON as JSONResponse. Routes that
+    return large bodies return this class directly, which also skips FastAPI's
+    jsonable_encoder pass over the content.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+def negotiate_encoding(accept_encoding: str, encodings: tuple) -> Optional[str]:
+    """The first of encodings with the highest q-value in an Accept-Encoding header, or None"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+class CompressionMiddleware:
+    """Negotiated zstd/brotli/gzip compression of responses (pure ASGI).
+
+    The encoding is picked from Accept-Encoding by q-value, preferring zstd,
+    then br, then gzip among those whose module is installed. Whole bodies
+    under COMPRESSION_MIN_BYTES are sent as they are. Streamed bodies are
+    compressed chunk by chunk and flushed after each one, so NDJSON exports
+    keep arriving incrementally.
+
+    Responses that already carry a Content-Encoding (precompressed files,
+    upstream payloads passed through by the gateway), ranges, event streams
+    and binary media types are left untouched.
+    """
+
+    COMPRESSIBLE = re.compile(r"^(text/(?!event-stream)|application/([\w.+-]*\+)?(json|x-ndjson|javascript|xml|csv)"
+                              r"|image/svg\+xml)")
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+        self.min_bytes = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+        self.gzip_level = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+        self.brotli_quality = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+        self.zstd_level = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+        self.encodings = tuple(name for name, module in (("zstd", zstandard), ("br", brotli), ("gzip", zlib))
+                               if module is not None)
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        """The preferred encoding the client accepts, or None"""
+        return negotiate_encoding(accept_encoding, self.encodings)
+
+    def compressor(self, encoding: str) -> tuple:
+        """(compress, flush, finish) callables of a fresh streaming compressor"""
+        if encoding == "gzip":
+            stream = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            return stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+        if encoding == "br":
+            stream = brotli.Compressor(quality=self.brotli_quality)
+            return stream.process, stream.flush, stream.finish
+        stream = zstandard.ZstdCompressor(level=self.zstd_level).compressobj()
+        return stream.compress, lambda: stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), stream.flush
+
+    def compress(self, encoding: str, data: bytes) -> bytes:
+        compress, _, finish = self.compressor(encoding)
+        return compress(data) + finish()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+        accept_encoding = next((value.decode("latin-1") for key, value in scope["headers"]
+                                if key == b"accept-encoding"), "")
+        encoding = self.negotiate(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        stream = None  # (compress, flush, finish) once the body is being compressed
+
+        async def send_compressed(message):
+            nonlocal start, stream
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                return await send(message)
+            if message["type"] != "http.response.body":
+                return await send(message)
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if stream is None:
+                headers = MutableHeaders(raw=start["headers"])
+                compressible = (200 <= start["status"] < 300 and start["status"] != 204
+                                and "content-encoding" not in headers and "content-range" not in headers
+                                and self.COMPRESSIBLE.match(headers.get("content-type", "")))
+                if not compressible or (not more_body and len(body) < self.min_bytes):
+                    await send(start)
+                    start = None
+                    return await send(message)
+                stream = self.compressor(encoding)
+                compressed = stream[0](body) + (stream[1]() if more_body else stream[2]())
+                del headers["content-length"]
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if not more_body:
+                    headers["content-length"] = str(len(compressed))
+                metrics.inc("apiengine_compressed_responses_total", encoding)
+                await send(start)
+            else:
+                compressed = stream[0](body) + (stream[1]() if more_body else stream[2]())
+            metrics.inc("apiengine_compression_bytes_total", encoding, "in", amount=len(body))
+            metrics.inc("apiengine_compression_bytes_total", encoding, "out", amount=len(compressed))
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+metrics.counter("apiengine_compressed_responses_total", "Responses compressed by the gateway", ("encoding",))
+metrics.counter("apiengine_compression_bytes_total", "Response bytes before (in) and after (out) compression",
+                ("encoding", "direction"))
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles serving precompressed siblings, with long-lived caching of hashed assets.
+
+    precompress() writes file.br (when brotli is installed) and file.gz next to
+    every compressible file of at least COMPRESSION_MIN_BYTES, at maximum
+    compression, and rewrites them only when the file is newer. A request that
+    accepts one of those encodings gets the sibling as a plain file response,
+    so the bundle is compressed once instead of on every dashboard load.
+
+    Files listed in asset-manifest.json with a content hash in their name are
+    sent with Cache-Control: immutable. Everything else (index.html, the
+    manifest, icons) is sent with no-cache, to be revalidated by ETag (304).
+    """
+
+    SUFFIXES = {".js", ".css", ".html", ".json", ".map", ".svg", ".txt", ".ico", ".xml", ".webmanifest"}
+    HASHED = re.compile(r"\.[0-9a-f]{8,}\.")
+    IMMUTABLE = "public, max-age=31536000, immutable"
+
+    def __init__(self, directory: str, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.root = Path(directory)
+        self.enabled = os.getenv("STATIC_PRECOMPRESS", "true").lower() == "true"
+        self.min_bytes = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+        self.encodings = (("br", ".br"),) * (brotli is not None) + (("gzip", ".gz"),)
+        self.manifest_mtime = None
+        self.immutable = frozenset()
+
+    def immutable_paths(self) -> frozenset:
+        """Paths (relative to the directory) of hashed assets in asset-manifest.json, reloaded when it changes"""
+        manifest = self.root / "asset-manifest.json"
+        try:
+            mtime = manifest.stat().st_mtime_ns
+            if mtime != self.manifest_mtime:
+                files = json.loads(manifest.read_text()).get("files", {})
+                self.immutable = frozenset(
+                    path for path in (url.split("/static/", 1)[-1].lstrip("/") for url in files.values())
+                    if self.HASHED.search(Path(path).name))
+                self.manifest_mtime = mtime
+        except (OSError, ValueError, AttributeError):
+            self.immutable = frozenset()
+        return self.immutable
+
+    def compress(self, encoding: str, data: bytes) -> bytes:
+        if encoding == "br":
+            return brotli.compress(data, quality=11)
+        return gzip.compress(data, compresslevel=9, mtime=0)
+
+    def precompress(self) -> dict:
+        """Write missing or stale .br/.gz siblings of compressible files (blocking)"""
+        written = skipped = 0
+        for path in self.root.rglob("*"):
+            if path.suffix not in self.SUFFIXES or not path.is_file():
+                continue
+            source = path.stat()
+            if source.st_size < self.min_bytes:
+                continue
+            data = None
+            for encoding, extension in self.encodings:
+                sibling = path.with_name(path.name + extension)
+                if sibling.exists() and sibling.stat().st_mtime >= source.st_mtime:
+                    skipped += 1
+                    continue
+                data = path.read_bytes() if data is None else data
+                compressed = self.compress(encoding, data)
+                if len(compressed) >= len(data):
+                    continue
+                tmp_path = sibling.with_name(f"{sibling.name}.{os.getpid()}.tmp")
+                tmp_path.write_bytes(compressed)
+                os.replace(tmp_path, sibling)  # Workers precompressing at once each write whole files
+                written += 1
+        if written:
+            logger.info(f"Precompressed {written} static files ({skipped} up to date)")
+        return {"written": written, "up_to_date": skipped}
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200):
+        relative = os.path.relpath(full_path, os.path.realpath(self.root)).replace(os.sep, "/")
+        headers = {"Cache-Control": self.IMMUTABLE if relative in self.immutable_paths() else "no-cache"}
+        request_headers = Headers(scope=scope)
+        media_type = guess_type(full_path)[0] or "text/plain"
+        if self.enabled and Path(full_path).suffix in self.SUFFIXES:
+            headers["Vary"] = "Accept-Encoding"
+            encoding = negotiate_encoding(request_headers.get("accept-encoding", ""),
+                                          tuple(name for name, _ in self.encodings))
+            extension = dict(self.encodings).get(encoding)
+            if extension:
+                try:
+                    sibling = os.stat(f"{full_path}{extension}")
+                except OSError:
+                    sibling = None
+                if sibling is not None and sibling.st_mtime >= stat_result.st_mtime:
+                    full_path, stat_result = f"{full_path}{extension}", sibling
+                    headers["Content-Encoding"] = encoding
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, method=scope["method"],
+                                media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
 # Initialize FastAPI app
-app = FastAPI(title="API Maker Engine", version="2.0.0", description="Build and deploy APIs instantly")
+app = FastAPI(title="API Maker Engine", version="2.0.0", description="Build and deploy APIs instantly",
+              default_response_class=FastJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -113,6 +923,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
 
 # Create static and templates directories if they don't exist
 Path("static").mkdir(exist_ok=True)
@@ -120,7 +931,8 @@ Path("templates").mkdir(exist_ok=True)
 Path("data").mkdir(exist_ok=True)
 
 # Static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+static_files = PrecompressedStaticFiles(directory="static")
+app.mount("/static", static_files, name="static")
 
 # Templates
 templates = Jinja2Templates(directory="templates")
@@ -130,13 +942,169 @@ security = HTTPBearer(auto_error=False)
 
 # Initialize Redis (for rate limiting and caching)
 try:
-    redis_client = redis.Redis(host='redis' if os.getenv('DOCKER_ENV') else 'localhost', port=6379, db=0, decode_responses=True)
+    if os.getenv('REDIS_URL'):
+        redis_client = TimedRedis.from_url(os.getenv('REDIS_URL'), decode_responses=True)
+    else:
+        redis_client = TimedRedis(host='redis' if os.getenv('DOCKER_ENV') else 'localhost', port=6379, db=0, decode_responses=True)
     redis_client.ping()
     logger.info("Redis connected successfully")
 except:
-    logger.warning("Redis not available, using in-memory storage")
+    logger.warning("Redis not available, using sqlite for shared state")
     redis_client = None
 
+# Shared state
+class SharedStateStore:
+    """Cross-process counters, locks and cache versions.
+
+    Redis is used when available; otherwise the control-plane sqlite database
+    provides the same operations. Either way all worker processes and replicas
+    see the same rate-limit counts, cost totals and background-job locks.
+    """
+
+    # INCRBYFLOAT and the first write's EXPIRE run as one script, so no counter is left without its TTL
+    INCR_SCRIPT = """
+    local value = redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+    if tonumber(ARGV[2]) > 0 and redis.call('TTL', KEYS[1]) < 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return value
+    """
+
+    def __init__(self, client):
+        self.redis = client
+        self._incr = client.register_script(self.INCR_SCRIPT) if client else None
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self.redis else "sqlite"
+
+    def incr(self, key: str, amount: float = 1, ttl: Optional[int] = None) -> float:
+        """Add to a counter, starting its TTL on first write; both happen in one atomic step"""
+        if self.redis:
+            return float(self._incr(keys=[key], args=[amount, ttl or 0]))
+        
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            row = conn.execute("""
+                INSERT INTO shared_counters (key, value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = CASE WHEN shared_counters.expires_at <= ? THEN excluded.value
+                                 ELSE shared_counters.value + excluded.value END,
+                    expires_at = CASE WHEN shared_counters.expires_at <= ? THEN excluded.expires_at
+                                      ELSE shared_counters.expires_at END
+                RETURNING value
+            """, (key, amount, now + ttl if ttl else None, now, now)).fetchone()
+            conn.commit()
+            return row['value']
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> float:
+        """Read a counter, treating missing or expired keys as zero"""
+        if self.redis:
+            return float(self.redis.get(key) or 0)
+        conn = get_db_connection()
+        try:
+            row = conn.execute("""
+                SELECT value FROM shared_counters
+                WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)
+            """, (key, time.time())).fetchone()
+            return row['value'] if row else 0.0
+        finally:
+            conn.close()
+
+    def acquire_lock(self, name: str, ttl: int, owner: str) -> bool:
+        """Take a named lock that expires after ttl seconds"""
+        if self.redis:
+            return bool(self.redis.set(f"lock:{name}", owner, nx=True, ex=ttl))
+        now = time.time()
+        conn = get_db_connection()
+        try:
+            conn.execute("DELETE FROM shared_locks WHERE name = ? AND expires_at <= ?", (name, now))
+            acquired = conn.execute("""
+                INSERT OR IGNORE INTO shared_locks (name, owner, expires_at) VALUES (?, ?, ?)
+            """, (name, owner, now + ttl)).rowcount == 1
+            conn.commit()
+            return acquired
+        finally:
+            conn.close()
+
+    def release_lock(self, name: str, owner: str):
+        """Release a lock if it is still held by owner"""
+        if self.redis:
+            if self.redis.get(f"lock:{name}") == owner:
+                self.redis.delete(f"lock:{name}")
+            return
+        conn = get_db_connection()
+        try:
+            conn.execute("DELETE FROM shared_locks WHERE name = ? AND owner = ?", (name, owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def is_locked(self, name: str) -> bool:
+        """Whether any process currently holds the named lock"""
+        if self.redis:
+            return bool(self.redis.exists(f"lock:{name}"))
+        conn = get_db_connection()
+        try:
+            return conn.execute("SELECT 1 FROM shared_locks WHERE name = ? AND expires_at > ?",
+                                (name, time.time())).fetchone() is not None
+        finally:
+            conn.close()
+
+    def set_json(self, key: str, value, ttl: Optional[int] = None):
+        """Store a JSON document visible to every worker"""
+        payload = json.dumps(value, default=str)
+        if self.redis:
+            self.redis.set(key, payload, ex=ttl)
+            return
+        conn = get_db_connection()
+        try:
+            conn.execute("""
+                INSERT INTO shared_values (key, value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            """, (key, payload, time.time() + ttl if ttl else None))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_json(self, key: str):
+        """Read a JSON document, or None if missing or expired"""
+        if self.redis:
+            payload = self.redis.get(key)
+        else:
+            conn = get_db_connection()
+            try:
+                row = conn.execute("""
+                    SELECT value FROM shared_values
+                    WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)
+                """, (key, time.time())).fetchone()
+            finally:
+                conn.close()
+            payload = row['value'] if row else None
+        return json.loads(payload) if payload else None
+
+    def invalidate(self, namespace: str):
+        """Bump a namespace version so every process drops its local cache"""
+        self.incr(f"cache_version:{namespace}")
+
+    def version(self, namespace: str) -> int:
+        """Current version of a cache namespace"""
+        return int(self.get(f"cache_version:{namespace}"))
+
+shared_state = SharedStateStore(redis_client)
+
+# Optional columnar export support
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    logger.info("pyarrow not installed, request log exports will use CSV.gz")
+    pa = None
+    pq = None
+
 # Initialize Docker client
 try:
     docker_client = docker.from_env()
@@ -145,10 +1113,29 @@ except:
     docker_client = None
 
 # Database setup
+def add_column_if_missing(cursor, table: str, column: str, definition: str):
+    """Add a column to an existing table (lightweight migration)"""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def init_db():
     conn = sqlite3.connect('data/api_maker.db')
     cursor = conn.cursor()
     
+    # Incremental auto-vacuum lets the retention engine give space back in small steps.
+    # It can only be enabled cheaply on a new database; existing ones are converted
+    # explicitly with POST /api/admin/retention/convert-vacuum-mode (a full VACUUM).
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if cursor.execute("PRAGMA page_count").fetchone()[0] == 0:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        else:
+            logger.warning("Control-plane database is not in incremental auto-vacuum mode; "
+                           "retention will report reclaimable bytes until it is converted")
+    
+    # WAL lets every worker process read while one writes
+    cursor.execute("PRAGMA journal_mode = WAL")
+    
     # Users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -294,14 +1281,1162 @@ def init_db():
         )
     ''')
     
+    # API Request Rollups table (daily aggregates of expired api_requests rows)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_request_rollups (
+            api_id TEXT NOT NULL,
+            day DATE NOT NULL,
+            request_count INTEGER DEFAULT 0,
+            error_count INTEGER DEFAULT 0,
+            total_response_time REAL DEFAULT 0,
+            max_response_time REAL DEFAULT 0,
+            PRIMARY KEY (api_id, day),
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    
+    # API Keys table (hashed keys, many per API)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id TEXT PRIMARY KEY,
+            api_id TEXT NOT NULL,
+            name TEXT DEFAULT 'default',
+            key_prefix TEXT NOT NULL,
+            key_hash TEXT NOT NULL,
+            scopes TEXT DEFAULT '*',
+            expires_at TIMESTAMP,
+            revoked_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_prefix ON api_keys (key_prefix)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_api ON api_keys (api_id)")
+    
+    # Deployments (one container per version; the live one is mirrored on apis)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_deployments (
+            id TEXT PRIMARY KEY,
+            api_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            code_hash TEXT,
+            container_id TEXT,
+            port INTEGER,
+            status TEXT DEFAULT 'starting',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            activated_at TIMESTAMP,
+            stopped_at TIMESTAMP,
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_api_deployments_version ON api_deployments (api_id, version)")
+    
+    # Extra containers of a live deployment started by the autoscaler
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_replicas (
+            id TEXT PRIMARY KEY,
+            api_id TEXT NOT NULL,
+            deployment_id TEXT NOT NULL,
+            container_id TEXT,
+            port INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS autoscale_decisions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_id TEXT NOT NULL,
+            decided_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            action TEXT NOT NULL,
+            replicas_before INTEGER,
+            replicas_after INTEGER,
+            p95_ms REAL,
+            in_flight INTEGER,
+            reason TEXT,
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_autoscale_decisions_api ON autoscale_decisions (api_id, id)")
+    
+    # Webhook outbox (events waiting for, or done with, delivery to api_settings.webhook_url)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            event TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP,
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox (status, next_attempt_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_outbox_api ON webhook_outbox (api_id, id)")
+    
+    # Usage metering: daily counters per API and key, running totals per billing period,
+    # the flushed batches already applied, and closed (immutable) billing periods
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_counters (
+            api_id TEXT NOT NULL,
+            key_id TEXT NOT NULL DEFAULT '',
+            day DATE NOT NULL,
+            requests INTEGER DEFAULT 0,
+            PRIMARY KEY (api_id, key_id, day),
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_totals (
+            api_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            requests INTEGER DEFAULT 0,
+            PRIMARY KEY (api_id, period),
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_batches (
+            id TEXT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS billing_periods (
+            api_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            pricing_model TEXT,
+            price_per_request REAL,
+            amount REAL NOT NULL,
+            closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (api_id, period),
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    
+    # Latency sketches: one serialized DDSketch per API and time bucket (several until compacted)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS latency_sketches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            requests INTEGER NOT NULL,
+            sketch BLOB NOT NULL,
+            FOREIGN KEY (api_id) REFERENCES apis (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_latency_sketches_api ON latency_sketches (api_id, bucket)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_latency_sketches_bucket ON latency_sketches (bucket)")
+    
+    # Move legacy plaintext keys from the apis table into api_keys
+    legacy_keys = cursor.execute("SELECT id, api_key FROM apis WHERE api_key IS NOT NULL AND api_key != ''").fetchall()
+    for api_id, legacy_key in legacy_keys:
+        cursor.execute("""
+            INSERT INTO api_keys (id, api_id, name, key_prefix, key_hash) VALUES (?, ?, 'default', ?, ?)
+        """, (secrets.token_urlsafe(12), api_id, APIKeyIndex.prefix(legacy_key), APIKeyIndex.digest(legacy_key)))
+    if legacy_keys:
+        cursor.execute("UPDATE apis SET api_key = NULL WHERE api_key IS NOT NULL")
+        logger.info(f"Migrated {len(legacy_keys)} plaintext API keys to hashed storage")
+    
+    add_column_if_missing(cursor, "api_requests", "api_key_id", "TEXT")
+    add_column_if_missing(cursor, "apis", "replica_ports", "TEXT")
+    add_column_if_missing(cursor, "api_settings", "resource_profile", "TEXT DEFAULT 'small'")
+    add_column_if_missing(cursor, "api_settings", "min_replicas", "INTEGER DEFAULT 1")
+    add_column_if_missing(cursor, "api_settings", "max_replicas", "INTEGER DEFAULT 1")
+    add_column_if_missing(cursor, "api_settings", "target_p95_ms", "INTEGER DEFAULT 500")
+    add_column_if_missing(cursor, "api_settings", "max_concurrency", "INTEGER")
+    add_column_if_missing(cursor, "api_test_results", "response_body_hash", "TEXT")
+    add_column_if_missing(cursor, "api_test_results", "response_size", "INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_test_results_api ON api_test_results (api_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_test_results_body ON api_test_results (response_body_hash)")
+    
+    # Test response bodies, stored once per content (zlib-compressed) and referenced by hash
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS test_response_bodies (
+            hash TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Shared state fallback when Redis is unavailable (counters and locks)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shared_counters (
+            key TEXT PRIMARY KEY,
+            value REAL DEFAULT 0,
+            expires_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shared_values (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shared_locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    
     conn.commit()
     conn.close()
 
-# Pydantic models
-class UserCreate(BaseModel):
-    username: str
-    email: Optional[str] = None
-    password: str
+# Control-plane data access
+control_metadata = MetaData()
+
+users_table = Table(
+    "users", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("username", Text, unique=True, nullable=False),
+    Column("email", Text, unique=True),
+    Column("password_hash", Text, nullable=False),
+    Column("is_active", Boolean, server_default=text("TRUE")),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("updated_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+apis_table = Table(
+    "apis", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("user_id", Text, ForeignKey("users.id"), nullable=False),
+    Column("name", Text, nullable=False),
+    Column("endpoint", Text, unique=True, nullable=False),
+    Column("description", Text),
+    Column("code", Text, nullable=False),
+    Column("language", Text, nullable=False),
+    Column("is_public", Boolean, server_default=text("FALSE")),
+    Column("api_key", Text),
+    Column("rate_limit_requests", Integer, server_default=text("1000")),
+    Column("rate_limit_period", Text, server_default=text("'day'")),
+    Column("pricing_model", Text, server_default=text("'free'")),
+    Column("price_per_request", Float, server_default=text("0.0")),
+    Column("status", Text, server_default=text("'draft'")),
+    Column("container_id", Text),
+    Column("port", Integer),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("updated_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("replica_ports", Text),
+)
+
+api_parameters_table = Table(
+    "api_parameters", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("name", Text, nullable=False),
+    Column("type", Text, nullable=False),
+    Column("required", Boolean, server_default=text("FALSE")),
+    Column("description", Text),
+)
+
+api_requests_table = Table(
+    "api_requests", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("user_id", Text, ForeignKey("users.id")),
+    Column("endpoint", Text, nullable=False),
+    Column("method", Text, nullable=False),
+    Column("status_code", Integer),
+    Column("response_time", Float),
+    Column("ip_address", Text),
+    Column("user_agent", Text),
+    Column("timestamp", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("api_key_id", Text),
+)
+
+rate_limits_table = Table(
+    "rate_limits", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("ip_address", Text),
+    Column("user_id", Text, ForeignKey("users.id")),
+    Column("request_count", Integer, server_default=text("0")),
+    Column("window_start", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+api_settings_table = Table(
+    "api_settings", control_metadata,
+    Column("api_id", Text, ForeignKey("apis.id"), primary_key=True),
+    Column("max_requests_per_hour", Integer, server_default=text("1000")),
+    Column("max_requests_per_day", Integer, server_default=text("10000")),
+    Column("max_requests_per_month", Integer, server_default=text("100000")),
+    Column("requires_auth", Boolean, server_default=text("FALSE")),
+    Column("allowed_origins", Text, server_default=text("'*'")),
+    Column("webhook_url", Text),
+    Column("resource_profile", Text, server_default=text("'small'")),
+    Column("min_replicas", Integer, server_default=text("1")),
+    Column("max_replicas", Integer, server_default=text("1")),
+    Column("target_p95_ms", Integer, server_default=text("500")),
+    Column("max_concurrency", Integer),
+)
+
+user_databases_table = Table(
+    "user_databases", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("user_id", Text, ForeignKey("users.id"), nullable=False),
+    Column("database_name", Text, nullable=False),
+    Column("database_type", Text, server_default=text("'sqlite'")),
+    Column("connection_string", Text),
+    Column("database_path", Text),
+    Column("is_active", Boolean, server_default=text("TRUE")),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+api_database_connections_table = Table(
+    "api_database_connections", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("database_id", Text, ForeignKey("user_databases.id"), nullable=False),
+    Column("table_name", Text),
+    Column("connection_settings", Text),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+api_test_results_table = Table(
+    "api_test_results", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("test_name", Text),
+    Column("test_method", Text),
+    Column("test_url", Text),
+    Column("test_body", Text),
+    Column("test_headers", Text),
+    Column("response_status", Integer),
+    Column("response_body", Text),  # Only in rows written before bodies moved to test_response_bodies
+    Column("response_time", Float),
+    Column("success", Boolean),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("response_body_hash", Text),
+    Column("response_size", Integer),  # Body size before the stored copy was capped
+    Index("idx_api_test_results_api", "api_id", "id"),
+    Index("idx_api_test_results_body", "response_body_hash"),
+)
+
+test_response_bodies_table = Table(
+    "test_response_bodies", control_metadata,
+    Column("hash", Text, primary_key=True),  # SHA-256 of the (capped) body
+    Column("body", LargeBinary, nullable=False),  # zlib-compressed
+    Column("size", Integer, nullable=False),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+api_request_rollups_table = Table(
+    "api_request_rollups", control_metadata,
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("day", Date, nullable=False),
+    Column("request_count", Integer, server_default=text("0")),
+    Column("error_count", Integer, server_default=text("0")),
+    Column("total_response_time", Float, server_default=text("0")),
+    Column("max_response_time", Float, server_default=text("0")),
+    PrimaryKeyConstraint("api_id", "day"),
+)
+
+api_keys_table = Table(
+    "api_keys", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("name", Text, server_default=text("'default'")),
+    Column("key_prefix", Text, nullable=False),
+    Column("key_hash", Text, nullable=False),
+    Column("scopes", Text, server_default=text("'*'")),
+    Column("expires_at", DateTime),
+    Column("revoked_at", DateTime),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Index("idx_api_keys_prefix", "key_prefix"),
+    Index("idx_api_keys_api", "api_id"),
+)
+
+api_deployments_table = Table(
+    "api_deployments", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("version", Integer, nullable=False),
+    Column("code_hash", Text),
+    Column("container_id", Text),
+    Column("port", Integer),
+    Column("status", Text, server_default=text("'starting'")),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("activated_at", DateTime),
+    Column("stopped_at", DateTime),
+    Index("idx_api_deployments_version", "api_id", "version", unique=True),
+)
+
+api_replicas_table = Table(
+    "api_replicas", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("deployment_id", Text, nullable=False),
+    Column("container_id", Text),
+    Column("port", Integer),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+autoscale_decisions_table = Table(
+    "autoscale_decisions", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("decided_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("action", Text, nullable=False),
+    Column("replicas_before", Integer),
+    Column("replicas_after", Integer),
+    Column("p95_ms", Float),
+    Column("in_flight", Integer),
+    Column("reason", Text),
+    Index("idx_autoscale_decisions_api", "api_id", "id"),
+)
+
+webhook_outbox_table = Table(
+    "webhook_outbox", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("url", Text, nullable=False),
+    Column("event", Text, nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("status", Text, server_default=text("'pending'")),  # pending, delivered or dead
+    Column("attempts", Integer, server_default=text("0")),
+    Column("next_attempt_at", DateTime),
+    Column("last_error", Text),
+    Column("created_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    Column("delivered_at", DateTime),
+    Index("idx_webhook_outbox_due", "status", "next_attempt_at"),
+    Index("idx_webhook_outbox_api", "api_id", "id"),
+)
+
+usage_counters_table = Table(
+    "usage_counters", control_metadata,
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("key_id", Text, nullable=False, server_default=text("''")),  # '' for requests without a key
+    Column("day", Date, nullable=False),
+    Column("requests", Integer, server_default=text("0")),
+    PrimaryKeyConstraint("api_id", "key_id", "day"),
+)
+
+usage_totals_table = Table(
+    "usage_totals", control_metadata,
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("period", Text, nullable=False),  # YYYY-MM (UTC)
+    Column("requests", Integer, server_default=text("0")),
+    PrimaryKeyConstraint("api_id", "period"),
+)
+
+usage_batches_table = Table(
+    "usage_batches", control_metadata,
+    Column("id", Text, primary_key=True),
+    Column("applied_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+)
+
+billing_periods_table = Table(
+    "billing_periods", control_metadata,
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("period", Text, nullable=False),
+    Column("requests", Integer, nullable=False),
+    Column("pricing_model", Text),
+    Column("price_per_request", Float),
+    Column("amount", Float, nullable=False),
+    Column("closed_at", DateTime, server_default=text("CURRENT_TIMESTAMP")),
+    PrimaryKeyConstraint("api_id", "period"),
+)
+
+latency_sketches_table = Table(
+    "latency_sketches", control_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("api_id", Text, ForeignKey("apis.id"), nullable=False),
+    Column("bucket", BigInteger, nullable=False),  # Bucket start, in seconds since the epoch (UTC)
+    Column("requests", Integer, nullable=False),
+    Column("sketch", LargeBinary, nullable=False),
+    Index("idx_latency_sketches_api", "api_id", "bucket"),
+    Index("idx_latency_sketches_bucket", "bucket"),
+)
+
+# Tables that reference apis, deleted along with an API
+API_CHILD_TABLES = (api_parameters_table, api_requests_table, api_keys_table, api_settings_table,
+                    api_test_results_table, api_database_connections_table, api_request_rollups_table,
+                    rate_limits_table, api_deployments_table, api_replicas_table, autoscale_decisions_table,
+                    webhook_outbox_table, usage_counters_table, usage_totals_table, billing_periods_table,
+                    latency_sketches_table)
+
+class ControlPlaneStore:
+    """Async data access for the control-plane tables (SQLAlchemy Core).
+
+    CONTROL_PLANE_URL selects the backend: the SQLite file shared by the
+    worker processes of one host (the default), or Postgres
+    (postgresql+asyncpg://...), which lets any number of gateway hosts share
+    one control plane. Each worker keeps a connection pool of
+    CONTROL_PLANE_POOL_SIZE connections (+ CONTROL_PLANE_MAX_OVERFLOW under
+    bursts). Statements are compiled once per process and prepared once per
+    connection: asyncpg keeps CONTROL_PLANE_STATEMENT_CACHE prepared
+    statements per connection, sqlite3 the same number of compiled ones.
+    Timestamps are naive UTC on both backends.
+
+    On SQLite, init_db still owns the schema (auto-vacuum mode, legacy
+    migrations); on Postgres the schema is created from the table
+    definitions above. Retention, request log export and control-plane
+    snapshots work on the SQLite file itself and only run on a SQLite
+    control plane.
+    """
+
+    def __init__(self, url: str):
+        url = make_url(url)
+        if url.drivername in ("postgres", "postgresql"):
+            url = url.set(drivername="postgresql+asyncpg")
+        elif url.drivername == "sqlite":
+            url = url.set(drivername="sqlite+aiosqlite")
+        self.is_sqlite = url.get_backend_name() == "sqlite"
+        self.pool_size = int(os.getenv("CONTROL_PLANE_POOL_SIZE", "5"))
+        self.max_overflow = int(os.getenv("CONTROL_PLANE_MAX_OVERFLOW", "10"))
+        statement_cache = int(os.getenv("CONTROL_PLANE_STATEMENT_CACHE", "256"))
+
+        options = {"pool_size": self.pool_size, "max_overflow": self.max_overflow}
+        if self.is_sqlite:
+            # aiosqlite defaults to a connection per checkout; keep them open instead
+            options.update(poolclass=AsyncAdaptedQueuePool,
+                           connect_args={"timeout": 30, "cached_statements": statement_cache})
+        else:
+            url = url.update_query_dict({"prepared_statement_cache_size": str(statement_cache)})
+            options.update(pool_pre_ping=True, pool_recycle=1800,
+                           connect_args={"server_settings": {"timezone": "UTC", "application_name": "api-engine"}})
+        self.url = url
+        self.engine = create_async_engine(url, **options)
+        event.listen(self.engine.sync_engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine.sync_engine, "after_cursor_execute", self._after_execute)
+
+    @property
+    def backend(self) -> str:
+        return self.url.get_backend_name()
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["statement_started"] = time.perf_counter()
+
+    @staticmethod
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("statement_started", None)
+        if started is not None:
+            metrics.observe("apiengine_control_plane_call_seconds", time.perf_counter() - started,
+                            statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER")
+
+    async def create_schema(self):
+        """Create missing tables and indexes (a no-op on a SQLite file set up by init_db)"""
+        async with self.engine.begin() as conn:
+            await conn.run_sync(control_metadata.create_all)
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+    async def _one(self, statement) -> Optional[dict]:
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(statement)).first()
+        return dict(row._mapping) if row else None
+
+    async def _all(self, statement) -> List[dict]:
+        async with self.engine.connect() as conn:
+            return [dict(row._mapping) for row in await conn.execute(statement)]
+
+    async def _scalar(self, statement):
+        async with self.engine.connect() as conn:
+            return (await conn.execute(statement)).scalar()
+
+    # Users
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        return await self._one(select(users_table).where(users_table.c.id == user_id,
+                                                         users_table.c.is_active == True))
+
+    async def find_user(self, username: Optional[str] = None, email: Optional[str] = None,
+                        active_only: bool = False) -> Optional[dict]:
+        statement = select(users_table)
+        if username is not None:
+            statement = statement.where(users_table.c.username == username)
+        if email is not None:
+            statement = statement.where(users_table.c.email == email)
+        if active_only:
+            statement = statement.where(users_table.c.is_active == True)
+        return await self._one(statement)
+
+    async def create_user(self, user_id: str, username: str, email: Optional[str], password_hash: str):
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(users_table).values(id=user_id, username=username, email=email,
+                                                          password_hash=password_hash))
+
+    # APIs
+    async def get_api(self, api_id: str, user_id: Optional[str] = None) -> Optional[dict]:
+        statement = select(apis_table).where(apis_table.c.id == api_id)
+        if user_id is not None:
+            statement = statement.where(apis_table.c.user_id == user_id)
+        return await self._one(statement)
+
+    async def get_api_with_settings(self, api_id: Optional[str] = None, endpoint: Optional[str] = None,
+                                    user_id: Optional[str] = None) -> Optional[dict]:
+        """An API row joined with its rate-limit and auth settings"""
+        settings = api_settings_table.c
+        statement = select(apis_table, settings.max_requests_per_hour, settings.max_requests_per_day,
+                           settings.requires_auth, settings.allowed_origins, settings.resource_profile,
+                           settings.min_replicas, settings.max_replicas, settings.target_p95_ms,
+                           settings.max_concurrency, settings.webhook_url).outerjoin(api_settings_table, settings.api_id == apis_table.c.id)
+        if api_id is not None:
+            statement = statement.where(apis_table.c.id == api_id)
+        if endpoint is not None:
+            statement = statement.where(apis_table.c.endpoint == endpoint)
+        if user_id is not None:
+            statement = statement.where(apis_table.c.user_id == user_id)
+        return await self._one(statement)
+
+    async def endpoint_exists(self, endpoint: str) -> bool:
+        return await self._scalar(select(apis_table.c.id).where(apis_table.c.endpoint == endpoint)) is not None
+
+    async def create_api(self, api: dict, parameters: List[dict], settings: Optional[dict] = None,
+                         api_key: Optional[str] = None, database_link: Optional[dict] = None):
+        """Insert an API with its parameters, settings, key and database link in one transaction"""
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(apis_table).values(**api))
+            if api_key:
+                await conn.execute(insert(api_keys_table).values(**api_key_index.key_row(api['id'], api_key)))
+            if parameters:
+                await conn.execute(insert(api_parameters_table),
+                                   [{"api_id": api['id'], **parameter} for parameter in parameters])
+            if settings is not None:
+                await conn.execute(insert(api_settings_table).values(api_id=api['id'], **settings))
+            if database_link:
+                await conn.execute(insert(api_database_connections_table).values(api_id=api['id'], **database_link))
+
+    async def list_apis(self, user_id: str) -> List[dict]:
+        a, s = apis_table.c, api_settings_table.c
+        total_requests = (select(func.count()).select_from(api_requests_table)
+                          .where(api_requests_table.c.api_id == a.id).scalar_subquery())
+        return await self._all(
+            select(a.id, a.name, a.endpoint, a.description, a.language, a.is_public, a.status,
+                   a.rate_limit_requests, a.rate_limit_period, a.created_at, a.port,
+                   total_requests.label("total_requests"),
+                   s.max_requests_per_hour, s.max_requests_per_day, s.max_requests_per_month, s.requires_auth)
+            .outerjoin(api_settings_table, s.api_id == a.id)
+            .where(a.user_id == user_id)
+            .order_by(a.created_at.desc(), a.id)
+        )
+
+    async def get_parameters(self, api_id: str) -> List[dict]:
+        p = api_parameters_table.c
+        return await self._all(select(p.name, p.type, p.required, p.description)
+                               .where(p.api_id == api_id).order_by(p.id))
+
+    async def update_api(self, api_id: str, fields: dict, api_key: Optional[str] = None,
+                         settings: Optional[dict] = None):
+        """Update columns of an API; a new key replaces (revokes) every existing key"""
+        async with self.engine.begin() as conn:
+            if settings:
+                updated = await conn.execute(update(api_settings_table)
+                                             .where(api_settings_table.c.api_id == api_id).values(**settings))
+                if not updated.rowcount:
+                    await conn.execute(insert(api_settings_table).values(api_id=api_id, **settings))
+            if api_key:
+                await conn.execute(self._revoke_statement(api_id))
+                await conn.execute(insert(api_keys_table).values(**api_key_index.key_row(api_id, api_key)))
+            if fields:
+                await conn.execute(update(apis_table).where(apis_table.c.id == api_id)
+                                   .values(**fields, updated_at=func.current_timestamp()))
+
+    # Deployments
+    async def create_deployment(self, api_id: str, code_hash: str) -> dict:
+        """Register the next version of an API (the unique index settles concurrent deploys)"""
+        d = api_deployments_table.c
+        async with self.engine.begin() as conn:
+            version = (await conn.execute(select(func.coalesce(func.max(d.version), 0))
+                                          .where(d.api_id == api_id))).scalar() + 1
+            row = {"id": secrets.token_urlsafe(12), "api_id": api_id, "version": version, "code_hash": code_hash}
+            await conn.execute(insert(api_deployments_table).values(**row))
+        return {**row, "status": "starting", "container_id": None, "port": None}
+
+    async def update_deployment(self, deployment_id: str, **fields):
+        async with self.engine.begin() as conn:
+            await conn.execute(update(api_deployments_table)
+                               .where(api_deployments_table.c.id == deployment_id).values(**fields))
+
+    async def list_deployments(self, api_id: str) -> List[dict]:
+        d = api_deployments_table.c
+        return await self._all(select(api_deployments_table).where(d.api_id == api_id).order_by(d.version.desc()))
+
+    async def activate_deployment(self, api_id: str, deployment: dict) -> Optional[dict]:
+        """Route an API to a deployment in one transaction; returns what it was routed to before"""
+        d = api_deployments_table.c
+        async with self.engine.begin() as conn:
+            current = (await conn.execute(select(apis_table.c.container_id, apis_table.c.port)
+                                          .where(apis_table.c.id == api_id))).first()
+            previous = (await conn.execute(select(api_deployments_table)
+                                           .where(d.api_id == api_id, d.status == 'live'))).first()
+            await conn.execute(update(api_deployments_table).where(d.api_id == api_id, d.status == 'live')
+                               .values(status='draining'))
+            await conn.execute(update(api_deployments_table).where(d.id == deployment['id'])
+                               .values(status='live', container_id=deployment['container_id'],
+                                       port=deployment['port'], activated_at=datetime.utcnow()))
+            await conn.execute(update(apis_table).where(apis_table.c.id == api_id).values(
+                status='deployed', container_id=deployment['container_id'], port=deployment['port'],
+                updated_at=func.current_timestamp()))
+            await self._route_replicas(conn, api_id, deployment['id'])
+        if previous:
+            return dict(previous._mapping)
+        if current and current.container_id and current.container_id != deployment['container_id']:
+            return {"id": None, "version": None, "container_id": current.container_id, "port": current.port}
+        return None
+
+    # Replicas and autoscaling
+    async def list_replicas(self, deployment_id: str) -> List[dict]:
+        r = api_replicas_table.c
+        return await self._all(select(api_replicas_table).where(r.deployment_id == deployment_id)
+                               .order_by(r.created_at, r.id))
+
+    async def _route_replicas(self, conn, api_id: str, deployment_id: str):
+        """Mirror a live deployment's replica ports on the apis row the gateway routes by"""
+        d, r = api_deployments_table.c, api_replicas_table.c
+        live = (await conn.execute(select(d.id).where(d.id == deployment_id, d.status == 'live'))).first()
+        if live is None:
+            return
+        ports = (await conn.execute(select(r.port).where(r.deployment_id == deployment_id)
+                                    .order_by(r.created_at, r.id))).scalars()
+        await conn.execute(update(apis_table).where(apis_table.c.id == api_id)
+                           .values(replica_ports=",".join(str(port) for port in ports) or None))
+
+    async def add_replica(self, api_id: str, deployment_id: str, container_id: str, port: int) -> str:
+        replica_id = secrets.token_urlsafe(12)
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(api_replicas_table).values(
+                id=replica_id, api_id=api_id, deployment_id=deployment_id, container_id=container_id, port=port,
+                created_at=datetime.utcnow()))
+            await self._route_replicas(conn, api_id, deployment_id)
+        return replica_id
+
+    async def remove_replica(self, replica: dict):
+        """Take a replica out of the route (the caller drains and stops its container)"""
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(api_replicas_table).where(api_replicas_table.c.id == replica['id']))
+            await self._route_replicas(conn, replica['api_id'], replica['deployment_id'])
+
+    async def autoscaled_apis(self) -> List[dict]:
+        """Deployed APIs whose settings ask for more than one replica, with their live deployment"""
+        a, s, d = apis_table.c, api_settings_table.c, api_deployments_table.c
+        return await self._all(
+            select(a.id, a.endpoint, a.language, a.port, a.replica_ports, d.id.label("deployment_id"),
+                   d.version, s.resource_profile, s.min_replicas, s.max_replicas, s.target_p95_ms)
+            .join(api_settings_table, s.api_id == a.id)
+            .join(api_deployments_table, (d.api_id == a.id) & (d.status == 'live'))
+            .where(a.status == 'deployed', (s.min_replicas > 1) | (s.max_replicas > 1))
+            .order_by(a.id)
+        )
+
+    async def record_autoscale_decision(self, **row):
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(autoscale_decisions_table).values(**row, decided_at=datetime.utcnow()))
+
+    async def autoscale_decisions(self, api_id: str, limit: int = 50) -> List[dict]:
+        c = autoscale_decisions_table.c
+        return await self._all(select(autoscale_decisions_table).where(c.api_id == api_id)
+                               .order_by(c.id.desc()).limit(limit))
+
+    # Webhook outbox
+    async def enqueue_webhook(self, **row):
+        now = datetime.utcnow()
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(webhook_outbox_table).values(**row, created_at=now, next_attempt_at=now))
+
+    async def due_webhooks(self, now: datetime, limit: int) -> List[dict]:
+        """Pending deliveries whose next attempt is due, oldest first"""
+        c = webhook_outbox_table.c
+        return await self._all(select(webhook_outbox_table)
+                               .where(c.status == 'pending', c.next_attempt_at <= now)
+                               .order_by(c.id).limit(limit))
+
+    async def settle_webhooks(self, rows: List[dict]):
+        """Write the outcome of delivery attempts (id, status, attempts, next_attempt_at, last_error, delivered_at)"""
+        c = webhook_outbox_table.c
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(webhook_outbox_table).where(c.id == bindparam("row_id")).values(
+                    status=bindparam("status"), attempts=bindparam("attempts"),
+                    next_attempt_at=bindparam("next_attempt_at"), last_error=bindparam("last_error"),
+                    delivered_at=bindparam("delivered_at")),
+                [{"row_id": row["id"], **{key: row.get(key) for key in (
+                    "status", "attempts", "next_attempt_at", "last_error", "delivered_at")}} for row in rows])
+
+    async def webhook_deliveries(self, api_id: str, status_filter: Optional[str] = None, limit: int = 50) -> List[dict]:
+        c = webhook_outbox_table.c
+        statement = select(webhook_outbox_table).where(c.api_id == api_id)
+        if status_filter is not None:
+            statement = statement.where(c.status == status_filter)
+        return await self._all(statement.order_by(c.id.desc()).limit(limit))
+
+    async def webhook_counts(self, api_id: Optional[str] = None) -> Dict[str, int]:
+        c = webhook_outbox_table.c
+        statement = select(c.status, func.count().label("count")).group_by(c.status)
+        if api_id is not None:
+            statement = statement.where(c.api_id == api_id)
+        return {row["status"]: row["count"] for row in await self._all(statement)}
+
+    async def redeliver_webhooks(self, api_id: str) -> int:
+        """Move an API's dead-lettered deliveries back to the queue"""
+        c = webhook_outbox_table.c
+        async with self.engine.begin() as conn:
+            result = await conn.execute(update(webhook_outbox_table)
+                                        .where(c.api_id == api_id, c.status == 'dead')
+                                        .values(status='pending', attempts=0, next_attempt_at=datetime.utcnow()))
+            return result.rowcount
+
+    async def purge_webhooks(self, before: datetime) -> int:
+        """Delete delivered rows created before a cutoff"""
+        c = webhook_outbox_table.c
+        async with self.engine.begin() as conn:
+            result = await conn.execute(delete(webhook_outbox_table)
+                                        .where(c.status == 'delivered', c.created_at < before))
+            return result.rowcount
+
+    # Usage metering
+    def _insert(self, table):
+        """A dialect INSERT, which has ON CONFLICT clauses"""
+        return (sqlite_insert if self.is_sqlite else postgresql_insert)(table)
+
+    async def apply_usage_batch(self, batch_id: str, counts: List[tuple]) -> bool:
+        """Add a flushed batch of (api_id, key_id, day, requests) to the usage tables, once.
+
+        Returns False when the batch was applied before (a retried or replayed
+        flush). Usage of deleted APIs is dropped, and usage dated in a billing
+        period that is already closed is counted on today instead.
+        """
+        u, t, b = usage_counters_table.c, usage_totals_table.c, billing_periods_table.c
+        today = datetime.utcnow().date()
+        async with self.engine.begin() as conn:
+            applied = await conn.execute(self._insert(usage_batches_table)
+                                         .values(id=batch_id, applied_at=datetime.utcnow()).on_conflict_do_nothing())
+            if not applied.rowcount:
+                return False
+            api_ids = {count[0] for count in counts}
+            live = set((await conn.execute(select(apis_table.c.id).where(apis_table.c.id.in_(api_ids)))).scalars())
+            closed = {(row.api_id, row.period) for row in await conn.execute(
+                select(b.api_id, b.period).where(b.api_id.in_(live),
+                                                 b.period.in_({billing_period(day) for _, _, day, _ in counts})))}
+            days, periods = {}, {}
+            for api_id, key_id, day, requests in counts:
+                if api_id not in live:
+                    continue
+                if (api_id, billing_period(day)) in closed:
+                    day = today
+                days[(api_id, key_id or "", day)] = days.get((api_id, key_id or "", day), 0) + requests
+                periods[(api_id, billing_period(day))] = periods.get((api_id, billing_period(day)), 0) + requests
+            if days:
+                statement = self._insert(usage_counters_table)
+                await conn.execute(
+                    statement.on_conflict_do_update(index_elements=["api_id", "key_id", "day"],
+                                                    set_={"requests": u.requests + statement.excluded.requests}),
+                    [{"api_id": api_id, "key_id": key_id, "day": day, "requests": requests}
+                     for (api_id, key_id, day), requests in days.items()])
+                statement = self._insert(usage_totals_table)
+                await conn.execute(
+                    statement.on_conflict_do_update(index_elements=["api_id", "period"],
+                                                    set_={"requests": t.requests + statement.excluded.requests}),
+                    [{"api_id": api_id, "period": period, "requests": requests}
+                     for (api_id, period), requests in periods.items()])
+        return True
+
+    async def close_billing_periods(self, before_period: str) -> int:
+        """Write an immutable billing row for every period before before_period that has none yet"""
+        a, t, b = apis_table.c, usage_totals_table.c, billing_periods_table.c
+        now = datetime.utcnow()
+        async with self.engine.begin() as conn:
+            open_periods = (await conn.execute(
+                select(t.api_id, t.period, t.requests, a.pricing_model, a.price_per_request)
+                .select_from(usage_totals_table.join(apis_table, a.id == t.api_id)
+                             .outerjoin(billing_periods_table, (b.api_id == t.api_id) & (b.period == t.period)))
+                .where(t.period < before_period, b.api_id.is_(None)))).all()
+            if not open_periods:
+                return 0
+            await conn.execute(
+                self._insert(billing_periods_table).on_conflict_do_nothing(),
+                [{"api_id": row.api_id, "period": row.period, "requests": row.requests,
+                  "pricing_model": row.pricing_model, "price_per_request": row.price_per_request,
+                  "amount": round(row.requests * (row.price_per_request or 0), 6) if row.pricing_model == 'payg' else 0.0,
+                  "closed_at": now} for row in open_periods])
+        return len(open_periods)
+
+    async def prune_usage_batches(self, before: datetime) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(delete(usage_batches_table)
+                                        .where(usage_batches_table.c.applied_at < before))
+            return result.rowcount
+
+    async def billing(self, api_id: str, period: str) -> dict:
+        """An API's usage in a billing period, by key, and its closed billing periods, newest first"""
+        u, t, b = usage_counters_table.c, usage_totals_table.c, billing_periods_table.c
+        async with self.engine.connect() as conn:
+            requests = (await conn.execute(select(t.requests).where(t.api_id == api_id, t.period == period))
+                        ).scalar() or 0
+            # Days of the period are compared as text on SQLite and as dates on Postgres
+            start = datetime.strptime(period, "%Y-%m").date()
+            by_key = await conn.execute(
+                select(u.key_id, func.sum(u.requests).label("requests"))
+                .where(u.api_id == api_id, u.day >= start).group_by(u.key_id).order_by(u.key_id))
+            closed = await conn.execute(select(billing_periods_table).where(b.api_id == api_id)
+                                        .order_by(b.period.desc()))
+            return {"period": period, "requests": int(requests),
+                    "by_key": [{"key_id": row.key_id or None, "requests": int(row.requests)} for row in by_key],
+                    "closed_periods": [dict(row._mapping) for row in closed]}
+
+    # Latency sketches
+    async def add_latency_sketches(self, rows: List[dict]) -> int:
+        """Store flushed sketches ({api_id, bucket, requests, sketch}); those of deleted APIs are dropped"""
+        async with self.engine.begin() as conn:
+            live = set((await conn.execute(select(apis_table.c.id).where(
+                apis_table.c.id.in_({row["api_id"] for row in rows})))).scalars())
+            rows = [row for row in rows if row["api_id"] in live]
+            if rows:
+                await conn.execute(insert(latency_sketches_table), rows)
+        return len(rows)
+
+    async def latency_sketches(self, since: int, api_id: str = None, user_id: str = None) -> List[dict]:
+        """Sketch rows from the bucket `since` on, of one API or of all a user's APIs, oldest first"""
+        s = latency_sketches_table.c
+        statement = select(s.api_id, s.bucket, s.requests, s.sketch).where(s.bucket >= since).order_by(s.bucket)
+        if api_id is not None:
+            statement = statement.where(s.api_id == api_id)
+        if user_id is not None:
+            statement = statement.where(s.api_id.in_(select(apis_table.c.id).where(apis_table.c.user_id == user_id)))
+        return await self._all(statement)
+
+    async def compact_latency_sketches(self, since: int, closed_before: int, coarse_before: int,
+                                       coarse_seconds: int) -> int:
+        """Merge the rows of each closed bucket into one; buckets before coarse_before become coarse_seconds long.
+
+        Only buckets from `since` on are looked at, so a pass costs the same
+        however much history is kept. Returns the number of rows removed.
+        """
+        s = latency_sketches_table.c
+        async with self.engine.connect() as conn:
+            buckets = (await conn.execute(
+                select(s.api_id, s.bucket, func.count().label("rows"))
+                .where(s.bucket >= since, s.bucket < closed_before).group_by(s.api_id, s.bucket))).all()
+        groups = {}
+        for row in buckets:
+            target = row.bucket - row.bucket % coarse_seconds if row.bucket < coarse_before else row.bucket
+            groups.setdefault((row.api_id, target), []).append(row)
+        removed = 0
+        for (api_id, target), rows in groups.items():
+            if len(rows) == 1 and rows[0].rows == 1 and rows[0].bucket == target:
+                continue
+            async with self.engine.begin() as conn:
+                found = (await conn.execute(
+                    select(s.id, s.requests, s.sketch)
+                    .where(s.api_id == api_id, s.bucket.in_([row.bucket for row in rows])))).all()
+                if not found:
+                    continue
+                merged = LatencySketch()
+                for row in found:
+                    merged.merge(LatencySketch.from_bytes(row.sketch))
+                await conn.execute(delete(latency_sketches_table).where(s.id.in_([row.id for row in found])))
+                await conn.execute(insert(latency_sketches_table).values(
+                    api_id=api_id, bucket=target, requests=merged.count, sketch=merged.to_bytes()))
+            removed += len(found) - 1
+        return removed
+
+    async def prune_latency_sketches(self, before: int) -> int:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(delete(latency_sketches_table)
+                                        .where(latency_sketches_table.c.bucket < before))
+            return result.rowcount
+
+    async def delete_api(self, api_id: str):
+        """Delete an API and every row that references it"""
+        async with self.engine.begin() as conn:
+            for table in API_CHILD_TABLES:
+                await conn.execute(delete(table).where(table.c.api_id == api_id))
+            await conn.execute(delete(apis_table).where(apis_table.c.id == api_id))
+
+    # API keys
+    async def list_keys(self, api_id: str) -> List[dict]:
+        k = api_keys_table.c
+        return await self._all(select(k.id, k.name, k.key_prefix, k.scopes, k.expires_at, k.revoked_at, k.created_at)
+                               .where(k.api_id == api_id).order_by(k.created_at.desc(), k.id))
+
+    async def create_key(self, api_id: str, name: str = "default", scopes: str = "*",
+                         expires_at: Optional[datetime] = None):
+        """Generate and store a new key, returning (key_id, plaintext key)"""
+        key = generate_api_key()
+        row = api_key_index.key_row(api_id, key, name, scopes, expires_at)
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(api_keys_table).values(**row))
+        return row['id'], key
+
+    async def live_keys_with_prefix(self, prefix: str) -> List[dict]:
+        k = api_keys_table.c
+        return await self._all(select(k.id, k.api_id, k.name, k.key_hash, k.scopes, k.expires_at)
+                               .where(k.key_prefix == prefix, k.revoked_at.is_(None)))
+
+    async def get_live_key(self, api_id: str, key_id: str) -> Optional[dict]:
+        k = api_keys_table.c
+        return await self._one(select(api_keys_table).where(k.id == key_id, k.api_id == api_id,
+                                                            k.revoked_at.is_(None)))
+
+    @staticmethod
+    def _revoke_statement(api_id: str, key_id: Optional[str] = None, at: Optional[datetime] = None):
+        k = api_keys_table.c
+        statement = (update(api_keys_table).where(k.api_id == api_id, k.revoked_at.is_(None))
+                     .values(revoked_at=at or datetime.utcnow()))
+        return statement.where(k.id == key_id) if key_id else statement
+
+    async def revoke_keys(self, api_id: str, key_id: Optional[str] = None) -> int:
+        """Revoke one key (or every key of an API); the caller invalidates the key cache"""
+        async with self.engine.begin() as conn:
+            return (await conn.execute(self._revoke_statement(api_id, key_id))).rowcount
+
+    async def rotate_key(self, api_id: str, key_id: str, grace_seconds: int = 0) -> Optional[tuple]:
+        """Issue a key replacing key_id, which expires after the grace period (or now)"""
+        async with self.engine.begin() as conn:
+            old_key = (await conn.execute(select(api_keys_table).where(
+                api_keys_table.c.id == key_id, api_keys_table.c.api_id == api_id,
+                api_keys_table.c.revoked_at.is_(None)))).first()
+            if old_key is None:
+                return None
+            key = generate_api_key()
+            row = api_key_index.key_row(api_id, key, old_key.name, old_key.scopes, old_key.expires_at)
+            await conn.execute(insert(api_keys_table).values(**row))
+            if grace_seconds > 0:
+                await conn.execute(update(api_keys_table).where(api_keys_table.c.id == key_id)
+                                   .values(expires_at=datetime.utcnow() + timedelta(seconds=grace_seconds)))
+            else:
+                await conn.execute(self._revoke_statement(api_id, key_id))
+        return row['id'], key
+
+    # Request log and analytics
+    async def log_request(self, **row):
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(api_requests_table).values(**row))
+
+    async def analytics(self, user_id: str) -> dict:
+        """Dashboard aggregates for a user's APIs (time windows are computed here, not in SQL)"""
+        a, r, ru = apis_table.c, api_requests_table.c, api_request_rollups_table.c
+        now = datetime.utcnow()
+        owned = api_requests_table.join(apis_table, r.api_id == a.id)
+        request_day = func.date(r.timestamp)
+        usage = usage_totals_table.c
+        request_count = func.count(r.id).label("request_count")
+
+        async with self.engine.connect() as conn:
+            total_requests = (await conn.execute(
+                select(func.count()).select_from(owned).where(a.user_id == user_id))).scalar()
+            total_requests += (await conn.execute(
+                select(func.coalesce(func.sum(ru.request_count), 0))
+                .select_from(api_request_rollups_table.join(apis_table, ru.api_id == a.id))
+                .where(a.user_id == user_id))).scalar()
+            active_apis = (await conn.execute(
+                select(func.count()).select_from(apis_table)
+                .where(a.user_id == user_id, a.status == 'deployed'))).scalar()
+            avg_response_time = (await conn.execute(
+                select(func.avg(r.response_time)).select_from(owned)
+                .where(a.user_id == user_id, r.timestamp > now - timedelta(hours=24)))).scalar() or 0
+            top_endpoints = await conn.execute(
+                select(a.name, a.endpoint, request_count)
+                .select_from(apis_table.outerjoin(api_requests_table, r.api_id == a.id))
+                .where(a.user_id == user_id, a.status == 'deployed')
+                .group_by(a.id, a.name, a.endpoint)
+                .order_by(request_count.desc(), a.name)
+                .limit(5))
+            daily_requests = await conn.execute(
+                select(request_day.label("date"), func.count().label("count")).select_from(owned)
+                .where(a.user_id == user_id, r.timestamp > now - timedelta(days=7))
+                .group_by(request_day).order_by(request_day))
+            revenue = (await conn.execute(
+                select(func.sum(a.price_per_request * usage.requests))
+                .select_from(apis_table.join(usage_totals_table, usage.api_id == a.id))
+                .where(a.user_id == user_id, a.pricing_model == 'payg',
+                       usage.period == billing_period(now)))).scalar() or 0
+
+            return {
+                "total_requests": int(total_requests),
+                "active_apis": active_apis,
+                "avg_response_time": float(avg_response_time),
+                "revenue": float(revenue),
+                "top_endpoints": [dict(row._mapping) for row in top_endpoints],
+                # SQLite returns dates as text, Postgres as date objects
+                "daily_requests": [{"date": str(row.date), "count": row.count} for row in daily_requests],
+            }
+
+    # API tests
+    async def record_test_results(self, rows: List[dict], max_body_bytes: Optional[int] = None):
+        """Insert test results; each distinct body is stored once, capped at max_body_bytes and compressed"""
+        if not rows:
+            return
+        bodies = {}
+        for row in rows:
+            body = row.pop("response_body", None)
+            data = body.encode() if body is not None else None
+            row["response_size"] = len(data) if data is not None else None
+            row["response_body_hash"] = None
+            if data is not None:
+                data = data[:max_body_bytes] if max_body_bytes is not None else data
+                row["response_body_hash"] = hashlib.sha256(data).hexdigest()
+                bodies[row["response_body_hash"]] = data
+        async with self.engine.begin() as conn:
+            if bodies:
+                await conn.execute(self._insert(test_response_bodies_table).on_conflict_do_nothing(),
+                                   [{"hash": digest, "body": zlib.compress(data, 6), "size": len(data)}
+                                    for digest, data in bodies.items()])
+            await conn.execute(insert(api_test_results_table), rows)
+
+    async def test_history(self, api_id: str, limit: int = 50, before_id: Optional[int] = None) -> List[dict]:
+        """An API's test results, newest first; pass the last id seen as before_id for the next page"""
+        t, b = api_test_results_table.c, test_response_bodies_table.c
+        statement = (select(api_test_results_table, b.body.label("stored_body"))
+                     .select_from(api_test_results_table.outerjoin(test_response_bodies_table,
+                                                                   b.hash == t.response_body_hash))
+                     .where(t.api_id == api_id).order_by(t.id.desc()).limit(limit))
+        if before_id is not None:
+            statement = statement.where(t.id < before_id)
+        rows = await self._all(statement)
+        for row in rows:
+            stored = row.pop("stored_body")
+            if stored is not None:
+                row["response_body"] = zlib.decompress(stored).decode(errors="replace")
+        return rows
+
+    # User databases
+    async def create_database_record(self, **row):
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(user_databases_table).values(**row))
+
+    async def list_databases(self, user_id: str) -> List[dict]:
+        d = user_databases_table.c
+        return await self._all(select(user_databases_table).where(d.user_id == user_id, d.is_active == True)
+                               .order_by(d.created_at, d.id))
+
+    async def get_database(self, database_id: str, user_id: str, active_only: bool = True) -> Optional[dict]:
+        d = user_databases_table.c
+        statement = select(user_databases_table).where(d.id == database_id, d.user_id == user_id)
+        if active_only:
+            statement = statement.where(d.is_active == True)
+        return await self._one(statement)
+
+    async def sqlite_database_paths(self) -> Dict[str, str]:
+        """Active SQLite user databases, id -> file path"""
+        d = user_databases_table.c
+        rows = await self._all(select(d.id, d.database_path).where(
+            d.is_active == True, d.database_type == 'sqlite', d.database_path.is_not(None)))
+        return {row['id']: row['database_path'] for row in rows}
+
+control_plane = ControlPlaneStore(os.getenv("CONTROL_PLANE_URL", "sqlite:///data/api_maker.db"))
+
+def require_sqlite_control_plane(feature: str):
+    """Reject jobs that work on the control-plane SQLite file when the control plane is elsewhere"""
+    if not control_plane.is_sqlite:
+        raise HTTPException(status_code=409, detail=f"{feature} requires a SQLite control plane")
+
+# Pydantic models
+class UserCreate(BaseModel):
+    username: str
+    email: Optional[str] = None
+    password: str
 
 class UserLogin(BaseModel):
     username: str
@@ -327,6 +2462,11 @@ class APISettings(BaseModel):
     requires_auth: bool = False
     allowed_origins: str = "*"
     webhook_url: Optional[str] = None
+    resource_profile: Literal["micro", "small", "medium", "large"] = "small"
+    min_replicas: int = 1
+    max_replicas: int = 1
+    target_p95_ms: int = 500
+    max_concurrency: Optional[int] = None  # Gateway slots per worker; GATEWAY_API_MAX_CONCURRENCY when unset
 
 class APICreate(BaseModel):
     name: str
@@ -360,6 +2500,10 @@ class CodeGenerationRequest(BaseModel):
     language: str = "python"
     endpoint: str = ""
 
+class CodeValidationRequest(BaseModel):
+    code: str
+    language: str = "python"
+
 class APITestRequest(BaseModel):
     method: str = "POST"
     headers: Dict[str, str] = {}
@@ -393,6 +2537,16 @@ class EnhancedAPICreate(BaseModel):
     database_connection: Optional[DatabaseConnection] = None
     enable_testing: bool = True
 
+class APIKeyCreate(BaseModel):
+    name: str = "default"
+    scopes: List[str] = ["*"]  # "*", "read" (GET) or "write" (POST/PUT/DELETE)
+    expires_in_days: Optional[int] = None
+
+class DatabaseQuery(BaseModel):
+    sql: str
+    params: Union[List[Any], Dict[str, Any]] = []
+    max_rows: Optional[int] = None
+
 class APITestCase(BaseModel):
     name: str
     method: str = "POST"
@@ -435,7 +2589,7 @@ def verify_jwt_token(token: str) -> Optional[str]:
         return None
 
 def get_db_connection():
-    conn = sqlite3.connect('data/api_maker.db')
+    conn = sqlite3.connect('data/api_maker.db', factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -447,65 +2601,206 @@ async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] =
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     
-    conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE id = ? AND is_active = TRUE", (user_id,)).fetchone()
-    conn.close()
-    
+    user = await control_plane.get_user(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     
-    return dict(user)
+    return user
+
+async def get_admin_user(current_user: dict = Depends(get_current_user)):
+    """Require a platform administrator (usernames listed in ADMIN_USERNAMES)"""
+    admin_usernames = [name.strip() for name in os.getenv("ADMIN_USERNAMES", "admin").split(",")]
+    if current_user['username'] not in admin_usernames:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    return current_user
+
+RATE_LIMIT_WINDOWS = {"hour": 3600, "day": 86400, "month": 2592000}
 
 def check_rate_limit_enhanced(api_id: str, settings: Dict, user_id: str = None, ip_address: str = None):
-    """Enhanced rate limiting with per-API settings"""
-    conn = get_db_connection()
-    
-    # Get current time and calculate window start
-    now = datetime.now()
-    
-    # Check rate limit based on API settings
-    max_requests = settings.get('max_requests_per_hour', 1000)
-    window_start = now - timedelta(hours=1)
-    
-    # Count requests in the current window
-    if user_id:
-        count = conn.execute("""
-            SELECT COUNT(*) as count FROM rate_limits 
-            WHERE api_id = ? AND user_id = ? AND window_start > ?
-        """, (api_id, user_id, window_start)).fetchone()['count']
-    else:
-        count = conn.execute("""
-            SELECT COUNT(*) as count FROM rate_limits 
-            WHERE api_id = ? AND ip_address = ? AND window_start > ?
-        """, (api_id, ip_address, window_start)).fetchone()['count']
-    
-    if count >= max_requests:
-        conn.close()
-        return False, count, max_requests
+    """Enhanced rate limiting with per-API settings.
+
+    Fixed-window counters for the hourly and daily limits are kept in the
+    shared state store, so the limits hold across worker processes. Each
+    window is incremented atomically; if any window is over its limit the
+    increments are rolled back, so denied requests consume no quota.
+    """
+    now = time.time()
+    client = user_id or ip_address or "global"
     
-    # Record this request
-    conn.execute("""
-        INSERT INTO rate_limits (api_id, user_id, ip_address, request_count, window_start)
-        VALUES (?, ?, ?, ?, ?)
-    """, (api_id, user_id, ip_address, 1, now))
+    counted = []
+    binding = None
+    for period, setting in (("hour", "max_requests_per_hour"), ("day", "max_requests_per_day")):
+        max_requests = settings.get(setting)
+        if not max_requests:
+            continue
+        window_seconds = RATE_LIMIT_WINDOWS[period]
+        key = f"rate_limit:{api_id}:{period}:{int(now // window_seconds)}:{client}"
+        count = int(shared_state.incr(key, 1, ttl=window_seconds))
+        counted.append(key)
+        if count > max_requests:
+            for counted_key in counted:
+                shared_state.incr(counted_key, -1)
+            return False, max_requests, max_requests
+        # Report the window with the least headroom
+        if binding is None or max_requests - count < binding[1] - binding[0]:
+            binding = (count, max_requests)
     
-    conn.commit()
-    conn.close()
-    return True, count + 1, max_requests
+    if binding is None:
+        return True, 0, 0
+    return True, binding[0], binding[1]
+
+# Quota leases
+class _Lease:
+    __slots__ = ("remaining", "block", "counted", "exhausted", "renewal")
+
+    def __init__(self):
+        self.remaining = 0  # Allowance claimed from the shared counter and not spent yet
+        self.block = 0  # Size of the last claim
+        self.counted = 0  # Shared counter value after the last claim
+        self.exhausted = False  # The window's limit is reached; nothing more to claim
+        self.renewal = None
+
+class QuotaLeases:
+    """Rate limiting that spends locally claimed blocks of the shared counters.
+
+    check_rate_limit_enhanced pays one shared-state round trip per window per
+    request. With leases, a worker claims a block of allowance for an (API,
+    window, client) with a single INCR of the shared counter, and spends it in
+    memory. When a lease runs down to RATE_LIMIT_LEASE_RENEW_AT of its block,
+    the next block is claimed in the background, so a steady client is checked
+    without waiting on Redis or sqlite. Only an empty lease makes a request
+    wait for a claim.
+
+    Blocks start at one request and double with every claim, up to
+    RATE_LIMIT_LEASE_MAX and RATE_LIMIT_LEASE_FRACTION of the limit. Quiet
+    clients therefore claim exactly what they use, and only hot clients hold
+    larger blocks. A claim that takes the counter past the limit gives the
+    excess back at once, so the limit is never exceeded. When the limit is
+    reached, the lease is marked exhausted and the client is denied locally
+    until the window ends. The cost is under-admission: allowance that other
+    workers claimed but have not spent is not available to this one. At most
+    (workers - 1) × block requests, which is a bound set by the two knobs. A
+    limit too small for a block of two requests is checked exactly, one claim
+    per request.
+
+    The count reported with a decision is the shared count at the last claim,
+    less what is still unspent here. Leases are kept per worker, in an LRU of
+    RATE_LIMIT_LEASE_CAPACITY entries.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("RATE_LIMIT_LEASES", "true").lower() == "true"
+        self.max_block = max(1, int(os.getenv("RATE_LIMIT_LEASE_MAX", "100")))
+        self.fraction = float(os.getenv("RATE_LIMIT_LEASE_FRACTION", "0.01"))
+        self.renew_at = float(os.getenv("RATE_LIMIT_LEASE_RENEW_AT", "0.5"))
+        self.capacity = int(os.getenv("RATE_LIMIT_LEASE_CAPACITY", "10000"))
+        self.leases = OrderedDict()
+
+    def block_limit(self, max_requests: int) -> int:
+        """Largest block claimed for a window with this limit"""
+        return max(1, min(self.max_block, int(max_requests * self.fraction)))
+
+    @staticmethod
+    def claim(key: str, amount: int, max_requests: int, ttl: int) -> tuple:
+        """Claim up to `amount` of a shared counter, giving back what is over the limit (blocking).
+
+        Returns the allowance granted and the counter value after the claim.
+        """
+        count = int(shared_state.incr(key, amount, ttl=ttl))
+        excess = min(amount, max(0, count - max_requests))
+        if excess:
+            count = int(shared_state.incr(key, -excess))
+        return amount - excess, count
+
+    def lease(self, key: str) -> _Lease:
+        lease = self.leases.get(key)
+        if lease is None:
+            lease = self.leases[key] = _Lease()
+            while len(self.leases) > self.capacity:
+                self.leases.popitem(last=False)
+        else:
+            self.leases.move_to_end(key)
+        return lease
+
+    async def renew(self, key: str, lease: _Lease, max_requests: int, ttl: int):
+        try:
+            block = min(max(1, lease.block * 2), self.block_limit(max_requests))
+            granted, count = await asyncio.to_thread(self.claim, key, block, max_requests, ttl)
+            metrics.inc("apiengine_rate_limit_lease_claims_total", "granted" if granted else "exhausted")
+            lease.remaining += granted
+            lease.block = block
+            lease.counted = count
+            lease.exhausted = granted < block
+        finally:
+            lease.renewal = None
+
+    def start_renewal(self, key: str, lease: _Lease, max_requests: int, ttl: int) -> asyncio.Task:
+        if lease.renewal is None:
+            lease.renewal = asyncio.create_task(self.renew(key, lease, max_requests, ttl))
+            # A failed background claim is retried, and raised, by the request that finds the lease empty
+            lease.renewal.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return lease.renewal
+
+    async def check(self, api_id: str, settings: Dict, user_id: str = None, ip_address: str = None):
+        """Same decision and result as check_rate_limit_enhanced, spent from local leases"""
+        if not self.enabled:
+            return check_rate_limit_enhanced(api_id, settings, user_id, ip_address)
+        now = time.time()
+        client = user_id or ip_address or "global"
+
+        windows = []
+        for period, setting in (("hour", "max_requests_per_hour"), ("day", "max_requests_per_day")):
+            max_requests = settings.get(setting)
+            if not max_requests:
+                continue
+            window_seconds = RATE_LIMIT_WINDOWS[period]
+            key = f"rate_limit:{api_id}:{period}:{int(now // window_seconds)}:{client}"
+            lease = self.lease(key)
+            while not lease.remaining and not lease.exhausted:
+                await asyncio.shield(self.start_renewal(key, lease, max_requests, window_seconds))
+            if not lease.remaining:
+                # Nothing is spent from the other windows, so denied requests consume no quota
+                return False, max_requests, max_requests
+            windows.append((key, lease, max_requests, window_seconds))
+
+        binding = None
+        for key, lease, max_requests, window_seconds in windows:
+            lease.remaining -= 1
+            if not lease.exhausted and lease.remaining <= lease.block * self.renew_at:
+                self.start_renewal(key, lease, max_requests, window_seconds)
+            count = lease.counted - lease.remaining
+            # Report the window with the least headroom
+            if binding is None or max_requests - count < binding[1] - binding[0]:
+                binding = (count, max_requests)
+
+        if binding is None:
+            return True, 0, 0
+        return True, binding[0], binding[1]
+
+    def report(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "leases": len(self.leases),
+            "unspent": sum(lease.remaining for lease in self.leases.values()),
+            "exhausted": sum(lease.exhausted for lease in self.leases.values()),
+            "renewing": sum(lease.renewal is not None for lease in self.leases.values()),
+        }
+
+quota_leases = QuotaLeases()
+metrics.counter("apiengine_rate_limit_lease_claims_total",
+                "Rate limit allowance claims from the shared counters (granted, exhausted)", ("outcome",))
 
 def generate_database_id():
     """Generate unique database ID"""
     return secrets.token_urlsafe(16)
 
-def create_user_database(user_id: str, database_name: str, database_type: str = "sqlite"):
+async def create_user_database(user_id: str, database_name: str, database_type: str = "sqlite"):
     """Create a new database for user"""
-    conn = get_db_connection()
     database_id = generate_database_id()
     
     # Create database path based on user
-    user = conn.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+    user = await control_plane.get_user(user_id)
     if not user:
-        conn.close()
         raise HTTPException(status_code=404, detail="User not found")
     
     username = user['username']
@@ -532,13 +2827,10 @@ def create_user_database(user_id: str, database_name: str, database_type: str =
         connection_string = f"{database_type}://user_{username}_{database_name}"
     
     # Store database info
-    conn.execute("""
-        INSERT INTO user_databases (id, user_id, database_name, database_type, connection_string, database_path)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (database_id, user_id, database_name, database_type, connection_string, database_path))
-    
-    conn.commit()
-    conn.close()
+    await control_plane.create_database_record(
+        id=database_id, user_id=user_id, database_name=database_name, database_type=database_type,
+        connection_string=connection_string, database_path=database_path
+    )
     
     return {
         "database_id": database_id,
@@ -548,187 +2840,295 @@ def create_user_database(user_id: str, database_name: str, database_type: str =
         "database_path": database_path
     }
 
-def get_user_databases(user_id: str):
+async def get_user_databases(user_id: str):
     """Get all databases for a user"""
-    conn = get_db_connection()
-    databases = conn.execute("""
-        SELECT * FROM user_databases WHERE user_id = ? AND is_active = TRUE
-    """, (user_id,)).fetchall()
-    conn.close()
-    return [dict(db) for db in databases]
+    return await control_plane.list_databases(user_id)
+
+async def load_user_database(database_id: str, user_id: str) -> dict:
+    """Return a SQLite database owned by the user, or raise 404/400"""
+    database = await control_plane.get_database(database_id, user_id)
+    if not database:
+        raise HTTPException(status_code=404, detail="Database not found")
+    if database['database_type'] != 'sqlite' or not database['database_path']:
+        raise HTTPException(status_code=400, detail="Only SQLite databases support this operation")
+    return database
 
-def generate_enhanced_api_code(prompt: str, language: str, endpoint: str, database_info: Dict = None):
-    """Generate API code with database integration"""
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,62}$")
+
+def quote_identifier(name: str) -> str:
+    """Validate a user-supplied table or column name and quote it for SQL"""
+    if not IDENTIFIER_PATTERN.match(name) or name.lower().startswith("sqlite_"):
+        raise HTTPException(status_code=400, detail=f"Invalid identifier: {name}")
+    return f'"{name}"'
+
+def database_mtime(path: str) -> tuple:
+    """Modification times of a SQLite database and its WAL; changes whenever data is written"""
+    stamps = []
+    for suffix in ("", "-wal"):
+        try:
+            stat = os.stat(path + suffix)
+        except FileNotFoundError:
+            stamps.append(0)
+            continue
+        # An empty WAL is created just by opening the database read-only
+        stamps.append(stat.st_mtime_ns if stat.st_size else 0)
+    return tuple(stamps)
+
+# Columns of tables created by generated APIs, in schema catalog format
+DEFAULT_TABLE_COLUMNS = [
+    {"name": "id", "type": "INTEGER", "notnull": False, "default": None, "primary_key": 1, "autoincrement": True},
+    {"name": "name", "type": "TEXT", "notnull": True, "default": None, "primary_key": 0},
+    {"name": "description", "type": "TEXT", "notnull": False, "default": None, "primary_key": 0},
+    {"name": "created_at", "type": "TIMESTAMP", "notnull": False, "default": "CURRENT_TIMESTAMP", "primary_key": 0},
+]
+
+def sqlite_python_type(declared: str) -> str:
+    """Python annotation for a declared SQLite column type (SQLite affinity rules)"""
+    declared = (declared or "").upper()
+    if "INT" in declared:
+        return "int"
+    if any(name in declared for name in ("CHAR", "CLOB", "TEXT", "DATE", "TIME")):
+        return "str"
+    if not declared or "BLOB" in declared:
+        return "Any"
+    if any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+        return "float"
+    return "bool" if "BOOL" in declared else "float"
+
+def model_field_lines(columns: List[Dict], skip=()) -> str:
+    """Pydantic field declarations for columns (NOT NULL columns are required)"""
+    lines = []
+    for column in columns:
+        if column["name"] in skip:
+            continue
+        annotation = sqlite_python_type(column["type"])
+        lines.append(f"    {column['name']}: {annotation}" if column["notnull"]
+                     else f"    {column['name']}: Optional[{annotation}] = None")
+    return "\n".join(lines) or "    pass"
+
+def table_template_fields(table_name: str, columns: Optional[List[Dict]] = None) -> Dict[str, str]:
+    """Model fields and SQL for the with_db template, derived from a table's columns"""
+    if not columns or not all(IDENTIFIER_PATTERN.match(column["name"]) and not keyword.iskeyword(column["name"])
+                              for column in columns):
+        columns = DEFAULT_TABLE_COLUMNS
+    primary_keys = [column for column in columns if column["primary_key"]]
+    # An INTEGER PRIMARY KEY aliases the rowid; any other table is paged and addressed by rowid
+    if len(primary_keys) == 1 and (primary_keys[0]["type"] or "").upper() == "INTEGER":
+        key_column, select_list = primary_keys[0]["name"], "*"
+    else:
+        key_column, select_list = "rowid", "rowid, *"
+    
+    definitions, writable = [], []
+    for column in columns:
+        definition = f"{column['name']} {column['type'] or ''}".rstrip()
+        if column["name"] == key_column:
+            definition += " PRIMARY KEY" + (" AUTOINCREMENT" if column.get("autoincrement") else "")
+        if column["notnull"]:
+            definition += " NOT NULL"
+        if column["default"] is not None:
+            definition += f" DEFAULT {column['default']}"
+        definitions.append(definition)
+        if column["name"] == key_column or column["default"] is not None:
+            continue  # Assigned by the database
+        writable.append(column["name"])
+    if len(primary_keys) > 1:
+        definitions.append(f"PRIMARY KEY ({', '.join(column['name'] for column in primary_keys)})")
+    
+    def as_tuple(items):
+        return f"({items[0]},)" if len(items) == 1 else f"({', '.join(items)})"
+    
+    values = [f"data.{name}" for name in writable]
+    if writable:
+        insert_sql = f"INSERT INTO {table_name} ({', '.join(writable)}) VALUES ({', '.join('?' * len(writable))})"
+        insert_values = as_tuple(values)
+        update_sql = (f"UPDATE {table_name} SET {', '.join(f'{name} = ?' for name in writable)} "
+                      f"WHERE {key_column} = ?")
+    else:
+        insert_sql = f"INSERT INTO {table_name} DEFAULT VALUES"
+        insert_values = "()"
+        update_sql = f"UPDATE {table_name} SET {key_column} = {key_column} WHERE {key_column} = ?"
+    return {
+        "column_definitions": ",\n            ".join(definitions),
+        "model_fields": model_field_lines([column for column in columns if column["name"] in writable]),
+        "key_column": key_column,
+        "select_list": select_list,
+        "insert_sql": insert_sql,
+        "insert_values": insert_values,
+        "update_sql": update_sql,
+        "update_values": as_tuple(values + ["item_id"]),
+    }
+
+def generate_enhanced_api_code(prompt: str, language: str, endpoint: str, database_info: Dict = None,
+                               columns: Optional[List[Dict]] = None):
+    """Generate API code with database integration (columns shape the model of in-memory APIs)"""
     
     base_templates = {
         "python": {
             "with_db": '''
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
 import sqlite3
-from typing import Optional, List
-import json
+from typing import Any, Optional, List
 
 app = FastAPI()
 
-# Database connection
-def get_db_connection():
-    conn = sqlite3.connect("{database_path}")
-    conn.row_factory = sqlite3.Row
-    return conn
+# One connection per process, opened once at startup (WAL: readers never wait on writers)
+db = None
+
+@app.on_event("startup")
+def open_database():
+    global db
+    db = sqlite3.connect("{database_path}", check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            {column_definitions}
+        )
+    """)
+    db.commit()
 
-# Request/Response models
+@app.on_event("shutdown")
+def close_database():
+    db.close()
+
+# Request/Response models (fields match the table's columns)
 class {model_name}(BaseModel):
-    # Add your fields here based on requirements
-    name: str
-    description: Optional[str] = None
+{model_fields}
 
 @app.get("/{endpoint}")
-async def get_{endpoint_clean}():
-    """Get all records"""
-    conn = get_db_connection()
+async def get_{endpoint_clean}(limit: int = Query(50, ge=1, le=500), after: Optional[int] = None):
+    """List records newest first; pass next_cursor as `after` to fetch the next page"""
     try:
-        records = conn.execute("SELECT * FROM {table_name} ORDER BY id DESC").fetchall()
-        return [dict(record) for record in records]
+        if after is None:
+            records = db.execute(
+                "SELECT {select_list} FROM {table_name} ORDER BY {key_column} DESC LIMIT ?", (limit,)
+            ).fetchall()
+        else:
+            records = db.execute(
+                "SELECT {select_list} FROM {table_name} WHERE {key_column} < ? ORDER BY {key_column} DESC LIMIT ?",
+                (after, limit)
+            ).fetchall()
+        items = [dict(record) for record in records]
+        return {{"items": items, "next_cursor": items[-1]["{key_column}"] if len(items) == limit else None}}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.post("/{endpoint}")
 async def create_{endpoint_clean}(data: {model_name}):
     """Create new record"""
-    conn = get_db_connection()
     try:
-        # Create table if not exists
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        cursor = conn.execute(
-            "INSERT INTO {table_name} (name, description) VALUES (?, ?)",
-            (data.name, data.description)
+        cursor = db.execute(
+            "{insert_sql}",
+            {insert_values}
         )
-        conn.commit()
-        
-        # Get the created record
-        record = conn.execute("SELECT * FROM {table_name} WHERE id = ?", (cursor.lastrowid,)).fetchone()
+        db.commit()
+        record = db.execute("SELECT {select_list} FROM {table_name} WHERE rowid = ?", (cursor.lastrowid,)).fetchone()
         return dict(record)
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/{endpoint}/{{item_id}}")
 async def get_{endpoint_clean}_by_id(item_id: int):
     """Get record by ID"""
-    conn = get_db_connection()
-    try:
-        record = conn.execute("SELECT * FROM {table_name} WHERE id = ?", (item_id,)).fetchone()
-        if not record:
-            raise HTTPException(status_code=404, detail="Record not found")
-        return dict(record)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+    record = db.execute("SELECT {select_list} FROM {table_name} WHERE {key_column} = ?", (item_id,)).fetchone()
+    if not record:
+        raise HTTPException(status_code=404, detail="Record not found")
+    return dict(record)
 
 @app.put("/{endpoint}/{{item_id}}")
 async def update_{endpoint_clean}(item_id: int, data: {model_name}):
     """Update record"""
-    conn = get_db_connection()
     try:
-        cursor = conn.execute(
-            "UPDATE {table_name} SET name = ?, description = ? WHERE id = ?",
-            (data.name, data.description, item_id)
+        cursor = db.execute(
+            "{update_sql}",
+            {update_values}
         )
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Record not found")
-        conn.commit()
-        
-        # Get updated record
-        record = conn.execute("SELECT * FROM {table_name} WHERE id = ?", (item_id,)).fetchone()
-        return dict(record)
+        db.commit()
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Record not found")
+    record = db.execute("SELECT {select_list} FROM {table_name} WHERE {key_column} = ?", (item_id,)).fetchone()
+    return dict(record)
 
 @app.delete("/{endpoint}/{{item_id}}")
 async def delete_{endpoint_clean}(item_id: int):
     """Delete record"""
-    conn = get_db_connection()
     try:
-        cursor = conn.execute("DELETE FROM {table_name} WHERE id = ?", (item_id,))
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Record not found")
-        conn.commit()
-        return {{"message": "Record deleted successfully"}}
+        cursor = db.execute("DELETE FROM {table_name} WHERE {key_column} = ?", (item_id,))
+        db.commit()
     except Exception as e:
+        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+    if cursor.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Record not found")
+    return {{"message": "Record deleted successfully"}}
 ''',
             "without_db": '''
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Any, Optional, List
+import bisect
 
 app = FastAPI()
 
-# In-memory storage (replace with database in production)
-data_store = []
+# In-memory storage keyed by id (replace with database in production)
+data_store = {{}}
+ids = []  # The ids in data_store, ascending, so a page is one bisect and a slice
+last_id = 0
 
+# Request/Response model
 class {model_name}(BaseModel):
-    # Add your fields here based on requirements
-    name: str
-    description: Optional[str] = None
+{model_fields}
 
 @app.get("/{endpoint}")
-async def get_{endpoint_clean}():
-    """Get all records"""
-    return data_store
+async def get_{endpoint_clean}(limit: int = Query(50, ge=1, le=500), after: Optional[int] = None):
+    """List records newest first; pass next_cursor as `after` to fetch the next page"""
+    end = bisect.bisect_left(ids, after) if after is not None else len(ids)
+    start = max(end - limit, 0)
+    items = [data_store[item_id] for item_id in reversed(ids[start:end])]
+    return {{"items": items, "next_cursor": items[-1]["id"] if start > 0 else None}}
 
 @app.post("/{endpoint}")
 async def create_{endpoint_clean}(data: {model_name}):
     """Create new record"""
-    new_item = data.dict()
-    new_item["id"] = len(data_store) + 1
-    data_store.append(new_item)
+    global last_id
+    last_id += 1
+    new_item = data.model_dump()
+    new_item["id"] = last_id
+    data_store[last_id] = new_item
+    ids.append(last_id)  # Ids only grow, so appending keeps the list sorted
     return new_item
 
 @app.get("/{endpoint}/{{item_id}}")
 async def get_{endpoint_clean}_by_id(item_id: int):
     """Get record by ID"""
-    for item in data_store:
-        if item.get("id") == item_id:
-            return item
-    raise HTTPException(status_code=404, detail="Record not found")
+    item = data_store.get(item_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Record not found")
+    return item
 
 @app.put("/{endpoint}/{{item_id}}")
 async def update_{endpoint_clean}(item_id: int, data: {model_name}):
     """Update record"""
-    for i, item in enumerate(data_store):
-        if item.get("id") == item_id:
-            updated_item = data.dict()
-            updated_item["id"] = item_id
-            data_store[i] = updated_item
-            return updated_item
-    raise HTTPException(status_code=404, detail="Record not found")
+    if item_id not in data_store:
+        raise HTTPException(status_code=404, detail="Record not found")
+    updated_item = data.model_dump()
+    updated_item["id"] = item_id
+    data_store[item_id] = updated_item
+    return updated_item
 
 @app.delete("/{endpoint}/{{item_id}}")
 async def delete_{endpoint_clean}(item_id: int):
     """Delete record"""
-    for i, item in enumerate(data_store):
-        if item.get("id") == item_id:
-            del data_store[i]
-            return {{"message": "Record deleted successfully"}}
-    raise HTTPException(status_code=404, detail="Record not found")
+    if data_store.pop(item_id, None) is None:
+        raise HTTPException(status_code=404, detail="Record not found")
+    del ids[bisect.bisect_left(ids, item_id)]
+    return {{"message": "Record deleted successfully"}}
 '''
         }
     }
@@ -747,71 +3147,24 @@ async def delete_{endpoint_clean}(item_id: int):
             endpoint_clean=endpoint_clean,
             model_name=model_name,
             table_name=table_name,
-            database_path=database_path
+            database_path=database_path,
+            **table_template_fields(table_name, database_info.get("columns"))
         )
     else:
         template = base_templates[language]["without_db"]
         return template.format(
             endpoint=endpoint,
             endpoint_clean=endpoint_clean,
-            model_name=model_name
+            model_name=model_name,
+            model_fields=model_field_lines(columns or DEFAULT_TABLE_COLUMNS, skip=("id", "created_at"))
         )
-    if not redis_client:
-        return True  # Skip rate limiting if Redis not available
-    
-    # Create unique keys for different time windows
-    hour_key = f"rate_limit:{api_id}:hour:{user_id or ip_address}"
-    day_key = f"rate_limit:{api_id}:day:{user_id or ip_address}"
-    month_key = f"rate_limit:{api_id}:month:{user_id or ip_address}"
-    
-    # Check hourly limit
-    hour_count = redis_client.get(hour_key) or 0
-    if int(hour_count) >= settings.get('max_requests_per_hour', 1000):
-        return False
-    
-    # Check daily limit
-    day_count = redis_client.get(day_key) or 0
-    if int(day_count) >= settings.get('max_requests_per_day', 10000):
-        return False
-    
-    # Check monthly limit
-    month_count = redis_client.get(month_key) or 0
-    if int(month_count) >= settings.get('max_requests_per_month', 100000):
-        return False
-    
-    # Increment counters
-    pipe = redis_client.pipeline()
-    pipe.incr(hour_key)
-    pipe.expire(hour_key, 3600)  # 1 hour
-    pipe.incr(day_key)
-    pipe.expire(day_key, 86400)  # 1 day
-    pipe.incr(month_key)
-    pipe.expire(month_key, 2592000)  # 30 days
-    pipe.execute()
-    
-    return True
 
 def check_rate_limit(api_id: str, rate_limit_requests: int, rate_limit_period: str, ip_address: str = None):
-    if not redis_client:
-        return True  # Skip rate limiting if Redis not available
-    
     key = f"rate_limit:{api_id}:{ip_address or 'global'}"
-    current_requests = redis_client.get(key)
-    
-    if current_requests is None:
-        # First request
-        if rate_limit_period == "hour":
-            redis_client.setex(key, 3600, 1)
-        elif rate_limit_period == "day":
-            redis_client.setex(key, 86400, 1)
-        elif rate_limit_period == "month":
-            redis_client.setex(key, 2592000, 1)
-        return True
-    
-    if int(current_requests) >= rate_limit_requests:
+    ttl = RATE_LIMIT_WINDOWS.get(rate_limit_period, RATE_LIMIT_WINDOWS["day"])
+    if shared_state.incr(key, 1, ttl=ttl) > rate_limit_requests:
+        shared_state.incr(key, -1)  # Denied requests do not consume quota
         return False
-    
-    redis_client.incr(key)
     return True
 
 async def generate_code_with_gpt(prompt: str, language: str, endpoint: str) -> str:
@@ -841,6 +3194,7 @@ Framework: {get_framework_for_language(language)}
 Requirements: JSON response, error handling, input validation.
 Return only code, no explanations."""
 
+    openai_start = time.perf_counter()
     try:
         response = client.chat.completions.create(
             model=model,  # Using gpt-3.5-turbo (cheapest)
@@ -851,18 +3205,23 @@ Return only code, no explanations."""
             max_tokens=max_tokens,  # Reduced token limit
             temperature=temperature
         )
+        metrics.observe("apiengine_openai_request_seconds", time.perf_counter() - openai_start, model, "success")
         
         # Track usage and cost
+        usage = response.usage
+        metrics.inc("apiengine_openai_tokens_total", model, "input", amount=usage.prompt_tokens)
+        metrics.inc("apiengine_openai_tokens_total", model, "output", amount=usage.completion_tokens)
         if os.getenv("OPENAI_ENABLE_COST_TRACKING", "true").lower() == "true":
-            usage = response.usage
-            cost_tracker.track_usage(
+            cost = cost_tracker.track_usage(
                 model=model,
                 input_tokens=usage.prompt_tokens,
                 output_tokens=usage.completion_tokens
             )
+            metrics.inc("apiengine_openai_cost_dollars_total", model, amount=cost)
         
         return response.choices[0].message.content
     except Exception as e:
+        metrics.observe("apiengine_openai_request_seconds", time.perf_counter() - openai_start, model, "error")
         logger.error(f"OpenAI API error: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate code")
 
@@ -899,6 +3258,201 @@ def generate_endpoint_from_prompt(prompt: str) -> str:
         return endpoint
     return "custom-endpoint"
 
+# Template fast path
+class TemplateRouter:
+    """Serve recognizable CRUD prompts from the local templates instead of the LLM.
+
+    A prompt is routed locally when it asks for a plain resource API ("CRUD
+    API for books with title, author, price (float) and published (bool)")
+    and mentions nothing the templates cannot do (external calls, files,
+    auth flows, ...). Fields are read from the prompt: an explicit type
+    ("price (float)", "price: float", "price as float", "float price")
+    wins, otherwise the type is inferred from the name (is_*, *_id, price,
+    *_at, ...). Anything the classifier is unsure about goes to the LLM.
+
+    Every generation is counted in shared state with its latency, so
+    GET /api/admin/code-generation reports the share served locally and the
+    time saved against the mean LLM latency (CODEGEN_LLM_BASELINE_SECONDS
+    until an LLM generation has been timed).
+    """
+
+    INTENT_WORDS = {"crud", "rest", "restful", "resource", "manage", "manages", "managing", "management",
+                    "store", "stores", "storing", "track", "tracks", "tracking", "catalog", "inventory",
+                    "registry", "records"}
+    CRUD_VERBS = {"create", "add", "list", "get", "read", "update", "edit", "delete", "remove"}
+    UNSUPPORTED_WORDS = {"scrape", "scraper", "scraping", "crawl", "proxy", "weather", "translate", "translation",
+                         "summarize", "summarise", "summary", "classify", "predict", "prediction", "sentiment",
+                         "convert", "calculate", "calculator", "send", "sms", "upload", "uploads", "file", "files",
+                         "image", "images", "pdf", "webhook", "webhooks", "websocket", "stream", "streaming",
+                         "login", "oauth", "authentication", "payment", "payments", "stripe", "openai", "gpt",
+                         "llm", "search", "recommend", "recommendation", "chat", "notify", "notification",
+                         "external", "fetch", "http", "url", "aggregate", "report", "statistics", "join"}
+    RESOURCE_TRIGGERS = {"for", "of", "manage", "managing", "store", "storing", "track", "tracking"}
+    RESOURCE_MARKERS = {"api", "apis", "crud", "endpoint", "endpoints", "service"}
+    FILLER_WORDS = {"a", "an", "the", "my", "our", "some", "all", "simple", "basic", "small", "new", "crud",
+                    "rest", "restful", "api", "apis", "manage", "managing", "management", "store", "storing",
+                    "track", "tracking", "keep", "keeping", "of", "for", "to", "that", "lets", "users"}
+    STOP_WORDS = {"with", "having", "that", "which", "where", "including", "containing", "and", "fields",
+                  "field", "columns", "api", "apis", "endpoint", "endpoints", "service", "in", "on", "by",
+                  "using", "to", "from", "into"}
+    FIELD_LIST = re.compile(r"\b(?:with|having|including|containing)\b\s*(?:the\s+)?"
+                            r"(?:(?:fields?|columns?|properties|attributes)\b\s*:?\s*)?(?P<fields>.+)$")
+    FIELD = re.compile(r"^(?P<name>[a-z][a-z0-9_ ]*?)\s*(?:\((?P<paren>[a-z ]+)\)|:\s*(?P<colon>[a-z ]+)"
+                       r"|\s+as\s+(?:an?\s+)?(?P<as>[a-z ]+))?$")
+    TYPES = {"str": "TEXT", "string": "TEXT", "text": "TEXT", "varchar": "TEXT", "int": "INTEGER",
+             "integer": "INTEGER", "number": "REAL", "float": "REAL", "decimal": "REAL", "double": "REAL",
+             "real": "REAL", "numeric": "REAL", "bool": "BOOLEAN", "boolean": "BOOLEAN", "flag": "BOOLEAN",
+             "date": "DATE", "datetime": "TIMESTAMP", "timestamp": "TIMESTAMP"}
+    BOOLEAN_NAMES = {"active", "enabled", "done", "completed", "published", "archived", "verified",
+                     "available", "paid", "visible", "deleted"}
+    INTEGER_NAMES = {"count", "quantity", "qty", "age", "year", "stock", "pages", "position", "priority",
+                     "rank", "votes", "likes", "views", "capacity", "seats"}
+    REAL_NAMES = {"price", "amount", "cost", "total", "rate", "salary", "balance", "weight", "height", "width",
+                  "length", "latitude", "longitude", "lat", "lng", "lon", "score", "rating", "temperature",
+                  "discount", "budget"}
+    DATE_NAMES = {"date", "birthday", "deadline", "dob", "due"}
+    MAX_FIELDS = 30
+
+    def __init__(self):
+        self.enabled = os.getenv("TEMPLATE_FAST_PATH_ENABLED", "true").lower() == "true"
+        self.llm_baseline = float(os.getenv("CODEGEN_LLM_BASELINE_SECONDS", "6"))
+
+    @classmethod
+    def infer_type(cls, name: str) -> str:
+        """Declared column type for a field the prompt gave no type for"""
+        last = name.rsplit("_", 1)[-1]
+        if name.startswith(("is_", "has_", "can_")) or name in cls.BOOLEAN_NAMES:
+            return "BOOLEAN"
+        if last in ("id", "count") or name in cls.INTEGER_NAMES:
+            return "INTEGER"
+        if name in cls.REAL_NAMES or last in ("price", "amount", "cost", "total"):
+            return "REAL"
+        if last == "at" or name == "timestamp":
+            return "TIMESTAMP"
+        if last == "date" or name in cls.DATE_NAMES:
+            return "DATE"
+        return "TEXT"
+
+    @classmethod
+    def parse_field(cls, item: str) -> Optional[dict]:
+        """A column from one field of the prompt, or None when it is not a plain field"""
+        item = re.sub(r"\b(?:a|an|the|field|column)\b", " ", item.strip(" .;:").lower())
+        optional = bool(re.search(r"\boptional\b", item))
+        item = re.sub(r"\s+", " ", re.sub(r"\b(?:optional|required)\b", " ", item)).strip()
+        match = cls.FIELD.match(item)
+        if not match:
+            return None
+        words = match["name"].split()
+        explicit = match["paren"] or match["colon"] or match["as"]
+        if not explicit and len(words) > 1 and words[0] in cls.TYPES:
+            explicit, words = words[0], words[1:]  # "float price"
+        if not words or len(words) > 3:
+            return None
+        name = "_".join(words)
+        if not IDENTIFIER_PATTERN.match(name) or keyword.iskeyword(name):
+            return None
+        if explicit:
+            declared = cls.TYPES.get(explicit.split()[0])
+            if declared is None:
+                return None  # e.g. "tags (list of strings)": leave it to the LLM
+        else:
+            declared = cls.infer_type(name)
+        return {"name": name, "type": declared, "notnull": not optional, "default": None, "primary_key": 0}
+
+    @classmethod
+    def parse_fields(cls, text: str) -> Optional[List[dict]]:
+        items = [item for item in re.split(r",|;|\band\b|\bplus\b", text) if item.strip(" .")]
+        columns, seen = [], set()
+        for item in items[:cls.MAX_FIELDS + 1]:
+            column = cls.parse_field(item)
+            if column is None:
+                return None
+            if column["name"] in ("id", "created_at") or column["name"] in seen:
+                continue  # Assigned by the template, or repeated
+            seen.add(column["name"])
+            columns.append(column)
+        return columns if 0 < len(columns) <= cls.MAX_FIELDS else None
+
+    @classmethod
+    def _resource(cls, words: List[str]) -> Optional[List[str]]:
+        """Noun phrase naming the resource: after "for/manage/track...", or before "API/CRUD" """
+        for index, word in enumerate(words):
+            if word not in cls.RESOURCE_TRIGGERS:
+                continue
+            phrase = []
+            for following in words[index + 1:]:
+                if following in cls.STOP_WORDS or len(phrase) == 2:
+                    break
+                if following in cls.FILLER_WORDS and not phrase:
+                    continue
+                phrase.append(following)
+            if phrase:
+                return phrase
+        for index, word in enumerate(words):
+            if word not in cls.RESOURCE_MARKERS:
+                continue
+            phrase = []
+            for preceding in reversed(words[:index]):
+                if preceding in cls.FILLER_WORDS and not phrase:
+                    continue  # "user management API"
+                if preceding in cls.FILLER_WORDS or preceding in cls.CRUD_VERBS - {"list"} or len(phrase) == 2:
+                    break
+                phrase.insert(0, preceding)
+            if phrase:
+                return phrase
+        return None
+
+    def classify(self, prompt: str) -> Optional[dict]:
+        """Return {"resource", "endpoint", "columns"} for a templatable prompt, else None"""
+        text = " ".join(prompt.lower().split())
+        field_list = self.FIELD_LIST.search(text)
+        head = text[:field_list.start()] if field_list else text
+        columns = self.parse_fields(field_list["fields"]) if field_list else None
+        if field_list and columns is None:
+            return None  # Fields we cannot type faithfully
+        words = re.findall(r"[a-z][a-z0-9_]*", head)
+        if self.UNSUPPORTED_WORDS.intersection(words):
+            return None
+        if not (columns or self.INTENT_WORDS.intersection(words) or len(self.CRUD_VERBS.intersection(words)) >= 3):
+            return None
+        resource = self._resource(words)
+        if not resource or not all(IDENTIFIER_PATTERN.match(word) for word in resource):
+            return None
+        return {"resource": "_".join(resource), "endpoint": "-".join(resource),
+                "columns": columns or DEFAULT_TABLE_COLUMNS}
+
+    async def record(self, generator: str, seconds: float):
+        """Count a generation ("template" or "llm") and its latency in every worker's report"""
+        metrics.inc("apiengine_code_generations_total", generator)
+        metrics.observe("apiengine_code_generation_seconds", seconds, generator)
+        await asyncio.to_thread(self._count, generator, seconds)
+
+    def _count(self, generator: str, seconds: float):
+        shared_state.incr(f"codegen:{generator}:count", 1)
+        shared_state.incr(f"codegen:{generator}:seconds", seconds)
+
+    def report(self) -> dict:
+        counts = {generator: int(shared_state.get(f"codegen:{generator}:count")) for generator in ("template", "llm")}
+        seconds = {generator: shared_state.get(f"codegen:{generator}:seconds") for generator in counts}
+        means = {generator: seconds[generator] / counts[generator] if counts[generator] else None
+                 for generator in counts}
+        llm_mean = means["llm"] if means["llm"] is not None else self.llm_baseline
+        total = sum(counts.values())
+        return {
+            "enabled": self.enabled,
+            "generations": counts,
+            "local_share": round(counts["template"] / total, 4) if total else 0.0,
+            "mean_seconds": {generator: round(mean, 4) if mean is not None else None
+                             for generator, mean in means.items()},
+            "llm_latency_source": "observed" if means["llm"] is not None else "baseline",
+            "estimated_seconds_saved": round(max(llm_mean - (means["template"] or 0), 0) * counts["template"], 3)
+        }
+
+template_router = TemplateRouter()
+metrics.counter("apiengine_code_generations_total", "Code generations by generator (template or llm)", ("generator",))
+metrics.histogram("apiengine_code_generation_seconds", "Code generation latency", ("generator",),
+                  buckets=(0.001, 0.005, 0.025, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0))
+
 def create_dockerfile(language: str, code: str, endpoint: str) -> str:
     """Create Dockerfile for the API"""
     if language == "python":
@@ -949,112 +3503,3032 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-{code}
+{code}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8000)
+"""
+    return code
+
+# Deploy validation
+PYTHON_CONTAINER_REQUIREMENTS = ["fastapi==0.104.1", "uvicorn==0.24.0"]
+# Top-level standard library modules of the python:3.9-slim image (which ships without the test suite and Tk).
+# Pinned rather than read from the gateway's interpreter, whose standard library differs.
+PYTHON_STDLIB_MODULES = frozenset({
+    "__future__", "_abc", "_aix_support", "_ast", "_asyncio", "_bisect", "_blake2", "_bootlocale",
+    "_bootsubprocess", "_bz2", "_codecs", "_codecs_cn", "_codecs_hk", "_codecs_iso2022", "_codecs_jp", "_codecs_kr",
+    "_codecs_tw", "_collections", "_collections_abc", "_compat_pickle", "_compression", "_contextvars", "_crypt",
+    "_csv", "_ctypes", "_curses", "_curses_panel", "_datetime", "_dbm", "_decimal", "_elementtree", "_functools",
+    "_gdbm", "_hashlib", "_heapq", "_imp", "_io", "_json", "_locale", "_lsprof", "_lzma", "_markupbase", "_md5",
+    "_multibytecodec", "_multiprocessing", "_opcode", "_operator", "_osx_support", "_peg_parser", "_pickle",
+    "_posixshmem", "_posixsubprocess", "_py_abc", "_pydecimal", "_pyio", "_queue", "_random", "_sha1", "_sha256",
+    "_sha3", "_sha512", "_signal", "_sitebuiltins", "_socket", "_sqlite3", "_sre", "_ssl", "_stat", "_statistics",
+    "_string", "_strptime", "_struct", "_symtable", "_thread", "_threading_local", "_tracemalloc", "_uuid",
+    "_warnings", "_weakref", "_weakrefset", "_xxsubinterpreters", "_zoneinfo", "abc", "aifc", "antigravity",
+    "argparse", "array", "ast", "asynchat", "asyncio", "asyncore", "atexit", "audioop", "base64", "bdb", "binascii",
+    "binhex", "bisect", "builtins", "bz2", "cProfile", "calendar", "cgi", "cgitb", "chunk", "cmath", "cmd", "code",
+    "codecs", "codeop", "collections", "colorsys", "compileall", "concurrent", "configparser", "contextlib",
+    "contextvars", "copy", "copyreg", "crypt", "csv", "ctypes", "curses", "dataclasses", "datetime", "dbm",
+    "decimal", "difflib", "dis", "distutils", "doctest", "email", "encodings", "ensurepip", "enum", "errno",
+    "faulthandler", "fcntl", "filecmp", "fileinput", "fnmatch", "formatter", "fractions", "ftplib", "functools",
+    "gc", "genericpath", "getopt", "getpass", "gettext", "glob", "graphlib", "grp", "gzip", "hashlib", "heapq",
+    "hmac", "html", "http", "imaplib", "imghdr", "imp", "importlib", "inspect", "io", "ipaddress", "itertools",
+    "json", "keyword", "lib2to3", "linecache", "locale", "logging", "lzma", "mailbox", "mailcap", "marshal", "math",
+    "mimetypes", "mmap", "modulefinder", "multiprocessing", "netrc", "nis", "nntplib", "ntpath", "nturl2path",
+    "numbers", "opcode", "operator", "optparse", "os", "ossaudiodev", "parser", "pathlib", "pdb", "pickle",
+    "pickletools", "pipes", "pkgutil", "platform", "plistlib", "poplib", "posix", "posixpath", "pprint", "profile",
+    "pstats", "pty", "pwd", "py_compile", "pyclbr", "pydoc", "pydoc_data", "pyexpat", "queue", "quopri", "random",
+    "re", "readline", "reprlib", "resource", "rlcompleter", "runpy", "sched", "secrets", "select", "selectors",
+    "shelve", "shlex", "shutil", "signal", "site", "smtpd", "smtplib", "sndhdr", "socket", "socketserver", "spwd",
+    "sqlite3", "sre_compile", "sre_constants", "sre_parse", "ssl", "stat", "statistics", "string", "stringprep",
+    "struct", "subprocess", "sunau", "symbol", "symtable", "sys", "sysconfig", "syslog", "tabnanny", "tarfile",
+    "telnetlib", "tempfile", "termios", "textwrap", "this", "threading", "time", "timeit", "token", "tokenize",
+    "trace", "traceback", "tracemalloc", "tty", "types", "typing", "unicodedata", "unittest", "urllib", "uu",
+    "uuid", "venv", "warnings", "wave", "weakref", "webbrowser", "wsgiref", "xdrlib", "xml", "xmlrpc", "zipapp",
+    "zipfile", "zipimport", "zlib", "zoneinfo"
+})
+# Top-level modules importable in the python image: the requirements and what they pull in
+PYTHON_CONTAINER_MODULES = {"fastapi", "uvicorn", "starlette", "pydantic", "pydantic_core", "annotated_types",
+                            "typing_extensions", "anyio", "sniffio", "idna", "exceptiongroup", "click", "h11"}
+JAVASCRIPT_PACKAGE = {"name": "api", "version": "1.0.0", "main": "app.js", "dependencies": {"express": "^4.18.2"}}
+NODE_BUILTIN_MODULES = {"assert", "buffer", "crypto", "events", "fs", "http", "https", "os", "path",
+                        "querystring", "stream", "string_decoder", "timers", "url", "util", "zlib"}
+CONTAINER_PORTS = {"python": 8000, "javascript": 3000}
+
+class CodeValidator:
+    """Static checks on generated code before a container image is built.
+
+    Python is parsed with the grammar of the image's interpreter (3.9) and
+    compiled, every import must resolve to the image's standard library or a
+    module installed in it (unless a try/except ImportError guards it, as for
+    optional dependencies), and a module-level ``app`` must stay a FastAPI
+    application since uvicorn serves ``app:app``. JavaScript is checked with
+    ``node --check`` (or a bracket balance scan when node is missing), its
+    requires against the image's package.json, and it must call listen().
+
+    Verdicts are cached by a hash of the language and code, in-process and in
+    shared state for CODE_VALIDATION_CACHE_TTL_SECONDS, so redeploying the
+    same code skips validation and bad code fails before Docker is involved.
+    """
+
+    VERSION = 2  # Bump when the checks change so cached verdicts are recomputed
+    PYTHON_VERSION = (3, 9)
+    IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+    REQUIRE = re.compile(r"""\brequire\(\s*['"]([^'"]+)['"]\s*\)|\bimport\s[^'"]*?\bfrom\s*['"]([^'"]+)['"]""")
+    BRACKETS = {")": "(", "]": "[", "}": "{"}
+
+    def __init__(self):
+        self.cache = OrderedDict()
+        self.max_entries = int(os.getenv("CODE_VALIDATION_CACHE_SIZE", "1024"))
+        self.cache_ttl = int(os.getenv("CODE_VALIDATION_CACHE_TTL_SECONDS", "86400"))
+        self.python_modules = PYTHON_STDLIB_MODULES | PYTHON_CONTAINER_MODULES
+        self.javascript_modules = NODE_BUILTIN_MODULES | set(JAVASCRIPT_PACKAGE["dependencies"])
+
+    @classmethod
+    def code_hash(cls, language: str, code: str) -> str:
+        return hashlib.sha256(f"{cls.VERSION}:{language}\0{code}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def error(line: Optional[int], message: str) -> dict:
+        return {"line": line, "message": message}
+
+    @classmethod
+    def _catches_import_errors(cls, handler: ast.ExceptHandler) -> bool:
+        types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+        return any(kind is None or isinstance(kind, ast.Name) and kind.id in cls.IMPORT_ERRORS for kind in types)
+
+    def check_python(self, code: str) -> List[dict]:
+        try:
+            tree = ast.parse(code, filename="app.py", feature_version=self.PYTHON_VERSION)
+            compile(tree, "app.py", "exec", dont_inherit=True)
+        except SyntaxError as e:
+            return [self.error(e.lineno, f"SyntaxError: {e.msg}")]
+        except ValueError as e:
+            return [self.error(None, str(e))]
+
+        # Imports in the body of a try that handles ImportError may fail: the code has a fallback
+        guarded = {id(node) for statement in ast.walk(tree)
+                   if isinstance(statement, ast.Try) and any(map(self._catches_import_errors, statement.handlers))
+                   for guarded_statement in statement.body for node in ast.walk(guarded_statement)}
+        errors, reported = [], set()
+        for node in ast.walk(tree):
+            if id(node) in guarded:
+                continue
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split(".")[0]
+                if module not in self.python_modules and module not in reported:
+                    reported.add(module)
+                    errors.append(self.error(node.lineno, f"Module '{module}' is not installed in the container "
+                                                          f"(requirements: {', '.join(PYTHON_CONTAINER_REQUIREMENTS)})"))
+
+        # The wrapper defines app = FastAPI(); the code may rebind it, but only to another FastAPI()
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.name == "app":
+                errors.append(self.error(node.lineno, "'app' must be the FastAPI application served by uvicorn"))
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                if not any(isinstance(target, ast.Name) and target.id == "app" for target in targets):
+                    continue
+                call = node.value.func if isinstance(node.value, ast.Call) else None
+                name = call.id if isinstance(call, ast.Name) else call.attr if isinstance(call, ast.Attribute) else None
+                if name != "FastAPI":
+                    errors.append(self.error(node.lineno, "'app' must be assigned a FastAPI() application"))
+        return errors
+
+    def _check_brackets(self, code: str) -> List[dict]:
+        """Bracket balance outside strings and comments, for hosts without node"""
+        stack, index, line = [], 0, 1
+        while index < len(code):
+            char = code[index]
+            if char == "\n":
+                line += 1
+            elif code.startswith("//", index):
+                index = code.find("\n", index) - 1 if "\n" in code[index:] else len(code)
+            elif code.startswith("/*", index):
+                end = code.find("*/", index + 2)
+                end = len(code) if end < 0 else end + 1
+                line += code.count("\n", index, end)
+                index = end
+            elif char in "'\"`":
+                end = index + 1
+                while end < len(code) and code[end] != char and (char == "`" or code[end] != "\n"):
+                    end += 2 if code[end] == "\\" else 1
+                if end >= len(code) or code[end] != char:
+                    return [self.error(line, "Unterminated string literal")]
+                line += code.count("\n", index, end)
+                index = end
+            elif char in "([{":
+                stack.append((char, line))
+            elif char in self.BRACKETS:
+                if not stack or stack[-1][0] != self.BRACKETS[char]:
+                    return [self.error(line, f"SyntaxError: Unexpected token '{char}'")]
+                stack.pop()
+            index += 1
+        if stack:
+            return [self.error(stack[-1][1], f"SyntaxError: '{stack[-1][0]}' is never closed")]
+        return []
+
+    def check_javascript(self, code: str) -> List[dict]:
+        node = shutil.which("node")
+        if node:
+            with tempfile.NamedTemporaryFile("w", suffix=".js") as source:
+                source.write(code)
+                source.flush()
+                result = subprocess.run([node, "--check", source.name], capture_output=True, text=True, timeout=10)
+            if result.returncode:
+                location = re.search(rf"{re.escape(source.name)}:(\d+)", result.stderr)
+                message = next((text for text in result.stderr.splitlines() if "Error" in text), "SyntaxError")
+                return [self.error(int(location[1]) if location else None, message.strip())]
+        else:
+            errors = self._check_brackets(code)
+            if errors:
+                return errors
+
+        errors, reported = [], set()
+        for match in self.REQUIRE.finditer(code):
+            name = match[1] or match[2]
+            if name.startswith("."):
+                errors.append(self.error(code.count("\n", 0, match.start()) + 1,
+                                         f"Relative module '{name}' does not exist in the container"))
+                continue
+            module = name.removeprefix("node:").split("/")[0]
+            if module not in self.javascript_modules and module not in reported:
+                reported.add(module)
+                errors.append(self.error(code.count("\n", 0, match.start()) + 1,
+                                         f"Module '{module}' is not installed in the container "
+                                         f"(dependencies: {', '.join(JAVASCRIPT_PACKAGE['dependencies'])})"))
+        if ".listen(" not in code:
+            errors.append(self.error(None, f"The app must call listen() on port {CONTAINER_PORTS['javascript']}"))
+        return errors
+
+    CHECKERS = {"python": check_python, "javascript": check_javascript}
+
+    def validate(self, language: str, code: str) -> dict:
+        """Check code for deployment; blocking (node may run), call from a thread"""
+        started = time.perf_counter()
+        digest = self.code_hash(language, code)
+        result = self.cache.get(digest)
+        cached = result is not None
+        if cached:
+            self.cache.move_to_end(digest)
+        else:
+            result = shared_state.get_json(f"validation:{digest}")
+            cached = result is not None
+            if not cached:
+                checker = self.CHECKERS.get(language)
+                errors = (checker(self, code) if checker else
+                          [self.error(None, f"Deployment is not supported for language '{language}'")])
+                result = {"valid": not errors, "errors": errors}
+                shared_state.set_json(f"validation:{digest}", result, ttl=self.cache_ttl)
+            self.cache[digest] = result
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+        elapsed = time.perf_counter() - started
+        metrics.inc("apiengine_code_validations_total", language, "valid" if result["valid"] else "invalid",
+                    "hit" if cached else "miss")
+        metrics.observe("apiengine_code_validation_seconds", elapsed, language)
+        return {**result, "language": language, "code_hash": digest, "cached": cached,
+                "elapsed_ms": round(elapsed * 1000, 3)}
+
+    async def require_valid(self, language: str, code: str) -> dict:
+        """Validation result, or a 422 listing the errors"""
+        result = await asyncio.to_thread(self.validate, language, code)
+        if not result["valid"]:
+            raise HTTPException(status_code=422, detail={"message": "Code validation failed", **result})
+        return result
+
+code_validator = CodeValidator()
+metrics.counter("apiengine_code_validations_total", "Pre-deploy code validations",
+                ("language", "result", "cache"))
+metrics.histogram("apiengine_code_validation_seconds", "Pre-deploy code validation latency", ("language",),
+                  buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+async def deploy_api_container(api_id: str, language: str, code: str, endpoint: str, version: int = 1,
+                               profile: Optional[str] = None):
+    """Build the image for one version of an API and start its container (or worker process)"""
+    # Code that could never start fails here, before an image is built
+    await code_validator.require_valid(language, code)
+    if worker_runtime.active:
+        deploy_start = time.perf_counter()
+        await asyncio.to_thread(worker_runtime.prepare, api_id, version, language, code)
+        container_id, port = await asyncio.to_thread(run_api_container, api_id, version, language, profile)
+        metrics.observe("apiengine_deploy_duration_seconds", time.perf_counter() - deploy_start, language, "success")
+        return container_id, port
+    if not docker_client:
+        raise HTTPException(status_code=500, detail="Docker not available")
+    
+    deploy_start = time.perf_counter()
+    try:
+        # Create temporary directory for build
+        build_dir = Path(f"/tmp/api_{api_id}_v{version}")
+        build_dir.mkdir(exist_ok=True)
+        
+        # Create application files
+        app_content = create_app_file(language, code)
+        dockerfile_content = create_dockerfile(language, code, endpoint)
+        
+        # Write files
+        (build_dir / "Dockerfile").write_text(dockerfile_content)
+        
+        if language == "python":
+            (build_dir / "app.py").write_text(app_content)
+            (build_dir / "requirements.txt").write_text("\n".join(PYTHON_CONTAINER_REQUIREMENTS))
+        elif language == "javascript":
+            (build_dir / "app.js").write_text(app_content)
+            (build_dir / "package.json").write_text(json.dumps(JAVASCRIPT_PACKAGE, indent=2))
+        
+        # Build Docker image off the event loop, so the live version keeps serving meanwhile
+        image_tag = container_image(api_id, version)
+        await asyncio.to_thread(docker_client.images.build, path=str(build_dir), tag=image_tag)
+        
+        container_id, port = await asyncio.to_thread(run_api_container, api_id, version, language, profile)
+        
+        metrics.observe("apiengine_deploy_duration_seconds", time.perf_counter() - deploy_start, language, "success")
+        return container_id, port
+        
+    except Exception as e:
+        metrics.observe("apiengine_deploy_duration_seconds", time.perf_counter() - deploy_start, language, "failure")
+        logger.error(f"Deployment error: {e}")
+        raise HTTPException(status_code=500, detail=f"Deployment failed: {str(e)}")
+
+# Per-API resource profiles (api_settings.resource_profile), enforced as Docker cgroup limits
+RESOURCE_PROFILES = {
+    "micro": {"cpus": 0.25, "memory_mb": 128, "pids": 64},
+    "small": {"cpus": 0.5, "memory_mb": 256, "pids": 128},
+    "medium": {"cpus": 1.0, "memory_mb": 512, "pids": 256},
+    "large": {"cpus": 2.0, "memory_mb": 1024, "pids": 512},
+}
+
+def container_limits(profile: Optional[str]) -> dict:
+    """docker run options capping CPU, memory (no swap) and process count for a profile"""
+    limits = RESOURCE_PROFILES.get(profile or "small", RESOURCE_PROFILES["small"])
+    memory = f"{limits['memory_mb']}m"
+    return {"nano_cpus": int(limits["cpus"] * 1e9), "mem_limit": memory, "memswap_limit": memory,
+            "pids_limit": limits["pids"]}
+
+def replica_bounds(settings: dict) -> tuple:
+    """(min, max) containers for an API, clamped to 1..AUTOSCALE_MAX_REPLICAS"""
+    cap = int(os.getenv("AUTOSCALE_MAX_REPLICAS", "10"))
+    low = min(max(settings.get('min_replicas') or 1, 1), cap)
+    return low, min(max(settings.get('max_replicas') or 1, low), cap)
+
+def parse_ports(replica_ports: Optional[str]) -> List[int]:
+    return [int(port) for port in replica_ports.split(",")] if replica_ports else []
+
+def container_image(api_id: str, version: int) -> str:
+    return f"api_{api_id}:v{version}"
+
+def run_api_container(api_id: str, version: int, language: str, profile: Optional[str] = None,
+                      replica: Optional[str] = None):
+    """Start a container from a version's image (blocking); returns (container id, host port)"""
+    if worker_runtime.active:
+        return worker_runtime.start(api_id, version, language, profile, replica)
+    container_port = f"{CONTAINER_PORTS[language]}/tcp"
+    container = docker_client.containers.run(
+        container_image(api_id, version),
+        detach=True,
+        ports={container_port: None},
+        name=f"api_{api_id}_v{version}" + (f"_r{replica}" if replica else ""),
+        **container_limits(profile)
+    )
+    
+    # Get assigned port
+    container.reload()
+    return container.id, int(container.attrs['NetworkSettings']['Ports'][container_port][0]['HostPort'])
+
+def stop_api_container(container_id: str):
+    """Stop and remove a container (blocking); missing containers are ignored"""
+    if container_id and container_id.startswith(WorkerRuntime.PREFIX):
+        return worker_runtime.stop(container_id)
+    if not docker_client or not container_id:
+        return
+    try:
+        container = docker_client.containers.get(container_id)
+        container.stop()
+        container.remove()
+    except Exception as e:
+        logger.warning(f"Could not remove container {container_id}: {e}")
+
+# Worker process runtime
+WORKER_BOOTSTRAP = """
+import socket, sys, types
+import uvicorn
+module = sys.modules["app"] = types.ModuleType("app")
+module.__file__ = "app.py"
+exec(compile(sys.stdin.read(), "app.py", "exec"), module.__dict__)
+listener = socket.socket(fileno=int(sys.argv[1]))
+uvicorn.Server(uvicorn.Config(module.app, log_level="warning", access_log=False)).run(sockets=[listener])
+"""
+
+class WorkerRuntime:
+    """Runs Python APIs as supervised local processes instead of Docker containers.
+
+    Deploying writes the app file and starts one uvicorn process per replica;
+    there is no image build. The gateway binds a loopback port for each
+    process and hands the listening socket over, so routing, readiness
+    checks, draining, blue/green and autoscaling treat a worker exactly like
+    a container. Processes keep serving across gateway restarts and are
+    tracked in data/runtime/<hostname>/workers/ so any gateway worker can
+    supervise or stop them.
+
+    Workers run as WORKER_RUNTIME_USER (nobody by default), which needs a
+    gateway started as root. They get their app source on stdin, start in /,
+    and inherit only PATH, LANG, PYTHONPATH and TZ; data/ is made private to
+    the gateway's user, so a worker cannot read the JWT secret or the
+    control-plane database.
+
+    One gateway worker at a time supervises (shared lock) every
+    WORKER_RUNTIME_SUPERVISE_SECONDS: a process that exited, or whose
+    resident memory is above its resource profile, is restarted on the same
+    port, with exponential backoff while it keeps crashing. CPU and process
+    limits need Docker; workers only get the memory cap.
+
+    API_RUNTIME=worker opts in; docker and auto (the default) use Docker.
+    All workers of a host share one user, so they are isolated from each
+    other only as processes are; keep Docker for untrusted code.
+    """
+
+    PREFIX = "worker:"
+    STABLE_SECONDS = 60  # A process that lived this long starts its backoff over
+
+    def __init__(self):
+        self.mode = os.getenv("API_RUNTIME", "auto")
+        self.user = os.getenv("WORKER_RUNTIME_USER", "nobody")
+        self.supervise_interval = float(os.getenv("WORKER_RUNTIME_SUPERVISE_SECONDS", "2"))
+        self.directory = Path(os.getenv("WORKER_RUNTIME_DIR", "data/runtime")) / socket.gethostname()
+        self.processes = {}  # pid -> Popen, for the processes this gateway worker started
+
+    @property
+    def active(self) -> bool:
+        return self.mode == "worker"
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("worker_runtime")
+
+    def app_dir(self, api_id: str, version: int) -> Path:
+        return self.directory / "apps" / api_id / f"v{version}"
+
+    def _entry_path(self, container_id: str) -> Path:
+        return self.directory / "workers" / f"{container_id[len(self.PREFIX):].replace(':', '_')}.json"
+
+    def _save(self, entry: dict):
+        path = self._entry_path(entry['container_id'])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(entry))
+        os.replace(tmp_path, path)
+
+    def entries(self) -> List[dict]:
+        entries = []
+        for path in sorted((self.directory / "workers").glob("*.json")):
+            try:
+                entries.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue  # Being replaced or removed
+        return entries
+
+    def prepare(self, api_id: str, version: int, language: str, code: str):
+        """Write a version's app file (the worker counterpart of building an image)"""
+        if language != "python":
+            raise HTTPException(status_code=400, detail=f"The worker runtime runs Python APIs only; "
+                                                        f"{language} APIs need a host with Docker")
+        app_dir = self.app_dir(api_id, version)
+        app_dir.mkdir(parents=True, exist_ok=True)
+        (app_dir / "app.py").write_text(create_app_file(language, code))
+
+    @staticmethod
+    def _start_ticks(pid: int) -> Optional[str]:
+        """Kernel start time of a live process (guards against pid reuse), None if gone or a zombie"""
+        try:
+            fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        return None if fields[0] == "Z" else fields[19]
+
+    @staticmethod
+    def rss_mb(pid: int) -> float:
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return 0.0
+
+    def alive(self, entry: dict) -> bool:
+        process = self.processes.get(entry['pid'])
+        if process is not None and process.poll() is not None:
+            del self.processes[entry['pid']]  # Reaped
+            return False
+        return self._start_ticks(entry['pid']) == entry['start_ticks']
+
+    def credentials(self) -> dict:
+        """Popen arguments that drop a worker to WORKER_RUNTIME_USER"""
+        try:
+            account = pwd.getpwnam(self.user)
+        except KeyError:
+            raise HTTPException(status_code=503, detail=f"WORKER_RUNTIME_USER {self.user!r} does not exist")
+        if account.pw_uid == os.geteuid():
+            return {}
+        if os.geteuid() != 0:
+            raise HTTPException(status_code=503, detail=f"The gateway must run as root to start workers "
+                                                        f"as {self.user!r}")
+        Path("data").chmod(0o700)  # Workers must not read the secrets and databases in here
+        return {"user": account.pw_uid, "group": account.pw_gid, "extra_groups": []}
+
+    def _spawn(self, entry: dict, listener: socket.socket):
+        app_dir = Path(entry['app_dir'])
+        source = (app_dir / "app.py").read_bytes()
+        environment = {name: os.environ[name] for name in ("PATH", "LANG", "PYTHONPATH", "TZ") if name in os.environ}
+        with open(app_dir / "worker.log", "ab") as log:
+            process = subprocess.Popen(
+                [sys.executable, "-c", WORKER_BOOTSTRAP, str(listener.fileno())],
+                pass_fds=(listener.fileno(),), cwd="/", env=environment, stdin=subprocess.PIPE,
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True, **self.credentials())
+        self.processes[process.pid] = process
+        try:
+            with process.stdin:
+                process.stdin.write(source)
+        except BrokenPipeError:
+            pass  # Died on startup; supervision restarts it
+        # Read start_ticks after the fork; the process is ours until it has been recorded
+        entry.update(pid=process.pid, start_ticks=self._start_ticks(process.pid), started_at=time.time())
+
+    def start(self, api_id: str, version: int, language: str, profile: Optional[str] = None,
+              replica: Optional[str] = None):
+        """Start a worker process for a prepared version (blocking); returns (container id, port)"""
+        if language != "python" or not (self.app_dir(api_id, version) / "app.py").exists():
+            raise HTTPException(status_code=400, detail=f"Version {version} has no Python app to run as a worker")
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            entry = {"container_id": f"{self.PREFIX}{api_id}:v{version}:{replica or 'main'}:{secrets.token_hex(3)}",
+                     "api_id": api_id, "version": version, "port": listener.getsockname()[1],
+                     "app_dir": str(self.app_dir(api_id, version)), "profile": profile or "small", "restarts": 0}
+            self._spawn(entry, listener)
+        self._save(entry)
+        metrics.inc("apiengine_worker_starts_total", "deploy")
+        return entry['container_id'], entry['port']
+
+    def stop(self, container_id: str, timeout: float = 5.0):
+        """Stop a worker process (blocking); forgetting it first keeps the supervisor from restarting it"""
+        path = self._entry_path(container_id)
+        try:
+            entry = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return
+        path.unlink(missing_ok=True)
+        if not self.alive(entry):
+            return
+        os.kill(entry['pid'], signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while self.alive(entry) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.alive(entry):
+            os.kill(entry['pid'], signal.SIGKILL)
+            while self.alive(entry):
+                time.sleep(0.01)
+
+    def supervise_once(self) -> dict:
+        """Restart exited or oversized worker processes (blocking)"""
+        restarted = []
+        now = time.time()
+        for entry in self.entries():
+            cap = RESOURCE_PROFILES.get(entry['profile'], RESOURCE_PROFILES["small"])["memory_mb"]
+            reason = None
+            if not self.alive(entry):
+                reason = entry.get('stopped_for', "exited")
+            elif self.rss_mb(entry['pid']) > cap:
+                reason = "memory"
+                os.kill(entry['pid'], signal.SIGKILL)
+                while self.alive(entry):
+                    time.sleep(0.01)
+            if reason is None:
+                continue
+            if now - entry['started_at'] >= self.STABLE_SECONDS:
+                entry['restarts'] = 0
+            if now < entry.get('retry_at', 0):
+                if reason != entry.get('stopped_for') and self._entry_path(entry['container_id']).exists():
+                    entry['stopped_for'] = reason
+                    self._save(entry)
+                continue  # Crash-looping: wait out the backoff
+            try:
+                # Same port, so the route and the autoscaler's bookkeeping stay valid
+                with socket.create_server(("127.0.0.1", entry['port'])) as listener:
+                    self._spawn(entry, listener)
+            except OSError as e:
+                logger.error(f"Could not restart worker {entry['container_id']}: {e}")
+                continue
+            entry.pop('stopped_for', None)
+            entry['restarts'] += 1
+            entry['retry_at'] = now + min(2 ** entry['restarts'], 60)
+            if self._entry_path(entry['container_id']).exists():
+                self._save(entry)
+            else:  # Stopped while we restarted it
+                os.kill(entry['pid'], signal.SIGKILL)
+                continue
+            metrics.inc("apiengine_worker_starts_total", reason)
+            logger.warning(f"Restarted worker {entry['container_id']} ({reason}, restart {entry['restarts']})")
+            restarted.append({"container_id": entry['container_id'], "reason": reason, "restarts": entry['restarts']})
+        return {"restarted": restarted}
+
+    def report(self) -> List[dict]:
+        return [{**{key: entry[key] for key in ("container_id", "api_id", "version", "port", "pid", "profile",
+                                                "restarts")},
+                 "alive": self.alive(entry), "rss_mb": round(self.rss_mb(entry['pid']), 1),
+                 "memory_cap_mb": RESOURCE_PROFILES.get(entry['profile'], RESOURCE_PROFILES["small"])["memory_mb"]}
+                for entry in self.entries()]
+
+    async def run_forever(self):
+        """Supervision loop started with the application"""
+        while True:
+            await asyncio.sleep(self.supervise_interval)
+            for pid, process in list(self.processes.items()):
+                if process.poll() is not None:
+                    del self.processes[pid]  # Reap children stopped by other gateway workers
+            owner = secrets.token_urlsafe(8)
+            try:
+                if not await asyncio.to_thread(shared_state.acquire_lock, "worker_runtime", 30, owner):
+                    continue  # Another gateway worker supervises this pass
+                try:
+                    await asyncio.to_thread(self.supervise_once)
+                finally:
+                    await asyncio.to_thread(shared_state.release_lock, "worker_runtime", owner)
+            except Exception as e:
+                logger.error(f"Worker supervision failed: {e}")
+
+worker_runtime = WorkerRuntime()
+metrics.counter("apiengine_worker_starts_total", "Worker runtime process starts by reason (deploy, exited, memory)",
+                ("reason",))
+
+# Blue/green deployments
+class DeploymentManager:
+    """Versioned deployments switched without a gap.
+
+    Every deploy starts version N+1 in its own container next to the live
+    one and waits until it answers HTTP (DEPLOY_READY_TIMEOUT_SECONDS). The
+    route (apis.container_id/port, read by the gateway on every request) is
+    then switched to it in one transaction, so no request ever finds the API
+    without a container. The old version drains in the background: it gets
+    no new requests and is retired once no gateway connection to it is open
+    (counted from /proc/net/tcp, so every worker on the host is seen, bounded
+    by DEPLOY_DRAIN_TIMEOUT_SECONDS).
+
+    Retired versions stay running as warm standbys (DEPLOY_STANDBY_VERSIONS
+    of them), so rolling back is only another route switch. Older versions
+    are stopped and removed; their images are kept, so rolling back to them
+    starts the container again first.
+
+    A new version starts with as many replicas as the live one runs (at
+    least min_replicas); a standby keeps only its first container.
+    """
+
+    TCP_TABLES = ("/proc/net/tcp", "/proc/net/tcp6")
+    TCP_ESTABLISHED = "01"
+
+    def __init__(self):
+        self.ready_timeout = float(os.getenv("DEPLOY_READY_TIMEOUT_SECONDS", "60"))
+        self.drain_timeout = float(os.getenv("DEPLOY_DRAIN_TIMEOUT_SECONDS", "30"))
+        self.standby_versions = int(os.getenv("DEPLOY_STANDBY_VERSIONS", "1"))
+        # A request that read the old route just before the switch connects within this
+        self.drain_settle = 1.0
+        self.poll_interval = 0.2
+        self.turns = itertools.count()
+
+    def upstream_port(self, api: dict) -> int:
+        """Round-robin over the containers of the live deployment"""
+        ports = parse_ports(api.get('replica_ports'))
+        if not ports:
+            return api['port']
+        ports.insert(0, api['port'])
+        return ports[next(self.turns) % len(ports)]
+
+    async def wait_ready(self, port: int):
+        """Wait until a container answers HTTP on port (any status counts as up)"""
+        import httpx
+        deadline = time.monotonic() + self.ready_timeout
+        async with httpx.AsyncClient(timeout=2.0) as client:
+            while True:
+                try:
+                    await client.get(f"http://localhost:{port}/")
+                    return
+                except httpx.TransportError:
+                    if time.monotonic() >= deadline:
+                        raise HTTPException(status_code=504, detail=f"New version not ready after {self.ready_timeout:g}s")
+                    await asyncio.sleep(self.poll_interval)
+
+    @classmethod
+    def open_connections(cls, port: int) -> Optional[int]:
+        """Established TCP connections from this host to a local port, None where /proc is unavailable"""
+        count, found = 0, False
+        for table in cls.TCP_TABLES:
+            try:
+                with open(table) as source:
+                    next(source)
+                    for line in source:
+                        fields = line.split()
+                        if fields[3] == cls.TCP_ESTABLISHED and int(fields[2].rsplit(":", 1)[1], 16) == port:
+                            count += 1
+                found = True
+            except OSError:
+                continue
+        return count if found else None
+
+    async def drain(self, *ports: Optional[int]) -> float:
+        """Wait for in-flight requests to retired ports to finish; returns the seconds waited"""
+        started = time.monotonic()
+        await asyncio.sleep(self.drain_settle)
+        ports = [port for port in ports if port]
+        while ports and time.monotonic() - started < self.drain_timeout:
+            connections = [self.open_connections(port) for port in ports]
+            if not any(connections):
+                break
+            await asyncio.sleep(self.poll_interval if None not in connections else 1.0)
+        waited = time.monotonic() - started
+        metrics.observe("apiengine_deploy_drain_seconds", waited)
+        return waited
+
+    async def retire(self, api_id: str, previous: Optional[dict]):
+        """Drain the version that was just replaced, keep it as a standby and prune older ones"""
+        if not previous:
+            return
+        replicas = await control_plane.list_replicas(previous['id']) if previous['id'] else []
+        await self.drain(previous['port'], *(replica['port'] for replica in replicas))
+        # Deploys and rollbacks hold the same lock, so the version cannot be re-activated under us
+        owner = secrets.token_urlsafe(8)
+        while not await asyncio.to_thread(shared_state.acquire_lock, f"deploy:{api_id}", 600, owner):
+            await asyncio.sleep(self.poll_interval)
+        try:
+            if previous['id'] is None:  # A container from before versioned deployments
+                await asyncio.to_thread(stop_api_container, previous['container_id'])
+            else:
+                current = next((row for row in await control_plane.list_deployments(api_id)
+                                if row['id'] == previous['id']), None)
+                if not current or current['status'] != 'draining' or current['activated_at'] != previous['activated_at']:
+                    return  # Rolled back to while it drained; it is live (or being retired again)
+                for replica in replicas:
+                    await control_plane.remove_replica(replica)
+                    await asyncio.to_thread(stop_api_container, replica['container_id'])
+                await control_plane.update_deployment(previous['id'], status='standby')
+            standbys = [row for row in await control_plane.list_deployments(api_id) if row['status'] == 'standby']
+            standbys.sort(key=lambda row: row['activated_at'] or datetime.min, reverse=True)
+            for row in standbys[self.standby_versions:]:
+                await asyncio.to_thread(stop_api_container, row['container_id'])
+                await control_plane.update_deployment(row['id'], status='stopped', stopped_at=datetime.utcnow())
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, f"deploy:{api_id}", owner)
+
+    async def start_replica(self, api: dict, deployment: dict):
+        """Start one more container of a deployment and add it to the route once it answers"""
+        container_id, port = await asyncio.to_thread(run_api_container, api['id'], deployment['version'],
+                                                     api['language'], api.get('resource_profile'), secrets.token_hex(3))
+        try:
+            await self.wait_ready(port)
+        except Exception:
+            await asyncio.to_thread(stop_api_container, container_id)
+            raise
+        await control_plane.add_replica(api['id'], deployment['id'], container_id, port)
+
+    async def stop_replica(self, replica: dict):
+        """Take a replica out of the route, let it drain, then stop it"""
+        await control_plane.remove_replica(replica)
+        await self.drain(replica['port'])
+        await asyncio.to_thread(stop_api_container, replica['container_id'])
+
+    async def deploy(self, api: dict) -> dict:
+        """Start a new version next to the live one and switch to it once it is ready"""
+        deployment = await control_plane.create_deployment(api['id'], CodeValidator.code_hash(api['language'], api['code']))
+        low, high = replica_bounds(api)
+        running = 1 + len(parse_ports(api.get('replica_ports'))) if api.get('status') == 'deployed' else 1
+        try:
+            container_id, port = await deploy_api_container(api['id'], api['language'], api['code'], api['endpoint'],
+                                                            deployment['version'], api.get('resource_profile'))
+            deployment.update(container_id=container_id, port=port)
+            await control_plane.update_deployment(deployment['id'], container_id=container_id, port=port)
+            await self.wait_ready(port)
+            for _ in range(min(max(low, running), high) - 1):
+                await self.start_replica(api, deployment)
+        except Exception as e:
+            metrics.inc("apiengine_deployments_total", "failed")
+            await webhooks.enqueue(api, "deploy.failed", {"version": deployment['version'],
+                                                          "error": getattr(e, "detail", None) or str(e)})
+            for replica in await control_plane.list_replicas(deployment['id']):
+                await control_plane.remove_replica(replica)
+                await asyncio.to_thread(stop_api_container, replica['container_id'])
+            await asyncio.to_thread(stop_api_container, deployment['container_id'])
+            await control_plane.update_deployment(deployment['id'], status='failed', stopped_at=datetime.utcnow())
+            raise
+        metrics.inc("apiengine_deployments_total", "deployed")
+        previous = await control_plane.activate_deployment(api['id'], deployment)
+        await webhooks.enqueue(api, "deploy.succeeded", {"version": deployment['version'], "port": deployment['port'],
+                                                         "previous_version": previous['version'] if previous else None})
+        return {**deployment, "previous": previous}
+
+    async def rollback(self, api: dict, version: Optional[int] = None) -> dict:
+        """Switch back to an earlier version: the newest one replaced, unless version is given"""
+        deployments = await control_plane.list_deployments(api['id'])
+        candidates = [row for row in deployments if row['status'] in ('standby', 'draining', 'stopped')
+                      and (version is None or row['version'] == version)]
+        if not candidates:
+            raise HTTPException(status_code=404, detail="No earlier version to roll back to")
+        target = max(candidates, key=lambda row: row['activated_at'] or datetime.min)
+        warm = target['status'] != 'stopped'
+        if not warm:
+            if not docker_client and not worker_runtime.active:
+                raise HTTPException(status_code=500, detail="Docker not available")
+            container_id, port = await asyncio.to_thread(run_api_container, api['id'], target['version'],
+                                                         api['language'], api.get('resource_profile'))
+            target.update(container_id=container_id, port=port)
+            await control_plane.update_deployment(target['id'], container_id=container_id, port=port, stopped_at=None)
+            await self.wait_ready(port)
+        metrics.inc("apiengine_deployments_total", "rolled_back")
+        previous = await control_plane.activate_deployment(api['id'], target)
+        await webhooks.enqueue(api, "deploy.rolled_back", {"version": target['version'], "warm": warm,
+                                                           "previous_version": previous['version'] if previous else None})
+        return {**target, "warm": warm, "previous": previous}
+
+deployment_manager = DeploymentManager()
+metrics.counter("apiengine_deployments_total", "Deployments by outcome (deployed, failed, rolled_back)", ("outcome",))
+metrics.histogram("apiengine_deploy_drain_seconds", "Time a replaced version took to drain",
+                  buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0))
+
+# Autoscaling
+class Autoscaler:
+    """Adds and removes replicas of deployed APIs from the gateway's own signals.
+
+    Every AUTOSCALE_INTERVAL_SECONDS one worker (shared lock) looks at the
+    APIs whose settings allow more than one replica (min_replicas /
+    max_replicas in api_settings). Two signals are read per API:
+
+      p95 latency  over the last interval, from the gateway's
+                   apiengine_request_duration_seconds histogram merged across
+                   the host's workers (ignored under AUTOSCALE_MIN_SAMPLES)
+      in flight    open gateway connections to the API's containers
+
+    An API is hot when p95 exceeds target_p95_ms or its replicas average more
+    than AUTOSCALE_TARGET_IN_FLIGHT requests in flight, and cold when both
+    are under AUTOSCALE_SCALE_IN_RATIO of those targets. Hysteresis: scaling
+    out takes AUTOSCALE_OUT_TICKS consecutive hot intervals, scaling in
+    AUTOSCALE_IN_TICKS cold ones, one replica at a time, and an API that was
+    just scaled is left alone for AUTOSCALE_COOLDOWN_SECONDS. The min/max
+    bounds are enforced right away. Every change is written to the
+    autoscale_decisions log together with the signals behind it.
+    """
+
+    LATENCY_METRIC = "apiengine_request_duration_seconds"
+
+    def __init__(self):
+        self.enabled = os.getenv("AUTOSCALE_ENABLED", "true").lower() == "true"
+        self.interval = int(os.getenv("AUTOSCALE_INTERVAL_SECONDS", "15"))
+        self.target_in_flight = float(os.getenv("AUTOSCALE_TARGET_IN_FLIGHT", "8"))
+        self.scale_in_ratio = float(os.getenv("AUTOSCALE_SCALE_IN_RATIO", "0.5"))
+        self.out_ticks = int(os.getenv("AUTOSCALE_OUT_TICKS", "2"))
+        self.in_ticks = int(os.getenv("AUTOSCALE_IN_TICKS", "5"))
+        self.cooldown = float(os.getenv("AUTOSCALE_COOLDOWN_SECONDS", "60"))
+        self.min_samples = int(os.getenv("AUTOSCALE_MIN_SAMPLES", "20"))
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("autoscaler")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:autoscaler")
+
+    @staticmethod
+    def quantile(counts: List[int], buckets: tuple, q: float) -> Optional[float]:
+        """Quantile of histogram bucket counts, interpolated within the bucket (as histogram_quantile)"""
+        total = sum(counts)
+        if not total:
+            return None
+        rank, seen = q * total, 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index >= len(buckets):
+                    return buckets[-1]  # +Inf bucket: all we know is the last bound
+                lower = buckets[index - 1] if index else 0.0
+                return lower + (buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return buckets[-1]
+
+    def p95_ms(self, previous: Optional[List[int]], current: Optional[List[int]]) -> tuple:
+        """(p95 in ms or None, requests) over the interval between two cumulative bucket snapshots"""
+        if not current:
+            return None, 0
+        counts = [now - before for now, before in zip(current, previous or [0] * len(current))]
+        if any(count < 0 for count in counts):  # Workers restarted: the snapshot is a fresh start
+            counts = list(current)
+        requests = sum(counts)
+        if requests < self.min_samples:
+            return None, requests
+        return self.quantile(counts, metrics.meta[self.LATENCY_METRIC][3], 0.95) * 1000, requests
+
+    def decide(self, state: dict, replicas: int, bounds: tuple, target_p95_ms: float,
+               p95_ms: Optional[float], in_flight: int, now: float) -> tuple:
+        """(action, replicas after, reason) for one API; updates its hysteresis state"""
+        low, high = bounds
+        if replicas < low:
+            return "scale_out", low, f"below min_replicas ({low})"
+        if replicas > high:
+            return "scale_in", high, f"above max_replicas ({high})"
+
+        per_replica = in_flight / replicas
+        hot = []
+        if p95_ms is not None and p95_ms > target_p95_ms:
+            hot.append(f"p95 {p95_ms:.0f}ms > {target_p95_ms:g}ms")
+        if per_replica > self.target_in_flight:
+            hot.append(f"{per_replica:.1f} in flight per replica > {self.target_in_flight:g}")
+        cold = ((p95_ms is None or p95_ms < target_p95_ms * self.scale_in_ratio)
+                and per_replica < self.target_in_flight * self.scale_in_ratio)
+        state["hot"] = state.get("hot", 0) + 1 if hot else 0
+        state["cold"] = state.get("cold", 0) + 1 if cold else 0
+
+        if now - state.get("changed_at", 0) < self.cooldown:
+            return "hold", replicas, "cooldown"
+        if hot and state["hot"] >= self.out_ticks and replicas < high:
+            return "scale_out", replicas + 1, f"{'; '.join(hot)} for {state['hot']} intervals"
+        if cold and state["cold"] >= self.in_ticks and replicas > low:
+            return "scale_in", replicas - 1, f"under {self.scale_in_ratio:g} of targets for {state['cold']} intervals"
+        return "hold", replicas, ""
+
+    async def scale(self, api: dict, replicas: int, target: int):
+        deployment = {"id": api['deployment_id'], "version": api['version']}
+        for _ in range(target - replicas):
+            await deployment_manager.start_replica(api, deployment)
+        if target < replicas:
+            # Newest replicas go first; the deployment's own container always stays
+            extra = await control_plane.list_replicas(api['deployment_id'])
+            for replica in reversed(extra[max(target - 1, 0):]):
+                await deployment_manager.stop_replica(replica)
+
+    async def evaluate(self, api: dict, histograms: dict) -> Optional[dict]:
+        """Run one decision for an API and act on it; returns the logged decision, if any"""
+        ports = [api['port']] + parse_ports(api['replica_ports'])
+        state = shared_state.get_json(f"autoscale:{api['id']}") or {}
+        current = histograms.get((api['endpoint'],))
+        p95_ms, requests = self.p95_ms(state.get("histogram"), current)
+        state["histogram"] = current
+        in_flight = sum(DeploymentManager.open_connections(port) or 0 for port in ports)
+        now = time.time()
+        action, target, reason = self.decide(state, len(ports), replica_bounds(api), api['target_p95_ms'] or 500,
+                                             p95_ms, in_flight, now)
+        decision = None
+        if action != "hold":
+            decision = {"api_id": api['id'], "action": action, "replicas_before": len(ports),
+                        "replicas_after": target, "p95_ms": round(p95_ms, 1) if p95_ms is not None else None,
+                        "in_flight": in_flight, "reason": reason}
+            try:
+                await self.scale(api, len(ports), target)
+            except Exception as e:
+                logger.error(f"Autoscaling {api['endpoint']} failed: {e}")
+                decision.update(action=f"{action}_failed", replicas_after=len(ports), reason=f"{reason}: {e}")
+            else:
+                state.update(hot=0, cold=0, changed_at=now)
+            metrics.inc("apiengine_autoscale_decisions_total", decision["action"])
+            await control_plane.record_autoscale_decision(**decision)
+        shared_state.set_json(f"autoscale:{api['id']}", state, ttl=max(self.interval * 10, int(self.cooldown) * 2))
+        return decision
+
+    async def run_once(self) -> dict:
+        started = time.time()
+        histograms = {}
+        if metrics.enabled:
+            histograms = (await asyncio.to_thread(metrics.collect))[1].get(self.LATENCY_METRIC, {})
+        decisions, skipped = [], 0
+        for api in await control_plane.autoscaled_apis():
+            # Deploys and rollbacks hold this lock too, so replicas never change under them
+            owner = secrets.token_urlsafe(8)
+            if not shared_state.acquire_lock(f"deploy:{api['id']}", 600, owner):
+                skipped += 1
+                continue
+            try:
+                decision = await self.evaluate(api, histograms)
+            finally:
+                shared_state.release_lock(f"deploy:{api['id']}", owner)
+            if decision:
+                decisions.append(decision)
+        report = {"finished_at": datetime.utcnow().isoformat(), "duration_seconds": round(time.time() - started, 3),
+                  "decisions": decisions, "skipped_busy": skipped}
+        shared_state.set_json("report:autoscaler", report)
+        return report
+
+    async def run(self) -> dict:
+        # The shared lock makes a single worker process run each pass
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "autoscaler", self.interval * 4, owner):
+            raise HTTPException(status_code=409, detail="An autoscaling pass is already running")
+        try:
+            return await self.run_once()
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "autoscaler", owner)
+
+    async def run_forever(self):
+        """Periodic autoscaling loop started with the application"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except HTTPException:
+                pass  # Another worker is already running this pass
+            except Exception as e:
+                logger.error(f"Autoscaling pass failed: {e}")
+
+autoscaler = Autoscaler()
+metrics.counter("apiengine_autoscale_decisions_total", "Autoscaler replica changes by action", ("action",))
+
+# Webhooks
+class WebhookDispatcher:
+    """Delivers API events to api_settings.webhook_url through a persistent outbox.
+
+    Events are inserted into the webhook_outbox table and delivered later by
+    a background pass. The gateway request path only schedules that insert,
+    so it never waits on the database or a webhook receiver. The events are:
+
+      deploy.succeeded / deploy.failed / deploy.rolled_back
+      rate_limit.exceeded   at most once per API per WEBHOOK_RATE_LIMIT_EVENT_SECONDS
+      error_rate.spike      when at least WEBHOOK_ERROR_RATE of an API's requests
+                            (WEBHOOK_ERROR_MIN_REQUESTS or more) fail with 5xx
+                            within WEBHOOK_ERROR_WINDOW_SECONDS, once per window
+
+    Every WEBHOOK_POLL_SECONDS one worker (shared lock) takes the due
+    deliveries and groups them by URL. Each URL gets POSTs of up to
+    WEBHOOK_BATCH_SIZE events ({"deliveries": [...]}), sent over one pooled
+    HTTP client, with destinations delivered concurrently. A failed batch is
+    retried with exponential backoff and jitter, together with the rest of
+    that destination's events. After WEBHOOK_MAX_ATTEMPTS it is dead-lettered
+    (status dead) until the owner redelivers it.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("WEBHOOKS_ENABLED", "true").lower() == "true"
+        self.interval = float(os.getenv("WEBHOOK_POLL_SECONDS", "2"))
+        self.batch_size = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+        self.pass_limit = int(os.getenv("WEBHOOK_PASS_LIMIT", "1000"))
+        self.timeout = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "10"))
+        self.max_attempts = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+        self.backoff = float(os.getenv("WEBHOOK_BACKOFF_SECONDS", "5"))
+        self.backoff_max = float(os.getenv("WEBHOOK_BACKOFF_MAX_SECONDS", "3600"))
+        self.retention_days = int(os.getenv("WEBHOOK_RETENTION_DAYS", "7"))
+        self.rate_limit_every = int(os.getenv("WEBHOOK_RATE_LIMIT_EVENT_SECONDS", "300"))
+        self.error_window = float(os.getenv("WEBHOOK_ERROR_WINDOW_SECONDS", "60"))
+        self.error_rate = float(os.getenv("WEBHOOK_ERROR_RATE", "0.5"))
+        self.error_min_requests = int(os.getenv("WEBHOOK_ERROR_MIN_REQUESTS", "20"))
+        self.windows = {}  # api_id -> [window start, requests, 5xx, alerted]
+        self.rate_limit_seen = {}  # api_id -> monotonic time this worker last reported a rejection
+        self.pending = set()  # Enqueue tasks, referenced until they finish
+        self.client = None
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("webhooks")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:webhooks")
+
+    async def enqueue(self, api: dict, event: str, data: dict):
+        """Add an event to the outbox if the API has a webhook URL"""
+        if not api.get('webhook_url'):
+            return
+        payload = {"event": event, "api_id": api['id'], "endpoint": api.get('endpoint'),
+                   "occurred_at": datetime.utcnow().isoformat(), "data": data}
+        try:
+            await control_plane.enqueue_webhook(api_id=api['id'], url=api['webhook_url'], event=event,
+                                                payload=json.dumps(payload, default=str))
+            metrics.inc("apiengine_webhook_events_total", event)
+        except Exception as e:
+            logger.error(f"Queueing webhook {event} for {api['id']} failed: {e}")
+
+    async def enqueue_once(self, api: dict, event: str, data: dict, every: int):
+        """Add an event to the outbox unless a worker already added it for the API in the last `every` seconds"""
+        # Never released: the lock expiring is what allows the next event
+        if await asyncio.to_thread(shared_state.acquire_lock, f"webhook:{event}:{api['id']}", every, "gateway"):
+            await self.enqueue(api, event, data)
+
+    def notify(self, api: dict, event: str, data: dict, once_every: Optional[int] = None):
+        """Queue an event without waiting (for the request path); once_every deduplicates it across workers"""
+        if not self.enabled or not api.get('webhook_url'):
+            return
+        task = asyncio.create_task(self.enqueue_once(api, event, data, once_every) if once_every
+                                   else self.enqueue(api, event, data))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    def rate_limited(self, api: dict, used: int, limit: int):
+        """Report a rate-limit rejection, once per API per WEBHOOK_RATE_LIMIT_EVENT_SECONDS across workers"""
+        if not self.enabled or not api.get('webhook_url'):
+            return
+        now = time.monotonic()
+        if now - self.rate_limit_seen.get(api['id'], -math.inf) < self.rate_limit_every:
+            return  # This worker reported it already; no shared-state call for every 429
+        self.rate_limit_seen[api['id']] = now
+        self.notify(api, "rate_limit.exceeded", {"requests": used, "limit": limit}, once_every=self.rate_limit_every)
+
+    def record(self, api: dict, status_code: int):
+        """Count a proxied request towards the API's error-rate window (per worker process)"""
+        if not self.enabled or not api.get('webhook_url'):
+            return
+        now = time.monotonic()
+        window = self.windows.get(api['id'])
+        if window is None or now - window[0] >= self.error_window:
+            window = self.windows[api['id']] = [now, 0, 0, False]
+        window[1] += 1
+        if status_code >= 500:
+            window[2] += 1
+            if (not window[3] and window[1] >= self.error_min_requests
+                    and window[2] >= self.error_rate * window[1]):
+                window[3] = True
+                self.notify(api, "error_rate.spike", {"requests": window[1], "errors": window[2],
+                                                      "error_rate": round(window[2] / window[1], 3),
+                                                      "window_seconds": self.error_window})
+
+    def retry_delay(self, attempts: int) -> float:
+        """Seconds until attempt number attempts + 1: exponential, capped, with ±20% jitter"""
+        return min(self.backoff * 2 ** (attempts - 1), self.backoff_max) * random.uniform(0.8, 1.2)
+
+    async def post(self, url: str, rows: List[dict]) -> Optional[str]:
+        """POST one batch; returns an error message, or None when the receiver accepted it"""
+        import httpx
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout, follow_redirects=False,
+                                            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+                                            headers={"User-Agent": "api-engine-webhooks"})
+        deliveries = [{**json.loads(row['payload']), "delivery_id": row['id'], "attempt": row['attempts'] + 1}
+                      for row in rows]
+        try:
+            with metrics.time("apiengine_webhook_post_seconds"):
+                response = await self.client.post(url, json={"deliveries": deliveries})
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"[:500]
+        if 200 <= response.status_code < 300:
+            return None
+        return f"HTTP {response.status_code}: {response.text[:200]}"
+
+    async def deliver(self, url: str, rows: List[dict]) -> List[dict]:
+        """Send a destination's due events in batches; returns the rows to write back"""
+        now = datetime.utcnow()
+        for start in range(0, len(rows), self.batch_size):
+            error = await self.post(url, rows[start:start + self.batch_size])
+            if error is None:
+                for row in rows[start:start + self.batch_size]:
+                    row.update(status='delivered', attempts=row['attempts'] + 1, delivered_at=now, last_error=None)
+                continue
+            # The destination is failing: everything else for it this pass backs off too
+            for row in rows[start:]:
+                row.update(attempts=row['attempts'] + 1, last_error=error)
+                if row['attempts'] >= self.max_attempts:
+                    row['status'] = 'dead'
+                else:
+                    row['next_attempt_at'] = now + timedelta(seconds=self.retry_delay(row['attempts']))
+            break
+        for row in rows:
+            metrics.inc("apiengine_webhook_deliveries_total", row['status'] if row['status'] != 'pending' else 'retry')
+        return rows
+
+    async def run_once(self) -> dict:
+        started = time.time()
+        due = await control_plane.due_webhooks(datetime.utcnow(), self.pass_limit)
+        destinations = {}
+        for row in due:
+            destinations.setdefault(row['url'], []).append(row)
+        settled = [row for rows in await asyncio.gather(*(self.deliver(url, rows) for url, rows in destinations.items()))
+                   for row in rows]
+        if settled:
+            await control_plane.settle_webhooks(settled)
+        purged = await control_plane.purge_webhooks(datetime.utcnow() - timedelta(days=self.retention_days))
+        outcomes = {}
+        for row in settled:
+            outcome = row['status'] if row['status'] != 'pending' else 'retry'
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        report = {"finished_at": datetime.utcnow().isoformat(), "duration_seconds": round(time.time() - started, 3),
+                  "destinations": len(destinations), "events": len(due), "outcomes": outcomes, "purged": purged}
+        if due or purged:
+            shared_state.set_json("report:webhooks", report)
+        return report
+
+    async def run(self) -> dict:
+        # The shared lock makes a single worker process deliver each pass
+        owner = secrets.token_urlsafe(8)
+        ttl = int(self.interval + self.timeout * 4 + 30)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "webhooks", ttl, owner):
+            raise HTTPException(status_code=409, detail="A webhook delivery pass is already running")
+        try:
+            return await self.run_once()
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "webhooks", owner)
+
+    async def run_forever(self):
+        """Periodic delivery loop started with the application"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except HTTPException:
+                pass  # Another worker is already delivering
+            except Exception as e:
+                logger.error(f"Webhook delivery pass failed: {e}")
+
+webhooks = WebhookDispatcher()
+metrics.counter("apiengine_webhook_events_total", "API events queued for webhook delivery", ("event",))
+metrics.counter("apiengine_webhook_deliveries_total", "Webhook delivery attempts by outcome (delivered, retry, dead)",
+                ("outcome",))
+metrics.histogram("apiengine_webhook_post_seconds", "Time webhook receivers took to answer a batch")
+
+# Usage metering
+def billing_period(moment) -> str:
+    """The billing period (UTC calendar month, YYYY-MM) of a date or datetime"""
+    return moment.strftime("%Y-%m")
+
+class UsageMeter:
+    """Counts billable requests per API and key, and closes monthly billing periods.
+
+    The gateway only increments an in-memory counter per (API, key, day).
+    Every METERING_FLUSH_SECONDS each worker turns its counters into a batch
+    with a unique id. It writes the batch to a journal file,
+    METERING_DIR/<hostname>/<pid>-<token>.json (like the metrics snapshots),
+    then applies it to the control plane in one transaction. That transaction
+    records the batch id, so a retried or replayed batch is never counted
+    twice. Batches stay in the journal until they are applied. While the
+    control plane is unreachable they pile up on disk, not only in memory.
+
+    A worker that crashes loses at most its last METERING_FLUSH_SECONDS of
+    counts. Any batches still in its journal are replayed by the periodic pass
+    (one worker, shared lock) once the process is gone. The same pass writes
+    a billing_periods row for each month that ended more than
+    METERING_CLOSE_GRACE_SECONDS ago. These rows are never updated, and usage
+    flushed later is counted in the open period. Revenue reads the per-period
+    running totals in usage_totals, one row per API and month, instead of
+    counting request logs.
+    """
+
+    BATCH_RETENTION_DAYS = 35  # Long enough for any journal to be replayed
+
+    def __init__(self):
+        self.enabled = os.getenv("METERING_ENABLED", "true").lower() == "true"
+        self.interval = float(os.getenv("METERING_FLUSH_SECONDS", "5"))
+        self.close_interval = float(os.getenv("METERING_CLOSE_INTERVAL_SECONDS", "600"))
+        self.grace = float(os.getenv("METERING_CLOSE_GRACE_SECONDS", "3600"))
+        self.directory = Path(os.getenv("METERING_DIR", "data/metering")) / socket.gethostname()
+        self.token = secrets.token_hex(4)
+        self.sequence = 0
+        self.counts = {}
+        self.pending = []  # Batches not applied yet, oldest first
+        self.flushing = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("metering")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:metering")
+
+    @property
+    def journal(self) -> Path:
+        return self.directory / f"{os.getpid()}-{self.token}.json"
+
+    def record(self, api_id: str, key_id: Optional[str]):
+        """Count one billable request (hot path: a dict update)"""
+        if self.enabled:
+            key = (api_id, key_id, int(time.time() // 86400))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def cut(self):
+        """Turn the counters into a new pending batch (on the event loop, so no increment is lost)"""
+        if not self.counts:
+            return
+        counts, self.counts = self.counts, {}
+        self.sequence += 1
+        self.pending.append({
+            "id": f"{socket.gethostname()}:{os.getpid()}:{self.token}:{self.sequence}",
+            "counts": [[api_id, key_id, datetime.utcfromtimestamp(day * 86400).date().isoformat(), requests]
+                       for (api_id, key_id, day), requests in counts.items()],
+        })
+
+    @staticmethod
+    def write_journal(path: Path, batches: List[dict]):
+        """Replace a journal file atomically, or remove it when nothing is pending (blocking)"""
+        if not batches:
+            path.unlink(missing_ok=True)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(batches))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def batch_counts(batch: dict) -> List[tuple]:
+        return [(api_id, key_id, datetime.strptime(day, "%Y-%m-%d").date(), requests)
+                for api_id, key_id, day, requests in batch["counts"]]
+
+    async def flush(self) -> dict:
+        """Apply this worker's counts to the control plane; batches that fail stay pending"""
+        async with self.flushing:
+            self.cut()
+            if not self.pending:
+                return {"applied": 0, "pending": 0}
+            await asyncio.to_thread(self.write_journal, self.journal, list(self.pending))
+            applied = 0
+            while self.pending:
+                try:
+                    await control_plane.apply_usage_batch(self.pending[0]["id"], self.batch_counts(self.pending[0]))
+                except Exception as e:
+                    logger.warning(f"Usage flush failed, {len(self.pending)} batches kept in the journal: {e}")
+                    break
+                self.pending.pop(0)
+                applied += 1
+            await asyncio.to_thread(self.write_journal, self.journal, list(self.pending))
+            metrics.inc("apiengine_metering_batches_total", "applied", amount=applied)
+            return {"applied": applied, "pending": len(self.pending)}
+
+    def orphaned_journals(self) -> List[Path]:
+        """Journals of worker processes that are gone (blocking)"""
+        orphans = []
+        for path in self.directory.glob("*.json"):
+            if path == self.journal:
+                continue
+            try:
+                pid = int(path.stem.split("-")[0])
+                os.kill(pid, 0)
+                alive = time.time() - path.stat().st_mtime < max(60.0, self.interval * 10)
+            except (ValueError, ProcessLookupError):
+                alive = False
+            except (PermissionError, FileNotFoundError):
+                continue  # Another user's process, or already replayed
+            if not alive:
+                orphans.append(path)
+        return orphans
+
+    async def recover(self) -> int:
+        """Replay the batches left behind by crashed workers of this host"""
+        replayed = 0
+        for path in await asyncio.to_thread(self.orphaned_journals):
+            try:
+                batches = json.loads(await asyncio.to_thread(path.read_text))
+            except (OSError, ValueError) as e:
+                logger.error(f"Unreadable metering journal {path}: {e}")
+                continue
+            for batch in batches:
+                if await control_plane.apply_usage_batch(batch["id"], self.batch_counts(batch)):
+                    replayed += 1
+            await asyncio.to_thread(path.unlink, True)
+        metrics.inc("apiengine_metering_batches_total", "replayed", amount=replayed)
+        return replayed
+
+    def closable_before(self, now: datetime) -> str:
+        """Periods before this one can be closed: the current month, once the previous one is past its grace"""
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        if (now - month_start).total_seconds() >= self.grace:
+            return billing_period(now)
+        return billing_period(month_start - timedelta(days=1))
+
+    async def run_once(self) -> dict:
+        started = time.time()
+        flushed = await self.flush()
+        replayed = await self.recover()
+        now = datetime.utcnow()
+        closed = await control_plane.close_billing_periods(self.closable_before(now))
+        pruned = await control_plane.prune_usage_batches(now - timedelta(days=self.BATCH_RETENTION_DAYS))
+        report = {"finished_at": now.isoformat(), "duration_seconds": round(time.time() - started, 3),
+                  "flushed": flushed, "replayed_batches": replayed, "closed_periods": closed,
+                  "pruned_batches": pruned}
+        shared_state.set_json("report:metering", report)
+        return report
+
+    async def run(self) -> dict:
+        # The shared lock makes a single worker process replay journals and close periods
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "metering", 600, owner):
+            raise HTTPException(status_code=409, detail="A metering pass is already running")
+        try:
+            return await self.run_once()
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "metering", owner)
+
+    async def run_forever(self):
+        """Flush this worker's counts periodically, and run the shared pass every METERING_CLOSE_INTERVAL_SECONDS"""
+        last_pass = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_pass >= self.close_interval:
+                    last_pass = time.monotonic()
+                    await self.run()
+            except HTTPException:
+                pass  # Another worker is already running the pass
+            except Exception as e:
+                logger.error(f"Metering pass failed: {e}")
+
+usage_meter = UsageMeter()
+metrics.counter("apiengine_metering_batches_total", "Usage batches applied to the control plane (applied, replayed)",
+                ("source",))
+
+# Latency sketches
+class LatencySketch:
+    """A DDSketch of latencies in seconds: quantiles within 1% relative error, mergeable exactly.
+
+    Values are counted in logarithmic bins (bin i holds values in
+    (GAMMA^(i-1), GAMMA^i]), so a quantile estimate is never more than
+    RELATIVE_ACCURACY away from the true value, whatever the distribution.
+    Merging two sketches adds their bins, so sketches of several workers or
+    buckets merge into the sketch of all their values. Serialized, a sketch
+    is 7 bytes plus 6 per occupied bin, which is a few hundred bytes for a
+    real latency distribution.
+    """
+
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    MIN_VALUE = 1e-6  # Faster than a microsecond counts as zero
+    FORMAT_VERSION = 1
+
+    __slots__ = ("bins", "zero", "count")
+
+    def __init__(self):
+        self.bins = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value: float):
+        if value <= self.MIN_VALUE:
+            self.zero += 1
+        else:
+            index = max(-32768, min(32767, math.ceil(math.log(value) / self.LOG_GAMMA)))
+            self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other: "LatencySketch"):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+
+    def value(self, index: int) -> float:
+        """Estimate of the values in a bin (the point with the least relative error to both ends)"""
+        return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self.value(index)
+        return self.value(max(self.bins))
+
+    def count_above(self, threshold: float) -> int:
+        """Values above a threshold (to the sketch's accuracy)"""
+        if threshold <= self.MIN_VALUE:
+            return self.count - self.zero
+        boundary = math.ceil(math.log(threshold) / self.LOG_GAMMA)
+        return sum(count for index, count in self.bins.items() if index > boundary)
+
+    def to_bytes(self) -> bytes:
+        indexes = sorted(self.bins)
+        return struct.pack(f"<BIH{len(indexes)}h{len(indexes)}I", self.FORMAT_VERSION, self.zero, len(indexes),
+                           *indexes, *(self.bins[index] for index in indexes))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LatencySketch":
+        version, zero, size = struct.unpack_from("<BIH", data)
+        if version != cls.FORMAT_VERSION:
+            raise ValueError(f"Unknown latency sketch format {version}")
+        values = struct.unpack_from(f"<{size}h{size}I", data, struct.calcsize("<BIH"))
+        sketch = cls()
+        sketch.bins = dict(zip(values[:size], values[size:]))
+        sketch.zero = zero
+        sketch.count = zero + sum(values[size:])
+        return sketch
+
+    def percentiles(self) -> dict:
+        """p50/p95/p99 in milliseconds"""
+        return {f"p{round(q * 100)}_ms": round(value * 1000, 2) if value is not None else None
+                for q, value in ((q, self.quantile(q)) for q in (0.5, 0.95, 0.99))}
+
+class LatencyTracker:
+    """Per-API latency quantiles and SLO burn rates from sketches built on the gateway.
+
+    Every request that passed authentication and rate limiting adds its
+    latency to an in-memory LatencySketch for its API and
+    LATENCY_BUCKET_SECONDS bucket, whatever its outcome: requests the
+    admission queue turned away and upstream errors and timeouts count too. Every LATENCY_FLUSH_SECONDS
+    each worker inserts its sketches into latency_sketches, one row per API
+    and bucket. A flush that fails is merged back into memory and retried
+    with the next one.
+
+    The periodic pass (one worker, shared lock) merges the rows that workers
+    wrote for a closed bucket into a single row. Buckets older than
+    LATENCY_FINE_HOURS are merged into hourly ones, and buckets older than
+    LATENCY_RETENTION_DAYS are dropped. A query therefore reads one small
+    row per bucket in its window and merges them in memory. Its cost grows
+    with the number of buckets, not with the number of requests.
+
+    The SLO is that a share `objective` of requests is faster than a
+    threshold. It defaults to 95% under the API's target_p95_ms. The burn
+    rate is the share of slower requests divided by the error budget
+    (1 - objective). A burn rate of 1 uses the budget up exactly over the
+    window, and 14.4 over one hour would use a 30-day budget in two days.
+    """
+
+    COARSE_SECONDS = 3600
+
+    def __init__(self):
+        self.enabled = os.getenv("LATENCY_SKETCHES_ENABLED", "true").lower() == "true"
+        self.bucket_seconds = int(os.getenv("LATENCY_BUCKET_SECONDS", "300"))
+        self.interval = float(os.getenv("LATENCY_FLUSH_SECONDS", "10"))
+        self.compact_interval = float(os.getenv("LATENCY_COMPACT_INTERVAL_SECONDS", "300"))
+        self.fine_hours = float(os.getenv("LATENCY_FINE_HOURS", "48"))
+        self.retention_days = float(os.getenv("LATENCY_RETENTION_DAYS", "30"))
+        self.sketches = {}
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("latency-sketches")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:latency-sketches")
+
+    def bucket(self, moment: float) -> int:
+        return int(moment // self.bucket_seconds) * self.bucket_seconds
+
+    def record(self, api_id: str, seconds: float):
+        """Add one request's latency (hot path: a log and a dict update)"""
+        if self.enabled:
+            key = (api_id, self.bucket(time.time()))
+            sketch = self.sketches.get(key)
+            if sketch is None:
+                sketch = self.sketches[key] = LatencySketch()
+            sketch.add(seconds)
+
+    async def flush(self) -> int:
+        """Write this worker's sketches to the control plane; returns the rows written"""
+        if not self.sketches:
+            return 0
+        sketches, self.sketches = self.sketches, {}
+        try:
+            return await control_plane.add_latency_sketches([
+                {"api_id": api_id, "bucket": bucket, "requests": sketch.count, "sketch": sketch.to_bytes()}
+                for (api_id, bucket), sketch in sketches.items()])
+        except Exception as e:
+            logger.warning(f"Latency sketch flush failed, {len(sketches)} sketches kept for the next one: {e}")
+            for key, sketch in sketches.items():
+                if key in self.sketches:
+                    sketch.merge(self.sketches[key])
+                self.sketches[key] = sketch
+            return 0
+
+    async def run_once(self) -> dict:
+        started = time.time()
+        flushed = await self.flush()
+        now = time.time()
+        # Workers may still flush the last two flush intervals into the buckets before the current one
+        closed_before = self.bucket(now - 2 * self.interval)
+        coarse_before = int(now - self.fine_hours * 3600) // self.COARSE_SECONDS * self.COARSE_SECONDS
+        compacted = await control_plane.compact_latency_sketches(
+            coarse_before - 24 * 3600, closed_before, coarse_before, self.COARSE_SECONDS)
+        pruned = await control_plane.prune_latency_sketches(int(now - self.retention_days * 86400))
+        report = {"finished_at": datetime.utcnow().isoformat(), "duration_seconds": round(time.time() - started, 3),
+                  "flushed": flushed, "compacted_rows": compacted, "pruned_rows": pruned}
+        shared_state.set_json("report:latency-sketches", report)
+        return report
+
+    async def run(self) -> dict:
+        # The shared lock makes a single worker process compact and prune
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "latency-sketches", 600, owner):
+            raise HTTPException(status_code=409, detail="A latency sketch pass is already running")
+        try:
+            return await self.run_once()
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "latency-sketches", owner)
+
+    async def run_forever(self):
+        """Flush this worker's sketches periodically, and run the shared pass every LATENCY_COMPACT_INTERVAL_SECONDS"""
+        last_pass = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_pass >= self.compact_interval:
+                    last_pass = time.monotonic()
+                    await self.run()
+            except HTTPException:
+                pass  # Another worker is already running the pass
+            except Exception as e:
+                logger.error(f"Latency sketch pass failed: {e}")
+
+    @staticmethod
+    def merge(rows: List[dict]) -> LatencySketch:
+        merged = LatencySketch()
+        for row in rows:
+            merged.merge(LatencySketch.from_bytes(row["sketch"]))
+        return merged
+
+    def burn_rate(self, sketch: LatencySketch, threshold_ms: float, objective: float) -> Optional[float]:
+        if not sketch.count:
+            return None
+        return round(sketch.count_above(threshold_ms / 1000) / sketch.count / (1 - objective), 3)
+
+    async def summary(self, api_id: str, hours: float, threshold_ms: float, objective: float) -> dict:
+        """Quantiles, SLO burn rates and an hourly series of an API over the last `hours`"""
+        now = time.time()
+        rows = await control_plane.latency_sketches(self.bucket(now - hours * 3600), api_id=api_id)
+        hourly = {}
+        for row in rows:
+            hourly.setdefault(row["bucket"] - row["bucket"] % self.COARSE_SECONDS, []).append(row)
+        window = self.merge(rows)
+        last_hour = self.merge([row for row in rows if row["bucket"] >= self.bucket(now - 3600)])
+        return {
+            "window_hours": hours,
+            "requests": window.count,
+            **window.percentiles(),
+            "slo": {"threshold_ms": threshold_ms, "objective": objective,
+                    "burn_rate": self.burn_rate(window, threshold_ms, objective),
+                    "burn_rate_1h": self.burn_rate(last_hour, threshold_ms, objective)},
+            "series": [{"start": datetime.utcfromtimestamp(start).isoformat(), "requests": sketch.count,
+                        **sketch.percentiles()}
+                       for start, sketch in ((start, self.merge(hour_rows)) for start, hour_rows in hourly.items())],
+        }
+
+latency_tracker = LatencyTracker()
+
+# API test suites
+class TestSuiteRunner:
+    """Runs an API's test cases against the gateway, yielding each result as it completes.
+
+    Up to TEST_SUITE_CONCURRENCY cases are in flight at once. A private API is
+    called with a short-lived key, revoked when the suite ends or the client
+    goes away. Response bodies are kept in test_response_bodies, capped at
+    TEST_RESULT_BODY_MAX_BYTES, zlib-compressed, and stored once per distinct
+    content (SHA-256). Suites that get the same answer again and again cost one
+    body row, not one per result.
+    """
+
+    METHODS = ("GET", "POST", "PUT", "DELETE")
+
+    def __init__(self):
+        self.base_url = os.getenv("TEST_SUITE_BASE_URL", "http://localhost:8000")
+        self.concurrency = max(1, int(os.getenv("TEST_SUITE_CONCURRENCY", "4")))
+        self.max_body_bytes = int(os.getenv("TEST_RESULT_BODY_MAX_BYTES", "65536"))
+
+    async def run_case(self, client, api: dict, test_case: APITestCase, test_key: Optional[str]) -> tuple:
+        """(result for the caller, row to store or None when the request could not be made)"""
+        url = f"{self.base_url}/api/execute/{api['endpoint']}"
+        headers = test_case.headers.copy()
+        if test_key:
+            headers['X-API-Key'] = test_key
+        try:
+            method = test_case.method.upper()
+            if method not in self.METHODS:
+                raise HTTPException(status_code=400, detail=f"Unsupported method: {test_case.method}")
+            start_time = time.time()
+            response = await client.request(method, url, headers=headers, params=test_case.query_params,
+                                            json=test_case.body if method in ("POST", "PUT") else None)
+            response_time = time.time() - start_time
+        except Exception as e:
+            return {
+                "test_name": test_case.name, "method": test_case.method,
+                "expected_status": test_case.expected_status, "actual_status": 0, "success": False,
+                "response_time": 0, "error": getattr(e, "detail", None) or str(e), "headers_sent": test_case.headers,
+            }, None
+        success = response.status_code == test_case.expected_status
+        return {
+            "test_name": test_case.name, "method": test_case.method,
+            "expected_status": test_case.expected_status, "actual_status": response.status_code, "success": success,
+            "response_time": round(response_time * 1000, 2),  # Convert to ms
+            "response_body": response.text[:1000],  # Limit response size
+            "headers_sent": headers,
+        }, {
+            "api_id": api['id'], "test_name": test_case.name, "test_method": test_case.method, "test_url": url,
+            "test_body": json.dumps(test_case.body), "test_headers": json.dumps(test_case.headers),
+            "response_status": response.status_code, "response_body": response.text,
+            "response_time": response_time, "success": success,
+        }
+
+    async def results(self, api: dict, test_cases: List[APITestCase]):
+        """Yield (index, result, row) for each case, in the order the cases finish"""
+        import httpx
+        test_key_id, test_key = None, None
+        if not api['is_public']:
+            test_key_id, test_key = await control_plane.create_key(
+                api['id'], "test-suite", "*", expires_at=datetime.utcnow() + timedelta(minutes=15)
+            )
+        slots = asyncio.Semaphore(self.concurrency)
+        try:
+            async with httpx.AsyncClient(timeout=30) as client:
+                async def run(index: int, test_case: APITestCase):
+                    async with slots:
+                        return (index, *await self.run_case(client, api, test_case, test_key))
+
+                tasks = [asyncio.create_task(run(index, test_case)) for index, test_case in enumerate(test_cases)]
+                try:
+                    for finished in asyncio.as_completed(tasks):
+                        yield await finished
+                finally:
+                    # Cases still running when the caller goes away are stopped
+                    for task in tasks:
+                        task.cancel()
+        finally:
+            if test_key_id:
+                await control_plane.revoke_keys(api['id'], test_key_id)
+                api_key_index.invalidate()
+
+    async def record(self, rows: List[dict]):
+        await control_plane.record_test_results([row for row in rows if row is not None], self.max_body_bytes)
+
+    @staticmethod
+    def summary(results: List[dict]) -> dict:
+        total_tests = len(results)
+        passed_tests = sum(1 for result in results if result['success'])
+        return {
+            "total_tests": total_tests,
+            "passed": passed_tests,
+            "failed": total_tests - passed_tests,
+            "success_rate": round((passed_tests / total_tests) * 100, 2) if total_tests > 0 else 0
+        }
+
+test_suite_runner = TestSuiteRunner()
+
+# API key index
+class APIKeyIndex:
+    """Hashed API keys with a prefix index and a verified-key cache.
+
+    Only the SHA-256 digest and a short prefix of each key are stored. Lookups
+    go through the prefix index and digests are compared in constant time.
+    Verified keys are cached in-process so a repeat caller costs one dict
+    lookup; revocations bump a shared cache version that every worker checks
+    (off the event loop) at most every API_KEY_CACHE_REFRESH_SECONDS.
+
+    The cache is an LRU keyed by the presented key itself, so a cache hit
+    does no hashing beyond the dict's. The trade-off is that the keys of
+    recent callers stay in worker memory (and in a core dump) for up to
+    API_KEY_CACHE_TTL_SECONDS, where the database only ever holds digests.
+    """
+
+    PREFIX_LENGTH = 12
+
+    def __init__(self):
+        self.cache = OrderedDict()
+        self.max_entries = int(os.getenv("API_KEY_CACHE_SIZE", "10000"))
+        self.cache_ttl = float(os.getenv("API_KEY_CACHE_TTL_SECONDS", "300"))
+        self.refresh_interval = float(os.getenv("API_KEY_CACHE_REFRESH_SECONDS", "5"))
+        self.cache_version = None
+        self.version_checked_at = 0.0
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def prefix(cls, key: str) -> str:
+        return key[:cls.PREFIX_LENGTH]
+
+    def key_row(self, api_id: str, key: str, name: str = "default", scopes: str = "*",
+                expires_at: Optional[datetime] = None) -> dict:
+        """The api_keys row storing the hash of a key"""
+        return {"id": secrets.token_urlsafe(12), "api_id": api_id, "name": name, "key_prefix": self.prefix(key),
+                "key_hash": self.digest(key), "scopes": scopes, "expires_at": expires_at}
+
+    def invalidate(self):
+        """Drop cached verifications here and in every other worker"""
+        self.cache.clear()
+        shared_state.invalidate("api_keys")
+
+    async def _sync(self):
+        now = time.monotonic()
+        if now - self.version_checked_at < self.refresh_interval:
+            return
+        self.version_checked_at = now
+        version = await asyncio.to_thread(shared_state.version, "api_keys")
+        if version != self.cache_version:
+            self.cache.clear()
+            self.cache_version = version
+
+    async def verify(self, api_id: str, presented: str) -> Optional[dict]:
+        """Return the key record if presented is a live key for api_id"""
+        await self._sync()
+        now = time.time()
+        cached = self.cache.get(presented)
+        if cached is not None:
+            record, valid_until = cached
+            if valid_until > now:
+                self.cache.move_to_end(presented)
+                return record if record['api_id'] == api_id else None
+            del self.cache[presented]
+        
+        candidates = await control_plane.live_keys_with_prefix(self.prefix(presented))
+        
+        digest = self.digest(presented)
+        record = None
+        for row in candidates:
+            if hmac.compare_digest(row['key_hash'], digest):
+                record = row
+                break
+        if record is None:
+            return None
+        
+        expires_at = record['expires_at'].timestamp() if record['expires_at'] else None
+        if expires_at is not None and expires_at <= datetime.utcnow().timestamp():
+            return None
+        
+        record = {"id": record['id'], "api_id": record['api_id'], "name": record['name'],
+                  "scopes": set(record['scopes'].split(","))}
+        valid_until = now + self.cache_ttl
+        if expires_at is not None:
+            valid_until = min(valid_until, now + (expires_at - datetime.utcnow().timestamp()))
+        self.cache[presented] = (record, valid_until)
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return record if record['api_id'] == api_id else None
+
+    @staticmethod
+    def allows(record: dict, method: str) -> bool:
+        """Scopes: '*' for everything, 'read' for GET, 'write' for POST/PUT/DELETE"""
+        scopes = record['scopes']
+        if "*" in scopes:
+            return True
+        return ("read" if method == "GET" else "write") in scopes
+
+api_key_index = APIKeyIndex()
+
+# Data retention
+class RetentionEngine:
+    """Background retention for the control-plane database.
+
+    Policies (days unless noted):
+      api_requests      raw rows kept RETENTION_REQUESTS_DAYS, then rolled up
+                        into api_request_rollups (kept RETENTION_ROLLUPS_DAYS)
+      shared_counters,  rows purged once expired (rate-limit windows, leases,
+      shared_values,    job reports, webhook event locks)
+      shared_locks
+      api_test_results  bodies truncated after RETENTION_TEST_BODY_DAYS,
+                        rows purged after RETENTION_TEST_RESULTS_DAYS
+
+    Every batch is its own short transaction so the gateway never waits long
+    on the write lock. Freed pages are returned with PRAGMA incremental_vacuum,
+    for at most RETENTION_VACUUM_SECONDS per pass; the rest is left for the
+    next pass and reported as bytes_reclaimable.
+    """
+
+    VACUUM_STEP_PAGES = 1000
+
+    def __init__(self):
+        self.enabled = os.getenv("RETENTION_ENABLED", "true").lower() == "true"
+        self.interval = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+        self.batch_size = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+        self.batch_pause = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.05"))
+        self.vacuum_seconds = float(os.getenv("RETENTION_VACUUM_SECONDS", "10"))
+        self.policies = {
+            "requests_days": int(os.getenv("RETENTION_REQUESTS_DAYS", "30")),
+            "rollups_days": int(os.getenv("RETENTION_ROLLUPS_DAYS", "730")),
+            "test_body_days": int(os.getenv("RETENTION_TEST_BODY_DAYS", "7")),
+            "test_body_max_bytes": int(os.getenv("RETENTION_TEST_BODY_MAX_BYTES", "2048")),
+            "test_results_days": int(os.getenv("RETENTION_TEST_RESULTS_DAYS", "90")),
+        }
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("retention")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:retention")
+
+    def _batched(self, conn, statement: str, params: tuple) -> int:
+        """Run a LIMIT-bounded statement until it stops affecting rows"""
+        total = 0
+        while True:
+            affected = conn.execute(statement, params + (self.batch_size,)).rowcount
+            conn.commit()
+            total += affected
+            if affected < self.batch_size:
+                return total
+            time.sleep(self.batch_pause)
+
+    def rollup_api_requests(self, conn) -> dict:
+        """Fold expired raw request logs into daily rollups, batch by batch"""
+        cutoff = f"-{self.policies['requests_days']} days"
+        # Never drop raw rows the request log exporter has not written out yet
+        export_cap = request_log_exporter.load_manifest()["high_water_mark"] if request_log_exporter.enabled else None
+        rolled_up = 0
+        while True:
+            # Rows are appended in id order, so the oldest expired rows sit at the front
+            upper = conn.execute("""
+                SELECT MAX(id) AS max_id, COUNT(*) AS count FROM (
+                    SELECT id FROM api_requests
+                    WHERE timestamp < datetime('now', ?) AND (? IS NULL OR id <= ?)
+                    ORDER BY id LIMIT ?
+                )
+            """, (cutoff, export_cap, export_cap, self.batch_size)).fetchone()
+            if not upper['count']:
+                break
+            conn.execute("""
+                INSERT INTO api_request_rollups (api_id, day, request_count, error_count,
+                                                 total_response_time, max_response_time)
+                SELECT api_id, DATE(timestamp), COUNT(*),
+                       SUM(CASE WHEN status_code >= 400 THEN 1 ELSE 0 END),
+                       COALESCE(SUM(response_time), 0), COALESCE(MAX(response_time), 0)
+                FROM api_requests
+                WHERE id <= ? AND timestamp < datetime('now', ?)
+                GROUP BY api_id, DATE(timestamp)
+                ON CONFLICT(api_id, day) DO UPDATE SET
+                    request_count = request_count + excluded.request_count,
+                    error_count = error_count + excluded.error_count,
+                    total_response_time = total_response_time + excluded.total_response_time,
+                    max_response_time = MAX(max_response_time, excluded.max_response_time)
+            """, (upper['max_id'], cutoff))
+            deleted = conn.execute("""
+                DELETE FROM api_requests WHERE id <= ? AND timestamp < datetime('now', ?)
+            """, (upper['max_id'], cutoff)).rowcount
+            conn.commit()
+            rolled_up += deleted
+            if upper['count'] < self.batch_size:
+                break
+            time.sleep(self.batch_pause)
+        
+        purged = self._batched(conn, """
+            DELETE FROM api_request_rollups WHERE rowid IN (
+                SELECT rowid FROM api_request_rollups WHERE day < DATE('now', ?) LIMIT ?
+            )
+        """, (f"-{self.policies['rollups_days']} days",))
+        return {"rolled_up": rolled_up, "rollups_purged": purged}
+
+    def purge_shared_state(self, conn) -> dict:
+        """Delete expired counters, values and locks that nothing reads again"""
+        now = time.time()
+        purged = {}
+        for table, action in (("shared_counters", "expired_counters"), ("shared_values", "expired_values"),
+                              ("shared_locks", "expired_locks")):
+            purged[action] = self._batched(conn, f"""
+                DELETE FROM {table} WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE expires_at <= ? LIMIT ?
+                )
+            """, (now,))
+        return purged
+
+    def compact_test_results(self, conn) -> dict:
+        """Truncate old inline response bodies, purge expired test results and the bodies nothing refers to"""
+        max_bytes = self.policies['test_body_max_bytes']
+        compacted = self._batched(conn, """
+            UPDATE api_test_results SET response_body = substr(response_body, 1, ?)
+            WHERE id IN (
+                SELECT id FROM api_test_results
+                WHERE created_at < datetime('now', ?) AND length(response_body) > ?
+                ORDER BY id LIMIT ?
+            )
+        """, (max_bytes, f"-{self.policies['test_body_days']} days", max_bytes))
+        deleted = self._batched(conn, """
+            DELETE FROM api_test_results WHERE id IN (
+                SELECT id FROM api_test_results WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?
+            )
+        """, (f"-{self.policies['test_results_days']} days",))
+        orphaned = self._batched(conn, """
+            DELETE FROM test_response_bodies WHERE hash IN (
+                SELECT hash FROM test_response_bodies WHERE NOT EXISTS (
+                    SELECT 1 FROM api_test_results WHERE response_body_hash = test_response_bodies.hash
+                ) LIMIT ?
+            )
+        """, ())
+        return {"compacted": compacted, "deleted": deleted, "orphaned_bodies": orphaned}
+
+    def vacuum(self, conn) -> dict:
+        """Return free pages to the filesystem and report the bytes reclaimed"""
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return {"bytes_reclaimed": 0, "bytes_reclaimable": free_pages * page_size}
+        # Release free pages in chunks to keep each step short, and stop at the pass's time cap
+        deadline = time.monotonic() + self.vacuum_seconds
+        while free_pages and time.monotonic() < deadline:
+            conn.execute(f"PRAGMA incremental_vacuum({self.VACUUM_STEP_PAGES})").fetchall()
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if free_pages:
+                time.sleep(self.batch_pause)
+        pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+        return {"bytes_reclaimed": (pages_before - pages_after) * page_size,
+                "bytes_reclaimable": free_pages * page_size}
+
+    def convert_vacuum_mode(self) -> dict:
+        """Switch an existing database to incremental auto-vacuum (full VACUUM, blocking)"""
+        conn = get_db_connection()
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return {"converted": False, "auto_vacuum": "incremental"}
+            started = time.perf_counter()
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            "converted": True,
+            "auto_vacuum": "incremental",
+            "bytes_reclaimed": max(pages_before - pages_after, 0) * page_size,
+            "duration_seconds": round(time.perf_counter() - started, 3)
+        }
+
+    def run_once(self) -> dict:
+        """Apply every policy once (blocking; run in a worker thread)"""
+        started = time.perf_counter()
+        conn = get_db_connection()
+        try:
+            report = {
+                "api_requests": self.rollup_api_requests(conn),
+                "shared_state": self.purge_shared_state(conn),
+                "api_test_results": self.compact_test_results(conn),
+            }
+            report["vacuum"] = self.vacuum(conn)
+        finally:
+            conn.close()
+        for table, actions in report.items():
+            if table == "vacuum":
+                continue
+            for action, count in actions.items():
+                metrics.inc("apiengine_retention_rows_total", table, action, amount=count)
+        metrics.inc("apiengine_retention_bytes_reclaimed_total", amount=report["vacuum"]["bytes_reclaimed"])
+        report["duration_seconds"] = round(time.perf_counter() - started, 3)
+        report["completed_at"] = datetime.now().isoformat()
+        shared_state.set_json("report:retention", report)
+        logger.info(f"Retention pass completed: {report}")
+        return report
+
+    async def run(self) -> dict:
+        """Run one retention pass without blocking the event loop"""
+        require_sqlite_control_plane("Retention")
+        # The shared lock makes a single worker process run each pass
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "retention", self.interval, owner):
+            raise HTTPException(status_code=409, detail="A retention pass is already running")
+        try:
+            return await asyncio.to_thread(self.run_once)
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "retention", owner)
+
+    async def run_forever(self):
+        """Periodic retention loop started with the application"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except HTTPException:
+                pass  # Another worker is already running this pass
+            except Exception as e:
+                logger.error(f"Retention pass failed: {e}")
+
+retention_engine = RetentionEngine()
+metrics.counter("apiengine_retention_rows_total", "Rows processed by retention", ("table", "action"))
+metrics.counter("apiengine_retention_bytes_reclaimed_total", "Database bytes returned by incremental vacuum")
+
+# Request log export
+class RequestLogExporter:
+    """Incremental, time-partitioned export of api_requests for offline analytics.
+
+    Rows past the high-water-mark id are streamed from a read-only connection
+    in chunks and written to data/exports/api_requests/date=YYYY-MM-DD/ as
+    Parquet (zstd) or uncompressed Arrow IPC when pyarrow is installed, else
+    CSV.gz. Arrow IPC stays uncompressed so files can be memory-mapped without
+    a decode step; use Parquet when size matters more. The
+    manifest records the high-water mark and every committed part file; parts
+    left behind by an interrupted run are removed before the next one.
+    """
+
+    COLUMNS = ("id", "api_id", "user_id", "endpoint", "method", "status_code",
+               "response_time", "ip_address", "user_agent", "timestamp")
+    EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv.gz"}
+
+    def __init__(self):
+        self.enabled = os.getenv("EXPORT_ENABLED", "false").lower() == "true"
+        self.interval = int(os.getenv("EXPORT_INTERVAL_SECONDS", "3600"))
+        self.chunk_size = int(os.getenv("EXPORT_CHUNK_ROWS", "50000"))
+        self.export_dir = Path(os.getenv("EXPORT_DIR", "data/exports")) / "api_requests"
+        self.format = os.getenv("EXPORT_FORMAT", "parquet" if pa else "csv").lower()
+        if self.format not in self.EXTENSIONS or (self.format != "csv" and not pa):
+            logger.warning(f"Export format '{self.format}' unavailable, falling back to csv")
+            self.format = "csv"
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("request_log_export")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:request_log_export")
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.export_dir / "_manifest.json"
+
+    def load_manifest(self) -> dict:
+        if self.manifest_path.exists():
+            return json.loads(self.manifest_path.read_text())
+        return {"high_water_mark": 0, "files": []}
+
+    def save_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_path, self.manifest_path)
+
+    def _remove_orphans(self, manifest: dict):
+        """Drop part files that were written but never committed to the manifest"""
+        committed = {entry["path"] for entry in manifest["files"]}
+        for path in self.export_dir.glob("date=*/part-*"):
+            relative = str(path.relative_to(self.export_dir))
+            if relative not in committed:
+                path.unlink()
+
+    def _arrow_table(self, rows: list):
+        columns = list(zip(*rows))
+        timestamps = [datetime.fromisoformat(value) if value else None for value in columns[9]]
+        return pa.table({
+            "id": pa.array(columns[0], pa.int64()),
+            "api_id": pa.array(columns[1], pa.string()).dictionary_encode(),
+            "user_id": pa.array(columns[2], pa.string()),
+            "endpoint": pa.array(columns[3], pa.string()).dictionary_encode(),
+            "method": pa.array(columns[4], pa.string()).dictionary_encode(),
+            "status_code": pa.array(columns[5], pa.int32()),
+            "response_time": pa.array(columns[6], pa.float64()),
+            "ip_address": pa.array(columns[7], pa.string()),
+            "user_agent": pa.array(columns[8], pa.string()),
+            "timestamp": pa.array(timestamps, pa.timestamp("s")),
+        })
+
+    def _write_part(self, path: Path, rows: list):
+        tmp_path = path.with_name(path.name + ".tmp")
+        if self.format == "parquet":
+            pq.write_table(self._arrow_table(rows), tmp_path, compression="zstd")
+        elif self.format == "arrow":
+            table = self._arrow_table(rows)
+            with pa.OSFile(str(tmp_path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        else:
+            with gzip.open(tmp_path, "wt", newline="", compresslevel=6) as handle:
+                writer = csv.writer(handle)
+                writer.writerow(self.COLUMNS)
+                writer.writerows(rows)
+        os.replace(tmp_path, path)
+
+    def export_once(self) -> dict:
+        """Export every row past the high-water mark (blocking; run in a worker thread)"""
+        started = time.perf_counter()
+        self.export_dir.mkdir(parents=True, exist_ok=True)
+        manifest = self.load_manifest()
+        self._remove_orphans(manifest)
+        
+        source = sqlite3.connect("file:data/api_maker.db?mode=ro", uri=True)
+        exported_rows = 0
+        written = []
+        try:
+            cursor = source.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM api_requests WHERE id > ? ORDER BY id",
+                (manifest["high_water_mark"],)
+            )
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                partitions = {}
+                for row in rows:
+                    partitions.setdefault((row[9] or "unknown")[:10], []).append(row)
+                for day, day_rows in partitions.items():
+                    partition_dir = self.export_dir / f"date={day}"
+                    partition_dir.mkdir(exist_ok=True)
+                    path = partition_dir / f"part-{day_rows[0][0]:012d}-{day_rows[-1][0]:012d}{self.EXTENSIONS[self.format]}"
+                    self._write_part(path, day_rows)
+                    entry = {
+                        "path": str(path.relative_to(self.export_dir)),
+                        "rows": len(day_rows),
+                        "min_id": day_rows[0][0],
+                        "max_id": day_rows[-1][0],
+                        "bytes": path.stat().st_size,
+                        "format": self.format
+                    }
+                    manifest["files"].append(entry)
+                    written.append(entry)
+                # Commit the chunk: the high-water mark only moves after its files exist
+                manifest["high_water_mark"] = rows[-1][0]
+                self.save_manifest(manifest)
+                exported_rows += len(rows)
+        finally:
+            source.close()
+        
+        report = {
+            "format": self.format,
+            "rows_exported": exported_rows,
+            "files_written": len(written),
+            "bytes_written": sum(entry["bytes"] for entry in written),
+            "high_water_mark": manifest["high_water_mark"],
+            "duration_seconds": round(time.perf_counter() - started, 3),
+            "completed_at": datetime.now().isoformat()
+        }
+        shared_state.set_json("report:request_log_export", report)
+        logger.info(f"Request log export completed: {report}")
+        return report
+
+    async def run(self) -> dict:
+        """Run one export without blocking the event loop"""
+        require_sqlite_control_plane("Request log export")
+        # The shared lock makes a single worker process run each pass
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "request_log_export", self.interval, owner):
+            raise HTTPException(status_code=409, detail="An export is already running")
+        try:
+            return await asyncio.to_thread(self.export_once)
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "request_log_export", owner)
+
+    async def run_forever(self):
+        """Periodic export loop started with the application"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except HTTPException:
+                pass  # Another worker is already exporting
+            except Exception as e:
+                logger.error(f"Request log export failed: {e}")
+
+request_log_exporter = RequestLogExporter()
+
+# User database read-only pool
+class _QueryClock:
+    """Time one query has spent inside SQLite (execute and fetches), against its budget"""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.spent = 0.0
+        self.resumed = None
+
+    def __enter__(self):
+        self.resumed = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.spent += time.perf_counter() - self.resumed
+        self.resumed = None
+        return False
+
+    def exceeded(self) -> bool:
+        return self.resumed is not None and self.spent + time.perf_counter() - self.resumed > self.budget
+
+class ReadOnlyPool:
+    """Per-database pools of read-only connections to user SQLite databases.
+
+    Connections are opened once with mode=ro and query_only, keep a statement
+    cache of QUERY_STATEMENT_CACHE entries, and an authorizer that only lets
+    reads (SELECT, read-only PRAGMAs) through. Idle connections are kept per
+    database file, up to QUERY_POOL_SIZE each, for the QUERY_POOL_DATABASES
+    most recently used databases.
+
+    Queries run under a budget: a progress handler aborts them once they
+    have spent QUERY_TIMEOUT_SECONDS executing in SQLite (504), and results
+    stop after QUERY_MAX_ROWS rows. Only execution counts: time the stream
+    spends waiting for a slow client to read a chunk does not.
+    """
+
+    ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                       sqlite3.SQLITE_RECURSIVE}
+    ALLOWED_PRAGMAS = {"table_info", "table_xinfo", "index_list", "index_info", "index_xinfo",
+                       "foreign_key_list", "schema_version", "page_count", "page_size", "freelist_count"}
+    PROGRESS_STEPS = 10000  # VM instructions between deadline checks
+
+    def __init__(self):
+        self.size = int(os.getenv("QUERY_POOL_SIZE", "4"))
+        self.max_databases = int(os.getenv("QUERY_POOL_DATABASES", "64"))
+        self.cached_statements = int(os.getenv("QUERY_STATEMENT_CACHE", "256"))
+        self.max_rows = int(os.getenv("QUERY_MAX_ROWS", "100000"))
+        self.timeout = float(os.getenv("QUERY_TIMEOUT_SECONDS", "5"))
+        self.chunk_rows = int(os.getenv("QUERY_CHUNK_ROWS", "1000"))
+        self.pools = OrderedDict()  # database path -> idle connections
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _authorize(cls, action, arg1, arg2, db_name, trigger):
+        if action in cls.ALLOWED_ACTIONS:
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_PRAGMA and arg1 and arg1.lower() in cls.ALLOWED_PRAGMAS:
+            return sqlite3.SQLITE_OK
+        return sqlite3.SQLITE_DENY
+
+    def _connect(self, path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.execute("PRAGMA query_only = ON")
+        conn.set_authorizer(self._authorize)
+        return conn
+
+    def acquire(self, path: str) -> sqlite3.Connection:
+        """Take an idle connection for a database file, opening one if none is idle"""
+        with self.lock:
+            idle = self.pools.get(path)
+            if idle:
+                self.pools.move_to_end(path)
+                return idle.pop()
+        return self._connect(path)
+
+    def release(self, path: str, conn: sqlite3.Connection):
+        """Return a connection to its pool, closing it if the pool is full"""
+        conn.set_progress_handler(None, 0)
+        evicted = []
+        with self.lock:
+            idle = self.pools.setdefault(path, [])
+            self.pools.move_to_end(path)
+            if len(idle) < self.size:
+                idle.append(conn)
+                conn = None
+            while len(self.pools) > self.max_databases:
+                evicted.extend(self.pools.popitem(last=False)[1])
+        for stale in evicted + ([conn] if conn else []):
+            stale.close()
+
+    def discard(self, path: str):
+        """Close idle connections of a database, e.g. after it is replaced on disk"""
+        with self.lock:
+            idle = self.pools.pop(path, [])
+        for conn in idle:
+            conn.close()
+
+    def start_query(self, path: str, sql: str, params, max_rows: Optional[int] = None):
+        """Prepare and run a query up to its first row (blocking).
+
+        Errors surface here, before any response is sent. Returns a generator
+        of NDJSON lines that streams the rest and releases the connection.
+        """
+        max_rows = min(max_rows or self.max_rows, self.max_rows)
+        conn = self.acquire(path)
+        started = time.perf_counter()
+        clock = _QueryClock(self.timeout)
+        conn.set_progress_handler(clock.exceeded, self.PROGRESS_STEPS)
+        try:
+            with clock:
+                cursor = conn.execute(sql, params)
+                first = cursor.fetchmany(min(self.chunk_rows, max_rows))
+        except sqlite3.DatabaseError as e:
+            self.release(path, conn)
+            if "interrupted" in str(e):
+                raise HTTPException(status_code=504, detail=f"Query exceeded {self.timeout}s budget")
+            raise HTTPException(status_code=400, detail=f"Query rejected: {e}")
+        except (sqlite3.Warning, ValueError) as e:
+            self.release(path, conn)
+            raise HTTPException(status_code=400, detail=f"Query rejected: {e}")
+        columns = [description[0] for description in cursor.description or ()]
+        return self._stream(path, conn, cursor, columns, first, max_rows, started, clock)
+
+    def _stream(self, path, conn, cursor, columns, rows, max_rows, started, clock):
+        sent = 0
+        summary = {}
+        try:
+            yield (json.dumps({"columns": columns}) + "\n").encode("utf-8")
+            while rows:
+                sent += len(rows)
+                yield "".join(json.dumps([_plain_value(value) for value in row], default=str) + "\n"
+                              for row in rows).encode("utf-8")
+                with clock:
+                    if sent >= max_rows:
+                        summary["truncated"] = cursor.fetchone() is not None
+                        break
+                    rows = cursor.fetchmany(min(self.chunk_rows, max_rows - sent))
+        except sqlite3.DatabaseError as e:
+            summary["error"] = (f"Query exceeded {self.timeout}s budget" if "interrupted" in str(e) else str(e))
+        finally:
+            cursor.close()
+            self.release(path, conn)
+        summary.setdefault("truncated", False)
+        summary.update(rows=sent, elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+                       execution_ms=round(clock.spent * 1000, 1))
+        metrics.observe("apiengine_user_query_seconds", clock.spent)
+        yield (json.dumps(summary) + "\n").encode("utf-8")
+
+user_db_pool = ReadOnlyPool()
+metrics.histogram("apiengine_user_query_seconds", "Read-only user database query latency")
+
+# User database schema catalog
+class SchemaCatalog:
+    """Cached schema introspection for user SQLite databases.
+
+    Each database is introspected once (tables, columns, indexes and row
+    estimates) through the read-only pool. Entries are keyed by the mtimes of
+    the database and its WAL file plus PRAGMA schema_version: a lookup only
+    stats the files, at most every SCHEMA_CATALOG_REFRESH_SECONDS, and when
+    data changed without a schema change only the row estimates are redone.
+    Row estimates are max(rowid), which stays cheap on any table size.
+    """
+
+    def __init__(self):
+        self.refresh_interval = float(os.getenv("SCHEMA_CATALOG_REFRESH_SECONDS", "2"))
+        self.entries = {}  # database path -> {"mtime", "checked_at", "schema"}
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
+
+    def _introspect(self, conn) -> dict:
+        tables = {}
+        names = conn.execute("""
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name != '_metadata'
+            ORDER BY name
+        """).fetchall()
+        for (name,) in names:
+            columns = [
+                {"name": row[1], "type": row[2], "notnull": bool(row[3]), "default": row[4], "primary_key": row[5]}
+                for row in conn.execute(f"PRAGMA table_info({self._quote(name)})")
+            ]
+            indexes = []
+            for row in conn.execute(f"PRAGMA index_list({self._quote(name)})").fetchall():
+                indexed = [info[2] for info in conn.execute(f"PRAGMA index_info({self._quote(row[1])})")]
+                indexes.append({"name": row[1], "unique": bool(row[2]), "origin": row[3], "columns": indexed})
+            tables[name] = {"columns": columns, "indexes": indexes}
+        return tables
+
+    def _estimate_rows(self, conn, tables: dict):
+        for name, table in tables.items():
+            try:
+                table["approx_rows"] = conn.execute(f"SELECT max(rowid) FROM {self._quote(name)}").fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                table["approx_rows"] = None  # WITHOUT ROWID table
+
+    def get(self, path: str) -> dict:
+        """Schema of a database, introspecting only when it changed (blocking)"""
+        entry = self.entries.get(path)
+        now = time.monotonic()
+        if entry and now - entry["checked_at"] < self.refresh_interval:
+            return entry["schema"]
+        mtime = database_mtime(path)
+        if entry and entry["mtime"] == mtime:
+            entry["checked_at"] = now
+            return entry["schema"]
+
+        conn = user_db_pool.acquire(path)
+        try:
+            version = conn.execute("PRAGMA schema_version").fetchone()[0]
+            if entry and entry["schema"]["schema_version"] == version:
+                # Same schema, new data: copy so readers of the old entry never see it change
+                tables = {name: dict(table) for name, table in entry["schema"]["tables"].items()}
+            else:
+                tables = self._introspect(conn)
+            self._estimate_rows(conn, tables)
+        finally:
+            user_db_pool.release(path, conn)
+
+        schema = {"schema_version": version, "tables": tables, "introspected_at": datetime.now().isoformat()}
+        self.entries[path] = {"mtime": mtime, "checked_at": now, "schema": schema}
+        return schema
+
+    def table(self, path: str, name: str) -> Optional[dict]:
+        return self.get(path)["tables"].get(name)
+
+schema_catalog = SchemaCatalog()
+
+# User database bulk import/export
+def _sqlite_value(value):
+    """Map a decoded JSON value onto a SQLite storage class"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+def _plain_value(value):
+    """Map a SQLite value onto something JSON and csv can carry"""
+    return value.hex() if isinstance(value, bytes) else value
+
+class BulkTransfer:
+    """Streaming NDJSON/CSV import and export for user SQLite databases.
+
+    Imports consume the request body as it arrives: a small bounded queue
+    hands chunks to a worker thread, which parses them incrementally and
+    inserts BULK_BATCH_ROWS rows per executemany, one transaction per batch.
+    Memory stays flat whatever the upload size, and progress is published to
+    shared state after every batch so any worker can report it. Exports walk
+    a read-only cursor with fetchmany and stream each chunk as it is encoded.
+    """
+
+    FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+    CONFLICT_MODES = {"abort": "INSERT", "ignore": "INSERT OR IGNORE", "replace": "INSERT OR REPLACE"}
+    ABORT = object()
+
+    def __init__(self):
+        self.batch_size = int(os.getenv("BULK_BATCH_ROWS", "5000"))
+        self.queue_chunks = int(os.getenv("BULK_QUEUE_CHUNKS", "16"))
+        self.progress_ttl = int(os.getenv("BULK_PROGRESS_TTL_SECONDS", "86400"))
+
+    @classmethod
+    def resolve_format(cls, requested: Optional[str], content_type: str = "") -> str:
+        fmt = (requested or ("csv" if "csv" in content_type else "ndjson")).lower()
+        if fmt not in cls.FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt} (use ndjson or csv)")
+        return fmt
+
+    @staticmethod
+    def progress_key(database_id: str, table: str) -> str:
+        return f"progress:import:{database_id}:{table}"
+
+    def progress(self, database_id: str, table: str) -> Optional[dict]:
+        return shared_state.get_json(self.progress_key(database_id, table))
+
+    def _report(self, database_id: str, table: str, report: dict):
+        shared_state.set_json(self.progress_key(database_id, table), report, ttl=self.progress_ttl)
+
+    @staticmethod
+    def _lines(chunks):
+        """Decode byte chunks into text lines, keeping line endings for csv"""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pending = ""
+        for chunk in chunks:
+            pending += decoder.decode(chunk)
+            lines = pending.split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+
+    @staticmethod
+    def _csv_rows(lines):
+        """Return (columns, rows) from a csv stream that starts with a header line"""
+        reader = csv.reader(lines)
+        columns = next(reader, None) or []
+        return columns, (tuple(value if value != "" else None for value in row) for row in reader if row)
+
+    @staticmethod
+    def _ndjson_rows(lines):
+        """Return (columns, rows) from NDJSON; the first object's keys name the columns"""
+        def objects():
+            for number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise HTTPException(status_code=400, detail=f"Invalid JSON on line {number}")
+                if not isinstance(record, dict):
+                    raise HTTPException(status_code=400, detail=f"Line {number} is not a JSON object")
+                yield number, record
+
+        records = objects()
+        first = next(records, None)
+        if first is None:
+            return [], iter(())
+        columns = list(first[1])
+        known = set(columns)
+
+        def rows():
+            yield tuple(_sqlite_value(first[1][column]) for column in columns)
+            for number, record in records:
+                if not known.issuperset(record):
+                    unknown = sorted(set(record) - known)
+                    raise HTTPException(status_code=400, detail=f"Unknown fields on line {number}: {unknown}")
+                yield tuple(_sqlite_value(record.get(column)) for column in columns)
+        return columns, rows()
+
+    def _batches(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def import_rows(self, database: dict, table: str, fmt: str, on_conflict: str,
+                    create_table: bool, chunks) -> dict:
+        """Insert every row of a byte-chunk stream (blocking; run in a worker thread)"""
+        started = time.perf_counter()
+        quoted_table = quote_identifier(table)
+        parse = self._csv_rows if fmt == "csv" else self._ndjson_rows
+        report = {"state": "running", "format": fmt, "rows_imported": 0, "batches": 0,
+                  "started_at": datetime.now().isoformat()}
+        self._report(database['id'], table, report)
+
+        conn = sqlite3.connect(database['database_path'], timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            columns, rows = parse(self._lines(chunks))
+            if not columns:
+                raise HTTPException(status_code=400, detail="No rows to import")
+            quoted_columns = [quote_identifier(column) for column in columns]
+
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({quoted_table})")}
+            if not existing:
+                if not create_table:
+                    raise HTTPException(status_code=404, detail=f"Table not found: {table}")
+                # Untyped columns keep each value's own storage class (integer, real, text)
+                conn.execute(f"CREATE TABLE {quoted_table} ({', '.join(quoted_columns)})")
+                conn.commit()
+            elif not existing.issuperset(columns):
+                missing = sorted(set(columns) - existing)
+                raise HTTPException(status_code=400, detail=f"Columns not in {table}: {missing}")
+
+            statement = (f"{self.CONFLICT_MODES[on_conflict]} INTO {quoted_table} "
+                         f"({', '.join(quoted_columns)}) VALUES ({', '.join('?' * len(columns))})")
+            for batch in self._batches(rows):
+                try:
+                    with conn:  # One transaction per batch
+                        conn.executemany(statement, batch)
+                except sqlite3.IntegrityError as e:
+                    raise HTTPException(status_code=409, detail=(
+                        f"{e} in batch starting at row {report['rows_imported'] + 1}; "
+                        f"{report['rows_imported']} rows were committed"))
+                except sqlite3.ProgrammingError as e:
+                    raise HTTPException(status_code=400, detail=f"{e}; {report['rows_imported']} rows were committed")
+                report["rows_imported"] += len(batch)
+                report["batches"] += 1
+                metrics.inc("apiengine_bulk_rows_total", "import", amount=len(batch))
+                self._report(database['id'], table, report)
+        except HTTPException as e:
+            report.update(state="failed", error=e.detail)
+            self._report(database['id'], table, report)
+            raise
+        finally:
+            conn.close()
+
+        report.update(state="completed", completed_at=datetime.now().isoformat(),
+                      duration_seconds=round(time.perf_counter() - started, 3))
+        self._report(database['id'], table, report)
+        logger.info(f"Imported {report['rows_imported']} rows into {database['id']}.{table}")
+        return report
+
+    @classmethod
+    def _drain(cls, queue: asyncio.Queue, loop):
+        """Iterate queued chunks from a worker thread"""
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+            if chunk is None:
+                return
+            if chunk is cls.ABORT:
+                raise HTTPException(status_code=400, detail="Upload interrupted")
+            yield chunk
+
+    @staticmethod
+    async def _offer(queue: asyncio.Queue, chunk, worker) -> bool:
+        """Queue a chunk; False once the worker has stopped reading"""
+        put = asyncio.ensure_future(queue.put(chunk))
+        await asyncio.wait({put, worker}, return_when=asyncio.FIRST_COMPLETED)
+        if put.done():
+            return True
+        put.cancel()
+        return False
+
+    async def import_stream(self, database: dict, table: str, fmt: str, on_conflict: str,
+                            create_table: bool, stream) -> dict:
+        """Import an async byte stream without buffering it"""
+        if on_conflict not in self.CONFLICT_MODES:
+            raise HTTPException(status_code=400, detail=f"on_conflict must be one of {sorted(self.CONFLICT_MODES)}")
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_chunks)
+        worker = loop.run_in_executor(None, self.import_rows, database, table, fmt, on_conflict,
+                                      create_table, self._drain(queue, loop))
+        try:
+            async for chunk in stream:
+                if chunk and not await self._offer(queue, chunk, worker):
+                    break
+            else:
+                await self._offer(queue, None, worker)
+        except Exception:
+            # Client went away: stop the worker and surface the original error
+            await self._offer(queue, self.ABORT, worker)
+            try:
+                await worker
+            except Exception:
+                pass
+            raise
+        return await worker
+
+    def open_export(self, database: dict, table: str):
+        """Check out a pooled read-only connection and cursor over a table (blocking)"""
+        quoted_table = quote_identifier(table)
+        conn = user_db_pool.acquire(database['database_path'])
+        try:
+            return conn, conn.execute(f"SELECT * FROM {quoted_table}")
+        except sqlite3.OperationalError:
+            user_db_pool.release(database['database_path'], conn)
+            raise HTTPException(status_code=404, detail=f"Table not found: {table}")
+
+    def export_rows(self, database: dict, conn, cursor, fmt: str):
+        """Yield encoded chunks of BULK_BATCH_ROWS rows, returning the connection at the end"""
+        columns = [description[0] for description in cursor.description]
+        try:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer) if fmt == "csv" else None
+            if writer:
+                writer.writerow(columns)
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    values = [_plain_value(value) for value in row]
+                    if writer:
+                        writer.writerow(values)
+                    else:
+                        buffer.write(json.dumps(dict(zip(columns, values)), default=str))
+                        buffer.write("\n")
+                metrics.inc("apiengine_bulk_rows_total", "export", amount=len(rows))
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+            if writer and buffer.tell():
+                yield buffer.getvalue().encode("utf-8")
+        finally:
+            cursor.close()
+            user_db_pool.release(database['database_path'], conn)
+
+bulk_transfer = BulkTransfer()
+metrics.counter("apiengine_bulk_rows_total", "Rows moved by user database import/export", ("direction",))
+
+# Snapshots
+class _SnapshotRestarted(Exception):
+    """Raised from the backup progress callback to stop a copy that keeps restarting"""
+
+class SnapshotManager:
+    """Online snapshots of the control-plane database and user databases.
+
+    Snapshots use SQLite's backup API SNAPSHOT_PAGES_PER_STEP pages at a time
+    and sleep SNAPSHOT_STEP_PAUSE_MS between steps. The source is only
+    read-locked for one short step, so writers keep going. WAL databases
+    are copied from one pinned read snapshot, so their writers are never
+    blocked and never restart the copy. Copies are gzip-compressed into
+    data/snapshots/<source>/, where the source is "control" or a user
+    database id. Scheduled runs are incremental: a source is only copied
+    when its files changed since its last snapshot. The newest SNAPSHOT_KEEP
+    snapshots of each source are kept.
+    """
+
+    CONTROL_SOURCE = "control"
+    CONTROL_PATH = "data/api_maker.db"
+    MAX_RESTARTS = 3
+
+    def __init__(self):
+        self.enabled = os.getenv("SNAPSHOT_ENABLED", "false").lower() == "true"
+        self.interval = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "21600"))
+        self.pages_per_step = int(os.getenv("SNAPSHOT_PAGES_PER_STEP", "256"))
+        self.step_pause = float(os.getenv("SNAPSHOT_STEP_PAUSE_MS", "5")) / 1000
+        self.keep = int(os.getenv("SNAPSHOT_KEEP", "7"))
+        self.compress_level = int(os.getenv("SNAPSHOT_COMPRESS_LEVEL", "6"))  # 0 stores plain .db files
+        self.snapshot_dir = Path(os.getenv("SNAPSHOT_DIR", "data/snapshots"))
+
+    @property
+    def running(self) -> bool:
+        return shared_state.is_locked("snapshots")
+
+    @property
+    def last_report(self) -> Optional[dict]:
+        return shared_state.get_json("report:snapshots")
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.snapshot_dir / "_manifest.json"
+
+    def load_manifest(self) -> dict:
+        if self.manifest_path.exists():
+            return json.loads(self.manifest_path.read_text())
+        return {"sources": {}}
+
+    def save_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_path, self.manifest_path)
+
+    async def sources(self) -> Dict[str, str]:
+        """Snapshot source name -> database path (the control plane only when it is SQLite)"""
+        paths = await control_plane.sqlite_database_paths()
+        sources = {self.CONTROL_SOURCE: self.CONTROL_PATH} if control_plane.is_sqlite else {}
+        sources.update({database_id: path for database_id, path in paths.items() if os.path.exists(path)})
+        return sources
+
+    def snapshot(self, source: str, path: str) -> dict:
+        """Copy one database online and compress it (blocking; run in a worker thread)"""
+        started = time.perf_counter()
+        target_dir = self.snapshot_dir / source
+        target_dir.mkdir(parents=True, exist_ok=True)
+        name = datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ") + (".db.gz" if self.compress_level else ".db")
+        raw_path = target_dir / f"{name}.tmp"
+
+        step_times = []
+        step_started = time.perf_counter()
+        restarts = 0
+        last_remaining = None
+        pinned = False
+
+        def progress(_status, remaining, total):
+            nonlocal step_started, restarts, last_remaining
+            step_times.append(time.perf_counter() - step_started)
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1  # Another connection wrote to the source; SQLite starts over
+                if restarts > self.MAX_RESTARTS and not pinned:
+                    raise _SnapshotRestarted()
+            last_remaining = remaining
+            if remaining:
+                time.sleep(self.step_pause)  # Yield the source between steps
+            step_started = time.perf_counter()
+
+        source_conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, isolation_level=None)
+        target_conn = sqlite3.connect(raw_path)
+        try:
+            page_size = source_conn.execute("PRAGMA page_size").fetchone()[0]
+            pinned = source_conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            if pinned:
+                # Copy one read snapshot: WAL writers neither wait for nor restart the backup
+                source_conn.execute("BEGIN")
+                source_conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            try:
+                source_conn.backup(target_conn, pages=self.pages_per_step, progress=progress, sleep=self.step_pause)
+            except _SnapshotRestarted:
+                # Rollback-journal database under constant writes: pin a snapshot to finish,
+                # which holds writers off for the rest of the copy
+                pinned, last_remaining = True, None
+                source_conn.execute("BEGIN")
+                source_conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                source_conn.backup(target_conn, pages=self.pages_per_step, progress=progress, sleep=self.step_pause)
+            pages = target_conn.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            target_conn.close()
+            source_conn.close()
+
+        final_path = target_dir / name
+        if self.compress_level:
+            compressed_path = target_dir / f"{name}.gz-tmp"
+            with open(raw_path, "rb") as raw, gzip.open(compressed_path, "wb", compresslevel=self.compress_level) as out:
+                while chunk := raw.read(1024 * 1024):
+                    out.write(chunk)
+            raw_path.unlink()
+            os.replace(compressed_path, final_path)
+        else:
+            os.replace(raw_path, final_path)
+
+        duration = time.perf_counter() - started
+        database_bytes = pages * page_size
+        entry = {
+            "name": name,
+            "pages": pages,
+            "bytes": database_bytes,
+            "stored_bytes": final_path.stat().st_size,
+            "steps": len(step_times),
+            "restarts": restarts,
+            "max_step_ms": round(max(step_times, default=0) * 1000, 2),
+            "mean_step_ms": round(sum(step_times) / len(step_times) * 1000, 2) if step_times else 0,
+            "duration_seconds": round(duration, 3),
+            "mb_per_second": round(database_bytes / 1e6 / duration, 2) if duration else None,
+            "created_at": datetime.now().isoformat()
+        }
+        metrics.observe("apiengine_snapshot_step_seconds", max(step_times, default=0))
+        metrics.inc("apiengine_snapshot_bytes_total", amount=database_bytes)
+        return entry
+
+    def _prune(self, source: str, state: dict):
+        while len(state["snapshots"]) > self.keep:
+            expired = state["snapshots"].pop(0)
+            (self.snapshot_dir / source / expired["name"]).unlink(missing_ok=True)
+
+    def run_once(self, sources: Dict[str, str], only: Optional[List[str]] = None, force: bool = False) -> dict:
+        """Snapshot every changed source, or the given ones (blocking)"""
+        started = time.perf_counter()
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        manifest = self.load_manifest()
+        taken, skipped = {}, []
+        for source, path in sources.items():
+            if only is not None and source not in only:
+                continue
+            state = manifest["sources"].setdefault(source, {"fingerprint": None, "snapshots": []})
+            # Fingerprint before copying, so writes during the copy trigger the next snapshot
+            fingerprint = list(database_mtime(path))
+            if not force and state["fingerprint"] == fingerprint:
+                skipped.append(source)
+                continue
+            try:
+                entry = self.snapshot(source, path)
+            except sqlite3.Error as e:
+                logger.error(f"Snapshot of {source} failed: {e}")
+                continue
+            state["fingerprint"] = fingerprint
+            state["snapshots"].append(entry)
+            self._prune(source, state)
+            self.save_manifest(manifest)
+            taken[source] = entry
+
+        report = {
+            "snapshots_taken": len(taken),
+            "sources_unchanged": len(skipped),
+            "bytes": sum(entry["bytes"] for entry in taken.values()),
+            "stored_bytes": sum(entry["stored_bytes"] for entry in taken.values()),
+            "max_step_ms": max((entry["max_step_ms"] for entry in taken.values()), default=0),
+            "duration_seconds": round(time.perf_counter() - started, 3),
+            "taken": taken,
+            "completed_at": datetime.now().isoformat()
+        }
+        shared_state.set_json("report:snapshots", report)
+        logger.info(f"Snapshots completed: {len(taken)} taken, {len(skipped)} unchanged")
+        return report
 
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-"""
-    return code
+    def restore(self, sources: Dict[str, str], source: str, name: str) -> dict:
+        """Replace a live database with one of its snapshots (blocking)"""
+        path = sources.get(source)
+        state = self.load_manifest()["sources"].get(source)
+        if not path or not state or name not in {entry["name"] for entry in state["snapshots"]}:
+            raise HTTPException(status_code=404, detail="Snapshot not found")
+        started = time.perf_counter()
+        snapshot_path = self.snapshot_dir / source / name
+        staging_path = self.snapshot_dir / source / f"restore-{secrets.token_hex(4)}.db"
+        try:
+            if name.endswith(".gz"):
+                with gzip.open(snapshot_path, "rb") as compressed, open(staging_path, "wb") as out:
+                    while chunk := compressed.read(1024 * 1024):
+                        out.write(chunk)
+            else:
+                staging_path.write_bytes(snapshot_path.read_bytes())
+            staged = sqlite3.connect(staging_path)
+            try:
+                if staged.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+                    raise HTTPException(status_code=422, detail="Snapshot failed its integrity check")
+                live = sqlite3.connect(path, timeout=30)
+                try:
+                    # A single step: readers see either the old or the restored database
+                    staged.backup(live)
+                    if source == self.CONTROL_SOURCE:
+                        # The copy carries the lock row held while it was taken
+                        live.execute("DELETE FROM shared_locks WHERE name = 'snapshots'")
+                        live.commit()
+                finally:
+                    live.close()
+            finally:
+                staged.close()
+        finally:
+            staging_path.unlink(missing_ok=True)
 
-async def deploy_api_container(api_id: str, language: str, code: str, endpoint: str):
-    """Deploy API in Docker container"""
-    if not docker_client:
-        raise HTTPException(status_code=500, detail="Docker not available")
-    
-    try:
-        # Create temporary directory for build
-        build_dir = Path(f"/tmp/api_{api_id}")
-        build_dir.mkdir(exist_ok=True)
-        
-        # Create application files
-        app_content = create_app_file(language, code)
-        dockerfile_content = create_dockerfile(language, code, endpoint)
-        
-        # Write files
-        (build_dir / "app.py").write_text(app_content)
-        (build_dir / "Dockerfile").write_text(dockerfile_content)
-        
-        if language == "python":
-            (build_dir / "requirements.txt").write_text("fastapi==0.104.1\nuvicorn==0.24.0")
-        
-        # Build Docker image
-        image_tag = f"api_{api_id}:latest"
-        docker_client.images.build(path=str(build_dir), tag=image_tag)
-        
-        # Run container
-        container = docker_client.containers.run(
-            image_tag,
-            detach=True,
-            ports={'8000/tcp': None},
-            name=f"api_{api_id}"
-        )
-        
-        # Get assigned port
-        container.reload()
-        port = container.attrs['NetworkSettings']['Ports']['8000/tcp'][0]['HostPort']
-        
-        return container.id, int(port)
-        
-    except Exception as e:
-        logger.error(f"Deployment error: {e}")
-        raise HTTPException(status_code=500, detail=f"Deployment failed: {str(e)}")
+        user_db_pool.discard(path)
+        schema_catalog.entries.pop(path, None)
+        if source == self.CONTROL_SOURCE:
+            api_key_index.invalidate()
+        logger.warning(f"Restored {source} from snapshot {name}")
+        return {"source": source, "snapshot": name, "duration_seconds": round(time.perf_counter() - started, 3)}
+
+    async def run_locked(self, function, *args):
+        """Run a snapshot or restore of the current sources in a worker thread under the shared lock"""
+        owner = secrets.token_urlsafe(8)
+        if not await asyncio.to_thread(shared_state.acquire_lock, "snapshots", self.interval, owner):
+            raise HTTPException(status_code=409, detail="A snapshot or restore is already running")
+        try:
+            return await asyncio.to_thread(function, await self.sources(), *args)
+        finally:
+            await asyncio.to_thread(shared_state.release_lock, "snapshots", owner)
+
+    async def run_forever(self):
+        """Periodic incremental snapshot loop started with the application"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_locked(self.run_once)
+            except HTTPException:
+                pass  # Another worker is already snapshotting
+            except Exception as e:
+                logger.error(f"Snapshot run failed: {e}")
+
+snapshot_manager = SnapshotManager()
+metrics.histogram("apiengine_snapshot_step_seconds", "Longest backup step (source read-lock hold) per snapshot")
+metrics.counter("apiengine_snapshot_bytes_total", "Database bytes copied into snapshots")
 
 # API Routes
 
 @app.on_event("startup")
 async def startup():
-    init_db()
+    if control_plane.is_sqlite:
+        # Worker processes start together; serialize schema setup
+        with open("data/.startup.lock", "w") as startup_lock:
+            fcntl.flock(startup_lock, fcntl.LOCK_EX)
+            init_db()
+    elif shared_state.backend != "redis":
+        # Without Redis, shared state lives in the SQLite control-plane file
+        raise RuntimeError("A Postgres control plane needs Redis (REDIS_URL) for shared state")
+    await control_plane.create_schema()
+    
     # Create default admin user if not exists
-    conn = get_db_connection()
-    admin_exists = conn.execute("SELECT id FROM users WHERE username = 'admin'").fetchone()
-    if not admin_exists:
-        admin_id = generate_user_id()
-        admin_password = hash_password("admin123")  # Change this in production
-        conn.execute("""
-            INSERT INTO users (id, username, email, password_hash)
-            VALUES (?, ?, ?, ?)
-        """, (admin_id, "admin", "admin@apimaker.local", admin_password))
-        conn.commit()
-        logger.info("Default admin user created: admin/admin123")
-    conn.close()
+    if not await control_plane.find_user(username="admin"):
+        try:
+            await control_plane.create_user(generate_user_id(), "admin", "admin@apimaker.local",
+                                            hash_password("admin123"))  # Change this in production
+            logger.info("Default admin user created: admin/admin123")
+        except IntegrityError:
+            pass  # Another worker or host created it first
+    logger.info(f"Worker {os.getpid()} started with {control_plane.backend} control plane "
+                f"and {shared_state.backend} shared state")
+    
+    if metrics.enabled:
+        app.state.metrics_task = asyncio.create_task(metrics.run_flusher())
+    if retention_engine.enabled and control_plane.is_sqlite:
+        app.state.retention_task = asyncio.create_task(retention_engine.run_forever())
+    if request_log_exporter.enabled and control_plane.is_sqlite:
+        app.state.export_task = asyncio.create_task(request_log_exporter.run_forever())
+    if snapshot_manager.enabled:
+        app.state.snapshot_task = asyncio.create_task(snapshot_manager.run_forever())
+    if worker_runtime.active:
+        app.state.worker_runtime_task = asyncio.create_task(worker_runtime.run_forever())
+    if autoscaler.enabled and (docker_client or worker_runtime.active):
+        app.state.autoscale_task = asyncio.create_task(autoscaler.run_forever())
+    if usage_meter.enabled:
+        app.state.metering_task = asyncio.create_task(usage_meter.run_forever())
+    if latency_tracker.enabled:
+        app.state.latency_task = asyncio.create_task(latency_tracker.run_forever())
+    if webhooks.enabled:
+        app.state.webhook_task = asyncio.create_task(webhooks.run_forever())
+    if static_files.enabled:
+        app.state.precompress_task = asyncio.create_task(asyncio.to_thread(static_files.precompress))
+
+@app.on_event("shutdown")
+async def shutdown():
+    await usage_meter.flush()
+    await latency_tracker.flush()
+    if webhooks.client is not None:
+        await webhooks.client.aclose()
+    await control_plane.dispose()
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    """The dashboard page, revalidated by ETag so repeat loads get a 304"""
+    response = templates.TemplateResponse("index.html", {"request": request})
+    etag = '"' + hashlib.sha1(response.body).hexdigest()[:20] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
 
 # Authentication Routes
 @app.post("/api/auth/register")
 async def register(user_data: UserCreate):
     """Register a new user"""
-    conn = get_db_connection()
-    
     # Check if username already exists
-    existing = conn.execute("SELECT id FROM users WHERE username = ?", (user_data.username,)).fetchone()
-    if existing:
-        conn.close()
+    if await control_plane.find_user(username=user_data.username):
         raise HTTPException(status_code=400, detail="Username already exists")
     
     # Check if email already exists (if provided)
-    if user_data.email:
-        existing_email = conn.execute("SELECT id FROM users WHERE email = ?", (user_data.email,)).fetchone()
-        if existing_email:
-            conn.close()
-            raise HTTPException(status_code=400, detail="Email already exists")
+    if user_data.email and await control_plane.find_user(email=user_data.email):
+        raise HTTPException(status_code=400, detail="Email already exists")
     
     try:
         user_id = generate_user_id()
         password_hash = hash_password(user_data.password)
         
-        conn.execute("""
-            INSERT INTO users (id, username, email, password_hash)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, user_data.username, user_data.email, password_hash))
-        conn.commit()
+        await control_plane.create_user(user_id, user_data.username, user_data.email, password_hash)
         
         # Create JWT token
         token = create_jwt_token(user_id)
         
-        conn.close()
         return {
             "access_token": token,
             "user": {
@@ -1064,17 +6538,15 @@ async def register(user_data: UserCreate):
                 "is_active": True
             }
         }
+    except IntegrityError:
+        raise HTTPException(status_code=400, detail="Username or email already exists")
     except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/auth/login")
 async def login(login_data: UserLogin):
     """Login user"""
-    conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE username = ? AND is_active = TRUE", 
-                       (login_data.username,)).fetchone()
-    conn.close()
+    user = await control_plane.find_user(username=login_data.username, active_only=True)
     
     if not user or not verify_password(login_data.password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -1103,21 +6575,36 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 
 @app.post("/api/generate-code")
 async def generate_code(request: CodeGenerationRequest, current_user: dict = Depends(get_current_user)):
-    """Generate API code using AI"""
+    """Generate API code from the templates when the prompt is a plain CRUD resource, else with AI"""
     try:
-        code = await generate_code_with_gpt(request.prompt, request.language, request.endpoint)
+        started = time.perf_counter()
+        plan = template_router.classify(request.prompt) if template_router.enabled and request.language == "python" else None
+        if plan:
+            endpoint = request.endpoint or plan["endpoint"]
+            code = generate_enhanced_api_code(request.prompt, request.language, endpoint, columns=plan["columns"])
+            generator = "template"
+        else:
+            code = await generate_code_with_gpt(request.prompt, request.language, request.endpoint)
+            generator = "llm"
+        await template_router.record(generator, time.perf_counter() - started)
         
         # Generate suggestions based on the prompt
         suggested_name = generate_api_name_from_prompt(request.prompt)
-        suggested_endpoint = request.endpoint or generate_endpoint_from_prompt(request.prompt)
+        suggested_endpoint = request.endpoint or (plan["endpoint"] if plan else generate_endpoint_from_prompt(request.prompt))
         description = request.prompt[:200]  # Use first part of prompt as description
         
         return {
             "code": code,
+            "generator": generator,
             "suggested_name": suggested_name,
             "suggested_endpoint": suggested_endpoint,
             "description": description,
-            "parameters": []  # Could be enhanced to parse parameters from generated code
+            # Template models come with typed fields; AI output is not parsed for parameters
+            "parameters": [
+                {"name": column["name"], "type": sqlite_python_type(column["type"]), "required": column["notnull"],
+                 "description": ""}
+                for column in plan["columns"] if column["name"] not in ("id", "created_at")
+            ] if plan else []
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1125,55 +6612,28 @@ async def generate_code(request: CodeGenerationRequest, current_user: dict = Dep
 @app.post("/api/apis")
 async def create_api(api_data: APICreate, current_user: dict = Depends(get_current_user)):
     """Create a new API"""
-    conn = get_db_connection()
     api_id = generate_api_id()
     
     # Check if endpoint already exists
-    existing = conn.execute("SELECT id FROM apis WHERE endpoint = ?", (api_data.endpoint,)).fetchone()
-    if existing:
-        conn.close()
+    if await control_plane.endpoint_exists(api_data.endpoint):
         raise HTTPException(status_code=400, detail="Endpoint already exists")
     
     # Generate API key if not public
     api_key = api_data.api_key if api_data.api_key else (generate_api_key() if not api_data.is_public else None)
     
     try:
-        # Insert API
-        conn.execute("""
-            INSERT INTO apis (id, user_id, name, endpoint, description, code, language, is_public, 
-                            api_key, rate_limit_requests, rate_limit_period, pricing_model, 
-                            price_per_request, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (api_id, current_user['id'], api_data.name, api_data.endpoint, api_data.description, 
-              api_data.code, api_data.language, api_data.is_public, api_key, 
-              api_data.rate_limit_requests, api_data.rate_limit_period, api_data.pricing_model, 
-              api_data.price_per_request, 'draft'))
-        
-        # Insert parameters
-        for param in api_data.parameters:
-            conn.execute("""
-                INSERT INTO api_parameters (api_id, name, type, required, description)
-                VALUES (?, ?, ?, ?, ?)
-            """, (api_id, param.name, param.type, param.required, param.description))
-        
-        # Insert API settings
-        if api_data.settings:
-            settings = api_data.settings
-            conn.execute("""
-                INSERT INTO api_settings (api_id, max_requests_per_hour, max_requests_per_day, 
-                                        max_requests_per_month, requires_auth, allowed_origins, webhook_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (api_id, settings.max_requests_per_hour, settings.max_requests_per_day, 
-                  settings.max_requests_per_month, settings.requires_auth, 
-                  settings.allowed_origins, settings.webhook_url))
-        else:
-            # Default settings
-            conn.execute("""
-                INSERT INTO api_settings (api_id) VALUES (?)
-            """, (api_id,))
-        
-        conn.commit()
-        conn.close()
+        # Insert API with its parameters and settings (keys are stored hashed in api_keys,
+        # never on the apis row); default settings when none are given
+        await control_plane.create_api(
+            {"id": api_id, "user_id": current_user['id'], "name": api_data.name, "endpoint": api_data.endpoint,
+             "description": api_data.description, "code": api_data.code, "language": api_data.language,
+             "is_public": api_data.is_public, "rate_limit_requests": api_data.rate_limit_requests,
+             "rate_limit_period": api_data.rate_limit_period, "pricing_model": api_data.pricing_model,
+             "price_per_request": api_data.price_per_request, "status": 'draft'},
+            [param.dict() for param in api_data.parameters],
+            api_data.settings.dict() if api_data.settings else {},
+            api_key
+        )
         
         return {
             "id": api_id,
@@ -1183,145 +6643,172 @@ async def create_api(api_data: APICreate, current_user: dict = Depends(get_curre
             "status": "created"
         }
         
+    except IntegrityError:
+        raise HTTPException(status_code=400, detail="Endpoint already exists")
     except Exception as e:
-        conn.close()
-        raise HTTPException(status_code=500, detail=str(e))
-        
-    except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/validate-code")
+async def validate_code(request: CodeValidationRequest, current_user: dict = Depends(get_current_user)):
+    """Run the pre-deploy checks on code without deploying it"""
+    return await asyncio.to_thread(code_validator.validate, request.language, request.code)
+
 @app.post("/api/apis/{api_id}/deploy")
 async def deploy_api(api_id: str, background_tasks: BackgroundTasks):
-    """Deploy API to container"""
-    conn = get_db_connection()
-    api = conn.execute("SELECT * FROM apis WHERE id = ?", (api_id,)).fetchone()
+    """Deploy the API's current code as a new version, replacing the live one without downtime"""
+    api = await control_plane.get_api_with_settings(api_id=api_id)
     
     if not api:
-        conn.close()
         raise HTTPException(status_code=404, detail="API not found")
     
+    # Only one worker process may deploy a given API at a time
+    deploy_owner = secrets.token_urlsafe(8)
+    if not shared_state.acquire_lock(f"deploy:{api_id}", 600, deploy_owner):
+        raise HTTPException(status_code=409, detail="A deployment for this API is already in progress")
+    
     try:
-        # Deploy in background
-        container_id, port = await deploy_api_container(api_id, api['language'], api['code'], api['endpoint'])
+        deployment = await deployment_manager.deploy(api)
         
-        # Update database
-        conn.execute("""
-            UPDATE apis SET status = 'deployed', container_id = ?, port = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        """, (container_id, port, api_id))
-        conn.commit()
-        conn.close()
+        # The replaced version finishes its in-flight requests after the response is sent
+        background_tasks.add_task(deployment_manager.retire, api_id, deployment['previous'])
         
         return {
             "status": "deployed",
-            "container_id": container_id,
-            "port": port,
-            "endpoint": f"http://localhost:{port}"
+            "version": deployment['version'],
+            "previous_version": deployment['previous']['version'] if deployment['previous'] else None,
+            "container_id": deployment['container_id'],
+            "port": deployment['port'],
+            "endpoint": f"http://localhost:{deployment['port']}"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        shared_state.release_lock(f"deploy:{api_id}", deploy_owner)
+
+@app.get("/api/apis/{api_id}/deployments")
+async def list_deployments(api_id: str, current_user: dict = Depends(get_current_user)):
+    """An API's deployed versions, newest first"""
+    await get_owned_api(api_id, current_user['id'])
+    return {"deployments": await control_plane.list_deployments(api_id)}
+
+@app.post("/api/apis/{api_id}/rollback")
+async def rollback_api(api_id: str, background_tasks: BackgroundTasks, version: Optional[int] = None,
+                       current_user: dict = Depends(get_current_user)):
+    """Route the API back to the version it replaced last (or to a given version)"""
+    api = await control_plane.get_api_with_settings(api_id=api_id, user_id=current_user['id'])
+    if not api:
+        raise HTTPException(status_code=404, detail="API not found")
+    
+    deploy_owner = secrets.token_urlsafe(8)
+    if not shared_state.acquire_lock(f"deploy:{api_id}", 600, deploy_owner):
+        raise HTTPException(status_code=409, detail="A deployment for this API is already in progress")
+    
+    try:
+        deployment = await deployment_manager.rollback(api, version)
+        background_tasks.add_task(deployment_manager.retire, api_id, deployment['previous'])
+        return {
+            "status": "rolled_back",
+            "version": deployment['version'],
+            "previous_version": deployment['previous']['version'] if deployment['previous'] else None,
+            "warm": deployment['warm'],
+            "port": deployment['port']
+        }
+    finally:
+        shared_state.release_lock(f"deploy:{api_id}", deploy_owner)
+
+@app.get("/api/apis/{api_id}/autoscaling")
+async def get_autoscaling(api_id: str, current_user: dict = Depends(get_current_user)):
+    """Resource profile, replica bounds, running replicas and the autoscaler's recent decisions"""
+    api = await control_plane.get_api_with_settings(api_id=api_id, user_id=current_user['id'])
+    if not api:
+        raise HTTPException(status_code=404, detail="API not found")
+    low, high = replica_bounds(api)
+    profile = api['resource_profile'] or "small"
+    return {
+        "resource_profile": profile,
+        "limits": RESOURCE_PROFILES.get(profile, RESOURCE_PROFILES["small"]),
+        "min_replicas": low,
+        "max_replicas": high,
+        "target_p95_ms": api['target_p95_ms'] or 500,
+        "replicas": (1 + len(parse_ports(api['replica_ports']))) if api['status'] == 'deployed' else 0,
+        "decisions": await control_plane.autoscale_decisions(api_id)
+    }
 
 @app.get("/api/apis")
 async def list_apis(current_user: dict = Depends(get_current_user)):
     """List user's APIs"""
-    conn = get_db_connection()
-    apis = conn.execute("""
-        SELECT a.id, a.name, a.endpoint, a.description, a.language, a.is_public, a.status, 
-               a.rate_limit_requests, a.rate_limit_period, a.created_at, a.port,
-               COUNT(r.id) as total_requests,
-               s.max_requests_per_hour, s.max_requests_per_day, s.max_requests_per_month,
-               s.requires_auth
-        FROM apis a
-        LEFT JOIN api_requests r ON a.id = r.api_id
-        LEFT JOIN api_settings s ON a.id = s.api_id
-        WHERE a.user_id = ?
-        GROUP BY a.id
-        ORDER BY a.created_at DESC
-    """, (current_user['id'],)).fetchall()
-    conn.close()
-    
-    return [dict(api) for api in apis]
+    return FastJSONResponse(await control_plane.list_apis(current_user['id']))
 
 @app.get("/api/apis/{api_id}")
 async def get_api(api_id: str):
     """Get API details"""
-    conn = get_db_connection()
-    api = conn.execute("SELECT * FROM apis WHERE id = ?", (api_id,)).fetchone()
+    api = await control_plane.get_api(api_id)
     
     if not api:
-        conn.close()
         raise HTTPException(status_code=404, detail="API not found")
     
-    # Get parameters
-    parameters = conn.execute("""
-        SELECT name, type, required, description FROM api_parameters WHERE api_id = ?
-    """, (api_id,)).fetchall()
-    
-    conn.close()
-    
-    result = dict(api)
-    result['parameters'] = [dict(param) for param in parameters]
-    return result
+    api['parameters'] = await control_plane.get_parameters(api_id)
+    return api
 
 @app.put("/api/apis/{api_id}")
 async def update_api(api_id: str, api_data: APIUpdate):
     """Update API"""
-    conn = get_db_connection()
-    api = conn.execute("SELECT * FROM apis WHERE id = ?", (api_id,)).fetchone()
+    api = await control_plane.get_api(api_id)
     
     if not api:
-        conn.close()
         raise HTTPException(status_code=404, detail="API not found")
     
-    # Build update query
-    updates = []
-    values = []
-    
-    for field, value in api_data.dict(exclude_unset=True).items():
-        if value is not None:
-            updates.append(f"{field} = ?")
-            values.append(value)
+    fields = api_data.dict(exclude_unset=True)
+    # Replacing the key revokes every existing key for this API
+    new_api_key = fields.pop('api_key', None)
+    settings = fields.pop('settings', None)  # Stored in api_settings, not on the apis row
+    updates = {field: value for field, value in fields.items() if value is not None}
     
-    if updates:
-        values.append(api_id)
-        query = f"UPDATE apis SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE id = ?"
-        conn.execute(query, values)
-        conn.commit()
+    if new_api_key or updates or settings:
+        await control_plane.update_api(api_id, updates, new_api_key, settings)
+    if new_api_key:
+        api_key_index.invalidate()
     
-    conn.close()
     return {"status": "updated"}
 
 @app.delete("/api/apis/{api_id}")
 async def delete_api(api_id: str):
-    """Delete API and stop container"""
-    conn = get_db_connection()
-    api = conn.execute("SELECT * FROM apis WHERE id = ?", (api_id,)).fetchone()
+    """Delete API and stop its containers"""
+    api = await control_plane.get_api(api_id)
     
     if not api:
-        conn.close()
         raise HTTPException(status_code=404, detail="API not found")
     
-    # Stop and remove container if exists
-    if api['container_id'] and docker_client:
-        try:
-            container = docker_client.containers.get(api['container_id'])
-            container.stop()
-            container.remove()
-        except:
-            pass
+    # Stop and remove the containers of every version still running, and their replicas
+    container_ids = {api['container_id']}
+    for row in await control_plane.list_deployments(api_id):
+        if row['status'] != 'stopped':
+            container_ids.add(row['container_id'])
+        container_ids.update(replica['container_id'] for replica in await control_plane.list_replicas(row['id']))
+    for container_id in container_ids - {None}:
+        await asyncio.to_thread(stop_api_container, container_id)
     
     # Delete from database
-    conn.execute("DELETE FROM api_parameters WHERE api_id = ?", (api_id,))
-    conn.execute("DELETE FROM api_requests WHERE api_id = ?", (api_id,))
-    conn.execute("DELETE FROM apis WHERE id = ?", (api_id,))
-    conn.commit()
-    conn.close()
+    await control_plane.delete_api(api_id)
+    api_key_index.invalidate()
     
     return {"status": "deleted"}
 
+# Connection-specific headers (RFC 9110 section 7.6.1); the proxy's own client sets Host and Content-Length
+HOP_BY_HOP_HEADERS = frozenset({"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                                "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+                                "host", "content-length"})
+
+def upstream_headers(headers: Headers) -> Dict[str, str]:
+    """Request headers to forward to a container: end-to-end ones only, Accept-Encoding always set"""
+    listed = {token.strip().lower() for value in headers.getlist("connection") for token in value.split(",")}
+    forwarded = {key: value for key, value in headers.items() if key not in HOP_BY_HOP_HEADERS | listed}
+    forwarded["accept-encoding"] = headers.get("accept-encoding", "identity")
+    return forwarded
+
 @app.post("/api/execute/{endpoint}")
 @app.get("/api/execute/{endpoint}")
 @app.put("/api/execute/{endpoint}")
@@ -1329,162 +6816,242 @@ async def delete_api(api_id: str):
 async def execute_api(endpoint: str, request: Request):
     """Execute deployed API with enhanced rate limiting and authentication"""
     start_time = time.time()
+    stages = RequestStages()
+    api_label = "_unknown"  # Keep unknown endpoints in a single series
+    status_code = 500
+    api = None
+    admitted = False  # Past auth and rate limiting: the request counts toward the API's latency
     
-    # Get API details with settings
-    conn = get_db_connection()
-    api = conn.execute("""
-        SELECT a.*, s.max_requests_per_hour, s.max_requests_per_day, s.requires_auth, s.allowed_origins
-        FROM apis a
-        LEFT JOIN api_settings s ON a.id = s.api_id
-        WHERE a.endpoint = ?
-    """, (endpoint,)).fetchone()
-    
-    if not api:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API endpoint not found")
-    
-    if api['status'] != 'deployed':
-        conn.close()
-        raise HTTPException(status_code=503, detail="API not deployed")
-    
-    # Enhanced authentication check
-    if not api['is_public']:
-        # Check for API key in multiple locations
-        api_key = None
-        
-        # Check X-API-Key header
-        if 'X-API-Key' in request.headers:
-            api_key = request.headers['X-API-Key']
-        # Check Authorization header
-        elif 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if auth_header.startswith('Bearer '):
-                api_key = auth_header.split(' ')[1]
-            elif auth_header.startswith('API-Key '):
-                api_key = auth_header.split(' ')[1]
-        # Check query parameter
-        elif 'api_key' in request.query_params:
-            api_key = request.query_params['api_key']
+    try:
+        # Get API details with settings
+        api = await control_plane.get_api_with_settings(endpoint=endpoint)
+        stages.mark("route_lookup")
         
-        if not api_key:
-            conn.close()
-            raise HTTPException(status_code=401, detail="API key required. Provide via X-API-Key header, Authorization header, or api_key query parameter")
+        if not api:
+            raise HTTPException(status_code=404, detail="API endpoint not found")
         
-        if api_key != api['api_key']:
-            conn.close()
-            raise HTTPException(status_code=401, detail="Invalid API key")
-    
-    # Enhanced rate limiting with per-API settings
-    client_ip = request.client.host
-    settings = {
-        'max_requests_per_hour': api.get('max_requests_per_hour', 1000),
-        'max_requests_per_day': api.get('max_requests_per_day', 10000)
-    }
-    
-    rate_limit_allowed, current_count, max_requests = check_rate_limit_enhanced(
-        api['id'], settings, None, client_ip
-    )
-    
-    if not rate_limit_allowed:
-        conn.close()
-        raise HTTPException(
-            status_code=429, 
-            detail=f"Rate limit exceeded. {current_count}/{max_requests} requests used."
-        )
-    
-    try:
-        # Forward request to deployed container
-        import httpx
-        container_url = f"http://localhost:{api['port']}/{endpoint}"
+        api_label = api['endpoint']
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            if request.method == "GET":
-                response = await client.get(container_url, params=request.query_params)
-            else:
-                body = await request.body()
-                response = await client.request(
-                    request.method,
-                    container_url,
-                    content=body,
-                    headers=dict(request.headers)
-                )
+        if api['status'] != 'deployed':
+            raise HTTPException(status_code=503, detail="API not deployed")
         
-        response_time = time.time() - start_time
+        # Enhanced authentication check
+        key_record = None
+        if not api['is_public']:
+            # Check for API key in multiple locations
+            api_key = None
+            
+            # Check X-API-Key header
+            if 'X-API-Key' in request.headers:
+                api_key = request.headers['X-API-Key']
+            # Check Authorization header
+            elif 'Authorization' in request.headers:
+                auth_header = request.headers['Authorization']
+                if auth_header.startswith('Bearer '):
+                    api_key = auth_header.split(' ')[1]
+                elif auth_header.startswith('API-Key '):
+                    api_key = auth_header.split(' ')[1]
+            # Check query parameter
+            elif 'api_key' in request.query_params:
+                api_key = request.query_params['api_key']
+            
+            if not api_key:
+                raise HTTPException(status_code=401, detail="API key required. Provide via X-API-Key header, Authorization header, or api_key query parameter")
+            
+            key_record = await api_key_index.verify(api['id'], api_key)
+            if not key_record:
+                raise HTTPException(status_code=401, detail="Invalid API key")
+            
+            if not api_key_index.allows(key_record, request.method):
+                raise HTTPException(status_code=403, detail="API key scope does not allow this method")
+        stages.mark("auth")
         
-        # Log request for analytics
-        conn.execute("""
-            INSERT INTO api_requests (api_id, endpoint, method, status_code, response_time, ip_address, user_agent)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (api['id'], endpoint, request.method, response.status_code, response_time, 
-              client_ip, request.headers.get('User-Agent', '')))
-        conn.commit()
-        conn.close()
+        # Enhanced rate limiting with per-API settings (per key when one is used)
+        client_ip = request.client.host
+        settings = {
+            'max_requests_per_hour': api['max_requests_per_hour'] or 1000,
+            'max_requests_per_day': api['max_requests_per_day'] or 10000
+        }
         
-        return JSONResponse(
-            content=response.json() if response.headers.get('content-type', '').startswith('application/json') else response.text,
-            status_code=response.status_code,
-            headers={"X-Rate-Limit-Remaining": str(max_requests - current_count)}
+        rate_limit_allowed, current_count, max_requests = await quota_leases.check(
+            api['id'], settings, f"key:{key_record['id']}" if key_record else None, client_ip
         )
+        stages.mark("rate_limit")
         
-    except Exception as e:
-        conn.close()
-        logger.error(f"API execution error: {e}")
-        raise HTTPException(status_code=500, detail=f"API execution failed: {str(e)}")
+        if not rate_limit_allowed:
+            webhooks.rate_limited(api, current_count, max_requests)
+            raise HTTPException(
+                status_code=429, 
+                detail=f"Rate limit exceeded. {current_count}/{max_requests} requests used."
+            )
+        
+        admitted = True
+        async with admission_controller.slot(api_label, api['max_concurrency'],
+                                             admission_controller.request_budget(request)):
+            stages.mark("queue")
+            try:
+                # Forward request to deployed container
+                import httpx
+                container_url = f"http://localhost:{deployment_manager.upstream_port(api)}/{endpoint}"
+            
+                async with httpx.AsyncClient(timeout=30.0) as client:
+                    if request.method == "GET":
+                        # Only encodings the caller accepts, so a compressed JSON body can be passed through
+                        upstream = client.build_request(
+                            "GET", container_url, params=request.query_params,
+                            headers={"Accept-Encoding": request.headers.get("Accept-Encoding", "identity")}
+                        )
+                    else:
+                        body = await request.body()
+                        upstream = client.build_request(
+                            request.method,
+                            container_url,
+                            content=body,
+                            headers=upstream_headers(request.headers)
+                        )
+                    response = await client.send(upstream, stream=True)
+                    try:
+                        # JSON bodies are relayed as received (still compressed, if they were) instead of re-encoded
+                        is_json = response.headers.get('content-type', '').startswith('application/json')
+                        if is_json:
+                            content = b"".join([chunk async for chunk in response.aiter_raw()])
+                        else:
+                            await response.aread()
+                    finally:
+                        await response.aclose()
+                stages.mark("upstream")
+                usage_meter.record(api['id'], key_record['id'] if key_record else None)
+            
+                response_time = time.time() - start_time
+            
+                # Log request for analytics
+                await control_plane.log_request(
+                    api_id=api['id'], endpoint=endpoint, method=request.method, status_code=response.status_code,
+                    response_time=response_time, ip_address=client_ip,
+                    user_agent=request.headers.get('User-Agent', ''), api_key_id=key_record['id'] if key_record else None
+                )
+                stages.mark("logging")
+            
+                status_code = response.status_code
+                headers = {"X-Rate-Limit-Remaining": str(max_requests - current_count)}
+                if SERVER_TIMING_ENABLED:
+                    headers["Server-Timing"] = stages.server_timing()
+                if not is_json:
+                    return FastJSONResponse(content=response.text, status_code=response.status_code, headers=headers)
+                if 'Content-Encoding' in response.headers:
+                    headers["Content-Encoding"] = response.headers['Content-Encoding']
+                    headers["Vary"] = "Accept-Encoding"
+                return Response(content=content, status_code=response.status_code, headers=headers,
+                                media_type="application/json")
+            
+            except Exception as e:
+                logger.error(f"API execution error: {e}")
+                raise HTTPException(status_code=500, detail=f"API execution failed: {str(e)}")
+    except HTTPException as e:
+        status_code = e.status_code
+        if SERVER_TIMING_ENABLED:
+            e.headers = {**(e.headers or {}), "Server-Timing": stages.server_timing()}
+        raise
+    finally:
+        stages.record(api_label, status_code)
+        if admitted:
+            # Queue rejections, upstream errors and timeouts are part of what the caller waited
+            latency_tracker.record(api['id'], time.time() - start_time)
+        if api:
+            webhooks.record(api, status_code)
+        if SERVER_TIMING_ENABLED:
+            timing = stages.log_fields()
+            logger.info(
+                "execute_api timing endpoint=%s status=%s %s",
+                endpoint, status_code, " ".join(f"{key}={value}" for key, value in timing.items()),
+                extra={"endpoint": endpoint, "status_code": status_code, "timing": timing}
+            )
 
 @app.get("/api/apis/{api_id}/playground")
 async def api_playground(api_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     """API testing playground"""
-    conn = get_db_connection()
-    api = conn.execute("""
-        SELECT a.*, s.max_requests_per_hour, s.max_requests_per_day, s.requires_auth
-        FROM apis a
-        LEFT JOIN api_settings s ON a.id = s.api_id
-        WHERE a.id = ? AND a.user_id = ?
-    """, (api_id, current_user['id'])).fetchone()
+    api = await control_plane.get_api_with_settings(api_id=api_id, user_id=current_user['id'])
     
     if not api:
-        conn.close()
         raise HTTPException(status_code=404, detail="API not found")
     
     # Get parameters
-    parameters = conn.execute("""
-        SELECT name, type, required, description FROM api_parameters WHERE api_id = ?
-    """, (api_id,)).fetchall()
-    
-    conn.close()
+    parameters = await control_plane.get_parameters(api_id)
     
     # Return playground data
-    return {
-        "api": dict(api),
-        "parameters": [dict(param) for param in parameters],
+    return FastJSONResponse({
+        "api": api,
+        "parameters": parameters,
         "test_url": f"/api/execute/{api['endpoint']}",
         "methods": ["GET", "POST", "PUT", "DELETE"],
         "example_request": {
             "method": "POST",
             "headers": {
                 "Content-Type": "application/json",
-                "Authorization": f"Bearer {api['api_key']}" if not api['is_public'] else None
+                "Authorization": "Bearer <your-api-key>" if not api['is_public'] else None
             },
             "body": {param['name']: f"example_{param['type']}" for param in parameters}
         }
+    })
+
+# API Key Management
+async def get_owned_api(api_id: str, user_id: str) -> dict:
+    api = await control_plane.get_api(api_id, user_id)
+    if not api:
+        raise HTTPException(status_code=404, detail="API not found")
+    return api
+
+@app.get("/api/apis/{api_id}/keys")
+async def list_api_keys(api_id: str, current_user: dict = Depends(get_current_user)):
+    """List an API's keys with today's usage (never the keys themselves)"""
+    await get_owned_api(api_id, current_user['id'])
+    keys = await control_plane.list_keys(api_id)
+    
+    day_window = int(time.time() // RATE_LIMIT_WINDOWS["day"])
+    return {
+        "keys": [
+            {**key, "requests_today": int(shared_state.get(f"rate_limit:{api_id}:day:{day_window}:key:{key['id']}"))}
+            for key in keys
+        ]
     }
 
+@app.post("/api/apis/{api_id}/keys")
+async def create_api_key_endpoint(api_id: str, key_data: APIKeyCreate, current_user: dict = Depends(get_current_user)):
+    """Issue an additional key for an API; the plaintext key is only returned here"""
+    await get_owned_api(api_id, current_user['id'])
+    expires_at = datetime.utcnow() + timedelta(days=key_data.expires_in_days) if key_data.expires_in_days else None
+    key_id, api_key = await control_plane.create_key(api_id, key_data.name, ",".join(key_data.scopes), expires_at)
+    return {"id": key_id, "api_key": api_key, "name": key_data.name, "scopes": key_data.scopes, "expires_at": expires_at}
+
+@app.post("/api/apis/{api_id}/keys/{key_id}/rotate")
+async def rotate_api_key(api_id: str, key_id: str, grace_seconds: int = 0, current_user: dict = Depends(get_current_user)):
+    """Replace a key with a new one, optionally keeping the old key valid for a grace period"""
+    await get_owned_api(api_id, current_user['id'])
+    rotated = await control_plane.rotate_key(api_id, key_id, grace_seconds)
+    if not rotated:
+        raise HTTPException(status_code=404, detail="API key not found")
+    api_key_index.invalidate()
+    new_key_id, api_key = rotated
+    return {"id": new_key_id, "api_key": api_key, "replaced": key_id}
+
+@app.delete("/api/apis/{api_id}/keys/{key_id}")
+async def revoke_api_key(api_id: str, key_id: str, current_user: dict = Depends(get_current_user)):
+    """Revoke a key immediately"""
+    await get_owned_api(api_id, current_user['id'])
+    revoked = await control_plane.revoke_keys(api_id, key_id)
+    api_key_index.invalidate()
+    if not revoked:
+        raise HTTPException(status_code=404, detail="API key not found")
+    return {"status": "revoked"}
+
 @app.post("/api/apis/{api_id}/test")
 async def test_api(api_id: str, test_request: APITestRequest, current_user: dict = Depends(get_current_user)):
     """Test API endpoint"""
-    conn = get_db_connection()
-    api = conn.execute("SELECT * FROM apis WHERE id = ? AND user_id = ?", (api_id, current_user['id'])).fetchone()
-    
-    if not api:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API not found")
+    api = await get_owned_api(api_id, current_user['id'])
     
     if api['status'] != 'deployed':
-        conn.close()
         raise HTTPException(status_code=400, detail="API must be deployed to test")
     
-    conn.close()
-    
     try:
         import httpx
         
@@ -1492,10 +7059,6 @@ async def test_api(api_id: str, test_request: APITestRequest, current_user: dict
         test_url = f"http://localhost:{api['port']}/api/{api['endpoint']}"
         headers = test_request.headers or {}
         
-        # Add auth if not public
-        if not api['is_public'] and api['api_key']:
-            headers['Authorization'] = f"Bearer {api['api_key']}"
-        
         async with httpx.AsyncClient(timeout=30.0) as client:
             if test_request.method.upper() == "GET":
                 response = await client.get(test_url, params=test_request.query_params, headers=headers)
@@ -1524,83 +7087,33 @@ async def test_api(api_id: str, test_request: APITestRequest, current_user: dict
 @app.get("/api/analytics")
 async def get_analytics(current_user: dict = Depends(get_current_user)):
     """Get user's analytics data"""
-    conn = get_db_connection()
-    
-    # Total requests for user's APIs
-    total_requests = conn.execute("""
-        SELECT COUNT(*) as count FROM api_requests r
-        JOIN apis a ON r.api_id = a.id
-        WHERE a.user_id = ?
-    """, (current_user['id'],)).fetchone()['count']
-    
-    # Active APIs for user
-    active_apis = conn.execute("""
-        SELECT COUNT(*) as count FROM apis WHERE user_id = ? AND status = 'deployed'
-    """, (current_user['id'],)).fetchone()['count']
-    
-    # Average response time for user's APIs
-    avg_response_time = conn.execute("""
-        SELECT AVG(r.response_time) as avg_time FROM api_requests r
-        JOIN apis a ON r.api_id = a.id
-        WHERE a.user_id = ? AND r.timestamp > datetime('now', '-24 hours')
-    """, (current_user['id'],)).fetchone()['avg_time'] or 0
-    
-    # Top endpoints for user
-    top_endpoints = conn.execute("""
-        SELECT a.name, a.endpoint, COUNT(r.id) as request_count
-        FROM apis a
-        LEFT JOIN api_requests r ON a.id = r.api_id
-        WHERE a.user_id = ? AND a.status = 'deployed'
-        GROUP BY a.id
-        ORDER BY request_count DESC
-        LIMIT 5
-    """, (current_user['id'],)).fetchall()
-    
-    # Request volume by day (last 7 days) for user's APIs
-    daily_requests = conn.execute("""
-        SELECT DATE(r.timestamp) as date, COUNT(*) as count
-        FROM api_requests r
-        JOIN apis a ON r.api_id = a.id
-        WHERE a.user_id = ? AND r.timestamp > datetime('now', '-7 days')
-        GROUP BY DATE(r.timestamp)
-        ORDER BY date
-    """, (current_user['id'],)).fetchall()
-    
-    # Revenue calculation (mock for now)
-    revenue = conn.execute("""
-        SELECT SUM(a.price_per_request * COALESCE(request_counts.count, 0)) as total_revenue
-        FROM apis a
-        LEFT JOIN (
-            SELECT api_id, COUNT(*) as count
-            FROM api_requests
-            WHERE timestamp > datetime('now', '-30 days')
-            GROUP BY api_id
-        ) request_counts ON a.id = request_counts.api_id
-        WHERE a.user_id = ? AND a.pricing_model = 'payg'
-    """, (current_user['id'],)).fetchone()['total_revenue'] or 0
+    # Totals include rolled-up history; revenue is the current billing period of payg APIs, from the usage meter
+    analytics = await control_plane.analytics(current_user['id'])
+    avg_response_time = analytics["avg_response_time"]
+    # Tail latency over the same 24h, merged from the per-API sketches
+    latency = latency_tracker.merge(await control_plane.latency_sketches(
+        latency_tracker.bucket(time.time() - 86400), user_id=current_user['id']))
     
     # Get OpenAI cost information
-    cost_tracker = OpenAICostTracker()
     openai_costs = cost_tracker.get_cost_analytics()
     
-    conn.close()
-    
-    return {
-        "total_requests": total_requests,
-        "active_apis": active_apis,
+    return FastJSONResponse({
+        "total_requests": analytics["total_requests"],
+        "active_apis": analytics["active_apis"],
         "avg_response_time": round(avg_response_time * 1000, 2) if avg_response_time else 0,  # Convert to ms
-        "revenue": round(revenue, 2),
-        "top_endpoints": [dict(row) for row in top_endpoints],
-        "daily_requests": [dict(row) for row in daily_requests],
+        "response_time_percentiles": latency.percentiles(),
+        "revenue": round(analytics["revenue"], 2),
+        "top_endpoints": analytics["top_endpoints"],
+        "daily_requests": analytics["daily_requests"],
         "openai_costs": openai_costs
-    }
+    })
 
 # Database Management Endpoints
 @app.post("/api/databases")
 async def create_database(database_data: DatabaseCreate, current_user: dict = Depends(get_current_user)):
     """Create a new database for the user"""
     try:
-        database_info = create_user_database(
+        database_info = await create_user_database(
             current_user['id'], 
             database_data.database_name, 
             database_data.database_type
@@ -1615,51 +7128,107 @@ async def create_database(database_data: DatabaseCreate, current_user: dict = De
 @app.get("/api/databases")
 async def get_user_databases_endpoint(current_user: dict = Depends(get_current_user)):
     """Get all databases for the current user"""
-    databases = get_user_databases(current_user['id'])
+    databases = await get_user_databases(current_user['id'])
     return {"databases": databases}
 
 @app.get("/api/databases/{database_id}/tables")
 async def get_database_tables(database_id: str, current_user: dict = Depends(get_current_user)):
     """Get tables in a specific database"""
-    conn = get_db_connection()
-    
     # Verify user owns this database
-    database = conn.execute("""
-        SELECT * FROM user_databases WHERE id = ? AND user_id = ?
-    """, (database_id, current_user['id'])).fetchone()
+    database = await control_plane.get_database(database_id, current_user['id'], active_only=False)
     
     if not database:
-        conn.close()
         raise HTTPException(status_code=404, detail="Database not found")
     
     if database['database_type'] == 'sqlite':
-        # Connect to user's database
-        user_conn = sqlite3.connect(database['database_path'])
-        tables = user_conn.execute("""
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name NOT LIKE '_metadata'
-        """).fetchall()
-        user_conn.close()
-        
-        table_list = [table[0] for table in tables]
+        schema = await asyncio.to_thread(schema_catalog.get, database['database_path'])
+        table_list = list(schema["tables"])
     else:
         # For other database types, implement accordingly
         table_list = []
     
-    conn.close()
     return {"tables": table_list}
 
+@app.get("/api/databases/{database_id}/schema")
+async def get_database_schema(database_id: str, current_user: dict = Depends(get_current_user)):
+    """Tables with their columns, indexes and approximate row counts"""
+    database = await load_user_database(database_id, current_user['id'])
+    schema = await asyncio.to_thread(schema_catalog.get, database['database_path'])
+    return {"database_id": database_id, **schema}
+
+@app.get("/api/databases/{database_id}/snapshots")
+async def list_database_snapshots(database_id: str, current_user: dict = Depends(get_current_user)):
+    """Snapshots of a user database, oldest first"""
+    await load_user_database(database_id, current_user['id'])
+    manifest = await asyncio.to_thread(snapshot_manager.load_manifest)
+    return {"snapshots": manifest["sources"].get(database_id, {}).get("snapshots", [])}
+
+@app.post("/api/databases/{database_id}/snapshots")
+async def create_database_snapshot(database_id: str, current_user: dict = Depends(get_current_user)):
+    """Take an online snapshot of a user database now"""
+    await load_user_database(database_id, current_user['id'])
+    report = await snapshot_manager.run_locked(snapshot_manager.run_once, [database_id], True)
+    if database_id not in report["taken"]:
+        raise HTTPException(status_code=500, detail="Snapshot failed")
+    return report["taken"][database_id]
+
+@app.post("/api/databases/{database_id}/snapshots/{snapshot}/restore")
+async def restore_database_snapshot(database_id: str, snapshot: str, current_user: dict = Depends(get_current_user)):
+    """Restore a user database from one of its snapshots"""
+    await load_user_database(database_id, current_user['id'])
+    return await snapshot_manager.run_locked(snapshot_manager.restore, database_id, snapshot)
+
+@app.post("/api/databases/{database_id}/query")
+async def query_database(database_id: str, query: DatabaseQuery, current_user: dict = Depends(get_current_user)):
+    """Run a read-only, parameterized query and stream the result as NDJSON.
+
+    The first line holds the column names, each following line one row, and
+    the last line a summary with the row count and whether it was truncated.
+    """
+    database = await load_user_database(database_id, current_user['id'])
+    lines = await asyncio.to_thread(user_db_pool.start_query, database['database_path'],
+                                    query.sql, query.params, query.max_rows)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@app.post("/api/databases/{database_id}/tables/{table}/import")
+async def import_table_rows(database_id: str, table: str, request: Request, format: Optional[str] = None,
+                            on_conflict: str = "abort", create_table: bool = True,
+                            current_user: dict = Depends(get_current_user)):
+    """Stream NDJSON or CSV rows into a table (format defaults from Content-Type)"""
+    database = await load_user_database(database_id, current_user['id'])
+    fmt = bulk_transfer.resolve_format(format, request.headers.get("content-type", ""))
+    return await bulk_transfer.import_stream(database, table, fmt, on_conflict, create_table, request.stream())
+
+@app.get("/api/databases/{database_id}/tables/{table}/import")
+async def get_import_progress(database_id: str, table: str, current_user: dict = Depends(get_current_user)):
+    """Progress of the latest import into a table"""
+    await load_user_database(database_id, current_user['id'])
+    progress = await asyncio.to_thread(bulk_transfer.progress, database_id, table)
+    if not progress:
+        raise HTTPException(status_code=404, detail="No import recorded for this table")
+    return progress
+
+@app.get("/api/databases/{database_id}/tables/{table}/export")
+async def export_table_rows(database_id: str, table: str, format: str = "ndjson",
+                            current_user: dict = Depends(get_current_user)):
+    """Stream every row of a table as NDJSON or CSV"""
+    database = await load_user_database(database_id, current_user['id'])
+    fmt = bulk_transfer.resolve_format(format)
+    conn, cursor = await asyncio.to_thread(bulk_transfer.open_export, database, table)
+    return StreamingResponse(
+        bulk_transfer.export_rows(database, conn, cursor, fmt),
+        media_type=BulkTransfer.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{fmt}"'}
+    )
+
 # Enhanced API Creation with Database Integration
 @app.post("/api/apis/enhanced")
 async def create_enhanced_api(api_data: EnhancedAPICreate, current_user: dict = Depends(get_current_user)):
     """Create API with enhanced features including database integration"""
-    conn = get_db_connection()
     api_id = generate_api_id()
     
     # Check if endpoint already exists
-    existing = conn.execute("SELECT id FROM apis WHERE endpoint = ?", (api_data.endpoint,)).fetchone()
-    if existing:
-        conn.close()
+    if await control_plane.endpoint_exists(api_data.endpoint):
         raise HTTPException(status_code=400, detail="Endpoint already exists")
     
     # Generate API key for private APIs
@@ -1670,9 +7239,8 @@ async def create_enhanced_api(api_data: EnhancedAPICreate, current_user: dict =
     # Get database connection info if specified
     database_info = None
     if api_data.database_connection:
-        database = conn.execute("""
-            SELECT * FROM user_databases WHERE id = ? AND user_id = ?
-        """, (api_data.database_connection.database_id, current_user['id'])).fetchone()
+        database = await control_plane.get_database(api_data.database_connection.database_id, current_user['id'],
+                                                    active_only=False)
         
         if database:
             database_info = {
@@ -1680,6 +7248,12 @@ async def create_enhanced_api(api_data: EnhancedAPICreate, current_user: dict =
                 "table_name": api_data.database_connection.table_name or api_data.endpoint.replace('-', '_'),
                 "connection_string": database['connection_string']
             }
+            if database['database_type'] == 'sqlite':
+                # Generate models from the table's real columns when it already exists
+                table = await asyncio.to_thread(schema_catalog.table, database['database_path'],
+                                                database_info["table_name"])
+                if table:
+                    database_info["columns"] = table["columns"]
     
     # Generate enhanced code with database integration
     if api_data.code.strip() == "" or api_data.code.strip() == "# Generated code will appear here":
@@ -1691,45 +7265,26 @@ async def create_enhanced_api(api_data: EnhancedAPICreate, current_user: dict =
         )
     
     try:
-        # Insert API
-        conn.execute("""
-            INSERT INTO apis (id, user_id, name, endpoint, description, code, language, is_public, 
-                            api_key, rate_limit_requests, rate_limit_period, pricing_model, 
-                            price_per_request, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (api_id, current_user['id'], api_data.name, api_data.endpoint, api_data.description, 
-              api_data.code, api_data.language, api_data.is_public, api_key, 
-              api_data.rate_limit_requests, api_data.rate_limit_period, api_data.pricing_model, 
-              api_data.price_per_request, 'draft'))
-        
-        # Insert parameters
-        for param in api_data.parameters:
-            conn.execute("""
-                INSERT INTO api_parameters (api_id, name, type, required, description)
-                VALUES (?, ?, ?, ?, ?)
-            """, (api_id, param.name, param.type, param.required, param.description))
-        
-        # Insert API settings
-        if api_data.settings:
-            settings = api_data.settings
-            conn.execute("""
-                INSERT INTO api_settings (api_id, max_requests_per_hour, max_requests_per_day, 
-                                        max_requests_per_month, requires_auth, allowed_origins, webhook_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (api_id, settings.max_requests_per_hour, settings.max_requests_per_day, 
-                  settings.max_requests_per_month, settings.requires_auth, 
-                  settings.allowed_origins, settings.webhook_url))
-        
-        # Link to database if specified
-        if api_data.database_connection:
-            conn.execute("""
-                INSERT INTO api_database_connections (api_id, database_id, table_name, connection_settings)
-                VALUES (?, ?, ?, ?)
-            """, (api_id, api_data.database_connection.database_id, 
-                  api_data.database_connection.table_name, 
-                  json.dumps(api_data.database_connection.connection_settings or {})))
-        
-        conn.commit()
+        # Insert API with its parameters, settings and database link
+        # (keys are stored hashed in api_keys, never on the apis row)
+        database_link = None
+        if database_info:
+            database_link = {
+                "database_id": api_data.database_connection.database_id,
+                "table_name": api_data.database_connection.table_name,
+                "connection_settings": json.dumps(api_data.database_connection.connection_settings or {})
+            }
+        await control_plane.create_api(
+            {"id": api_id, "user_id": current_user['id'], "name": api_data.name, "endpoint": api_data.endpoint,
+             "description": api_data.description, "code": api_data.code, "language": api_data.language,
+             "is_public": api_data.is_public, "rate_limit_requests": api_data.rate_limit_requests,
+             "rate_limit_period": api_data.rate_limit_period, "pricing_model": api_data.pricing_model,
+             "price_per_request": api_data.price_per_request, "status": 'draft'},
+            [param.dict() for param in api_data.parameters],
+            api_data.settings.dict() if api_data.settings else None,
+            api_key,
+            database_link
+        )
         
         return {
             "message": "Enhanced API created successfully",
@@ -1742,126 +7297,295 @@ async def create_enhanced_api(api_data: EnhancedAPICreate, current_user: dict =
             "database_connected": bool(database_info)
         }
         
+    except IntegrityError:
+        raise HTTPException(status_code=400, detail="Endpoint already exists")
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to create API: {str(e)}")
-    finally:
-        conn.close()
 
 # Enhanced API Testing
 @app.post("/api/apis/{api_id}/test-suite")
 async def run_api_test_suite(api_id: str, test_cases: List[APITestCase], current_user: dict = Depends(get_current_user)):
     """Run a comprehensive test suite for an API"""
-    conn = get_db_connection()
-    
     # Verify API ownership
-    api = conn.execute("SELECT * FROM apis WHERE id = ? AND user_id = ?", (api_id, current_user['id'])).fetchone()
-    if not api:
-        conn.close()
-        raise HTTPException(status_code=404, detail="API not found")
-    
-    test_results = []
-    
-    for test_case in test_cases:
-        try:
-            import httpx
-            
-            # Build URL
-            base_url = "http://localhost:8000"
-            url = f"{base_url}/api/execute/{api['endpoint']}"
-            
-            # Add API key if private
-            headers = test_case.headers.copy()
-            if not api['is_public'] and api['api_key']:
-                headers['X-API-Key'] = api['api_key']
-            
-            # Make request
-            start_time = time.time()
-            
-            if test_case.method.upper() == "GET":
-                response = httpx.get(url, headers=headers, params=test_case.query_params, timeout=30)
-            elif test_case.method.upper() == "POST":
-                response = httpx.post(url, headers=headers, json=test_case.body, params=test_case.query_params, timeout=30)
-            elif test_case.method.upper() == "PUT":
-                response = httpx.put(url, headers=headers, json=test_case.body, params=test_case.query_params, timeout=30)
-            elif test_case.method.upper() == "DELETE":
-                response = httpx.delete(url, headers=headers, params=test_case.query_params, timeout=30)
-            else:
-                raise HTTPException(status_code=400, detail=f"Unsupported method: {test_case.method}")
-            
-            response_time = time.time() - start_time
-            success = response.status_code == test_case.expected_status
-            
-            # Store test result
-            conn.execute("""
-                INSERT INTO api_test_results (api_id, test_name, test_method, test_url, test_body, 
-                                            test_headers, response_status, response_body, response_time, success)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (api_id, test_case.name, test_case.method, url, json.dumps(test_case.body), 
-                  json.dumps(test_case.headers), response.status_code, response.text, 
-                  response_time, success))
-            
-            test_results.append({
-                "test_name": test_case.name,
-                "method": test_case.method,
-                "expected_status": test_case.expected_status,
-                "actual_status": response.status_code,
-                "success": success,
-                "response_time": round(response_time * 1000, 2),  # Convert to ms
-                "response_body": response.text[:1000],  # Limit response size
-                "headers_sent": headers
-            })
-            
-        except Exception as e:
-            test_results.append({
-                "test_name": test_case.name,
-                "method": test_case.method,
-                "expected_status": test_case.expected_status,
-                "actual_status": 0,
-                "success": False,
-                "response_time": 0,
-                "error": str(e),
-                "headers_sent": test_case.headers
-            })
-    
-    conn.commit()
-    conn.close()
+    api = await get_owned_api(api_id, current_user['id'])
     
-    # Calculate summary
-    total_tests = len(test_results)
-    passed_tests = sum(1 for result in test_results if result['success'])
+    finished = sorted([item async for item in test_suite_runner.results(api, test_cases)], key=lambda item: item[0])
+    await test_suite_runner.record([row for _, _, row in finished])
+    test_results = [result for _, result, _ in finished]
     
     return {
-        "summary": {
-            "total_tests": total_tests,
-            "passed": passed_tests,
-            "failed": total_tests - passed_tests,
-            "success_rate": round((passed_tests / total_tests) * 100, 2) if total_tests > 0 else 0
-        },
+        "summary": test_suite_runner.summary(test_results),
         "test_results": test_results
     }
 
+@app.post("/api/apis/{api_id}/test-suite/stream")
+async def stream_api_test_suite(api_id: str, test_cases: List[APITestCase],
+                                current_user: dict = Depends(get_current_user)):
+    """Run a test suite, sending each case's result as a server-sent event as soon as it finishes.
+
+    Events are `result` (the case's `index` in the suite plus the usual result
+    fields) and a final `summary`. Results are stored as they arrive.
+    """
+    api = await get_owned_api(api_id, current_user['id'])
+
+    def event(name: str, data: dict, event_id: Optional[int] = None) -> bytes:
+        lines = f"id: {event_id}\n" if event_id is not None else ""
+        return f"{lines}event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+    async def events():
+        test_results = []
+        async for index, result, row in test_suite_runner.results(api, test_cases):
+            await test_suite_runner.record([row])
+            test_results.append(result)
+            yield event("result", {"index": index, **result}, index)
+        yield event("summary", test_suite_runner.summary(test_results))
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/api/apis/{api_id}/test-history")
-async def get_api_test_history(api_id: str, current_user: dict = Depends(get_current_user)):
-    """Get test history for an API"""
-    conn = get_db_connection()
-    
+async def get_api_test_history(api_id: str, limit: int = 50, cursor: Optional[int] = None,
+                               current_user: dict = Depends(get_current_user)):
+    """Get test history for an API, newest first; pass `next_cursor` back as `cursor` for older results"""
     # Verify API ownership
-    api = conn.execute("SELECT * FROM apis WHERE id = ? AND user_id = ?", (api_id, current_user['id'])).fetchone()
+    await get_owned_api(api_id, current_user['id'])
+    if not 1 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+    
+    history = await control_plane.test_history(api_id, limit, before_id=cursor)
+    return FastJSONResponse({
+        "test_history": history,
+        "next_cursor": history[-1]['id'] if len(history) == limit else None
+    })
+
+@app.post("/api/admin/profile", response_class=PlainTextResponse)
+async def profile_gateway(seconds: float = 10.0, interval_ms: float = 5.0, admin_user: dict = Depends(get_admin_user)):
+    """Capture a sampling profile of the running gateway as folded stacks"""
+    if seconds <= 0 or interval_ms <= 0:
+        raise HTTPException(status_code=400, detail="seconds and interval_ms must be positive")
+    result = await profiler.profile(seconds, interval_ms / 1000)
+    folded = "\n".join(f"{stack} {count}" for stack, count in
+                       sorted(result["stacks"].items(), key=lambda item: item[1], reverse=True))
+    logger.info(f"Profiling session by {admin_user['username']}: {result['samples']} samples over {seconds}s")
+    return PlainTextResponse(folded + "\n", headers={
+        "X-Profile-Samples": str(result["samples"]),
+        "X-Profile-Worker": str(os.getpid())  # Each worker process is profiled separately
+    })
+
+@app.get("/api/admin/code-generation")
+async def get_code_generation_report(admin_user: dict = Depends(get_admin_user)):
+    """Share of code generations served by the template fast path and the latency it saved"""
+    return await asyncio.to_thread(template_router.report)
+
+@app.get("/api/apis/{api_id}/webhooks")
+async def list_webhook_deliveries(api_id: str, status_filter: Optional[str] = Query(None, alias="status"),
+                                  limit: int = 50, current_user: dict = Depends(get_current_user)):
+    """Recent webhook deliveries of an API (optionally one status: pending, delivered, dead)"""
+    api = await control_plane.get_api_with_settings(api_id=api_id, user_id=current_user['id'])
     if not api:
-        conn.close()
         raise HTTPException(status_code=404, detail="API not found")
-    
-    test_history = conn.execute("""
-        SELECT * FROM api_test_results WHERE api_id = ? ORDER BY created_at DESC LIMIT 50
-    """, (api_id,)).fetchall()
-    
-    conn.close()
-    
+    deliveries = await control_plane.webhook_deliveries(api_id, status_filter, min(max(limit, 1), 500))
+    for delivery in deliveries:
+        delivery['payload'] = json.loads(delivery['payload'])
+    return {"webhook_url": api['webhook_url'], "counts": await control_plane.webhook_counts(api_id),
+            "deliveries": deliveries}
+
+@app.post("/api/apis/{api_id}/webhooks/redeliver")
+async def redeliver_webhooks(api_id: str, current_user: dict = Depends(get_current_user)):
+    """Queue an API's dead-lettered webhook deliveries again"""
+    await get_owned_api(api_id, current_user['id'])
+    return {"requeued": await control_plane.redeliver_webhooks(api_id)}
+
+@app.get("/api/admin/webhooks")
+async def get_webhook_status(admin_user: dict = Depends(get_admin_user)):
+    """Outbox totals and the last delivery pass"""
+    return {"enabled": webhooks.enabled, "running": webhooks.running, "counts": await control_plane.webhook_counts(),
+            "last_report": webhooks.last_report}
+
+@app.post("/api/admin/webhooks/run")
+async def run_webhooks(admin_user: dict = Depends(get_admin_user)):
+    """Run a delivery pass now"""
+    return await webhooks.run()
+
+@app.get("/api/apis/{api_id}/billing")
+async def get_api_billing(api_id: str, current_user: dict = Depends(get_current_user)):
+    """Usage and charges of the current billing period, and the closed periods"""
+    api = await get_owned_api(api_id, current_user['id'])
+    usage = await control_plane.billing(api_id, billing_period(datetime.utcnow()))
+    price = api['price_per_request'] if api['pricing_model'] == 'payg' else 0.0
+    return {"pricing_model": api['pricing_model'], "price_per_request": api['price_per_request'],
+            **usage, "amount": round(usage['requests'] * (price or 0), 6)}
+
+@app.get("/api/admin/metering")
+async def get_metering_status(admin_user: dict = Depends(get_admin_user)):
+    """The last shared metering pass, and the counts this worker has not applied yet"""
+    return {"enabled": usage_meter.enabled, "running": usage_meter.running, "last_report": usage_meter.last_report,
+            "worker_pid": os.getpid(), "unflushed_requests": sum(usage_meter.counts.values()),
+            "pending_batches": len(usage_meter.pending)}
+
+@app.post("/api/admin/metering/run")
+async def run_metering(admin_user: dict = Depends(get_admin_user)):
+    """Flush, replay orphaned journals and close finished billing periods now"""
+    return await usage_meter.run()
+
+@app.get("/api/apis/{api_id}/latency")
+async def get_api_latency(api_id: str, hours: float = 24, threshold_ms: Optional[float] = None,
+                          objective: float = 0.95, current_user: dict = Depends(get_current_user)):
+    """Latency percentiles, SLO burn rate and an hourly series over the last `hours`"""
+    api = await control_plane.get_api_with_settings(api_id, user_id=current_user['id'])
+    if not api:
+        raise HTTPException(status_code=404, detail="API not found")
+    if not 0 < objective < 1 or hours <= 0:
+        raise HTTPException(status_code=400, detail="objective must be between 0 and 1, and hours positive")
+    threshold_ms = threshold_ms or api['target_p95_ms'] or 500
+    return FastJSONResponse(await latency_tracker.summary(api_id, hours, threshold_ms, objective))
+
+@app.get("/api/admin/latency")
+async def get_latency_status(admin_user: dict = Depends(get_admin_user)):
+    """The last shared latency sketch pass, and the sketches this worker has not flushed yet"""
+    return {"enabled": latency_tracker.enabled, "running": latency_tracker.running,
+            "last_report": latency_tracker.last_report, "worker_pid": os.getpid(),
+            "unflushed_sketches": len(latency_tracker.sketches)}
+
+@app.post("/api/admin/latency/run")
+async def run_latency_sketches(admin_user: dict = Depends(get_admin_user)):
+    """Flush, compact and prune latency sketches now"""
+    return await latency_tracker.run()
+
+@app.get("/api/admin/admission")
+async def get_admission_status(admin_user: dict = Depends(get_admin_user)):
+    """Concurrency slots and queue depth per API in the worker serving this request"""
+    return {"worker_pid": os.getpid(), **admission_controller.report()}
+
+@app.get("/api/admin/rate-limits")
+async def get_rate_limit_leases(admin_user: dict = Depends(get_admin_user)):
+    """Rate limit leases held by the worker serving this request"""
+    return {"worker_pid": os.getpid(), **quota_leases.report()}
+
+@app.get("/api/admin/autoscaler")
+async def get_autoscaler_status(admin_user: dict = Depends(get_admin_user)):
+    """Show the autoscaler's thresholds and its last pass"""
+    return {
+        "enabled": autoscaler.enabled and (docker_client is not None or worker_runtime.active),
+        "interval_seconds": autoscaler.interval,
+        "target_in_flight": autoscaler.target_in_flight,
+        "scale_in_ratio": autoscaler.scale_in_ratio,
+        "ticks": {"scale_out": autoscaler.out_ticks, "scale_in": autoscaler.in_ticks},
+        "cooldown_seconds": autoscaler.cooldown,
+        "running": autoscaler.running,
+        "last_report": autoscaler.last_report
+    }
+
+@app.post("/api/admin/autoscaler/run")
+async def run_autoscaler(admin_user: dict = Depends(get_admin_user)):
+    """Trigger an autoscaling pass immediately"""
+    return await autoscaler.run()
+
+@app.get("/api/admin/runtime")
+async def get_runtime_status(admin_user: dict = Depends(get_admin_user)):
+    """Which runtime deploys use, and the worker processes running on this host"""
+    return {
+        "runtime": "worker" if worker_runtime.active else "docker",
+        "configured": worker_runtime.mode,
+        "supervising": worker_runtime.running,
+        "workers": await asyncio.to_thread(worker_runtime.report)
+    }
+
+@app.get("/api/admin/retention")
+async def get_retention_status(admin_user: dict = Depends(get_admin_user)):
+    """Show retention policies and the last pass report"""
+    return {
+        "enabled": retention_engine.enabled,
+        "interval_seconds": retention_engine.interval,
+        "policies": retention_engine.policies,
+        "running": retention_engine.running,
+        "last_report": retention_engine.last_report
+    }
+
+@app.post("/api/admin/retention/run")
+async def run_retention(admin_user: dict = Depends(get_admin_user)):
+    """Trigger a retention pass immediately"""
+    return await retention_engine.run()
+
+@app.post("/api/admin/retention/convert-vacuum-mode")
+async def convert_vacuum_mode(admin_user: dict = Depends(get_admin_user)):
+    """One-off maintenance: rewrite the database with incremental auto-vacuum.
+
+    This runs a full VACUUM, which blocks writers for its duration and needs
+    free disk space of about the database size; schedule it in a quiet window.
+    """
+    require_sqlite_control_plane("Vacuum mode conversion")
+    owner = secrets.token_urlsafe(8)
+    if not await asyncio.to_thread(shared_state.acquire_lock, "retention", 3600, owner):
+        raise HTTPException(status_code=409, detail="A retention pass is already running")
+    try:
+        return await asyncio.to_thread(retention_engine.convert_vacuum_mode)
+    finally:
+        await asyncio.to_thread(shared_state.release_lock, "retention", owner)
+
+@app.get("/api/admin/exports")
+async def get_export_status(admin_user: dict = Depends(get_admin_user)):
+    """Show the request log export manifest summary"""
+    manifest = await asyncio.to_thread(request_log_exporter.load_manifest)
+    return {
+        "enabled": request_log_exporter.enabled,
+        "format": request_log_exporter.format,
+        "export_dir": str(request_log_exporter.export_dir),
+        "high_water_mark": manifest["high_water_mark"],
+        "files": len(manifest["files"]),
+        "bytes": sum(entry["bytes"] for entry in manifest["files"]),
+        "running": request_log_exporter.running,
+        "last_report": request_log_exporter.last_report
+    }
+
+@app.post("/api/admin/exports/run")
+async def run_export(admin_user: dict = Depends(get_admin_user)):
+    """Export new request logs immediately"""
+    return await request_log_exporter.run()
+
+@app.get("/api/admin/snapshots")
+async def get_snapshots(admin_user: dict = Depends(get_admin_user)):
+    """List snapshots of every source and the last run report"""
+    manifest = await asyncio.to_thread(snapshot_manager.load_manifest)
     return {
-        "test_history": [dict(test) for test in test_history]
+        "enabled": snapshot_manager.enabled,
+        "interval_seconds": snapshot_manager.interval,
+        "sources": {source: state["snapshots"] for source, state in manifest["sources"].items()},
+        "running": snapshot_manager.running,
+        "last_report": snapshot_manager.last_report
     }
 
+@app.post("/api/admin/snapshots/run")
+async def run_snapshots(force: bool = False, admin_user: dict = Depends(get_admin_user)):
+    """Snapshot every database changed since its last snapshot (all of them with force)"""
+    return await snapshot_manager.run_locked(snapshot_manager.run_once, None, force)
+
+@app.post("/api/admin/snapshots/{source}/{snapshot}/restore")
+async def restore_snapshot(source: str, snapshot: str, admin_user: dict = Depends(get_admin_user)):
+    """Restore the control-plane database ("control") or a user database from a snapshot"""
+    logger.warning(f"Snapshot restore of {source} requested by {admin_user['username']}")
+    return await snapshot_manager.run_locked(snapshot_manager.restore, source, snapshot)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    """Prometheus metrics endpoint (METRICS_TOKEN bearer token, or loopback clients only)"""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    if metrics.token:
+        presented = credentials.credentials if credentials else ""
+        if not hmac.compare_digest(presented.encode(), metrics.token.encode()):
+            raise HTTPException(status_code=401, detail="Invalid metrics token",
+                                headers={"WWW-Authenticate": "Bearer"})
+    else:
+        try:
+            loopback = ipaddress.ip_address(request.client.host).is_loopback
+        except (AttributeError, ValueError):
+            loopback = False
+        if not loopback:
+            raise HTTPException(status_code=403, detail="Set METRICS_TOKEN to scrape metrics remotely")
+    counters, histograms = await asyncio.to_thread(metrics.collect)
+    return PlainTextResponse(metrics.render(counters, histograms), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -1871,10 +7595,12 @@ async def health_check():
         "services": {
             "database": "up",
             "redis": "up" if redis_client else "down",
-            "docker": "up" if docker_client else "down"
+            "docker": "up" if docker_client else "down",
+            "runtime": "worker" if worker_runtime.active else "docker"
         }
     }
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # All mutable state is shared, so any number of worker processes can serve traffic
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=int(os.getenv("WEB_CONCURRENCY", "1")))
 
@@ -0,0 +1,108 @@
+import importlib
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+
+@pytest.fixture(scope="session")
+def gateway(tmp_path_factory):
+    """Import main.py inside a scratch working directory with a fresh database."""
+    workdir = tmp_path_factory.mktemp("gateway")
+    for directory in ("templates", "static", "data"):
+        (workdir / directory).mkdir()
+    previous = os.getcwd()
+    os.chdir(workdir)
+    # Tests run webhook delivery, metering and latency sketch passes themselves
+    os.environ.setdefault("WEBHOOK_POLL_SECONDS", "3600")
+    os.environ.setdefault("METERING_FLUSH_SECONDS", "3600")
+    os.environ.setdefault("LATENCY_FLUSH_SECONDS", "3600")
+    try:
+        main = importlib.import_module("main")
+        main.init_db()
+        yield main
+    finally:
+        os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def client(gateway):
+    """HTTP client for the gateway app, started up once for the session"""
+    from fastapi.testclient import TestClient
+
+    with TestClient(gateway.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def run(client):
+    """Run a coroutine function on the app's event loop (where its connection pools live)"""
+    return client.portal.call
+
+
+@pytest.fixture(scope="session")
+def auth_headers(gateway):
+    """Bearer token headers for a freshly created user"""
+    user_id = gateway.generate_user_id()
+    conn = gateway.get_db_connection()
+    conn.execute("INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)",
+                 (user_id, f"user_{user_id[:8]}", f"{user_id[:8]}@example.com", "x"))
+    conn.commit()
+    conn.close()
+    return {"Authorization": f"Bearer {gateway.create_jwt_token(user_id)}"}
+
+
+def _serve(version):
+    """A stand-in for a deployed container that answers every GET with its version and port"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({"version": version, "port": self.server.server_address[1]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def containers(gateway, monkeypatch):
+    """Fake Docker: starting a container starts a local HTTP server, stopping it shuts the server down.
+
+    Yields the ids of the stopped containers; ids are c<version> and c<version>_r<replica>.
+    """
+    servers, stopped = {}, []
+
+    def run_api_container(api_id, version, language, profile=None, replica=None):
+        container_id = f"c{version}" + (f"_r{replica}" if replica else "")
+        servers[container_id] = _serve(version)
+        return container_id, servers[container_id].server_address[1]
+
+    async def deploy_api_container(api_id, language, code, endpoint, version=1, profile=None):
+        return run_api_container(api_id, version, language, profile)
+
+    def stop_api_container(container_id):
+        stopped.append(container_id)
+        servers.pop(container_id).shutdown()
+
+    monkeypatch.setattr(gateway, "run_api_container", run_api_container)
+    monkeypatch.setattr(gateway, "deploy_api_container", deploy_api_container)
+    monkeypatch.setattr(gateway, "stop_api_container", stop_api_container)
+    monkeypatch.setattr(gateway.deployment_manager, "drain_settle", 0)
+    monkeypatch.setattr(gateway.deployment_manager, "drain_timeout", 2)
+    yield stopped
+    for server in servers.values():
+        server.shutdown()
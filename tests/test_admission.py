@@ -0,0 +1,110 @@
+"""Admission control: per-API and global slots, a bounded FIFO queue, and 503 + Retry-After when shedding."""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def controller(gateway, monkeypatch):
+    monkeypatch.setenv("GATEWAY_MAX_CONCURRENCY", "3")
+    monkeypatch.setenv("GATEWAY_API_MAX_CONCURRENCY", "2")
+    monkeypatch.setenv("GATEWAY_QUEUE_SIZE", "2")
+    return gateway.AdmissionController()
+
+
+def test_waiters_are_admitted_in_order_as_slots_free_up(controller):
+    async def scenario():
+        first = await controller.acquire("a", None, 1)
+        second = await controller.acquire("a", None, 1)
+        waiters = [asyncio.create_task(controller.acquire("a", None, 1)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert controller.report()["apis"]["a"] == {"in_flight": 2, "queued": 2, "mean_hold_seconds": None}
+
+        controller.release("a", first, 0.1)
+        await asyncio.wait_for(waiters[0], 1)
+        assert not waiters[1].done()
+        controller.release("a", second, 0.1)
+        await asyncio.gather(*waiters)
+        assert controller.report()["in_flight"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_shedding_reasons_and_retry_after(controller):
+    async def scenario():
+        state = await controller.acquire("slow", 1, 5)
+        controller.release("slow", state, 4.0)  # The API holds slots for ~4s
+        await controller.acquire("slow", 1, 5)
+
+        with pytest.raises(Exception) as shed:
+            await controller.acquire("slow", 1, 2)  # Would wait ~4s on a 2s budget
+        assert shed.value.status_code == 503 and shed.value.headers["Retry-After"] == "4"
+        assert "deadline" in shed.value.detail
+
+        queued = [asyncio.create_task(controller.acquire("slow", 1, 30)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(Exception) as shed:
+            await controller.acquire("slow", 1, 30)
+        assert "queue full" in shed.value.detail
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        assert controller.report()["apis"]["slow"]["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_the_global_limit_caps_all_apis(controller):
+    async def scenario():
+        await controller.acquire("a", None, 1)
+        await controller.acquire("a", None, 1)
+        held = await controller.acquire("b", None, 1)
+        with pytest.raises(Exception) as shed:
+            await controller.acquire("c", None, 0.01)  # c is idle, but the process is full
+        assert "timeout" in shed.value.detail
+        controller.release("b", held, 0.01)
+        await controller.acquire("c", None, 0.01)
+
+    asyncio.run(scenario())
+
+
+def test_the_gateway_sheds_with_503(gateway, client, auth_headers, containers, run, monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Narrow", "endpoint": "narrow", "code": "", "language": "python", "is_public": True,
+        "settings": {"max_concurrency": 1}}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+
+    held = run(gateway.admission_controller.acquire, "narrow", 1, 1)
+    response = client.get("/api/execute/narrow", headers={"X-Request-Budget-Ms": "50"})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+
+    run(gateway.admission_controller.release, "narrow", held, None)
+    assert client.get("/api/execute/narrow").status_code == 200
+    assert gateway.admission_controller.report()["apis"]["narrow"]["in_flight"] == 0
+    monkeypatch.setattr(gateway.metrics, "token", "scrape-secret")
+    scraped = client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"}).text
+    assert 'apiengine_admission_shed_total{api="narrow",reason="timeout"} 1.0' in scraped
+
+
+def test_waiters_that_gave_up_leave_the_queue(controller):
+    async def scenario():
+        await controller.acquire("a", None, 1)
+        await controller.acquire("a", None, 1)
+        for _ in range(2):  # Fill the queue with requests that time out
+            with pytest.raises(Exception) as shed:
+                await controller.acquire("a", None, 0.01)
+            assert "timeout" in shed.value.detail
+        disconnected = asyncio.create_task(controller.acquire("a", None, 1))
+        await asyncio.sleep(0)
+        disconnected.cancel()
+        await asyncio.gather(disconnected, return_exceptions=True)
+        assert controller.report()["apis"]["a"]["queued"] == 0
+
+        live = [asyncio.create_task(controller.acquire("a", None, 1)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert controller.report()["apis"]["a"]["queued"] == 2  # Not shed as queue_full by the dead entries
+        for task in live:
+            task.cancel()
+        await asyncio.gather(*live, return_exceptions=True)
+
+    asyncio.run(scenario())
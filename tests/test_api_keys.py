@@ -0,0 +1,55 @@
+"""API keys: hashed at rest, verified through an LRU cache, and rejected when wrong, revoked, expired or out of scope."""
+from datetime import datetime, timedelta
+
+
+def _mint(main, run, api_id, count):
+    return [run(main.control_plane.create_key, api_id)[1] for _ in range(count)]
+
+
+def test_repeat_callers_are_served_from_the_cache(gateway, run, monkeypatch):
+    index = gateway.APIKeyIndex()
+    (key,) = _mint(gateway, run, "cache-repeat", 1)
+    assert run(index.verify, "cache-repeat", key)["api_id"] == "cache-repeat"
+
+    async def no_lookups(prefix):
+        raise AssertionError("a cached key went to the database")
+
+    monkeypatch.setattr(gateway.control_plane, "live_keys_with_prefix", no_lookups)
+    assert run(index.verify, "cache-repeat", key)["api_id"] == "cache-repeat"
+    assert run(index.verify, "another-api", key) is None
+
+
+def test_cache_evicts_least_recently_used(gateway, run):
+    index = gateway.APIKeyIndex()
+    index.max_entries = 2
+    first, second, third = _mint(gateway, run, "cache-lru", 3)
+
+    for key in (first, second, first, third):
+        run(index.verify, "cache-lru", key)
+
+    assert first in index.cache
+    assert second not in index.cache
+
+
+def test_wrong_revoked_expired_and_out_of_scope_keys_are_rejected(gateway, client, auth_headers, containers, run):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Guarded", "endpoint": "guarded", "code": "", "language": "python", "is_public": False}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+
+    def call(key, method="GET"):
+        return client.request(method, "/api/execute/guarded", headers={"X-API-Key": key}).status_code
+
+    created = client.post(f"/api/apis/{api_id}/keys", headers=auth_headers, json={"name": "reader",
+                                                                                  "scopes": ["read"]}).json()
+    reader = created["api_key"]
+    assert client.get("/api/execute/guarded").status_code == 401
+    assert call(reader) == 200
+    assert call(reader[:-4] + "xxxx") == 401
+    assert call(reader, "POST") == 403
+
+    _, expired = run(gateway.control_plane.create_key, api_id, "old", "*", datetime.utcnow() - timedelta(minutes=1))
+    assert call(expired) == 401
+
+    assert client.delete(f"/api/apis/{api_id}/keys/{created['id']}", headers=auth_headers).status_code == 200
+    assert call(reader) == 401  # Revocation clears the cached verification
+    client.delete(f"/api/apis/{api_id}")
@@ -0,0 +1,97 @@
+"""Resource profiles become cgroup limits; the autoscaler moves replicas within bounds, with hysteresis."""
+import pytest
+
+
+def test_containers_run_with_the_profile_limits(gateway, monkeypatch):
+    calls = []
+
+    class Container:
+        id = "container"
+        attrs = {"NetworkSettings": {"Ports": {"8000/tcp": [{"HostPort": "32768"}]}}}
+
+        def reload(self):
+            pass
+
+    class Containers:
+        def run(self, image, **options):
+            calls.append((image, options))
+            return Container()
+
+    monkeypatch.setattr(gateway, "docker_client", type("Docker", (), {"containers": Containers()})())
+
+    assert gateway.run_api_container("a1", 3, "python", "medium", "r1") == ("container", 32768)
+    image, options = calls[0]
+    assert image == "api_a1:v3" and options["name"] == "api_a1_v3_rr1"
+    assert (options["nano_cpus"], options["mem_limit"], options["memswap_limit"], options["pids_limit"]) == (
+        1_000_000_000, "512m", "512m", 256)
+    gateway.run_api_container("a1", 3, "python")
+    assert calls[1][1]["mem_limit"] == "256m"  # No profile: small
+
+
+def test_p95_comes_from_the_interval_not_the_lifetime(gateway):
+    autoscaler = gateway.Autoscaler()
+    buckets = gateway.metrics.meta[autoscaler.LATENCY_METRIC][3]
+    slow = buckets.index(1.0)
+    previous = [0] * (len(buckets) + 1)
+    previous[0] = 1000  # An earlier, fast interval
+    current = list(previous)
+    current[slow] += 100
+
+    p95, requests = autoscaler.p95_ms(previous, current)
+    assert requests == 100 and 500 < p95 <= 1000
+    assert autoscaler.p95_ms(current, current) == (None, 0)
+    assert autoscaler.quantile([0, 10, 0], (0.1, 0.2), 0.5) == pytest.approx(0.15)
+
+
+def test_decisions_have_hysteresis_and_bounds(gateway, monkeypatch):
+    monkeypatch.setenv("AUTOSCALE_OUT_TICKS", "2")
+    monkeypatch.setenv("AUTOSCALE_IN_TICKS", "3")
+    monkeypatch.setenv("AUTOSCALE_COOLDOWN_SECONDS", "60")
+    autoscaler = gateway.Autoscaler()
+    state, bounds = {}, (1, 4)
+
+    def decide(replicas, p95_ms, in_flight, now):
+        return autoscaler.decide(state, replicas, bounds, 200, p95_ms, in_flight, now)[:2]
+
+    assert decide(2, 450, 0, 1000) == ("hold", 2)
+    assert decide(2, 150, 0, 1010) == ("hold", 2)  # A normal interval resets the streak
+    assert decide(2, 450, 0, 1020) == ("hold", 2)
+    assert decide(2, 450, 0, 1030) == ("scale_out", 3)
+    state.update(hot=0, cold=0, changed_at=1030)
+    assert decide(3, 900, 40, 1040) == ("hold", 3)  # Cooling down
+    assert decide(3, None, 0, 1100) == ("hold", 3)
+    assert decide(3, None, 0, 1110) == ("hold", 3)
+    assert decide(3, None, 0, 1120) == ("scale_in", 2)
+    assert decide(6, 10, 0, 1130) == ("scale_in", 4)
+    assert decide(1, 10, 0, 1130)[0] == "hold"
+    assert autoscaler.decide({}, 1, (2, 4), 200, None, 0, 0)[:2] == ("scale_out", 2)
+
+
+def test_autoscaler_adds_and_removes_replicas(gateway, client, auth_headers, containers, run, monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Scaled", "endpoint": "scaled", "code": "", "language": "python", "is_public": True,
+        "settings": {"resource_profile": "micro", "min_replicas": 2, "max_replicas": 3, "target_p95_ms": 200}
+    }).json()["id"]
+
+    client.post(f"/api/apis/{api_id}/deploy")
+    # The gateway spreads requests over the deployment's containers
+    ports = {client.get("/api/execute/scaled").json()["port"] for _ in range(4)}
+    assert len(ports) == 2
+
+    monkeypatch.setattr(gateway.autoscaler, "cooldown", 0)
+    monkeypatch.setattr(gateway.autoscaler, "in_ticks", 1)
+    monkeypatch.setattr(gateway.DeploymentManager, "open_connections", staticmethod(lambda port: 30))
+    assert run(gateway.autoscaler.run)["decisions"] == []  # Hot, but only once so far
+    decision = run(gateway.autoscaler.run)["decisions"][0]
+    assert (decision["action"], decision["replicas_after"], decision["in_flight"]) == ("scale_out", 3, 60)
+
+    monkeypatch.setattr(gateway.DeploymentManager, "open_connections", staticmethod(lambda port: 0))
+    assert run(gateway.autoscaler.run)["decisions"][0]["action"] == "scale_in"
+    assert len(containers) == 1 and containers[0].startswith("c1_r")
+
+    report = client.get(f"/api/apis/{api_id}/autoscaling", headers=auth_headers).json()
+    assert (report["resource_profile"], report["limits"]["memory_mb"], report["replicas"]) == ("micro", 128, 2)
+    assert [row["action"] for row in report["decisions"]] == ["scale_in", "scale_out"]
+    assert client.post("/api/apis", headers=auth_headers, json={
+        "name": "Huge", "endpoint": "huge", "code": "", "language": "python",
+        "settings": {"resource_profile": "xxl"}}).status_code == 422
@@ -0,0 +1,126 @@
+"""Response encoding: orjson rendering, negotiated compression, and pass-through of compressed upstream bodies."""
+import gzip
+import json
+import threading
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+ROWS = [{"id": i, "name": f"api-{i}", "status": "deployed"} for i in range(200)]
+
+
+@pytest.fixture
+def compressed(gateway):
+    async def rows(request):
+        return gateway.FastJSONResponse(ROWS)
+
+    async def small(request):
+        return JSONResponse({"ok": True})
+
+    async def stream(request):
+        async def lines():
+            for row in ROWS[:3]:
+                yield json.dumps(row) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def png(request):
+        return Response(b"\x89PNG" + b"\0" * 4096, media_type="image/png")
+
+    app = Starlette(routes=[Route("/rows", rows), Route("/small", small), Route("/stream", stream),
+                            Route("/png", png)])
+    return TestClient(gateway.CompressionMiddleware(app))
+
+
+def test_negotiation_follows_q_values_and_preference(gateway):
+    middleware = gateway.CompressionMiddleware(None)
+    middleware.encodings = ("zstd", "br", "gzip")
+    assert middleware.negotiate("gzip, deflate, br, zstd") == "zstd"
+    assert middleware.negotiate("gzip;q=1.0, br;q=0.8") == "gzip"
+    assert middleware.negotiate("br;q=0, *;q=0.5") == "zstd"
+    assert middleware.negotiate("identity") is None
+    middleware.encodings = ("gzip",)
+    assert middleware.negotiate("br, zstd") is None
+
+
+def test_fast_json_matches_the_stdlib_encoding(gateway):
+    content = {"name": "café", "rows": ROWS[:2], "ratio": 0.5, "none": None}
+    assert gateway.FastJSONResponse(content).body == JSONResponse(content).body
+    assert json.loads(gateway.FastJSONResponse({"price": Decimal("1.5"), 1: {2}}).body) == {"price": 1.5, "1": [2]}
+
+
+def test_large_bodies_are_compressed_small_and_binary_ones_are_not(compressed):
+    response = compressed.get("/rows", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip" and response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(json.dumps(ROWS)) / 4
+    assert response.json() == ROWS
+
+    assert "content-encoding" not in compressed.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in compressed.get("/png", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in compressed.get("/rows", headers={"Accept-Encoding": "identity"}).headers
+
+
+def test_streams_are_compressed_incrementally(compressed):
+    with compressed.stream("GET", "/stream", headers={"Accept-Encoding": "gzip"}) as response:
+        assert response.headers["content-encoding"] == "gzip" and "content-length" not in response.headers
+        raw = b"".join(response.iter_raw())
+    assert [json.loads(line) for line in gzip.decompress(raw).splitlines()] == ROWS[:3]
+
+
+def test_compressed_upstream_json_passes_through(gateway, client, auth_headers, containers, monkeypatch):
+    payload = json.dumps({"items": ROWS}).encode()
+    seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self.do_GET()
+
+        def do_GET(self):
+            seen.append(self.headers.get("Accept-Encoding"))
+            body, encoded = payload, "gzip" in self.headers.get("Accept-Encoding", "")
+            if encoded:
+                body = gzip.compress(payload, mtime=0)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            if encoded:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Packed", "endpoint": "packed", "code": "", "language": "python", "is_public": True}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    monkeypatch.setattr(gateway.deployment_manager, "upstream_port", lambda api: server.server_address[1])
+    try:
+        with client.stream("GET", "/api/execute/packed", headers={"Accept-Encoding": "gzip"}) as response:
+            raw = b"".join(response.iter_raw())
+        assert response.headers["content-encoding"] == "gzip"
+        assert raw == gzip.compress(payload, mtime=0)  # Relayed byte for byte, not recompressed
+
+        plain = client.get("/api/execute/packed", headers={"Accept-Encoding": "identity"})
+        assert seen == ["gzip", "identity"]
+        assert "content-encoding" not in plain.headers and plain.content == payload
+
+        posted = client.post("/api/execute/packed", json={"q": 1}, headers={"Accept-Encoding": "gzip"})
+        assert seen[-1] == "gzip" and posted.json() == json.loads(payload)
+    finally:
+        server.shutdown()
+
+
+def test_only_end_to_end_headers_are_forwarded(gateway):
+    forwarded = gateway.upstream_headers(gateway.Headers(raw=[
+        (b"host", b"gateway"), (b"connection", b"keep-alive, x-session"), (b"keep-alive", b"timeout=5"),
+        (b"x-session", b"abc"), (b"te", b"trailers"), (b"content-length", b"2"), (b"content-type", b"application/json"),
+        (b"x-request-id", b"r1")]))
+    assert forwarded == {"content-type": "application/json", "x-request-id": "r1", "accept-encoding": "identity"}
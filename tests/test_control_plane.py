@@ -0,0 +1,167 @@
+"""Control-plane data layer parity: the same scenario must give the same results on every backend.
+
+SQLite always runs. Postgres runs when CONTROL_PLANE_TEST_POSTGRES_URL points at a
+scratch database (its control-plane tables are dropped and recreated).
+"""
+import asyncio
+import os
+from datetime import date, datetime
+
+import pytest
+
+BACKENDS = [
+    pytest.param("sqlite", id="sqlite"),
+    pytest.param("postgres", id="postgres", marks=pytest.mark.skipif(
+        not os.getenv("CONTROL_PLANE_TEST_POSTGRES_URL"), reason="CONTROL_PLANE_TEST_POSTGRES_URL not set")),
+]
+
+
+def _store_url(backend, tmp_path):
+    if backend == "sqlite":
+        return f"sqlite:///{tmp_path / 'control.db'}"
+    return os.environ["CONTROL_PLANE_TEST_POSTGRES_URL"]
+
+
+async def _scenario(main, url):
+    store = main.ControlPlaneStore(url)
+    async with store.engine.begin() as conn:
+        await conn.run_sync(main.control_metadata.drop_all)
+    await store.create_schema()
+    try:
+        await store.create_user("u1", "alice", "alice@example.com", "hash")
+        with pytest.raises(main.IntegrityError):
+            await store.create_user("u2", "alice", None, "hash")
+
+        api = {"id": "a1", "user_id": "u1", "name": "Weather", "endpoint": "weather", "code": "print()",
+               "language": "python", "is_public": False, "pricing_model": "payg", "price_per_request": 0.5}
+        await store.create_api(api, [{"name": "city", "type": "str", "required": True, "description": ""}],
+                               {"max_requests_per_hour": 10}, "ak_initial-key-value")
+        await store.create_api({**api, "id": "a2", "name": "Idle", "endpoint": "idle", "pricing_model": "free"}, [], {})
+        with pytest.raises(main.IntegrityError):
+            await store.create_api({**api, "id": "a3"}, [], {})
+
+        first = await store.create_deployment("a1", "hash-1")
+        await store.activate_deployment("a1", {**first, "container_id": "old-container", "port": 8999})
+        second = await store.create_deployment("a1", "hash-2")
+        replaced = await store.activate_deployment("a1", {**second, "container_id": "container", "port": 9000})
+        for status in (200, 200, 500):
+            await store.log_request(api_id="a1", endpoint="weather", method="GET", status_code=status,
+                                    response_time=0.1, ip_address="127.0.0.1", user_agent="test")
+
+        routed = await store.get_api_with_settings(endpoint="weather")
+        key_id, key = await store.create_key("a1", "ci", "read")
+        candidates = await store.live_keys_with_prefix(main.APIKeyIndex.prefix(key))
+        rotated_id, _ = await store.rotate_key("a1", key_id, grace_seconds=60)
+        await store.update_api("a1", {"description": "Forecasts"}, "ak_replacement-key", {"max_requests_per_day": 5})
+        keys = await store.list_keys("a1")
+
+        await store.record_test_results([
+            {"api_id": "a1", "test_name": name, "response_status": 200, "success": True, "response_body": "{}" * 10}
+            for name in ("first", "second")
+        ], max_body_bytes=8)
+        await store.create_database_record(id="d1", user_id="u1", database_name="main",
+                                           database_path="data/user_databases/alice/main.db")
+        await store.create_database_record(id="d2", user_id="u1", database_name="remote",
+                                           database_type="postgresql", connection_string="postgresql://x")
+
+        # Usage batches count once; usage of a closed period moves to the open one
+        today = datetime.utcnow().date()
+        first_batch = [("a1", None, today, 2), ("a1", "k1", today, 1), ("deleted-api", None, today, 9)]
+        applied = [await store.apply_usage_batch("w:1", first_batch), await store.apply_usage_batch("w:1", first_batch),
+                   await store.apply_usage_batch("w:2", [("a1", None, date(2000, 1, 15), 4)])]
+        closed = [await store.close_billing_periods(main.billing_period(today)) for _ in range(2)]
+        await store.apply_usage_batch("w:3", [("a1", None, date(2000, 1, 20), 1)])
+        billing = await store.billing("a1", main.billing_period(today))
+
+        # Latency sketch rows of one bucket are merged; those of deleted APIs are dropped
+        sketch = main.LatencySketch()
+        sketch.add(0.25)
+        sketch_rows = [{"api_id": api_id, "bucket": bucket, "requests": 1, "sketch": sketch.to_bytes()}
+                       for api_id, bucket in (("a1", 7200), ("a1", 7200), ("a1", 7500), ("deleted-api", 7200))]
+        stored_sketches = await store.add_latency_sketches(sketch_rows)
+        compacted = await store.compact_latency_sketches(0, 9000, 7400, 3600)
+        sketches = [(row["bucket"], row["requests"]) for row in await store.latency_sketches(0, user_id="u1")]
+
+        result = {
+            "latency": (stored_sketches, compacted, sketches, await store.prune_latency_sketches(7300)),
+            "usage": (applied, closed, billing["requests"], billing["by_key"],
+                      [(row["period"], row["requests"], row["amount"]) for row in billing["closed_periods"]]),
+            "user": {k: (await store.find_user(username="alice", active_only=True))[k]
+                     for k in ("id", "email", "is_active")},
+            "endpoint_taken": await store.endpoint_exists("weather"),
+            "routed": {k: routed[k] for k in ("id", "status", "port", "is_public", "max_requests_per_hour",
+                                              "max_requests_per_day", "requires_auth")},
+            "apis": [(row["id"], row["total_requests"], row["max_requests_per_hour"])
+                     for row in sorted(await store.list_apis("u1"), key=lambda row: row["id"])],
+            "parameters": await store.get_parameters("a1"),
+            "deployments": [(row["version"], row["status"]) for row in await store.list_deployments("a1")],
+            "replaced": (replaced["version"], replaced["port"]),
+            "key_candidates": [row["id"] for row in candidates],
+            "live_keys": sorted(row["name"] for row in keys if row["revoked_at"] is None),
+            "rotated_is_new": rotated_id != key_id,
+            "settings_after_update": {k: (await store.get_api_with_settings(api_id="a1"))[k]
+                                      for k in ("description", "max_requests_per_day")},
+            "analytics": await store.analytics("u1"),
+            "test_history": [(row["test_name"], row["response_body"], row["response_size"])
+                             for row in await store.test_history("a1")],
+            "test_history_page": [row["test_name"] for row in await store.test_history("a1", 5, before_id=2)],
+            "databases": [row["id"] for row in await store.list_databases("u1")],
+            "sqlite_paths": await store.sqlite_database_paths(),
+        }
+
+        await store.delete_api("a1")
+        result["after_delete"] = (await store.get_api("a1"), await store.list_keys("a1"),
+                                  await store.test_history("a1"), await store.list_deployments("a1"))
+        return result
+    finally:
+        await store.dispose()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_backend_parity(gateway, backend, tmp_path):
+    result = asyncio.run(_scenario(gateway, _store_url(backend, tmp_path)))
+
+    assert result["usage"] == ([True, False, True], [1, 0], 4,
+                               [{"key_id": None, "requests": 3}, {"key_id": "k1", "requests": 1}],
+                               [("2000-01", 4, 2.0)])
+    assert result["latency"] == (3, 1, [(7200, 2), (7500, 1)], 1)
+    assert result["user"] == {"id": "u1", "email": "alice@example.com", "is_active": True}
+    assert result["endpoint_taken"] is True
+    assert result["routed"] == {"id": "a1", "status": "deployed", "port": 9000, "is_public": False,
+                                "max_requests_per_hour": 10, "max_requests_per_day": 10000, "requires_auth": False}
+    assert result["apis"] == [("a1", 3, 10), ("a2", 0, 1000)]
+    assert result["parameters"] == [{"name": "city", "type": "str", "required": True, "description": ""}]
+    assert result["deployments"] == [(2, "live"), (1, "draining")] and result["replaced"] == (1, 8999)
+    assert len(result["key_candidates"]) == 1
+    # Rotation keeps the old key for its grace period; replacing the key revokes everything before it
+    assert result["rotated_is_new"] and result["live_keys"] == ["default"]
+    assert result["settings_after_update"] == {"description": "Forecasts", "max_requests_per_day": 5}
+    assert result["analytics"] == {
+        "total_requests": 3,
+        "active_apis": 1,
+        "avg_response_time": pytest.approx(0.1),
+        "revenue": pytest.approx(2.0),  # 4 requests metered this period at 0.5
+        "top_endpoints": [{"name": "Weather", "endpoint": "weather", "request_count": 3}],
+        "daily_requests": [{"date": datetime.utcnow().date().isoformat(), "count": 3}],
+    }
+    assert result["test_history"] == [("second", "{}{}{}{}", 20), ("first", "{}{}{}{}", 20)]
+    assert result["test_history_page"] == ["first"]
+    assert result["databases"] == ["d1", "d2"]
+    assert result["sqlite_paths"] == {"d1": "data/user_databases/alice/main.db"}
+    assert result["after_delete"] == (None, [], [], [])
+
+
+def test_gateway_runs_on_the_data_layer(gateway, client, auth_headers):
+    created = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Parity", "endpoint": "parity-check", "description": "", "code": "print()", "language": "python",
+        "parameters": [{"name": "q", "type": "str"}]})
+    assert created.status_code == 200
+    api_id = created.json()["id"]
+
+    listed = {api["id"]: api for api in client.get("/api/apis", headers=auth_headers).json()}
+    assert listed[api_id]["total_requests"] == 0 and listed[api_id]["max_requests_per_hour"] == 1000
+    assert client.get(f"/api/apis/{api_id}").json()["parameters"][0]["name"] == "q"
+    assert len(client.get(f"/api/apis/{api_id}/keys", headers=auth_headers).json()["keys"]) == 1
+    assert client.post("/api/apis", headers=auth_headers, json={
+        "name": "Dup", "endpoint": "parity-check", "code": "", "language": "python"}).status_code == 400
+    assert client.delete(f"/api/apis/{api_id}").json() == {"status": "deleted"}
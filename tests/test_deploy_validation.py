@@ -0,0 +1,85 @@
+"""Pre-deploy validation: bad code is rejected before Docker, verdicts are cached by code hash."""
+import pytest
+
+GOOD_PYTHON = '''
+import json
+from typing import Optional
+from pydantic import BaseModel
+
+class Item(BaseModel):
+    name: str
+
+@app.post("/items")
+async def create_item(item: Item):
+    return json.loads(item.model_dump_json())
+'''
+
+
+@pytest.mark.parametrize("code, line, message", [
+    ("def broken(:\n    pass", 1, "SyntaxError"),
+    ("x = 1\nreturn x", 2, "'return' outside function"),
+    ("match x:\n    case 1:\n        pass", 3, "only supported in Python 3.10"),  # Not on the 3.9 image
+    ("import requests\nimport numpy.linalg", 1, "Module 'requests' is not installed"),
+    ("import tomllib", 1, "Module 'tomllib' is not installed"),  # Standard library from 3.11
+    ("try:\n    import orjson\nexcept ValueError:\n    pass", 2, "Module 'orjson' is not installed"),
+    ("try:\n    import orjson\nexcept ImportError:\n    import ujson", 4, "Module 'ujson' is not installed"),
+    ("app = None", 1, "must be assigned a FastAPI() application"),
+    ("def app():\n    pass", 1, "must be the FastAPI application"),
+])
+def test_python_errors_point_at_the_line(gateway, code, line, message):
+    result = gateway.code_validator.validate("python", code)
+
+    assert result["valid"] is False
+    assert result["errors"][0]["line"] == line and message in result["errors"][0]["message"]
+
+
+@pytest.mark.parametrize("language, code", [
+    ("python", GOOD_PYTHON),
+    ("python", "import fastapi\napp = fastapi.FastAPI(title='Items')"),
+    ("python", "import graphlib, zoneinfo\nfrom _thread import allocate_lock"),
+    ("python", "try:\n    import orjson as json\nexcept (ModuleNotFoundError, AttributeError):\n    import json"),
+    ("javascript", "const express = require('express');\nconst app = express();\napp.listen(3000);"),
+])
+def test_deployable_code_passes(gateway, language, code):
+    assert gateway.code_validator.validate(language, code)["errors"] == []
+
+
+def test_javascript_checks(gateway):
+    validator = gateway.code_validator
+    assert "SyntaxError" in validator.validate("javascript", "const x = {;\napp.listen(3000)")["errors"][0]["message"]
+    errors = validator.validate("javascript", "const axios = require('axios');")["errors"]
+    assert [error["message"].split(" (")[0] for error in errors] == [
+        "Module 'axios' is not installed in the container", "The app must call listen() on port 3000"]
+    # Without node, a bracket scan that skips strings and comments stands in for node --check
+    assert validator._check_brackets("f('(', \"}\", `a\n{`) // )\n/* ] */ {\n}") == []
+    assert validator._check_brackets("if (a) {\n  b(\n}") == [{"line": 3, "message": "SyntaxError: Unexpected token '}'"}]
+    assert validator.validate("ruby", "puts 1")["errors"][0]["message"].startswith("Deployment is not supported")
+
+
+def test_verdicts_are_cached_by_code_hash(gateway):
+    validator = gateway.code_validator
+    code = GOOD_PYTHON + "\n# cached\n"
+    first = validator.validate("python", code)
+    second = validator.validate("python", code)
+
+    assert not first["cached"] and second["cached"] and second["code_hash"] == first["code_hash"]
+    # Another worker finds the verdict in shared state
+    validator.cache.clear()
+    assert validator.validate("python", code)["cached"]
+    assert validator.code_hash("javascript", code) != first["code_hash"]
+
+
+def test_deploy_rejects_invalid_code_before_docker(gateway, client, auth_headers):
+    created = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Broken", "endpoint": "broken-deploy", "code": "import requests\napp = None", "language": "python"})
+    api_id = created.json()["id"]
+
+    response = client.post(f"/api/apis/{api_id}/deploy", headers=auth_headers)
+
+    assert response.status_code == 422
+    detail = response.json()["detail"]
+    assert detail["message"] == "Code validation failed" and len(detail["errors"]) == 2
+    assert client.get(f"/api/apis/{api_id}").json()["status"] == "draft"
+
+    checked = client.post("/api/validate-code", headers=auth_headers, json={"code": GOOD_PYTHON})
+    assert checked.status_code == 200 and checked.json()["valid"] is True
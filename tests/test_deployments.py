@@ -0,0 +1,94 @@
+"""Blue/green deployments: each version gets its own container, the route switches only when it is ready."""
+import socket
+
+import pytest
+
+
+def test_redeploys_switch_versions_and_roll_back(gateway, client, auth_headers, containers):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Versions", "endpoint": "versions", "code": "", "language": "python", "is_public": True}).json()["id"]
+
+    def served():
+        return client.get("/api/execute/versions").json()["version"]
+
+    first = client.post(f"/api/apis/{api_id}/deploy").json()
+    assert (first["version"], first["previous_version"], served()) == (1, None, 1)
+
+    # The second deploy runs next to the first instead of conflicting with its container name
+    second = client.post(f"/api/apis/{api_id}/deploy").json()
+    assert (second["version"], second["previous_version"], served()) == (2, 1, 2)
+    history = client.get(f"/api/apis/{api_id}/deployments", headers=auth_headers).json()["deployments"]
+    assert [(row["version"], row["status"]) for row in history] == [(2, "live"), (1, "standby")]
+    assert containers == []
+
+    # Rolling back to the warm standby is a route switch
+    rolled = client.post(f"/api/apis/{api_id}/rollback", headers=auth_headers).json()
+    assert (rolled["version"], rolled["warm"], served()) == (1, True, 1)
+
+    # A third version keeps one standby (the version it replaced) and stops the rest
+    third = client.post(f"/api/apis/{api_id}/deploy").json()
+    assert (third["previous_version"], served()) == (1, 3)
+    history = client.get(f"/api/apis/{api_id}/deployments", headers=auth_headers).json()["deployments"]
+    assert [(row["version"], row["status"]) for row in history] == [(3, "live"), (2, "stopped"), (1, "standby")]
+    assert containers == ["c2"]
+
+    assert client.post(f"/api/apis/{api_id}/rollback?version=7", headers=auth_headers).status_code == 404
+    client.delete(f"/api/apis/{api_id}")
+    assert sorted(containers) == ["c1", "c2", "c3"]
+
+
+def test_a_version_that_never_gets_ready_leaves_the_live_one_routed(gateway, client, auth_headers, containers,
+                                                                    monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Stuck", "endpoint": "stuck-version", "code": "", "language": "python", "is_public": True}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+
+    async def never_ready(port):
+        raise gateway.HTTPException(status_code=504, detail="New version not ready")
+
+    monkeypatch.setattr(gateway.deployment_manager, "wait_ready", never_ready)
+    assert client.post(f"/api/apis/{api_id}/deploy").status_code == 504
+
+    assert client.get("/api/execute/stuck-version").json()["version"] == 1
+    history = client.get(f"/api/apis/{api_id}/deployments", headers=auth_headers).json()["deployments"]
+    assert [(row["version"], row["status"]) for row in history] == [(2, "failed"), (1, "live")]
+    assert containers == ["c2"]
+
+
+def test_drain_counts_open_connections_to_the_old_port(gateway):
+    listener = socket.create_server(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    if gateway.DeploymentManager.open_connections(port) is None:
+        pytest.skip("/proc/net/tcp is not available")
+
+    client = socket.create_connection(("127.0.0.1", port))
+    server_side, _ = listener.accept()
+    assert gateway.DeploymentManager.open_connections(port) == 1
+
+    client.close()
+    server_side.close()
+    listener.close()
+    assert gateway.DeploymentManager.open_connections(port) == 0
+
+
+def test_rolling_back_to_a_draining_version_keeps_it_live(gateway, client, auth_headers, containers, monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Drained", "endpoint": "drained", "code": "", "language": "python", "is_public": True,
+        "settings": {"min_replicas": 2, "max_replicas": 2}}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    rolled = []
+
+    async def roll_back_while_draining(*ports):
+        api = await gateway.control_plane.get_api_with_settings(api_id=api_id)
+        rolled.append(await gateway.deployment_manager.rollback(api))
+        return 0.0
+
+    monkeypatch.setattr(gateway.deployment_manager, "drain", roll_back_while_draining)
+    assert client.post(f"/api/apis/{api_id}/deploy").json()["version"] == 2
+    assert rolled[0]["version"] == 1
+
+    history = client.get(f"/api/apis/{api_id}/deployments", headers=auth_headers).json()["deployments"]
+    assert [(row["version"], row["status"]) for row in history] == [(2, "draining"), (1, "live")]
+    assert not [container for container in containers if container.startswith("c1")]
+    assert {client.get("/api/execute/drained").json()["version"] for _ in range(4)} == {1}
+    client.delete(f"/api/apis/{api_id}")
@@ -0,0 +1,90 @@
+"""Latency sketches: relative-error quantiles, exact merges, compaction of worker rows and SLO burn rates."""
+import random
+import socket
+import time
+
+import pytest
+
+
+def test_quantiles_are_within_the_relative_accuracy(gateway):
+    rng = random.Random(7)
+    values = [rng.lognormvariate(-3, 1) for _ in range(20000)]
+    sketch = gateway.LatencySketch()
+    for value in values:
+        sketch.add(value)
+
+    ordered = sorted(values)
+    for q in (0.5, 0.95, 0.99):
+        assert sketch.quantile(q) == pytest.approx(ordered[int(q * (len(values) - 1))], rel=0.01)
+    assert len(sketch.to_bytes()) < 4096
+
+    halves = gateway.LatencySketch(), gateway.LatencySketch()
+    for i, value in enumerate(values):
+        halves[i % 2].add(value)
+    halves[0].merge(gateway.LatencySketch.from_bytes(halves[1].to_bytes()))
+    assert halves[0].to_bytes() == sketch.to_bytes()  # Merging loses nothing
+
+
+def test_burn_rate_is_the_slow_share_over_the_error_budget(gateway):
+    sketch = gateway.LatencySketch()
+    for value in [0.05] * 90 + [0.8] * 10:
+        sketch.add(value)
+    assert gateway.latency_tracker.burn_rate(sketch, 500, 0.95) == 2.0
+    assert gateway.latency_tracker.burn_rate(sketch, 1000, 0.95) == 0.0
+    assert gateway.latency_tracker.burn_rate(gateway.LatencySketch(), 500, 0.95) is None
+
+
+def test_requests_are_sketched_flushed_and_compacted(gateway, client, auth_headers, containers, run):
+    tracker = gateway.latency_tracker
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Timed", "endpoint": "timed", "code": "", "language": "python", "is_public": True,
+        "settings": {"target_p95_ms": 250}}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    for _ in range(5):
+        assert client.get("/api/execute/timed").status_code == 200
+    assert run(tracker.flush) >= 1 and not tracker.sketches
+
+    # Three workers' rows for a closed bucket, and two for a bucket old enough to be hourly
+    closed = tracker.bucket(time.time() - 4 * 3600)
+    old = int(time.time() - (tracker.fine_hours + 2) * 3600) // 3600 * 3600
+    rows = []
+    for bucket, latencies in ((closed, (0.1, 0.2, 0.9)), (old, (0.3, 0.4)), (old + tracker.bucket_seconds, (0.6,))):
+        for latency in latencies:
+            sketch = gateway.LatencySketch()
+            sketch.add(latency)
+            rows.append({"api_id": api_id, "bucket": bucket, "requests": 1, "sketch": sketch.to_bytes()})
+    run(gateway.control_plane.add_latency_sketches, rows)
+    before = client.get(f"/api/apis/{api_id}/latency?hours=72", headers=auth_headers).json()
+
+    assert run(tracker.run)["compacted_rows"] == 4
+    stored = run(gateway.control_plane.latency_sketches, 0, api_id)
+    assert [(row["bucket"], row["requests"]) for row in stored[:2]] == [(old, 3), (closed, 3)]
+    after = client.get(f"/api/apis/{api_id}/latency?hours=72", headers=auth_headers).json()
+    assert after == before and after["requests"] == 11
+    assert after["slo"]["threshold_ms"] == 250 and after["slo"]["burn_rate"] == pytest.approx(4 / 11 / 0.05, rel=1e-3)
+    assert after["series"][-1]["requests"] == 5 and after["p99_ms"] == pytest.approx(600, rel=0.01)
+
+    analytics = client.get("/api/analytics", headers=auth_headers).json()
+    assert 0 < analytics["response_time_percentiles"]["p50_ms"] <= analytics["response_time_percentiles"]["p99_ms"]
+
+
+def test_upstream_timeouts_are_sketched_with_their_wait(gateway, client, auth_headers, containers, monkeypatch):
+    import httpx
+
+    class Impatient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **{**kwargs, "timeout": 0.3})
+
+    silent = socket.create_server(("127.0.0.1", 0))  # Accepts connections, never answers
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Hung", "endpoint": "hung", "code": "", "language": "python", "is_public": True}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    monkeypatch.setattr(gateway.deployment_manager, "upstream_port", lambda api: silent.getsockname()[1])
+    monkeypatch.setattr(httpx, "AsyncClient", Impatient)
+    try:
+        assert client.get("/api/execute/hung").status_code == 500
+    finally:
+        silent.close()
+
+    (sketch,) = [sketch for (api, _), sketch in gateway.latency_tracker.sketches.items() if api == api_id]
+    assert sketch.count == 1 and sketch.quantile(0.5) >= 0.3
@@ -0,0 +1,69 @@
+"""Usage metering: in-memory counts, idempotent flushes, journal replay after crashes, closed billing periods."""
+import json
+import subprocess
+import sys
+from datetime import datetime
+
+
+def test_requests_are_metered_and_billed(gateway, client, auth_headers, containers, run):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Paid", "endpoint": "paid", "code": "", "language": "python", "is_public": True,
+        "pricing_model": "payg", "price_per_request": 0.25}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    revenue_before = client.get("/api/analytics", headers=auth_headers).json()["revenue"]
+
+    for _ in range(4):
+        client.get("/api/execute/paid")
+    assert sum(count for (api, _, _), count in gateway.usage_meter.counts.items() if api == api_id) == 4
+    assert run(gateway.usage_meter.flush)["pending"] == 0
+
+    billing = client.get(f"/api/apis/{api_id}/billing", headers=auth_headers).json()
+    assert (billing["period"], billing["requests"], billing["amount"]) == (datetime.utcnow().strftime("%Y-%m"), 4, 1.0)
+    assert billing["by_key"] == [{"key_id": None, "requests": 4}] and billing["closed_periods"] == []
+    assert client.get("/api/analytics", headers=auth_headers).json()["revenue"] == revenue_before + 1.0
+
+
+def test_failed_flushes_stay_in_the_journal(gateway, client, auth_headers, run, monkeypatch):
+    meter = gateway.usage_meter
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Journaled", "endpoint": "journaled", "code": "", "language": "python"}).json()["id"]
+
+    async def unavailable(batch_id, counts):
+        raise ConnectionError("control plane down")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(gateway.control_plane, "apply_usage_batch", unavailable)
+        meter.record(api_id, None)
+        meter.record(api_id, None)
+        assert run(meter.flush) == {"applied": 0, "pending": 1}
+        assert [batch["counts"][0][3] for batch in json.loads(meter.journal.read_text())] == [2]
+        meter.record(api_id, None)
+        assert run(meter.flush)["pending"] == 2
+
+    assert run(meter.flush) == {"applied": 2, "pending": 0}
+    assert not meter.journal.exists()
+    assert client.get(f"/api/apis/{api_id}/billing", headers=auth_headers).json()["requests"] == 3
+
+
+def test_journals_of_crashed_workers_are_replayed_once(gateway, client, auth_headers, run):
+    meter = gateway.usage_meter
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Crashed", "endpoint": "crashed", "code": "", "language": "python"}).json()["id"]
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    batch = {"id": f"host:{gone.pid}:dead:1", "counts": [[api_id, None, datetime.utcnow().date().isoformat(), 7]]}
+    journal = meter.directory / f"{gone.pid}-dead.json"
+    meter.write_journal(journal, [batch])
+    meter.write_journal(meter.directory / f"{gone.pid}-again.json", [batch])  # The same batch seen twice
+
+    report = run(meter.run)
+    assert report["replayed_batches"] == 1 and not journal.exists()
+    assert client.get(f"/api/apis/{api_id}/billing", headers=auth_headers).json()["requests"] == 7
+
+
+def test_periods_close_after_the_grace_time(gateway):
+    meter = gateway.UsageMeter()
+    meter.grace = 3600
+    assert meter.closable_before(datetime(2026, 3, 1, 0, 30)) == "2026-02"  # February may still be flushing
+    assert meter.closable_before(datetime(2026, 3, 1, 1, 0)) == "2026-03"
+    assert meter.closable_before(datetime(2026, 1, 1, 0, 0)) == "2025-12"
@@ -0,0 +1,60 @@
+"""Prometheus metrics: served to loopback or token holders, merged across workers without resets."""
+import json
+import os
+import time
+
+import httpx
+
+
+def test_dead_workers_totals_survive_their_snapshot(gateway, monkeypatch, tmp_path):
+    registry = gateway.MetricsRegistry()
+    registry.directory = tmp_path
+    registry.counter("jobs_total", "Jobs", ("kind",))
+    registry.gauge("jobs_running", "Jobs running")
+    registry.histogram("job_seconds", "Job time", buckets=(1.0,))
+    registry.inc("jobs_total", "a", amount=2)
+    registry.observe("job_seconds", 0.5)
+
+    dead = {"counters": {"jobs_total": [[["a"], 5.0], [["b"], 1.0]], "jobs_running": [[[], 3.0]]},
+            "histograms": {"job_seconds": [[[], [1, 1, 2.5, 2]]]}}
+    for pid in ("1001", "1002"):
+        path = tmp_path / f"{pid}.json"
+        path.write_text(json.dumps(dead))
+        os.utime(path, (time.time() - 7200,) * 2)
+    expected_counters = {"jobs_total": {("a",): 12.0, ("b",): 2.0}, "jobs_running": {}}
+    expected_histograms = {"job_seconds": {(): [3, 2, 5.5, 5]}}
+
+    monkeypatch.setattr(registry, "stale_after", 10 ** 6)
+    live = registry.collect()
+    assert live[0]["jobs_total"] == expected_counters["jobs_total"]
+
+    monkeypatch.setattr(registry, "stale_after", 3600)
+    assert registry.collect() == (expected_counters, expected_histograms)  # Folded, not dropped
+    assert sorted(path.name for path in tmp_path.glob("*.json")) == [f"{os.getpid()}.json", "retired.json"]
+    assert registry.collect() == (expected_counters, expected_histograms)
+
+
+def test_metrics_are_served_only_to_loopback_or_token_holders(gateway, client, auth_headers, containers, run,
+                                                              monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Metered", "endpoint": "metered", "code": "", "language": "python", "is_public": True}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    assert client.get("/api/execute/metered").status_code == 200
+
+    async def scrape_from(host, headers=None):
+        transport = httpx.ASGITransport(app=gateway.app, client=(host, 40000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://gateway") as local:
+            return await local.get("/metrics", headers=headers)
+
+    monkeypatch.setattr(gateway.metrics, "token", "")
+    assert run(scrape_from, "203.0.113.9").status_code == 403
+    response = run(scrape_from, "127.0.0.1")
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    assert 'apiengine_requests_total{api="metered",status_class="2xx"} ' in response.text
+    assert 'apiengine_request_stage_seconds_count{api="metered",stage="upstream"} ' in response.text
+
+    monkeypatch.setattr(gateway.metrics, "token", "scrape-secret")
+    assert run(scrape_from, "127.0.0.1").status_code == 401
+    assert run(scrape_from, "203.0.113.9", {"Authorization": "Bearer wrong"}).status_code == 401
+    response = run(scrape_from, "203.0.113.9", {"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200 and "# TYPE apiengine_requests_total counter" in response.text
@@ -0,0 +1,57 @@
+"""Rate limiting and OpenAI cost tracking must behave the same at 1 and N workers."""
+import multiprocessing
+import secrets
+from datetime import datetime
+
+import pytest
+
+REQUESTS = 240
+HOURLY_LIMIT = 150
+DAILY_LIMIT = 1000
+INPUT_TOKENS = 1200
+OUTPUT_TOKENS = 300
+
+
+def _simulate_worker(main, api_id, requests, results):
+    allowed = 0
+    settings = {"max_requests_per_hour": HOURLY_LIMIT, "max_requests_per_day": DAILY_LIMIT}
+    for _ in range(requests):
+        ok, _, _ = main.check_rate_limit_enhanced(api_id, settings, None, "203.0.113.7")
+        allowed += ok
+        main.cost_tracker.track_usage("gpt-3.5-turbo", INPUT_TOKENS, OUTPUT_TOKENS)
+    results.put(allowed)
+
+
+def _run_workers(main, workers):
+    """Spread REQUESTS over `workers` forked processes sharing one database/Redis."""
+    api_id = f"parity-{workers}-{secrets.token_hex(4)}"
+    today = datetime.now().strftime("%Y-%m-%d")
+    cost_before = main.shared_state.get(f"openai_usage:{today}:cost")
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [
+        context.Process(target=_simulate_worker, args=(main, api_id, REQUESTS // workers, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    allowed = sum(results.get(timeout=120) for _ in processes)
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+
+    cost = main.shared_state.get(f"openai_usage:{today}:cost") - cost_before
+    return allowed, round(cost, 6)
+
+
+@pytest.mark.parametrize("workers", [4])
+def test_rate_limit_and_cost_match_single_worker(gateway, workers):
+    single_allowed, single_cost = _run_workers(gateway, 1)
+    multi_allowed, multi_cost = _run_workers(gateway, workers)
+
+    assert single_allowed == HOURLY_LIMIT
+    assert multi_allowed == single_allowed
+    expected_cost = REQUESTS * gateway.cost_tracker.calculate_cost("gpt-3.5-turbo", INPUT_TOKENS, OUTPUT_TOKENS)
+    assert single_cost == pytest.approx(expected_cost)
+    assert multi_cost == pytest.approx(single_cost)
@@ -0,0 +1,61 @@
+"""Quota leases: workers spend claimed blocks locally, never exceed a limit and refuse at most a bounded few early."""
+import asyncio
+import secrets
+
+
+def _workers(gateway, monkeypatch, count, max_block="20", fraction="0.05"):
+    monkeypatch.setenv("RATE_LIMIT_LEASE_MAX", max_block)
+    monkeypatch.setenv("RATE_LIMIT_LEASE_FRACTION", fraction)
+    return [gateway.QuotaLeases() for _ in range(count)]
+
+
+def test_leased_limits_hold_across_workers_with_few_round_trips(gateway, monkeypatch):
+    workers = _workers(gateway, monkeypatch, 4)
+    api_id, settings = f"leased-{secrets.token_hex(4)}", {"max_requests_per_hour": 400}
+    increments = []
+    incr = gateway.shared_state.incr
+    monkeypatch.setattr(gateway.shared_state, "incr", lambda *args, **kwargs: increments.append(args) or incr(*args, **kwargs))
+
+    async def scenario():
+        decisions = []
+        for i in range(600):
+            decisions.append(await workers[i % 4].check(api_id, settings, None, "203.0.113.9"))
+            await asyncio.sleep(0)  # Let background renewals run, as concurrent requests would
+        return decisions
+
+    decisions = asyncio.run(scenario())
+    allowed = sum(ok for ok, _, _ in decisions)
+    block = workers[0].block_limit(400)
+    assert block == 20
+    assert 400 - 3 * block <= allowed <= 400
+    unspent = sum(worker.report()["unspent"] for worker in workers)
+    key = next(iter(workers[0].leases))
+    assert gateway.shared_state.get(key) == allowed + unspent  # Every admitted request was claimed once
+    assert len(increments) < 600 / 4
+    assert all(worker.report()["exhausted"] == 1 for worker in workers)
+    assert decisions[-1] == (False, 400, 400)
+
+
+def test_denied_requests_spend_nothing_from_other_windows(gateway, monkeypatch):
+    leases, = _workers(gateway, monkeypatch, 1)
+    api_id = f"windows-{secrets.token_hex(4)}"
+    settings = {"max_requests_per_hour": 1000, "max_requests_per_day": 3}
+
+    async def scenario():
+        return [await leases.check(api_id, settings, "key:k1") for _ in range(5)]
+
+    decisions = asyncio.run(scenario())
+    assert [ok for ok, _, _ in decisions] == [True, True, True, False, False]
+    assert decisions[2] == (True, 3, 3) and decisions[3] == (False, 3, 3)  # Small limits are counted exactly
+    hour = next(lease for key, lease in leases.leases.items() if ":hour:" in key)
+    assert hour.counted - hour.remaining == 3
+
+
+def test_the_gateway_refuses_with_429(gateway, client, auth_headers, containers):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Leased", "endpoint": "leased", "code": "", "language": "python", "is_public": True,
+        "settings": {"max_requests_per_hour": 2}}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+
+    assert [client.get("/api/execute/leased").status_code for _ in range(3)] == [200, 200, 429]
+    assert gateway.quota_leases.report()["exhausted"] >= 1
@@ -0,0 +1,66 @@
+"""Request timing: opt-in Server-Timing headers and the administrators' sampling profiler."""
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def admin_headers(gateway, monkeypatch):
+    """Bearer token headers for a user listed in ADMIN_USERNAMES"""
+    user_id = gateway.generate_user_id()
+    conn = gateway.get_db_connection()
+    conn.execute("INSERT INTO users (id, username, email, password_hash) VALUES (?, ?, ?, ?)",
+                 (user_id, f"ops_{user_id[:8]}", f"ops_{user_id[:8]}@example.com", "x"))
+    conn.commit()
+    conn.close()
+    monkeypatch.setenv("ADMIN_USERNAMES", f"admin, ops_{user_id[:8]}")
+    return {"Authorization": f"Bearer {gateway.create_jwt_token(user_id)}"}
+
+
+def test_server_timing_is_opt_in(gateway, client, auth_headers, containers, monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Staged", "endpoint": "staged", "code": "", "language": "python", "is_public": True}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    assert "Server-Timing" not in client.get("/api/execute/staged").headers
+
+    monkeypatch.setattr(gateway, "SERVER_TIMING_ENABLED", True)
+    header = client.get("/api/execute/staged").headers["Server-Timing"]
+    timing = dict(part.split(";dur=") for part in header.split(", "))
+    assert {"route_lookup", "rate_limit", "upstream", "total"} <= set(timing)
+    assert sum(float(timing[stage]) for stage in timing if stage != "total") <= float(timing["total"])
+    assert "total;dur=" in client.get("/api/execute/no-such-endpoint").headers["Server-Timing"]
+
+
+def test_admin_endpoints_require_an_administrator(client, auth_headers, admin_headers):
+    assert client.get("/api/admin/code-generation").status_code == 401
+    assert client.get("/api/admin/code-generation", headers=auth_headers).status_code == 403
+    assert client.get("/api/admin/code-generation", headers=admin_headers).status_code == 200
+    assert client.post("/api/admin/profile?seconds=0.1", headers=auth_headers).status_code == 403
+
+
+def test_profiler_returns_folded_stacks_of_busy_threads(gateway, client, admin_headers):
+    stop = threading.Event()
+
+    def spin_for_the_profiler():
+        while not stop.is_set():
+            sum(range(1000))
+
+    spinner = threading.Thread(target=spin_for_the_profiler, name="spinner")
+    spinner.start()
+    try:
+        response = client.post("/api/admin/profile?seconds=0.3&interval_ms=5", headers=admin_headers)
+    finally:
+        stop.set()
+        spinner.join()
+
+    assert response.status_code == 200 and int(response.headers["X-Profile-Samples"]) > 10
+    stacks = dict(line.rsplit(" ", 1) for line in response.text.strip().splitlines())
+    spinning = [stack for stack in stacks if stack.startswith("spinner;") and "spin_for_the_profiler" in stack]
+    assert spinning and sum(int(stacks[stack]) for stack in spinning) > 10
+
+    assert client.post("/api/admin/profile?seconds=0", headers=admin_headers).status_code == 400
+    assert gateway.shared_state.acquire_lock("profiler", 30, "another-session")
+    try:
+        assert client.post("/api/admin/profile?seconds=0.1", headers=admin_headers).status_code == 409
+    finally:
+        gateway.shared_state.release_lock("profiler", "another-session")
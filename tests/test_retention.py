@@ -0,0 +1,79 @@
+"""Retention: expired request logs rolled up in batches, expired shared state purged, vacuum capped per pass."""
+import secrets
+import sqlite3
+import time
+
+
+def test_expired_requests_are_rolled_up_in_batches(gateway, monkeypatch):
+    engine = gateway.retention_engine
+    monkeypatch.setattr(engine, "batch_size", 2)
+    monkeypatch.setattr(engine, "batch_pause", 0)
+    api_id = f"retention-{secrets.token_hex(4)}"
+    conn = gateway.get_db_connection()
+    try:
+        rows = [(api_id, "old", "GET", status, response_time, "-40 days")
+                for status, response_time in ((200, 0.1), (200, 0.3), (500, 0.2), (404, 0.1), (200, 0.5))]
+        rows += [(api_id, "new", "GET", 200, 0.1, "-1 days")] * 2
+        conn.executemany("""
+            INSERT INTO api_requests (api_id, endpoint, method, status_code, response_time, timestamp)
+            VALUES (?, ?, ?, ?, ?, datetime('now', ?))
+        """, rows)
+        conn.execute("""
+            INSERT INTO api_request_rollups (api_id, day, request_count, error_count, total_response_time,
+                                             max_response_time)
+            VALUES (?, DATE('now', '-800 days'), 9, 0, 1.0, 0.2)
+        """, (api_id,))
+        conn.commit()
+
+        report = engine.rollup_api_requests(conn)
+        assert report["rolled_up"] >= 5 and report["rollups_purged"] >= 1
+
+        remaining = conn.execute("SELECT endpoint FROM api_requests WHERE api_id = ?", (api_id,)).fetchall()
+        assert [row["endpoint"] for row in remaining] == ["new", "new"]
+        (rollup,) = conn.execute("SELECT * FROM api_request_rollups WHERE api_id = ?", (api_id,)).fetchall()
+        assert (rollup["request_count"], rollup["error_count"], rollup["max_response_time"]) == (5, 2, 0.5)
+        assert abs(rollup["total_response_time"] - 1.2) < 1e-9
+    finally:
+        conn.close()
+
+
+def test_expired_shared_state_is_purged(gateway):
+    conn = gateway.get_db_connection()
+    now = time.time()
+    try:
+        for table, columns in (("shared_counters", "key, value"), ("shared_values", "key, value"),
+                               ("shared_locks", "name, owner")):
+            conn.executemany(f"INSERT INTO {table} ({columns}, expires_at) VALUES (?, ?, ?)",
+                             [("retention:expired", "1", now - 10), ("retention:live", "1", now + 3600)])
+        conn.commit()
+
+        report = gateway.retention_engine.purge_shared_state(conn)
+        assert min(report.values()) >= 1
+        for table, column in (("shared_counters", "key"), ("shared_values", "key"), ("shared_locks", "name")):
+            left = conn.execute(f"SELECT {column} FROM {table} WHERE {column} LIKE 'retention:%'").fetchall()
+            assert [row[0] for row in left] == ["retention:live"]
+            conn.execute(f"DELETE FROM {table} WHERE {column} = 'retention:live'")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_vacuum_stops_at_its_time_cap(gateway, tmp_path, monkeypatch):
+    engine = gateway.retention_engine
+    monkeypatch.setattr(engine, "batch_pause", 0)
+    conn = sqlite3.connect(tmp_path / "vacuum.db")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("CREATE TABLE blobs (body BLOB)")
+    conn.executemany("INSERT INTO blobs VALUES (?)", [(b"x" * 4000,) for _ in range(3000)])
+    conn.commit()
+    conn.execute("DELETE FROM blobs")
+    conn.commit()
+
+    monkeypatch.setattr(engine, "vacuum_seconds", 0)
+    capped = engine.vacuum(conn)
+    assert capped["bytes_reclaimed"] == 0 and capped["bytes_reclaimable"] > 3000 * 4000
+
+    monkeypatch.setattr(engine, "vacuum_seconds", 30)
+    finished = engine.vacuum(conn)
+    assert finished["bytes_reclaimed"] >= capped["bytes_reclaimable"] * 0.99 and finished["bytes_reclaimable"] == 0
+    conn.close()
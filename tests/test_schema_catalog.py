@@ -0,0 +1,83 @@
+"""Schema catalog: introspect once per change and generate models from real columns."""
+import secrets
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def database(gateway, client, auth_headers):
+    response = client.post("/api/databases", json={"database_name": f"db_{secrets.token_hex(4)}"},
+                           headers=auth_headers)
+    database = response.json()["database"]
+    conn = sqlite3.connect(database["database_path"])
+    conn.executescript("""
+        CREATE TABLE products (
+            sku INTEGER PRIMARY KEY,
+            title VARCHAR(80) NOT NULL,
+            price REAL,
+            in_stock BOOLEAN,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE UNIQUE INDEX products_title ON products (title);
+        INSERT INTO products (sku, title, price) VALUES (1, 'pen', 1.5), (2, 'ink', 4.0);
+    """)
+    conn.commit()
+    conn.close()
+    return database
+
+
+def test_schema_lists_columns_indexes_and_estimates(client, auth_headers, database):
+    schema = client.get(f"/api/databases/{database['database_id']}/schema", headers=auth_headers).json()
+
+    products = schema["tables"]["products"]
+    assert [column["name"] for column in products["columns"]] == ["sku", "title", "price", "in_stock", "added_at"]
+    assert products["indexes"] == [{"name": "products_title", "unique": True, "origin": "c", "columns": ["title"]}]
+    assert products["approx_rows"] == 2
+    assert client.get(f"/api/databases/{database['database_id']}/tables",
+                      headers=auth_headers).json()["tables"] == ["products"]
+
+
+def test_introspects_only_when_schema_changes(gateway, database, monkeypatch):
+    catalog = gateway.SchemaCatalog()
+    catalog.refresh_interval = 0
+    calls = []
+    introspect = catalog._introspect
+    monkeypatch.setattr(catalog, "_introspect", lambda conn: calls.append(1) or introspect(conn))
+    path = database["database_path"]
+
+    catalog.get(path)
+    catalog.get(path)
+    assert len(calls) == 1
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO products (sku, title) VALUES (10, 'cap')")
+    assert catalog.get(path)["tables"]["products"]["approx_rows"] == 10
+    assert len(calls) == 1
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("ALTER TABLE products ADD COLUMN color TEXT")
+    assert catalog.get(path)["tables"]["products"]["columns"][-1]["name"] == "color"
+    assert len(calls) == 2
+
+
+def test_enhanced_api_models_match_table_columns(client, auth_headers, database):
+    response = client.post("/api/apis/enhanced", headers=auth_headers, json={
+        "name": "Products", "endpoint": f"products-{secrets.token_hex(3)}", "code": "", "language": "python",
+        "database_connection": {"database_id": database["database_id"], "table_name": "products"},
+    })
+    code = response.json()["code"]
+
+    assert "    title: str\n    price: Optional[float] = None\n    in_stock: Optional[bool] = None\n" in code
+    assert "added_at:" not in code.split("class ")[1].split("@app")[0]
+
+    namespace = {}
+    exec(compile(code, "generated.py", "exec"), namespace)
+    endpoint = response.json()["endpoint"]
+    with TestClient(namespace["app"]) as generated:
+        created = generated.post(f"/{endpoint}", json={"title": "mug", "price": 7.25, "in_stock": True}).json()
+        assert created["title"] == "mug" and created["sku"] == 3
+        page = generated.get(f"/{endpoint}", params={"limit": 2}).json()
+        assert [item["sku"] for item in page["items"]] == [3, 2] and page["next_cursor"] == 2
+        assert generated.put(f"/{endpoint}/1", json={"title": "quill"}).json()["title"] == "quill"
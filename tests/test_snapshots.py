@@ -0,0 +1,107 @@
+"""Online snapshots and restore of user databases."""
+import secrets
+import sqlite3
+import threading
+import time
+
+import pytest
+
+
+def _create_database(client, auth_headers, journal_mode):
+    response = client.post("/api/databases", json={"database_name": f"db_{secrets.token_hex(4)}"},
+                           headers=auth_headers)
+    database = response.json()["database"]
+    conn = sqlite3.connect(database["database_path"])
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    with conn:
+        conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, payload TEXT)")
+        conn.executemany("INSERT INTO events (payload) VALUES (?)", [("x" * 200,)] * 5000)
+    conn.close()
+    return database
+
+
+@pytest.fixture
+def database(client, auth_headers):
+    return _create_database(client, auth_headers, "WAL")
+
+
+def _count(database):
+    with sqlite3.connect(database["database_path"]) as conn:
+        return conn.execute("SELECT count(*) FROM events").fetchone()[0]
+
+
+def test_snapshot_and_restore(client, auth_headers, database):
+    base = f"/api/databases/{database['database_id']}/snapshots"
+    entry = client.post(base, headers=auth_headers).json()
+    assert entry["name"].endswith(".db.gz")
+    assert entry["stored_bytes"] < entry["bytes"] and entry["steps"] >= 1
+
+    with sqlite3.connect(database["database_path"]) as conn:
+        conn.execute("DELETE FROM events WHERE id > 10")
+    assert _count(database) == 10
+
+    restored = client.post(f"{base}/{entry['name']}/restore", headers=auth_headers)
+    assert restored.status_code == 200
+    assert _count(database) == 5000
+    assert client.post(f"{base}/../../control/x/restore", headers=auth_headers).status_code == 404
+
+
+def test_scheduled_runs_skip_unchanged_databases(gateway, run, database):
+    manager = gateway.snapshot_manager
+    sources, only = run(manager.sources), [database["database_id"]]
+
+    assert manager.run_once(sources, only)["snapshots_taken"] == 1
+    assert manager.run_once(sources, only)["sources_unchanged"] == 1
+
+    with sqlite3.connect(database["database_path"]) as conn:
+        conn.execute("INSERT INTO events (payload) VALUES ('new')")
+    assert manager.run_once(sources, only)["snapshots_taken"] == 1
+
+
+def test_writers_keep_going_during_a_snapshot(gateway, database, monkeypatch):
+    monkeypatch.setattr(gateway.snapshot_manager, "pages_per_step", 8)
+    writes = []
+    stop = threading.Event()
+
+    def writer():
+        conn = sqlite3.connect(database["database_path"], timeout=0.5)
+        while not stop.is_set():
+            with conn:
+                conn.execute("INSERT INTO events (payload) VALUES ('during')")
+            writes.append(1)
+        conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        entry = gateway.snapshot_manager.snapshot(database["database_id"], database["database_path"])
+    finally:
+        stop.set()
+        thread.join()
+
+    assert entry["steps"] > 10
+    assert writes
+
+
+def test_rollback_journal_copy_finishes_under_constant_writes(gateway, client, auth_headers, monkeypatch):
+    database = _create_database(client, auth_headers, "DELETE")
+    monkeypatch.setattr(gateway.snapshot_manager, "pages_per_step", 4)
+    stop = threading.Event()
+
+    def writer():
+        conn = sqlite3.connect(database["database_path"], timeout=5)
+        while not stop.is_set():
+            with conn:
+                conn.execute("INSERT INTO events (payload) VALUES ('during')")
+            time.sleep(0.001)
+        conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        entry = gateway.snapshot_manager.snapshot(database["database_id"], database["database_path"])
+    finally:
+        stop.set()
+        thread.join()
+
+    assert entry["restarts"] > gateway.SnapshotManager.MAX_RESTARTS
@@ -0,0 +1,70 @@
+"""Static assets: precompressed siblings served by negotiation, immutable hashed files, ETag revalidation."""
+import gzip
+import json
+import os
+from pathlib import Path
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+BUNDLE = "const answer = 42;\n" * 500
+
+
+@pytest.fixture
+def assets(gateway, tmp_path):
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "static" / "js" / "main.5f9c4ab2.js").write_text(BUNDLE)
+    (tmp_path / "robots.txt").write_text("User-agent: *\n")
+    (tmp_path / "index.html").write_text("<!doctype html>" + "<div></div>" * 200)
+    (tmp_path / "asset-manifest.json").write_text(json.dumps({"files": {
+        "main.js": "/static/static/js/main.5f9c4ab2.js", "index.html": "/static/index.html"}}))
+    files = gateway.PrecompressedStaticFiles(directory=str(tmp_path))
+    return tmp_path, files, TestClient(Starlette(routes=[Mount("/static", files)]))
+
+
+def test_precompress_writes_siblings_once(assets):
+    root, files, _ = assets
+    assert files.precompress()["written"] == 2 * len(files.encodings)  # The bundle and index.html
+    assert gzip.decompress((root / "static/js/main.5f9c4ab2.js.gz").read_bytes()).decode() == BUNDLE
+    assert not (root / "robots.txt.gz").exists() and not (root / "asset-manifest.json.gz").exists()  # Too small
+    assert files.precompress()["written"] == 0
+
+
+def test_hashed_assets_are_served_precompressed_and_immutable(assets):
+    root, files, client = assets
+    files.precompress()
+
+    response = client.get("/static/static/js/main.5f9c4ab2.js", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert response.headers["content-type"].startswith(("application/javascript", "text/javascript"))
+    assert int(response.headers["content-length"]) == (root / "static/js/main.5f9c4ab2.js.gz").stat().st_size
+    assert response.text == BUNDLE
+
+    plain = client.get("/static/static/js/main.5f9c4ab2.js", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers and plain.text == BUNDLE
+
+    # A rebuilt file is served as it is until its sibling is rewritten
+    source = root / "static/js/main.5f9c4ab2.js"
+    os.utime(source, (source.stat().st_mtime + 10,) * 2)
+    assert "content-encoding" not in client.get("/static/static/js/main.5f9c4ab2.js",
+                                                headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_index_html_is_revalidated_by_etag(assets, client):
+    _, files, static_client = assets
+    files.precompress()
+    first = static_client.get("/static/index.html", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["cache-control"] == "no-cache" and first.headers["content-encoding"] == "gzip"
+    again = static_client.get("/static/index.html", headers={"Accept-Encoding": "gzip",
+                                                             "If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
+
+    template = Path("templates/index.html")  # The gateway runs in a scratch directory
+    if not template.exists():
+        template.write_text("<!doctype html><div id=\"root\"></div>")
+    page = client.get("/")
+    assert page.status_code == 200 and page.headers["cache-control"] == "no-cache"
+    assert client.get("/", headers={"If-None-Match": page.headers["etag"]}).status_code == 304
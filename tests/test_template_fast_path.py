@@ -0,0 +1,109 @@
+"""Template fast path: CRUD prompts are generated locally with typed fields, the rest goes to the LLM."""
+import ast
+import threading
+
+import pytest
+
+
+@pytest.mark.parametrize("prompt, endpoint, fields", [
+    ("CRUD API for books with title, author, price (float) and published (bool)", "books",
+     {"title": "TEXT", "author": "TEXT", "price": "REAL", "published": "BOOLEAN"}),
+    ("An API to track expenses with amount, category, spent_at and optional notes", "expenses",
+     {"amount": "REAL", "category": "TEXT", "spent_at": "TIMESTAMP", "notes": "TEXT"}),
+    ("Inventory of products with sku: integer, name: string, quantity, unit_price", "products",
+     {"sku": "INTEGER", "name": "TEXT", "quantity": "INTEGER", "unit_price": "REAL"}),
+    ("Create a todo list API with title, due date and completed", "todo-list",
+     {"title": "TEXT", "due_date": "DATE", "completed": "BOOLEAN"}),
+])
+def test_crud_prompts_are_classified_with_typed_fields(gateway, prompt, endpoint, fields):
+    plan = gateway.template_router.classify(prompt)
+
+    assert plan["endpoint"] == endpoint
+    assert {column["name"]: column["type"] for column in plan["columns"]} == fields
+
+
+@pytest.mark.parametrize("prompt", [
+    "A weather API that fetches the forecast for a city",
+    "API that summarizes a given text",
+    "crud for movies with tags (list of strings)",
+    "Generate random passwords with length and symbols",
+])
+def test_other_prompts_go_to_the_llm(gateway, prompt):
+    assert gateway.template_router.classify(prompt) is None
+
+
+def test_generate_code_serves_templates_without_the_llm(gateway, client, auth_headers, run, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    before = gateway.template_router.report()["generations"]
+
+    async def current_thread():
+        return threading.current_thread()
+
+    loop_thread, incr = run(current_thread), gateway.shared_state.incr
+    counted_on = []
+    monkeypatch.setattr(gateway.shared_state, "incr",
+                        lambda *args, **kwargs: counted_on.append(threading.current_thread()) or incr(*args, **kwargs))
+
+    response = client.post("/api/generate-code", headers=auth_headers, json={
+        "prompt": "CRUD API for books with title, price (float) and optional notes"})
+
+    body = response.json()
+    assert response.status_code == 200 and body["generator"] == "template"
+    assert body["suggested_endpoint"] == "books"
+    assert body["parameters"] == [
+        {"name": "title", "type": "str", "required": True, "description": ""},
+        {"name": "price", "type": "float", "required": True, "description": ""},
+        {"name": "notes", "type": "str", "required": False, "description": ""},
+    ]
+    model = next(node for node in ast.parse(body["code"]).body
+                 if isinstance(node, ast.ClassDef) and node.name == "Books")
+    assert [ast.unparse(field) for field in model.body] == [
+        "title: str", "price: float", "notes: Optional[str] = None"]
+
+    # Without an OpenAI key the LLM path fails, and is not counted
+    assert client.post("/api/generate-code", headers=auth_headers,
+                       json={"prompt": "Summarize a web page"}).status_code == 500
+    after = gateway.template_router.report()
+    assert after["generations"]["template"] == before["template"] + 1
+    assert after["generations"]["llm"] == before["llm"]
+    assert after["local_share"] > 0 and after["estimated_seconds_saved"] > 0
+    assert counted_on and loop_thread not in counted_on  # Shared counters never block the event loop
+
+
+@pytest.fixture
+def in_memory_app(gateway):
+    from fastapi.testclient import TestClient
+
+    namespace = {}
+    exec(gateway.generate_enhanced_api_code("", "python", "notes"), namespace)
+    return TestClient(namespace["app"])
+
+
+def test_in_memory_template_pages_newest_first_by_keyset(in_memory_app):
+    for i in range(7):
+        assert in_memory_app.post("/notes", json={"name": f"note-{i}"}).json()["id"] == i + 1
+    assert in_memory_app.delete("/notes/5").status_code == 200
+    assert in_memory_app.delete("/notes/5").status_code == 404
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"after": cursor} if cursor else {})}
+        page = in_memory_app.get("/notes", params=params).json()
+        pages.append([item["id"] for item in page["items"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == [[7, 6], [4, 3], [2, 1]]
+    assert in_memory_app.get("/notes", params={"after": 4}).json() == {
+        "items": [{"name": "note-2", "description": None, "id": 3}, {"name": "note-1", "description": None, "id": 2},
+                  {"name": "note-0", "description": None, "id": 1}],
+        "next_cursor": None}
+
+
+def test_in_memory_template_updates_and_reads_by_id(in_memory_app):
+    created = in_memory_app.post("/notes", json={"name": "draft"}).json()
+    updated = in_memory_app.put(f"/notes/{created['id']}", json={"name": "final", "description": "done"}).json()
+    assert updated == {"name": "final", "description": "done", "id": created["id"]}
+    assert in_memory_app.get(f"/notes/{created['id']}").json() == updated
+    assert in_memory_app.get("/notes/999").status_code == 404
+    assert in_memory_app.put("/notes/999", json={"name": "x"}).status_code == 404
@@ -0,0 +1,103 @@
+"""API test suites: results streamed as server-sent events, bodies stored compressed once, keyset-paged history."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+BODY = json.dumps({"status": "ok", "padding": "x" * 5000}).encode()
+
+
+@pytest.fixture
+def upstream(gateway, monkeypatch):
+    """The gateway as the suite sees it: every call answers BODY, after `sleep` seconds if asked"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(float(parse_qs(urlparse(self.path).query).get("sleep", ["0"])[0]))
+            status = 404 if "missing" in self.path else 200
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(gateway.test_suite_runner, "base_url", f"http://127.0.0.1:{server.server_address[1]}")
+    yield server
+    server.shutdown()
+
+
+def _api(client, auth_headers, endpoint):
+    return client.post("/api/apis", headers=auth_headers, json={
+        "name": endpoint.title(), "endpoint": endpoint, "code": "", "language": "python", "is_public": True,
+    }).json()["id"]
+
+
+def _events(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_results_stream_as_cases_finish(gateway, client, auth_headers, upstream):
+    api_id = _api(client, auth_headers, "streamed")
+    cases = [{"name": "slow", "method": "GET", "endpoint": "/", "query_params": {"sleep": "0.5"}},
+             {"name": "fast", "method": "GET", "endpoint": "/"},
+             {"name": "bad-method", "method": "PATCH", "endpoint": "/"}]
+
+    with client.stream("POST", f"/api/apis/{api_id}/test-suite/stream", headers=auth_headers, json=cases) as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = _events(response.read().decode())
+
+    names = [data.get("test_name") for _, data in events]
+    assert set(names[:2]) == {"fast", "bad-method"} and names[2] == "slow"  # In the order they finished
+    results = {data["test_name"]: data for name, data in events if name == "result"}
+    assert results["slow"]["index"] == 0 and results["slow"]["success"] is True
+    assert "Unsupported method" in results["bad-method"]["error"]
+    assert events[-1] == ("summary", {"total_tests": 3, "passed": 2, "failed": 1, "success_rate": 66.67})
+    assert [row["test_name"] for row in client.get(f"/api/apis/{api_id}/test-history",
+                                                   headers=auth_headers).json()["test_history"]] == ["slow", "fast"]
+
+
+def test_bodies_are_stored_once_capped_and_compressed(gateway, client, auth_headers, upstream, run, monkeypatch):
+    monkeypatch.setattr(gateway.test_suite_runner, "max_body_bytes", 1000)
+    api_id = _api(client, auth_headers, "deduplicated")
+    cases = [{"name": f"case-{i}", "method": "GET", "endpoint": "/"} for i in range(4)]
+    cases.append({"name": "missing", "method": "GET", "endpoint": "/", "query_params": {"missing": "1"},
+                  "expected_status": 404})
+    summary = client.post(f"/api/apis/{api_id}/test-suite", headers=auth_headers, json=cases).json()
+    assert summary["summary"]["passed"] == 5
+    assert [result["test_name"] for result in summary["test_results"]] == [case["name"] for case in cases]
+
+    history = client.get(f"/api/apis/{api_id}/test-history", headers=auth_headers).json()["test_history"]
+    assert {row["response_body_hash"] for row in history} == {history[0]["response_body_hash"]}
+    assert {(row["response_size"], row["response_body"]) for row in history} == {(len(BODY), BODY[:1000].decode())}
+    stored = run(gateway.control_plane._all, gateway.select(gateway.test_response_bodies_table).where(
+        gateway.test_response_bodies_table.c.hash == history[0]["response_body_hash"]))
+    assert len(stored) == 1 and stored[0]["size"] == 1000 and len(stored[0]["body"]) < 100
+
+
+def test_history_pages_with_a_keyset_cursor(gateway, client, auth_headers, upstream):
+    api_id = _api(client, auth_headers, "paged")
+    cases = [{"name": f"case-{i}", "method": "GET", "endpoint": "/"} for i in range(7)]
+    client.post(f"/api/apis/{api_id}/test-suite", headers=auth_headers, json=cases)
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        page = client.get(f"/api/apis/{api_id}/test-history", headers=auth_headers, params=params).json()
+        pages.append([row["test_name"] for row in page["test_history"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == [["case-6", "case-5", "case-4"], ["case-3", "case-2", "case-1"], ["case-0"]]
+    assert client.get(f"/api/apis/{api_id}/test-history", headers=auth_headers,
+                      params={"limit": 0}).status_code == 400
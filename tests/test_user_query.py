@@ -0,0 +1,91 @@
+"""Read-only, budgeted queries over pooled user database connections."""
+import json
+import secrets
+import time
+
+import pytest
+
+
+@pytest.fixture
+def database_id(client, auth_headers):
+    response = client.post("/api/databases", json={"database_name": f"db_{secrets.token_hex(4)}"}, headers=auth_headers)
+    database_id = response.json()["database"]["database_id"]
+    rows = "".join(json.dumps({"id": i, "n": i % 7}) + "\n" for i in range(300))
+    client.post(f"/api/databases/{database_id}/tables/numbers/import", content=rows, headers=auth_headers)
+    return database_id
+
+
+def _query(client, auth_headers, database_id, **body):
+    response = client.post(f"/api/databases/{database_id}/query", json=body, headers=auth_headers)
+    if response.status_code != 200:
+        return response.status_code, response.json()
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    return lines[0]["columns"], lines[1:-1], lines[-1]
+
+
+def test_parameterized_query_streams_rows(client, auth_headers, database_id):
+    columns, rows, summary = _query(client, auth_headers, database_id,
+                                    sql="SELECT id, n FROM numbers WHERE n = ? ORDER BY id", params=[3])
+
+    assert columns == ["id", "n"]
+    assert rows[:2] == [[3, 3], [10, 3]]
+    assert summary["rows"] == len(rows) == 43 and summary["truncated"] is False
+
+
+def test_row_budget_truncates(gateway, client, auth_headers, database_id, monkeypatch):
+    monkeypatch.setattr(gateway.user_db_pool, "chunk_rows", 40)
+    _, rows, summary = _query(client, auth_headers, database_id, sql="SELECT * FROM numbers", max_rows=100)
+
+    assert len(rows) == 100
+    assert summary == {"truncated": True, "rows": 100, "elapsed_ms": summary["elapsed_ms"],
+                       "execution_ms": summary["execution_ms"]}
+
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM numbers",
+    "CREATE TABLE t (x)",
+    "ATTACH DATABASE 'data/api_maker.db' AS control",
+    "PRAGMA query_only = OFF",
+    "SELECT 1; DELETE FROM numbers",
+])
+def test_writes_are_rejected(client, auth_headers, database_id, sql):
+    status, _ = _query(client, auth_headers, database_id, sql=sql)
+    assert status == 400
+    _, rows, _ = _query(client, auth_headers, database_id, sql="SELECT count(*) FROM numbers")
+    assert rows == [[300]]
+
+
+def test_time_budget_interrupts_runaway_queries(gateway, client, auth_headers, database_id, monkeypatch):
+    monkeypatch.setattr(gateway.user_db_pool, "timeout", 0.2)
+    runaway = "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) SELECT count(*) FROM r"
+
+    status, body = _query(client, auth_headers, database_id, sql=runaway)
+
+    assert status == 504 and body["detail"] == "Query exceeded 0.2s budget"
+
+
+def test_slow_readers_do_not_spend_the_time_budget(gateway, run, auth_headers, database_id, monkeypatch):
+    monkeypatch.setattr(gateway.user_db_pool, "timeout", 0.2)
+    monkeypatch.setattr(gateway.user_db_pool, "chunk_rows", 50)
+    path = run(gateway.load_user_database, database_id, gateway.verify_jwt_token(
+        auth_headers["Authorization"].split()[1]))["database_path"]
+
+    lines = []
+    for chunk in gateway.user_db_pool.start_query(path, "SELECT * FROM numbers", []):
+        lines.extend(json.loads(line) for line in chunk.splitlines())
+        time.sleep(0.05)  # A client reading one chunk at a time, 0.4s in all
+    summary = lines[-1]
+    assert "error" not in summary and summary["rows"] == 300
+    assert summary["execution_ms"] < 200 < summary["elapsed_ms"]
+
+
+def test_connections_are_reused(gateway, client, run, auth_headers, database_id):
+    path = run(gateway.load_user_database, database_id, gateway.verify_jwt_token(
+        auth_headers["Authorization"].split()[1]))["database_path"]
+    for _ in range(5):
+        _query(client, auth_headers, database_id, sql="SELECT 1")
+    idle = gateway.user_db_pool.pools[path]
+    assert len(idle) == 1
+
+    tables = client.get(f"/api/databases/{database_id}/tables", headers=auth_headers).json()["tables"]
+    assert tables == ["numbers"] and gateway.user_db_pool.pools[path] == idle
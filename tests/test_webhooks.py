@@ -0,0 +1,108 @@
+"""Webhooks: events go through the outbox, are batched per destination, retried with backoff and dead-lettered."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+@pytest.fixture
+def receiver():
+    """A webhook receiver that records each batch and answers with the status in its `status` list"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.server.batches.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(self.server.status[0])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.batches, server.status = [], [204]
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/hooks"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def test_deploy_events_are_delivered_in_batches(gateway, client, auth_headers, containers, receiver, run,
+                                                monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Hooked", "endpoint": "hooked", "code": "", "language": "python", "is_public": True,
+        "settings": {"webhook_url": receiver.url}}).json()["id"]
+    client.post(f"/api/apis/{api_id}/deploy")
+    client.post(f"/api/apis/{api_id}/deploy")
+    client.post(f"/api/apis/{api_id}/rollback", headers=auth_headers)
+
+    monkeypatch.setattr(gateway.webhooks, "batch_size", 2)
+    report = run(gateway.webhooks.run)
+    assert report["outcomes"] == {"delivered": 3} and report["destinations"] == 1
+    assert [len(batch["deliveries"]) for batch in receiver.batches] == [2, 1]
+    events = [delivery for batch in receiver.batches for delivery in batch["deliveries"]]
+    assert [event["event"] for event in events] == ["deploy.succeeded", "deploy.succeeded", "deploy.rolled_back"]
+    assert events[1]["data"]["previous_version"] == 1 and events[0]["attempt"] == 1
+
+    listed = client.get(f"/api/apis/{api_id}/webhooks", headers=auth_headers).json()
+    assert listed["counts"] == {"delivered": 3} and listed["deliveries"][0]["payload"]["event"] == "deploy.rolled_back"
+
+
+def test_failing_destinations_back_off_then_dead_letter(gateway, client, auth_headers, receiver, run, monkeypatch):
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Down", "endpoint": "hook-down", "code": "", "language": "python",
+        "settings": {"webhook_url": receiver.url}}).json()["id"]
+    api = run(gateway.control_plane.get_api_with_settings, api_id)
+    for attempt in range(3):
+        run(gateway.webhooks.enqueue, api, "error_rate.spike", {"attempt": attempt})
+    receiver.status[0] = 500
+    monkeypatch.setattr(gateway.webhooks, "batch_size", 2)
+    monkeypatch.setattr(gateway.webhooks, "max_attempts", 2)
+
+    assert run(gateway.webhooks.run)["outcomes"] == {"retry": 3}
+    assert len(receiver.batches) == 1  # The destination failed, so its second batch waits too
+    pending = run(gateway.control_plane.webhook_deliveries, api_id)
+    assert {row["attempts"] for row in pending} == {1} and pending[0]["last_error"].startswith("HTTP 500")
+    assert run(gateway.webhooks.run)["events"] == 0  # Backing off
+
+    monkeypatch.setattr(gateway.webhooks, "retry_delay", lambda attempts: 0)
+    for row in pending:
+        row.update(next_attempt_at=row["created_at"])
+    run(gateway.control_plane.settle_webhooks, pending)
+    assert run(gateway.webhooks.run)["outcomes"] == {"dead": 3}
+
+    receiver.status[0] = 200
+    assert client.post(f"/api/apis/{api_id}/webhooks/redeliver", headers=auth_headers).json() == {"requeued": 3}
+    assert run(gateway.webhooks.run)["outcomes"] == {"delivered": 3}
+    assert client.get(f"/api/apis/{api_id}/webhooks", headers=auth_headers, params={"status": "dead"}).json()["deliveries"] == []
+
+
+def test_request_path_events_are_deduplicated(gateway, monkeypatch):
+    sent = []
+    monkeypatch.setattr(gateway.webhooks, "notify", lambda api, event, data, **kwargs: sent.append((event, data)))
+    monkeypatch.setattr(gateway.webhooks, "error_min_requests", 4)
+    api = {"id": gateway.generate_api_id(), "endpoint": "spiky", "webhook_url": "http://127.0.0.1:9/hooks"}
+
+    for status in (200, 500, 200, 500, 500, 500, 500):
+        gateway.webhooks.record(api, status)
+    assert sent == [("error_rate.spike", {"requests": 4, "errors": 2, "error_rate": 0.5, "window_seconds": 60.0})]
+
+    monkeypatch.setattr(gateway.shared_state, "acquire_lock", None)  # Not called on the request path
+    gateway.webhooks.rate_limited(api, 1001, 1000)
+    gateway.webhooks.rate_limited(api, 1002, 1000)
+    assert [event for event, _ in sent].count("rate_limit.exceeded") == 1
+    gateway.webhooks.record({**api, "id": "no-url", "webhook_url": None}, 500)
+    assert "no-url" not in gateway.webhooks.windows
+
+
+def test_rate_limit_events_are_deduplicated_across_workers(gateway, run, monkeypatch):
+    queued = []
+
+    async def enqueue(api, event, data):
+        queued.append(event)
+
+    monkeypatch.setattr(gateway.webhooks, "enqueue", enqueue)
+    api = {"id": gateway.generate_api_id(), "endpoint": "limited", "webhook_url": "http://127.0.0.1:9/hooks"}
+    for used in (1001, 1002):  # Two workers, each reporting its first rejection
+        run(gateway.webhooks.enqueue_once, api, "rate_limit.exceeded", {"requests": used, "limit": 1000}, 300)
+    assert queued == ["rate_limit.exceeded"]
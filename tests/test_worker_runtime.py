@@ -0,0 +1,127 @@
+"""Worker runtime: Python APIs run as supervised local processes when Docker is not available."""
+import os
+import pwd
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+CODE = '''
+import os
+
+@app.get("/worker-echo")
+async def echo():
+    return {"pid": os.getpid(), "secret": os.getenv("JWT_SECRET")}
+'''
+
+
+@pytest.fixture
+def worker_api(gateway, client, auth_headers, monkeypatch):
+    monkeypatch.setattr(gateway.worker_runtime, "mode", "worker")
+    monkeypatch.setattr(gateway.worker_runtime, "user", pwd.getpwuid(os.geteuid()).pw_name)
+    monkeypatch.setenv("JWT_SECRET", "gateway-only")
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Worker", "endpoint": "worker-echo", "code": CODE, "language": "python", "is_public": True}).json()["id"]
+    yield api_id
+    client.delete(f"/api/apis/{api_id}")
+
+
+def _wait(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_deploys_run_as_worker_processes_and_restart(gateway, client, worker_api, monkeypatch):
+    runtime = gateway.worker_runtime
+    started = time.perf_counter()
+    deployed = client.post(f"/api/apis/{worker_api}/deploy")
+    assert deployed.status_code == 200 and time.perf_counter() - started < 10
+    assert deployed.json()["container_id"].startswith("worker:")
+
+    served = client.get("/api/execute/worker-echo").json()
+    assert served["secret"] is None  # Gateway secrets stay out of the worker's environment
+    (entry,) = [entry for entry in runtime.entries() if entry["api_id"] == worker_api]
+    assert entry["pid"] == served["pid"] and 0 < runtime.rss_mb(entry["pid"]) < 256
+
+    # A crashed worker comes back on the same port
+    os.kill(entry["pid"], signal.SIGKILL)
+    _wait(lambda: not runtime.alive(entry))
+    assert runtime.supervise_once()["restarted"][0]["reason"] == "exited"
+    (restarted,) = [entry for entry in runtime.entries() if entry["api_id"] == worker_api]
+    assert restarted["port"] == entry["port"] and restarted["restarts"] == 1
+    _wait(lambda: client.get("/api/execute/worker-echo").status_code == 200)
+    assert client.get("/api/execute/worker-echo").json()["pid"] == restarted["pid"]
+
+    # Over its memory cap it is replaced too (once the crash backoff has passed)
+    monkeypatch.setitem(gateway.RESOURCE_PROFILES, "small", {**gateway.RESOURCE_PROFILES["small"], "memory_mb": 1})
+    assert runtime.supervise_once()["restarted"] == []
+    (pending,) = [entry for entry in runtime.entries() if entry["api_id"] == worker_api]
+    runtime._save({**pending, "retry_at": 0})
+    assert runtime.supervise_once()["restarted"][0]["reason"] == "memory"
+
+
+def test_deleting_the_api_stops_its_workers(gateway, client, auth_headers, worker_api):
+    client.post(f"/api/apis/{worker_api}/deploy")
+    (entry,) = [entry for entry in gateway.worker_runtime.entries() if entry["api_id"] == worker_api]
+
+    client.delete(f"/api/apis/{worker_api}")
+    assert not gateway.worker_runtime.alive(entry)
+    assert [entry for entry in gateway.worker_runtime.entries() if entry["api_id"] == worker_api] == []
+
+
+def test_other_languages_still_need_docker(gateway, client, auth_headers, monkeypatch):
+    monkeypatch.setattr(gateway.worker_runtime, "mode", "worker")
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Node", "endpoint": "node-worker", "language": "javascript",
+        "code": "const express = require('express');\nexpress().listen(3000);"}).json()["id"]
+
+    response = client.post(f"/api/apis/{api_id}/deploy")
+    assert response.status_code == 400 and "need a host with Docker" in response.json()["detail"]
+
+
+def _can_run_as_nobody():
+    try:
+        nobody = pwd.getpwnam("nobody")
+        environment = {name: os.environ[name] for name in ("PATH", "PYTHONPATH") if name in os.environ}
+        return os.geteuid() == 0 and subprocess.run(
+            [sys.executable, "-c", "import uvicorn"], user=nobody.pw_uid, group=nobody.pw_gid, extra_groups=[],
+            cwd="/", env=environment, capture_output=True).returncode == 0
+    except (KeyError, OSError):
+        return False
+
+
+@pytest.mark.skipif(not _can_run_as_nobody(), reason="needs root and a Python the nobody user can run")
+def test_workers_run_as_their_own_user_without_access_to_data(gateway, client, auth_headers, monkeypatch):
+    monkeypatch.setattr(gateway.worker_runtime, "mode", "worker")
+    database = os.path.abspath("data/api_maker.db")
+    code = f"""
+import os
+
+@app.get("/worker-probe")
+async def probe():
+    try:
+        open({database!r}, "rb").close()
+        readable = True
+    except OSError:
+        readable = False
+    return {{"uid": os.getuid(), "cwd": os.getcwd(), "database_readable": readable}}
+"""
+    api_id = client.post("/api/apis", headers=auth_headers, json={
+        "name": "Probe", "endpoint": "worker-probe", "code": code, "language": "python", "is_public": True}).json()["id"]
+    try:
+        assert client.post(f"/api/apis/{api_id}/deploy").status_code == 200
+        probe = client.get("/api/execute/worker-probe").json()
+        assert probe == {"uid": pwd.getpwnam("nobody").pw_uid, "cwd": "/", "database_readable": False}
+        assert os.stat("data").st_mode & 0o777 == 0o700
+    finally:
+        client.delete(f"/api/apis/{api_id}")
+
+
+def test_auto_means_docker(gateway, monkeypatch):
+    monkeypatch.setattr(gateway.worker_runtime, "mode", "auto")
+    monkeypatch.setattr(gateway, "docker_client", None)
+    assert not gateway.worker_runtime.active